@@ -6,10 +6,12 @@ Architecture (why this works in a browser):
   * The WORKER thread parks in Atomics.wait().  The MAIN thread writes
     keystrokes into a SharedArrayBuffer and calls Atomics.notify(), so the
     blocked worker wakes — no event-loop yielding required for input.
-  * RENDERING happens on the MAIN thread: each frame the worker batches
-    draw commands and postMessage()s them.  The main thread's event loop is
-    free, so it paints and presents normally.  (A worker blocked in
-    Atomics.wait cannot present an OffscreenCanvas — hence main-thread render.)
+  * RENDERING happens on the MAIN thread: each frame the worker records
+    draw commands in a compact binary form (vscreen.py), copies them into a
+    SharedArrayBuffer ring and postMessage()s only where they are.  The main
+    thread's event loop is free, so it paints and presents normally.  (A
+    worker blocked in Atomics.wait cannot present an OffscreenCanvas — hence
+    main-thread render.)  A frame identical to the previous one is not sent.
 """
 
 import json
@@ -137,7 +139,7 @@ def run_app(code_path, args_list):
     if not force and (now - _last_frame[0]) < _MIN_FRAME_S:
       return
     _last_frame[0] = now
-    vs_mod._batch.clear()
+    vs_mod._begin_frame()
     vs_mod._in_callback = True
     try:
       cb(True)
@@ -148,7 +150,8 @@ def run_app(code_path, args_list):
       _post({'type': 'error', 'message': traceback.format_exc()})
     finally:
       vs_mod._in_callback = False
-    vs_mod._flush_frame()
+    # Callback time (drawing included) goes with the frame to the profiler.
+    vs_mod._flush_frame((_t.time() - now) * 1000)
 
   # Blocking read: render a frame, then park up to `wait_ms` for a key.
   def _blocking_read(n, wait_ms):
@@ -118,46 +118,15 @@ def split_pipeline_args(args):
 
 def run_stages(stages, make_stream=CaptureStream):
   """Run pre-split pipeline stages (a list of argv lists): each stage's
-  captured output is handed to the next as stdin via the pstdin bridge. Filter
-  commands (head/tail/grep, and any module that reads pstdin) pick it up when
-  given no file argument; commands that ignore stdin just drop it.
-  make_stream() must return a stream with write()/getvalue(), passed as the
-  `vs` to each stage's main(). Returns (last_stream, output) on success,
-  (None, error message) on failure."""
-  if not stages:
-    return None, "empty command"
+  output is handed to the next as stdin via the pstdin bridge. Filter
+  commands (head/tail/grep/cat, and any module that reads pstdin) pick it up
+  when given no file argument; commands that ignore stdin just drop it.
+  Stages whose module has pipe() get it line by line as it is written (see
+  pstdin.run_stages). make_stream() must return a stream with
+  write()/getvalue(), passed as the `vs` to each stage's main(). Returns
+  (last_stream, output) on success, (None, error message) on failure."""
   import pstdin
-  pstdin.take()  # clear any stale stdin left by a previous run
-
-  cap = None
-  prev_output = None
-  for parts in stages:
-    if not parts:
-      return None, "empty command in pipeline"
-    # 'r' prefix forces a fresh re-import of the module, exactly like the
-    # device shell (process_prefix). Essential after editing a script you
-    # already ran, since MicroPython otherwise reuses the cached module.
-    if parts[0] == 'r' and len(parts) > 1:
-      parts.pop(0)
-      if parts[0] in sys.modules:
-        del sys.modules[parts[0]]
-    modname = parts[0]
-    if prev_output is not None:
-      pstdin.feed(prev_output)
-    cap = make_stream()
-    try:
-      exec("import %s" % modname, {})
-      sys.modules[modname].main(cap, parts)
-    except BaseException as e:
-      # Catch BaseException, not just Exception: a module that calls sys.exit()/
-      # quit() (SystemExit) or raises KeyboardInterrupt would otherwise escape
-      # and kill the caller. Capture the full traceback so the model can debug.
-      cap.write("\nError running '%s':\n" % modname)
-      sys.print_exception(e, cap)
-    finally:
-      pstdin.take()  # don't leak stdin to a command that never read it
-    prev_output = cap.getvalue()
-  return cap, prev_output
+  return pstdin.run_stages(stages, make_stream)
 
 def run_pipeline(command, make_stream=CaptureStream):
   """Run an 'a | b | c' command line given as a single string (used by the gpt
@@ -1,8 +1,11 @@
+import io
 import math
+import struct
 import sys
 
 # ── JS bridge state (set by _init_js) ─────────────────────────────────────────
 _post = None         # worker postMessage(json) function
+_post_frame = None   # worker frame-ring writer (see _flush_frame)
 
 # SharedArrayBuffer-backed keyboard queue (single-producer / single-consumer).
 # META[0]=head (bytes written by main thread), META[1]=tail (bytes read by us),
@@ -16,8 +19,55 @@ _Atomics = None
 CANVAS_W = 400
 CANVAS_H = 240
 
-# Drawing command batch — flushed to main thread each frame.
-_batch = []
+# ── Draw-command encoding ─────────────────────────────────────────────────────
+# Each frame is one byte string of commands: an opcode byte followed by its
+# arguments, little-endian. Coordinates are int16. The renderer in index.html
+# (renderFrame) decodes the same layout.
+#
+#   state    COL DITH FMODE BMODE BASE   u8 value
+#            FONT                        u8 length, utf-8 name
+#   shapes   BOX FRAME LINE              x y w h (LINE: x1 y1 x2 y2)
+#            RBOX RFRAME                 x y w h r
+#            CIRC DISC                   x y r
+#            ARC                         x y r start end
+#            TRI                         x0 y0 x1 y1 x2 y2
+#            ELL                         x y rx ry, u8 filled
+#   lists    POLY                        u16 n, n int16 (u8g2 layout: xs, ys)
+#            FACES                       u16 n, n int16: per face dither, x0 x1
+#                                        x2, y0 y1 y2
+#   text     STR VSTR                    x y, u16 length, utf-8 text
+#   image    XBM                         x y w h, ((w + 7) // 8) * h bytes
+#
+# A frame starts with the render state it starts from (_begin_frame), so the
+# main thread can draw any frame on its own or skip it, and a frame that
+# encodes to the same bytes as the last one looks the same and is not sent.
+OP_COL, OP_DITH, OP_FMODE, OP_BMODE, OP_FONT, OP_BASE = 1, 2, 3, 4, 5, 6
+OP_BOX, OP_FRAME, OP_LINE, OP_RBOX, OP_RFRAME = 10, 11, 12, 13, 14
+OP_CIRC, OP_DISC, OP_ARC, OP_TRI, OP_ELL = 15, 16, 17, 18, 19
+OP_POLY, OP_STR, OP_VSTR, OP_FACES, OP_XBM = 20, 21, 22, 23, 24
+
+_BASELINES = ('alphabetic', 'top', 'bottom', 'middle')
+
+_U8 = struct.Struct('<BB')
+_N = struct.Struct('<BH')
+_XY3 = struct.Struct('<Bhhh')
+_XY4 = struct.Struct('<Bhhhh')
+_XY5 = struct.Struct('<Bhhhhh')
+_XY6 = struct.Struct('<Bhhhhhh')
+_ELL = struct.Struct('<BhhhhB')
+_TEXT = struct.Struct('<BhhH')
+_HEAD = struct.Struct('<BBBBBBBBBB')
+
+# The frame being recorded; reused from frame to frame.
+_out = io.BytesIO()
+
+# Render state as of the end of the recorded commands:
+# [color, dither, font mode, bitmap mode, baseline index, utf-8 font name].
+# Starts like the renderer's resetRenderState().
+_rstate = [1, 16, 1, 0, 0, b'']
+
+_prev = None         # last frame handed to the main thread
+_dups = 0            # identical frames not sent since then
 
 # Set by _runner before main()
 _blocking_read = None
@@ -30,17 +80,19 @@ class StopApp(Exception):
 
 
 def _init_js():
-  global _post, _meta, _data, _cap, _kstate, _Atomics, _batch
+  global _post, _post_frame, _meta, _data, _cap, _kstate, _Atomics, _prev
   import json
-  from js import (emulator_post_raw, emulator_meta, emulator_data,
-                  emulator_kstate, Atomics)
+  from js import (emulator_post_raw, emulator_post_frame, emulator_meta,
+                  emulator_data, emulator_kstate, Atomics)
   _post = lambda d: emulator_post_raw(json.dumps(d))
+  _post_frame = emulator_post_frame
   _meta = emulator_meta
   _data = emulator_data
   _cap = int(emulator_data.length)
   _kstate = emulator_kstate
   _Atomics = Atomics
-  _batch = []
+  _prev = None
+  _begin_frame()
 
 
 # ── Input helpers (SAB) ───────────────────────────────────────────────────────
@@ -88,11 +140,72 @@ def _wait_input(timeout_ms):
     _Atomics.wait(_meta, 0, head, max(1, int(timeout_ms)))
 
 
-# ── Draw-command batch ────────────────────────────────────────────────────────
+# ── Draw-command frame ────────────────────────────────────────────────────────
 
-def _flush_frame():
-  _post({'type': 'frame', 'cmds': list(_batch)})
-  _batch.clear()
+def _i16(v):
+  return max(-32768, min(32767, int(round(v))))
+
+
+def _cmd(st, op, *args):
+  try:
+    _out.write(st.pack(op, *args))
+  except struct.error:
+    # Float or out-of-range arguments (the device would take ints).
+    _out.write(st.pack(op, *[_i16(v) for v in args]))
+
+
+_int_lists = {}      # value count -> Struct for op, count and the values
+
+
+def _ints(op, vals):
+  n = len(vals)
+  st = _int_lists.get(n)
+  if st is None:
+    st = _int_lists[n] = struct.Struct('<BH%dh' % n)
+  try:
+    _out.write(st.pack(op, n, *vals))
+  except struct.error:
+    _out.write(st.pack(op, n, *[_i16(v) for v in vals]))
+
+
+def _text(op, x, y, text):
+  b = str(text).encode('utf-8')[:0xFFFF]
+  _cmd(_TEXT, op, x, y, len(b))
+  _out.write(b)
+
+
+def _state(i, op, value):
+  _rstate[i] = value
+  _out.write(_U8.pack(op, value))
+
+
+def _font(name):
+  _rstate[5] = name
+  _out.write(_U8.pack(OP_FONT, len(name)))
+  _out.write(name)
+
+
+def _begin_frame():
+  _out.seek(0)
+  _out.truncate()
+  col, dith, fmode, bmode, base, font = _rstate
+  _out.write(_HEAD.pack(OP_COL, col, OP_DITH, dith, OP_FMODE, fmode,
+                        OP_BMODE, bmode, OP_BASE, base))
+  _font(font)
+
+
+def _flush_frame(app_ms=0.0):
+  # Hand the frame to the main thread, unless it is the frame it already has.
+  # _post_frame returns False when the frame ring is full (the main thread is
+  # behind); the frame is dropped and the next one goes instead.
+  global _prev, _dups
+  data = _out.getvalue()
+  if data == _prev:
+    _dups += 1
+    return
+  if _post_frame(data, app_ms, _dups):
+    _prev = data
+    _dups = 0
 
 
 # Per-font metrics for layout math (get_str_width / button height). Values:
@@ -132,17 +245,14 @@ class Vscreen:
   def active(self):
     return self._active
 
-  def _emit(self, *cmd):
-    _batch.append(list(cmd))
-
   # ── state ──
   def set_draw_color(self, color):
     self._draw_color = color
-    self._emit('col', color)
+    _state(0, OP_COL, int(color) & 0xFF)
 
   def set_dither(self, level):
     self._dither = max(0, min(16, int(level)))
-    self._emit('dith', self._dither)
+    _state(1, OP_DITH, self._dither)
 
   def set_font(self, font_name):
     name = str(font_name)
@@ -151,61 +261,66 @@ class Vscreen:
     self._font_px_cache = px
     self._cell_w = cell
     # Emit the device font name; the browser maps it to the real u8g2 bitmap.
-    self._emit('font', name)
+    _font(name.encode('utf-8')[:0xFF])
 
   def set_font_mode(self, mode):
     # u8g2 font mode: 1 = transparent (glyph only), 0 = solid (opaque bg box of
     # the opposite color). Used e.g. by analog_clock to invert the selected day.
-    self._emit('fmode', int(mode))
+    _state(2, OP_FMODE, int(mode) & 0xFF)
 
   def set_bitmap_mode(self, mode):
     # Device's bitmap_transparency (default 0 = solid). It governs how dithered
     # fills composite: solid (0) REPLACES the region (on-dither→ink, off→bg),
     # transparent (1) only sets the on-dither pixels and leaves the rest. This is
     # why analog_clock's inner light box overrides the outer darker one.
-    self._emit('bmode', int(mode))
+    _state(3, OP_BMODE, int(mode) & 0xFF)
   def set_font_direction(self, d): pass
-  def set_font_pos_baseline(self): self._baseline = 'alphabetic'; self._emit('base', 'alphabetic')
-  def set_font_pos_top(self):      self._baseline = 'top';        self._emit('base', 'top')
-  def set_font_pos_bottom(self):   self._baseline = 'bottom';     self._emit('base', 'bottom')
-  def set_font_pos_center(self):   self._baseline = 'middle';     self._emit('base', 'middle')
+  def set_font_pos_baseline(self): self._set_baseline('alphabetic')
+  def set_font_pos_top(self):      self._set_baseline('top')
+  def set_font_pos_bottom(self):   self._set_baseline('bottom')
+  def set_font_pos_center(self):   self._set_baseline('middle')
+
+  def _set_baseline(self, baseline):
+    self._baseline = baseline
+    _state(4, OP_BASE, _BASELINES.index(baseline))
+
   def set_terminal_font(self, *a): pass
   def set_terminal_font_size(self, size): pass
 
   # ── primitives ──
-  def draw_pixel(self, x, y):              self._emit('box', x, y, 1, 1)
-  def draw_line(self, x1, y1, x2, y2):     self._emit('line', x1, y1, x2, y2)
-  def draw_h_line(self, x, y, w):          self._emit('box', x, y, w, 1)
-  def draw_v_line(self, x, y, h):          self._emit('box', x, y, 1, h)
-  def draw_box(self, x, y, w, h):          self._emit('box', x, y, w, h)
-  def draw_frame(self, x, y, w, h):        self._emit('frame', x, y, w, h)
-  def draw_rbox(self, x, y, w, h, r):      self._emit('rbox', x, y, w, h, r)
-  def draw_rframe(self, x, y, w, h, r):    self._emit('rframe', x, y, w, h, r)
-  def draw_circle(self, x, y, r, opt=0):   self._emit('circ', x, y, r)
-  def draw_disc(self, x, y, r, opt=0):     self._emit('disc', x, y, r)
-  def draw_arc(self, x, y, rad, s, e):     self._emit('arc', x, y, rad, s, e)
+  def draw_pixel(self, x, y):              _cmd(_XY4, OP_BOX, x, y, 1, 1)
+  def draw_line(self, x1, y1, x2, y2):     _cmd(_XY4, OP_LINE, x1, y1, x2, y2)
+  def draw_h_line(self, x, y, w):          _cmd(_XY4, OP_BOX, x, y, w, 1)
+  def draw_v_line(self, x, y, h):          _cmd(_XY4, OP_BOX, x, y, 1, h)
+  def draw_box(self, x, y, w, h):          _cmd(_XY4, OP_BOX, x, y, w, h)
+  def draw_frame(self, x, y, w, h):        _cmd(_XY4, OP_FRAME, x, y, w, h)
+  def draw_rbox(self, x, y, w, h, r):      _cmd(_XY5, OP_RBOX, x, y, w, h, r)
+  def draw_rframe(self, x, y, w, h, r):    _cmd(_XY5, OP_RFRAME, x, y, w, h, r)
+  def draw_circle(self, x, y, r, opt=0):   _cmd(_XY3, OP_CIRC, x, y, r)
+  def draw_disc(self, x, y, r, opt=0):     _cmd(_XY3, OP_DISC, x, y, r)
+  def draw_arc(self, x, y, rad, s, e):     _cmd(_XY5, OP_ARC, x, y, rad, s, e)
   def draw_triangle(self, x0, y0, x1, y1, x2, y2):
-    self._emit('tri', x0, y0, x1, y1, x2, y2)
-  def draw_ellipse(self, x, y, rx, ry, opt=0):        self._emit('ell', x, y, rx, ry, 0)
-  def draw_filled_ellipse(self, x, y, rx, ry, opt=0): self._emit('ell', x, y, rx, ry, 1)
+    _cmd(_XY6, OP_TRI, x0, y0, x1, y1, x2, y2)
+  def draw_ellipse(self, x, y, rx, ry, opt=0):        _cmd(_ELL, OP_ELL, x, y, rx, ry, 0)
+  def draw_filled_ellipse(self, x, y, rx, ry, opt=0): _cmd(_ELL, OP_ELL, x, y, rx, ry, 1)
 
   def draw_polygon(self, pts):
-    self._emit('poly', list(pts))
+    _ints(OP_POLY, pts)
 
   def draw_str(self, x, y, text):
-    self._emit('str', x, y, str(text))
+    _text(OP_STR, x, y, text)
 
   def draw_utf8(self, x, y, text):
-    self._emit('str', x, y, str(text))
+    _text(OP_STR, x, y, text)
 
   def draw_utf8_v(self, x, y, text):
-    self._emit('vstr', x, y, str(text))
+    _text(OP_VSTR, x, y, text)
 
   def draw_button_utf8(self, x, y, flags, width, ph, pv, text):
     tw = self.get_str_width(text)
     w = width if width > 0 else tw + 2 * ph
-    self._emit('frame', x, y, w, self._font_px_cache + 2 * pv)
-    self._emit('str', x + ph, y + pv, str(text))
+    _cmd(_XY4, OP_FRAME, x, y, w, self._font_px_cache + 2 * pv)
+    _text(OP_STR, x + ph, y + pv, text)
 
   def get_str_width(self, text):
     # Use the font's real cell advance (monospace device fonts), matching the
@@ -229,11 +344,12 @@ class Vscreen:
     self._emit_xbm(x, y, w, h, data, 0)
 
   def _emit_xbm(self, x, y, w, h, data, frame):
-    # Pack the visible frame's bytes into a plain list (MSB-first) for the renderer.
+    # The visible frame's bytes (MSB-first), padded if the image data is short.
     stride = (w + 7) // 8
     off = frame * stride * h
     chunk = bytes(data[off:off + stride * h])
-    self._emit('xbm', x, y, w, h, list(chunk))
+    _cmd(_XY4, OP_XBM, x, y, w, h)
+    _out.write(chunk.ljust(stride * h, b'\0'))
 
   def draw_3d_faces(self, points, indices, dither):
     faces = []
@@ -242,14 +358,14 @@ class Vscreen:
       if d < 0:
         continue
       b = idx * 6
-      faces.append([d, points[b], points[b+1], points[b+2],
-                       points[b+3], points[b+4], points[b+5]])
-    self._emit('faces', faces)
+      faces += (d, points[b], points[b+1], points[b+2],
+                   points[b+3], points[b+4], points[b+5])
+    _ints(OP_FACES, faces)
 
   draw_2d_faces = draw_3d_faces
 
   def draw_polygon_texture(self, pts, map_arr, image_tuple, frame=0):
-    self._emit('poly', list(pts))
+    _ints(OP_POLY, pts)
 
   def capture_as_xbm(self, x, y, w, h, buf): pass
 
@@ -318,8 +434,9 @@ class Vscreen:
 
   # ── callback ──
   def callback(self, fn):
-    global _registered_callback
+    global _registered_callback, _prev
     _registered_callback = fn
+    _prev = None     # the main thread redraws from the next frame on
     self._callback = fn
     _post({'type': 'mode', 'graphics': fn is not None})
 
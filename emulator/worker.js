@@ -160,6 +160,37 @@ self.onmessage = async (e) => {
         Atomics.notify(meta, 0);
       };
 
+      // Frame ring (layout: see the main thread's frameSab). vscreen.py hands
+      // each frame over as a Python bytes object; it is copied straight from
+      // the Pyodide heap into the ring, and only its position is posted.
+      // Returns false, dropping the frame, while the main thread is too far
+      // behind to leave room for it.
+      const fsab = msg.frameSab;
+      const frameMeta = new Int32Array(fsab, 0, 16);
+      const frameRing = new Uint8Array(fsab, 64);
+      self.emulator_post_frame = (frame, appMs, dups) => {
+        const view = frame.getBuffer('u8');
+        try {
+          const bytes = view.data, n = bytes.length, cap = frameRing.length;
+          let w = Atomics.load(frameMeta, 0) >>> 0;
+          const r = Atomics.load(frameMeta, 1) >>> 0;
+          // A frame is stored in one piece: skip the end of the ring if it
+          // doesn't fit there.
+          const pad = (w % cap) + n > cap ? cap - (w % cap) : 0;
+          if (((w - r) >>> 0) + pad + n > cap) {
+            Atomics.add(frameMeta, 2, 1);
+            return false;
+          }
+          w = (w + pad) >>> 0;
+          frameRing.set(bytes, w % cap);
+          Atomics.store(frameMeta, 0, (w + n) | 0);
+          self.postMessage({ type: 'frame', start: w, len: n, appMs, dups });
+          return true;
+        } finally {
+          view.release();
+        }
+      };
+
       self.emulator_post_raw = (jsonStr) => {
         try { self.postMessage(JSON.parse(jsonStr)); }
         catch (_) { self.postMessage({ type: 'error', message: jsonStr }); }
@@ -1,8 +1,34 @@
 import ls
 import pdeck
 
+# Files are copied to the output in pieces of this many characters, so a
+# large file never has to fit in memory and a pipe stage reading cat's output
+# (head, grep -m) can stop it early.
+_BLOCK = 4096
+
+
+def _cat_sink(vs):
+  # Streaming stdin (see pstdin): pass each line straight through.
+  while True:
+    line = yield
+    if line is None:
+      return
+    vs.write(line)
+
+
+def pipe(vs, args):
+  # Streaming stdin entry point: only a bare `cat` (or `cat -`) reads it.
+  if len(args) == 1 or args[1:] == ['-']:
+    return _cat_sink(vs)
+  return None
+
+
 def main(vs, args):
-  if len(args) == 1:
+  if len(args) == 1 or args[1:] == ['-']:
+    import pstdin
+    if pstdin.has():
+      vs.write(pstdin.take())
+      return
     print("Usage: cat file [file..]", file=vs)
     return
 
@@ -20,8 +46,11 @@ def main(vs, args):
       try:
         filename = ls_item[0] + '/' + file
         with open(filename,"r") as f:
-          c = f.read()
-          vs.write(c)
+          while True:
+            c = f.read(_BLOCK)
+            if not c:
+              break
+            vs.write(c)
           vs.write("\n")
       except Exception as e:
         print(f"Error at '{args[argno]}'", file=vs)
@@ -1,6 +1,7 @@
 import os
 import argparse
 import ls
+import dir_cache
 
 def _is_dir(path):
   try:
@@ -116,6 +117,7 @@ def main(vs, args_in):
       dst = dst_path
 
     ok, err = _copy_file(src, dst)
+    dir_cache.invalidate(dst)
     if not ok:
       print(err, file=vs)
       return
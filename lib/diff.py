@@ -1,4 +1,6 @@
 import argparse
+import array
+import os
 
 
 ESC = '\x1b['
@@ -127,69 +129,224 @@ def _truncate(text, width):
   return text[:width - 3] + '...'
 
 
-def _diff_lines(left_lines, right_lines, lookahead):
+# ---- diff engine ----
+#
+# Lines are mapped to small ints up front so every comparison below is an int
+# compare. The engine produces a list of matched runs (left_start, right_start,
+# length); everything between runs is a change. Myers' O(ND) algorithm in its
+# linear-space form (middle snake, divide and conquer) finds a minimal edit
+# script; the histogram mode first anchors on the rarest lines shared by both
+# sides (like git's --histogram), which lines up code blocks better, and uses
+# Myers for whatever is left between anchors. Subproblems go on an explicit
+# stack: MicroPython's recursion limit is low.
+
+# Lines occurring more than this often in a range are never histogram anchors.
+_HIST_MAX_CHAIN = 64
+
+
+def _hash_lines(left_lines, right_lines):
+  ids = {}
+  a = array.array('i', bytearray(4 * len(left_lines)))
+  b = array.array('i', bytearray(4 * len(right_lines)))
+  for seq, out in ((left_lines, a), (right_lines, b)):
+    for i in range(len(seq)):
+      line = seq[i]
+      v = ids.get(line)
+      if v is None:
+        v = len(ids)
+        ids[line] = v
+      out[i] = v
+  return a, b
+
+
+def _trim(a, b, alo, ahi, blo, bhi, matches):
+  # Strip the common prefix and suffix of a range, recording them as matches.
+  n = 0
+  while alo + n < ahi and blo + n < bhi and a[alo + n] == b[blo + n]:
+    n += 1
+  if n:
+    matches.append((alo, blo, n))
+    alo += n
+    blo += n
+  n = 0
+  while ahi - n > alo and bhi - n > blo and a[ahi - n - 1] == b[bhi - n - 1]:
+    n += 1
+  if n:
+    matches.append((ahi - n, bhi - n, n))
+    ahi -= n
+    bhi -= n
+  return alo, ahi, blo, bhi
+
+
+def _middle_snake(a, b, alo, ahi, blo, bhi, vf, vb, off):
+  # Myers' middle snake of a[alo:ahi] vs b[blo:bhi] (both non-empty, first and
+  # last lines differing). Returns (x0, y0, x1, y1): a diagonal run of
+  # matches, possibly empty, lying on some shortest edit path.
+  n = ahi - alo
+  m = bhi - blo
+  delta = n - m
+  odd = delta & 1
+  vf[off + 1] = 0
+  vb[off + 1] = 0
+  for d in range((n + m + 1) // 2 + 1):
+    for k in range(-d, d + 1, 2):
+      if k == -d or (k != d and vf[off + k - 1] < vf[off + k + 1]):
+        x = vf[off + k + 1]
+      else:
+        x = vf[off + k - 1] + 1
+      y = x - k
+      x0 = x
+      while x < n and y < m and a[alo + x] == b[blo + y]:
+        x += 1
+        y += 1
+      vf[off + k] = x
+      if odd and -(d - 1) <= delta - k <= d - 1 and x + vb[off + delta - k] >= n:
+        return (alo + x0, blo + x0 - k, alo + x, blo + y)
+    # The reverse search runs on both sequences read backwards.
+    for k in range(-d, d + 1, 2):
+      if k == -d or (k != d and vb[off + k - 1] < vb[off + k + 1]):
+        x = vb[off + k + 1]
+      else:
+        x = vb[off + k - 1] + 1
+      y = x - k
+      x0 = x
+      while x < n and y < m and a[ahi - 1 - x] == b[bhi - 1 - y]:
+        x += 1
+        y += 1
+      vb[off + k] = x
+      if not odd and -d <= delta - k <= d and x + vf[off + delta - k] >= n:
+        return (ahi - x, bhi - y, ahi - x0, bhi - (x0 - k))
+  return (alo, blo, alo, blo)  # not reached
+
+
+def _myers(a, b, alo, ahi, blo, bhi, matches):
+  size = (ahi - alo) + (bhi - blo) + 4
+  vf = array.array('i', bytearray(4 * size))
+  vb = array.array('i', bytearray(4 * size))
+  off = size // 2
+  stack = [(alo, ahi, blo, bhi)]
+  while stack:
+    alo, ahi, blo, bhi = stack.pop()
+    alo, ahi, blo, bhi = _trim(a, b, alo, ahi, blo, bhi, matches)
+    if alo == ahi or blo == bhi:
+      continue
+    x0, y0, x1, y1 = _middle_snake(a, b, alo, ahi, blo, bhi, vf, vb, off)
+    if x1 > x0:
+      matches.append((x0, y0, x1 - x0))
+    stack.append((x1, ahi, y1, bhi))
+    stack.append((alo, x0, blo, y0))
+
+
+def _histogram(a, b, alo, ahi, blo, bhi, matches):
+  stack = [(alo, ahi, blo, bhi)]
+  while stack:
+    alo, ahi, blo, bhi = stack.pop()
+    alo, ahi, blo, bhi = _trim(a, b, alo, ahi, blo, bhi, matches)
+    if alo == ahi or blo == bhi:
+      continue
+    where = {}  # line -> its positions in the left range
+    for i in range(alo, ahi):
+      v = a[i]
+      p = where.get(v)
+      if p is None:
+        where[v] = [i]
+      elif len(p) <= _HIST_MAX_CHAIN:
+        p.append(i)
+    # Anchor on the longest run starting at a line that is rarest on the left.
+    best_cnt = _HIST_MAX_CHAIN + 1
+    best = None
+    j = blo
+    while j < bhi:
+      p = where.get(b[j])
+      if p is None or len(p) > best_cnt:
+        j += 1
+        continue
+      nxt = j + 1
+      for i in p:
+        s = 0
+        while i - s > alo and j - s > blo and a[i - s - 1] == b[j - s - 1]:
+          s += 1
+        e = 1
+        while i + e < ahi and j + e < bhi and a[i + e] == b[j + e]:
+          e += 1
+        if len(p) < best_cnt or best is None or e + s > best[2]:
+          best_cnt = len(p)
+          best = (i - s, j - s, e + s)
+        if j + e > nxt:
+          nxt = j + e
+      j = nxt
+    if best is None:
+      _myers(a, b, alo, ahi, blo, bhi, matches)
+      continue
+    x, y, n = best
+    matches.append(best)
+    stack.append((x + n, ahi, y + n, bhi))
+    stack.append((alo, x, blo, y))
+
+
+def _diff_lines(left_lines, right_lines, histogram=False):
+  a, b = _hash_lines(left_lines, right_lines)
+  matches = []
+  if histogram:
+    _histogram(a, b, 0, len(a), 0, len(b), matches)
+  else:
+    _myers(a, b, 0, len(a), 0, len(b), matches)
+  matches.sort()
+
   ops = []
   i = 0
   j = 0
-  left_len = len(left_lines)
-  right_len = len(right_lines)
-
-  while i < left_len and j < right_len:
-    if left_lines[i] == right_lines[j]:
+  for x, y, n in matches:
+    while i < x:
+      ops.append(('-', i + 1, 0, left_lines[i], ''))
+      i += 1
+    while j < y:
+      ops.append(('+', 0, j + 1, '', right_lines[j]))
+      j += 1
+    for _ in range(n):
       ops.append((' ', i + 1, j + 1, left_lines[i], right_lines[j]))
       i += 1
       j += 1
-      continue
-
-    match_in_right = -1
-    end_right = right_len
-    if j + lookahead + 1 < end_right:
-      end_right = j + lookahead + 1
-    k = j + 1
-    while k < end_right:
-      if left_lines[i] == right_lines[k]:
-        match_in_right = k
-        break
-      k += 1
-
-    match_in_left = -1
-    end_left = left_len
-    if i + lookahead + 1 < end_left:
-      end_left = i + lookahead + 1
-    k = i + 1
-    while k < end_left:
-      if left_lines[k] == right_lines[j]:
-        match_in_left = k
-        break
-      k += 1
-
-    if match_in_right != -1 and (match_in_left == -1 or (match_in_right - j) <= (match_in_left - i)):
-      while j < match_in_right:
-        ops.append(('+', 0, j + 1, '', right_lines[j]))
-        j += 1
-      continue
-
-    if match_in_left != -1:
-      while i < match_in_left:
-        ops.append(('-', i + 1, 0, left_lines[i], ''))
-        i += 1
-      continue
-
-    ops.append(('!', i + 1, j + 1, left_lines[i], right_lines[j]))
-    i += 1
-    j += 1
 
-  while i < left_len:
+  while i < len(left_lines):
     ops.append(('-', i + 1, 0, left_lines[i], ''))
     i += 1
 
-  while j < right_len:
+  while j < len(right_lines):
     ops.append(('+', 0, j + 1, '', right_lines[j]))
     j += 1
 
   return ops
 
 
+def _pair_changes(ops):
+  # For the side-by-side view: a block of removed lines followed by added
+  # lines is shown as changed ('!') rows pairing them up, then the leftover.
+  out = []
+  i = 0
+  while i < len(ops):
+    if ops[i][0] != '-':
+      out.append(ops[i])
+      i += 1
+      continue
+    d = i
+    while d < len(ops) and ops[d][0] == '-':
+      d += 1
+    e = d
+    while e < len(ops) and ops[e][0] == '+':
+      e += 1
+    k = 0
+    while i + k < d and d + k < e:
+      left = ops[i + k]
+      right = ops[d + k]
+      out.append(('!', left[1], right[2], left[3], right[4]))
+      k += 1
+    out.extend(ops[i + k:d])
+    out.extend(ops[d + k:e])
+    i = e
+  return out
+
+
 def _compact_ops(ops, context):
   if context < 0:
     context = 0
@@ -348,8 +505,9 @@ def _render_header(writer, left_path, right_path, style):
   writer.line(_bold('+++ ' + right_path, style))
 
 
-def _render_side_by_side(writer, ops, width, style):
-  numw = _line_no_width(ops)
+def _render_side_by_side(writer, ops, width, style, numw=0):
+  if not numw:
+    numw = _line_no_width(ops)
   content_w = (width - (numw * 2) - 7) // 2
   if content_w < 8:
     content_w = 8
@@ -385,13 +543,373 @@ def _render_side_by_side(writer, ops, width, style):
     writer.line(left_cell + ' | ' + right_cell)
 
 
+# ---- streaming mode ----
+#
+# For files too big to hold as lists of str. A first pass reads each file in
+# blocks and keeps, per line, only its start offset and a 32-bit key (CRC32
+# mixed with the length, cut to 30 bits so it stays a small int on
+# MicroPython) in two arrays -- 8 bytes a line. Lines that occur
+# exactly once in each file are matched up first (patience style), which
+# splits the problem into small gaps for Myers; the engine above then runs on
+# the keys. Only the lines that end up in a hunk are read back from disk when
+# rendering, a batch at a time, so memory does not grow with the output
+# either. With 30-bit keys, different lines sharing a key are to be expected
+# in large files, so a key match is only a candidate: every matched run is
+# compared byte for byte before rendering (_verify_matches), and lines that
+# turn out to differ are shown as changes.
+
+# Files bigger than this are diffed in streaming mode even without -S.
+_STREAM_AUTO = 256 * 1024
+# Block size for the first pass, and lines rendered per re-read.
+_SCAN_BLOCK = 4096
+_BATCH_LINES = 128
+
+try:
+  from binascii import crc32 as _crc32
+except ImportError:
+  def _crc32(data, crc=0):
+    for c in data:
+      crc = (crc * 31 + c) & 0xffffffff
+    return crc
+
+
+def _scan_lines(path):
+  # (offs, keys): offs[i] is where line i starts, offs[n] one past the end of
+  # the last line's '\n' (a missing final newline is counted as if present).
+  offs = array.array('I', [0])
+  keys = array.array('I')
+  buf = bytearray(_SCAN_BLOCK)
+  mv = memoryview(buf)
+  pos = 0
+  crc = 0
+  ln = 0
+  with open(path, 'rb') as f:
+    while True:
+      got = f.readinto(buf)
+      if not got:
+        break
+      start = 0
+      while start < got:
+        nl = buf.find(b'\n', start, got)
+        end = got if nl == -1 else nl
+        if end > start:
+          crc = _crc32(mv[start:end], crc)
+          ln += end - start
+        if nl == -1:
+          break
+        keys.append((crc + ln * 0x9e3779b1) & 0x3fffffff)
+        offs.append(pos + nl + 1)
+        crc = 0
+        ln = 0
+        start = nl + 1
+      pos += got
+  if ln:
+    keys.append((crc + ln * 0x9e3779b1) & 0x3fffffff)
+    offs.append(pos + 1)
+  return offs, keys
+
+
+def _by_key(keys, lo, hi):
+  # Indexes lo..hi-1 sorted by their line key, as an array.
+  return array.array('i', sorted(range(lo, hi), key=lambda i: keys[i]))
+
+
+def _unique_anchors(a, b, alo, ahi, blo, bhi):
+  # Lines that occur exactly once in a[alo:ahi] and once in b[blo:bhi],
+  # reduced to the longest chain increasing on both sides. Returned as two
+  # arrays: xs[t] in a matches ys[t] in b.
+  # Memory stays in flat int arrays, a few words per line of the two ranges
+  # (the two sorted index arrays, and the list sorted() builds for each),
+  # rather than a dict entry per distinct line: equal keys are found by
+  # walking both ranges in key order.
+  sa = _by_key(a, alo, ahi)
+  sb = _by_key(b, blo, bhi)
+  at = array.array('i', bytearray(4 * (bhi - blo)))  # b line -> a line + 1
+  na = len(sa)
+  nb = len(sb)
+  i = 0
+  j = 0
+  while i < na and j < nb:
+    ka = a[sa[i]]
+    kb = b[sb[j]]
+    if ka < kb:
+      i += 1
+    elif kb < ka:
+      j += 1
+    else:
+      i2 = i + 1
+      while i2 < na and a[sa[i2]] == ka:
+        i2 += 1
+      j2 = j + 1
+      while j2 < nb and b[sb[j2]] == kb:
+        j2 += 1
+      if i2 - i == 1 and j2 - j == 1:
+        at[sb[j] - blo] = sa[i] + 1
+      i = i2
+      j = j2
+  sa = None
+  sb = None
+  pa = array.array('i')   # the pairs, in b order
+  pb = array.array('i')
+  for j in range(blo, bhi):
+    x = at[j - blo]
+    if x:
+      pa.append(x - 1)
+      pb.append(j)
+  at = None
+  # Longest increasing subsequence of the a-indexes.
+  tails = array.array('i')  # tails[l]: pair ending the best run of length l+1
+  back = array.array('i', bytearray(4 * len(pa)))
+  for p in range(len(pa)):
+    x = pa[p]
+    lo = 0
+    hi = len(tails)
+    while lo < hi:
+      mid = (lo + hi) >> 1
+      if pa[tails[mid]] < x:
+        lo = mid + 1
+      else:
+        hi = mid
+    back[p] = tails[lo - 1] if lo else -1
+    if lo == len(tails):
+      tails.append(p)
+    else:
+      tails[lo] = p
+  n = len(tails)
+  xs = array.array('i', bytearray(4 * n))
+  ys = array.array('i', bytearray(4 * n))
+  p = tails[-1] if n else -1
+  while p >= 0:
+    n -= 1
+    xs[n] = pa[p]
+    ys[n] = pb[p]
+    p = back[p]
+  return xs, ys
+
+
+def _stream_matches(a, b, histogram):
+  matches = []
+  alo, ahi, blo, bhi = _trim(a, b, 0, len(a), 0, len(b), matches)
+  if histogram:
+    _histogram(a, b, alo, ahi, blo, bhi, matches)
+  else:
+    xs, ys = _unique_anchors(a, b, alo, ahi, blo, bhi)
+    x0 = alo
+    y0 = blo
+    run = 0     # anchors directly following each other make one match
+    for t in range(len(xs)):
+      x = xs[t]
+      y = ys[t]
+      if x == x0 and y == y0 and run:
+        run += 1
+      else:
+        if run:
+          matches.append((x0 - run, y0 - run, run))
+        _myers(a, b, x0, x, y0, y, matches)
+        run = 1
+      x0 = x + 1
+      y0 = y + 1
+    if run:
+      matches.append((x0 - run, y0 - run, run))
+    _myers(a, b, x0, ahi, y0, bhi, matches)
+  matches.sort()
+  return matches
+
+
+def _verify_matches(lpath, lofs, rpath, rofs, matches):
+  # Re-read the lines of each matched run (x, y, k) from both files, a batch
+  # at a time, and split the run around lines whose bytes differ.
+  out = []
+  with open(lpath, 'rb') as fa, open(rpath, 'rb') as fb:
+    for x, y, k in matches:
+      s = 0     # start of the run of verified lines, relative to x and y
+      t = 0
+      while t < k:
+        c = min(k - t, _BATCH_LINES)
+        a0 = lofs[x + t]
+        b0 = rofs[y + t]
+        fa.seek(a0)
+        da = fa.read(lofs[x + t + c] - a0)
+        fb.seek(b0)
+        db = fb.read(rofs[y + t + c] - b0)
+        if da != db:
+          for u in range(t, t + c):
+            la = da[lofs[x + u] - a0:lofs[x + u + 1] - 1 - a0]
+            lb = db[rofs[y + u] - b0:rofs[y + u + 1] - 1 - b0]
+            if la != lb:
+              if u > s:
+                out.append((x + s, y + s, u - s))
+              s = u + 1
+        t += c
+      if k > s:
+        out.append((x + s, y + s, k - s))
+  return out
+
+
+def _stream_blocks(matches, n, m):
+  # Change blocks (i0, i1, j0, j1) between the matched runs.
+  out = []
+  i = 0
+  j = 0
+  for x, y, k in matches + [(n, m, 0)]:
+    if x > i or y > j:
+      out.append((i, x, j, y))
+    i = x + k
+    j = y + k
+  return out
+
+
+def _stream_hunks(blocks, context):
+  # Groups of blocks close enough to share a hunk (same rule as _make_hunks).
+  hunks = []
+  for blk in blocks:
+    if hunks and blk[0] - hunks[-1][-1][1] <= 2 * context:
+      hunks[-1].append(blk)
+    else:
+      hunks.append([blk])
+  return hunks
+
+
+class _LineSource:
+  # Reads lines back from one side by number, using the offsets of pass one.
+  def __init__(self, path, offs):
+    self.f = open(path, 'rb')
+    self.offs = offs
+
+  def close(self):
+    self.f.close()
+
+  def lines(self, i, j):
+    if j <= i:
+      return []
+    offs = self.offs
+    self.f.seek(offs[i])
+    data = self.f.read(offs[j] - offs[i])
+    out = []
+    for k in range(i, j):
+      p = offs[k] - offs[i]
+      line = data[p:offs[k + 1] - 1 - offs[i]]
+      try:
+        out.append(str(line, 'utf-8'))
+      except Exception:
+        out.append(''.join(chr(c) if c < 128 else '?' for c in line))
+    return out
+
+
+def _stream_ops(left, right, lo, hi, jlo, blocks, side_by_side):
+  # Ops (as built by _diff_lines, or _pair_changes for side by side) for
+  # left lines lo..hi, right lines from jlo, in lists of about _BATCH_LINES.
+  i = lo
+  j = jlo
+  jhi = jlo + (hi - lo) - sum(b[1] - b[0] - (b[3] - b[2]) for b in blocks)
+  for i0, i1, j0, j1 in blocks + [(hi, hi, jhi, jhi)]:
+    while i < i0:
+      k = min(i0 - i, _BATCH_LINES)
+      lt = left.lines(i, i + k)
+      yield [(' ', i + t + 1, j + t + 1, lt[t], lt[t]) for t in range(k)]
+      i += k
+      j += k
+    if side_by_side:
+      while i < i1 and j < j1:
+        k = min(i1 - i, j1 - j, _BATCH_LINES)
+        lt = left.lines(i, i + k)
+        rt = right.lines(j, j + k)
+        yield [('!', i + t + 1, j + t + 1, lt[t], rt[t]) for t in range(k)]
+        i += k
+        j += k
+    while i < i1:
+      k = min(i1 - i, _BATCH_LINES)
+      lt = left.lines(i, i + k)
+      yield [('-', i + t + 1, 0, lt[t], '') for t in range(k)]
+      i += k
+    while j < j1:
+      k = min(j1 - j, _BATCH_LINES)
+      rt = right.lines(j, j + k)
+      yield [('+', 0, j + t + 1, '', rt[t]) for t in range(k)]
+      j += k
+
+
+def _range_text(lo, count):
+  if count == 1:
+    return str(lo + 1)
+  return str(lo + 1 if count else lo) + ',' + str(count)
+
+
+def _render_stream(writer, args, width, style):
+  lofs, lkeys = _scan_lines(args.left)
+  rofs, rkeys = _scan_lines(args.right)
+  n = len(lkeys)
+  m = len(rkeys)
+  matches = _stream_matches(lkeys, rkeys, args.histogram)
+  lkeys = None
+  rkeys = None
+  matches = _verify_matches(args.left, lofs, args.right, rofs, matches)
+  blocks = _stream_blocks(matches, n, m)
+  matches = None
+  if not blocks and not (args.side_by_side or args.all):
+    writer.line('(no differences)')
+    return
+  show_all = args.all or not blocks
+  numw = len(str(n if n > m else m))
+  context = args.context if args.context > 0 else 0
+  left = _LineSource(args.left, lofs)
+  right = _LineSource(args.right, rofs)
+  try:
+    if show_all:
+      hunks = [blocks]
+    else:
+      hunks = _stream_hunks(blocks, context)
+    last = 0
+    for hunk in hunks:
+      if show_all:
+        lo = 0
+        hi = n
+      else:
+        lo = hunk[0][0] - context
+        if lo < 0:
+          lo = 0
+        hi = hunk[-1][1] + context
+        if hi > n:
+          hi = n
+      # Equal lines pair 1:1, so the right side is offset by a constant here.
+      if hunk:
+        jlo = hunk[0][2] - (hunk[0][0] - lo)
+        jhi = hunk[-1][3] + (hi - hunk[-1][1])
+      else:
+        jlo = 0
+        jhi = m
+      if args.side_by_side:
+        if lo > last:
+          writer.line(_bold('... ' + str(lo - last) + ' unchanged lines ...', style))
+        for ops in _stream_ops(left, right, lo, hi, jlo, hunk, True):
+          _render_side_by_side(writer, ops, width, style, numw)
+      else:
+        writer.line(_bold('@@ -' + _range_text(lo, hi - lo) + ' +' + _range_text(jlo, jhi - jlo) + ' @@', style))
+        for ops in _stream_ops(left, right, lo, hi, jlo, hunk, False):
+          for tag, _left_no, _right_no, left_text, right_text in ops:
+            if tag == ' ':
+              writer.line(' ' + left_text)
+            elif tag == '-':
+              writer.line(_style_line('-' + left_text, '-', style))
+            else:
+              writer.line(_style_line('+' + right_text, '+', style))
+      last = hi
+    if args.side_by_side and n > last:
+      writer.line(_bold('... ' + str(n - last) + ' unchanged lines ...', style))
+  finally:
+    left.close()
+    right.close()
+
+
 def _build_parser():
   parser = argparse.ArgumentParser(description='compare two text files')
   parser.add_argument('-a', '--all', action='store_true', help='show all unchanged lines in one unified hunk')
   parser.add_argument('-c', '--context', type=int, default=2, help='context lines around changes')
   parser.add_argument('-y', '--side-by-side', action='store_true', help='show side by side view')
   parser.add_argument('-w', '--width', type=int, default=0, help='target width for side by side view')
-  parser.add_argument('-l', '--lookahead', type=int, default=12, help='anchor search window')
+  parser.add_argument('--histogram', action='store_true', help='anchor on rare lines first (often reads better for code)')
+  parser.add_argument('-l', '--lookahead', type=int, help='ignored, with a warning (kept for old scripts)')
+  parser.add_argument('-S', '--stream', action='store_true', help='keep only line offsets in memory (automatic for big files)')
   parser.add_argument('-m', '--more', action='store_true', help='pause and wait for a key every page')
   parser.add_argument('-o', '--output', help='write output to file path')
   parser.add_argument('-p', '--plain', action='store_true', help='disable syntax highlighting / escape sequences')
@@ -401,6 +919,43 @@ def _build_parser():
   return parser
 
 
+def _main_stream(vs, args):
+  style = not args.plain
+  if args.output and not args.style:
+    style = False
+
+  if args.width and args.width > 0:
+    width = args.width
+  else:
+    width = _detect_terminal_width(vs, 76)
+
+  if args.output:
+    try:
+      with open(args.output, 'w') as fp:
+        writer = _TeeWriter(None, fp)
+        _render_header(writer, args.left, args.right, style)
+        _render_stream(writer, args, width, style)
+    except OSError as e:
+      print('diff: cannot write {}: {}'.format(args.output, e), file=vs)
+      return
+    print('diff output saved to {}'.format(args.output), file=vs)
+    return
+
+  if args.more:
+    height = _detect_terminal_height(vs, 20)
+    writer = _PagerWriter(vs, height - 1)
+  else:
+    writer = _Writer(vs)
+
+  try:
+    _render_header(writer, args.left, args.right, style)
+    _render_stream(writer, args, width, style)
+  except _StopPaging:
+    return
+  except OSError as e:
+    print('diff: read error: {}'.format(e), file=vs)
+
+
 def main(vs, args_in):
   parser = _build_parser()
   try:
@@ -408,6 +963,22 @@ def main(vs, args_in):
   except SystemExit:
     return
 
+  if args.lookahead is not None:
+    print('diff: -l/--lookahead has no effect any more (the diff is minimal)', file=vs)
+
+  stream = args.stream
+  for path in (args.left, args.right):
+    try:
+      if os.stat(path)[6] > _STREAM_AUTO:
+        stream = True
+    except OSError as e:
+      print('diff: cannot open {}: {}'.format(path, e), file=vs)
+      return
+
+  if stream:
+    _main_stream(vs, args)
+    return
+
   try:
     left_lines = _open_lines(args.left)
   except OSError as e:
@@ -424,7 +995,7 @@ def main(vs, args_in):
   if args.output and not args.style:
     style = False
 
-  ops = _diff_lines(left_lines, right_lines, args.lookahead)
+  ops = _diff_lines(left_lines, right_lines, args.histogram)
 
   if args.width and args.width > 0:
     width = args.width
@@ -437,7 +1008,9 @@ def main(vs, args_in):
         writer = _TeeWriter(None, fp)
         _render_header(writer, args.left, args.right, style)
         if args.side_by_side:
-          out_ops = ops if args.all else _compact_ops(ops, args.context)
+          out_ops = _pair_changes(ops)
+          if not args.all:
+            out_ops = _compact_ops(out_ops, args.context)
           _render_side_by_side(writer, out_ops, width, style)
         else:
           _render_unified(writer, ops, args.context, args.all, style)
@@ -456,7 +1029,9 @@ def main(vs, args_in):
   try:
     _render_header(writer, args.left, args.right, style)
     if args.side_by_side:
-      out_ops = ops if args.all else _compact_ops(ops, args.context)
+      out_ops = _pair_changes(ops)
+      if not args.all:
+        out_ops = _compact_ops(out_ops, args.context)
       _render_side_by_side(writer, out_ops, width, style)
     else:
       _render_unified(writer, ops, args.context, args.all, style)
@@ -8,6 +8,8 @@ import pdeck_utils
 import esclib as elib
 import anm
 import pem_open
+import link_index
+from link_index import clean_link, parse_links, link_candidates
 try:
   import micropython
 except ImportError:
@@ -118,6 +120,382 @@ if not _have_viper:
         vy[i] = vyi
 
 
+# Grid repulsion. Pairs further apart than the d2 cutoff above (about 114 px)
+# don't interact, so the all-pairs kernel only ever needs a node's neighbours.
+# 'grid' buckets nodes into 128 px cells (shift 17 in fixed point) and pairs
+# each cell only with itself and its 8 neighbours: same pairs, same integer
+# math, same result as all-pairs, in roughly O(n * density) instead of O(n^2).
+# 'approx' (for big vaults where many nodes crowd one area) uses 32 px cells:
+# nodes in the 3x3 cells around a node repel it exactly, cells further out
+# act as a single body at their centroid weighted by their node count, like a
+# one-level Barnes-Hut with theta ~1.
+# Cells live in a 64x64 table that wraps around; nodes further apart that
+# share a slot are told apart by the distance check, so wrapping only costs
+# time. work: array('i') with [minx, miny] then the tables (_grid_work).
+_GRID_BITS = 6
+_GRID_CELLS = 1 << (_GRID_BITS * 2)
+_GRID_SHIFT = 17
+_APPROX_SHIFT = 15
+_APPROX_RING = 4     # 4 * 32 px cells cover the cutoff
+
+
+def _grid_work(work, n, approx):
+  size = 2 + _GRID_CELLS * (4 if approx else 1) + n
+  if work is None or len(work) < size:
+    work = array.array('i', bytearray(4 * size))
+  return work
+
+
+_have_viper_grid = False
+if micropython:
+  try:
+    @micropython.viper
+    def _layout_repulse_grid(x: ptr32, y: ptr32, vx: ptr32, vy: ptr32, n: int, work: ptr32):
+      shift = int(_LAYOUT_D2_SHIFT)
+      pos_scale = int(_LAYOUT_SCALE)
+      d2_bias = int(_LAYOUT_D2_BIAS)
+      d2_limit = int(_LAYOUT_D2_LIMIT)
+      force_num = int(_LAYOUT_FORCE_NUM)
+      force_max = int(_LAYOUT_FORCE_MAX)
+      cshift = int(_GRID_SHIFT)
+      reach = 1 << cshift
+      minx = work[0]
+      miny = work[1]
+      head = 2
+      nxt = 2 + int(_GRID_CELLS)
+      b = 0
+      while b < int(_GRID_CELLS):
+        work[head + b] = -1
+        b += 1
+      i = 0
+      while i < n:
+        b = (((x[i] - minx) >> cshift) & 63) | ((((y[i] - miny) >> cshift) & 63) << 6)
+        work[nxt + i] = work[head + b]
+        work[head + b] = i
+        i += 1
+      b = 0
+      while b < int(_GRID_CELLS):
+        bx = b & 63
+        by = b >> 6
+        i = work[head + b]
+        while i >= 0:
+          # k = 0: rest of own cell; k = 1..4: E, SW, S, SE cells
+          k = 0
+          while k < 5:
+            if k == 0:
+              j = work[nxt + i]
+            else:
+              ox = 1
+              oy = 0
+              if k == 2:
+                ox = -1
+                oy = 1
+              elif k == 3:
+                ox = 0
+                oy = 1
+              elif k == 4:
+                oy = 1
+              j = work[head + (((bx + ox) & 63) | (((by + oy) & 63) << 6))]
+            while j >= 0:
+              a = i
+              c = j
+              if a > c:
+                a = j
+                c = i
+              dx = x[a] - x[c]
+              dy = y[a] - y[c]
+              if dx > -reach and dx < reach and dy > -reach and dy < reach:
+                sdx = dx >> shift
+                sdy = dy >> shift
+                d2 = sdx * sdx + sdy * sdy + d2_bias
+                if d2 <= d2_limit:
+                  force = force_num // d2
+                  if force > force_max:
+                    force = force_max
+                  fx = (dx * force) // pos_scale
+                  fy = (dy * force) // pos_scale
+                  if a != 0:
+                    vx[a] += fx
+                    vy[a] += fy
+                  if c != 0:
+                    vx[c] -= fx
+                    vy[c] -= fy
+              j = work[nxt + j]
+            k += 1
+          i = work[nxt + i]
+        b += 1
+
+    @micropython.viper
+    def _layout_repulse_approx(x: ptr32, y: ptr32, vx: ptr32, vy: ptr32, n: int, work: ptr32):
+      shift = int(_LAYOUT_D2_SHIFT)
+      pos_scale = int(_LAYOUT_SCALE)
+      d2_bias = int(_LAYOUT_D2_BIAS)
+      d2_limit = int(_LAYOUT_D2_LIMIT)
+      force_num = int(_LAYOUT_FORCE_NUM)
+      force_max = int(_LAYOUT_FORCE_MAX)
+      cshift = int(_APPROX_SHIFT)
+      ring = int(_APPROX_RING)
+      reach = (ring + 1) << cshift
+      cells = int(_GRID_CELLS)
+      minx = work[0]
+      miny = work[1]
+      head = 2
+      cnt = head + cells
+      sumx = cnt + cells
+      sumy = sumx + cells
+      nxt = sumy + cells
+      b = 0
+      while b < cells:
+        work[head + b] = -1
+        work[cnt + b] = 0
+        work[sumx + b] = 0
+        work[sumy + b] = 0
+        b += 1
+      i = 0
+      while i < n:
+        b = (((x[i] - minx) >> cshift) & 63) | ((((y[i] - miny) >> cshift) & 63) << 6)
+        work[nxt + i] = work[head + b]
+        work[head + b] = i
+        work[cnt + b] += 1
+        work[sumx + b] += (x[i] - minx) >> shift
+        work[sumy + b] += (y[i] - miny) >> shift
+        i += 1
+      i = 1
+      while i < n:
+        xi = x[i]
+        yi = y[i]
+        bx = ((xi - minx) >> cshift) & 63
+        by = ((yi - miny) >> cshift) & 63
+        oy = -ring
+        while oy <= ring:
+          ox = -ring
+          while ox <= ring:
+            b = ((bx + ox) & 63) | (((by + oy) & 63) << 6)
+            m = work[cnt + b]
+            if m > 0:
+              if ox >= -1 and ox <= 1 and oy >= -1 and oy <= 1:
+                j = work[head + b]
+                m = 1
+              else:
+                j = -2
+              while j != -1:
+                if j == -2:
+                  # the whole cell, at its centroid
+                  dx = xi - (minx + ((work[sumx + b] // work[cnt + b]) << shift))
+                  dy = yi - (miny + ((work[sumy + b] // work[cnt + b]) << shift))
+                  m = work[cnt + b]
+                  nj = -1
+                elif j == i:
+                  dx = reach
+                  dy = reach
+                  nj = work[nxt + j]
+                else:
+                  dx = xi - x[j]
+                  dy = yi - y[j]
+                  nj = work[nxt + j]
+                if dx > -reach and dx < reach and dy > -reach and dy < reach:
+                  sdx = dx >> shift
+                  sdy = dy >> shift
+                  d2 = sdx * sdx + sdy * sdy + d2_bias
+                  if d2 <= d2_limit:
+                    force = force_num // d2
+                    if force > force_max:
+                      force = force_max
+                    vx[i] += ((dx * force) // pos_scale) * m
+                    vy[i] += ((dy * force) // pos_scale) * m
+                j = nj
+            ox += 1
+          oy += 1
+        i += 1
+    _have_viper_grid = True
+  except NameError:
+    pass
+
+if not _have_viper_grid:
+  def _layout_repulse_grid(x, y, vx, vy, n, work):
+    shift = _LAYOUT_D2_SHIFT
+    pos_scale = _LAYOUT_SCALE
+    d2_bias = _LAYOUT_D2_BIAS
+    d2_limit = _LAYOUT_D2_LIMIT
+    force_num = _LAYOUT_FORCE_NUM
+    force_max = _LAYOUT_FORCE_MAX
+    cshift = _GRID_SHIFT
+    reach = 1 << cshift
+    minx = work[0]
+    miny = work[1]
+    cells = _GRID_CELLS
+    head = [-1] * cells
+    nxt = [-1] * n
+    for i in range(n):
+      b = (((x[i] - minx) >> cshift) & 63) | ((((y[i] - miny) >> cshift) & 63) << 6)
+      nxt[i] = head[b]
+      head[b] = i
+    for b in range(cells):
+      i = head[b]
+      if i < 0:
+        continue
+      bx = b & 63
+      by = b >> 6
+      # own cell (rest of the chain), then the E, SW, S, SE cells
+      around = (head[((bx + 1) & 63) | (by << 6)],
+                head[((bx - 1) & 63) | (((by + 1) & 63) << 6)],
+                head[bx | (((by + 1) & 63) << 6)],
+                head[((bx + 1) & 63) | (((by + 1) & 63) << 6)])
+      while i >= 0:
+        for start in (nxt[i],) + around:
+          j = start
+          while j >= 0:
+            if i < j:
+              a = i
+              c = j
+            else:
+              a = j
+              c = i
+            dx = x[a] - x[c]
+            dy = y[a] - y[c]
+            if -reach < dx < reach and -reach < dy < reach:
+              sdx = dx >> shift
+              sdy = dy >> shift
+              d2 = sdx * sdx + sdy * sdy + d2_bias
+              if d2 <= d2_limit:
+                force = force_num // d2
+                if force > force_max:
+                  force = force_max
+                fx = (dx * force) // pos_scale
+                fy = (dy * force) // pos_scale
+                if a != 0:
+                  vx[a] += fx
+                  vy[a] += fy
+                if c != 0:
+                  vx[c] -= fx
+                  vy[c] -= fy
+            j = nxt[j]
+        i = nxt[i]
+
+  def _layout_repulse_approx(x, y, vx, vy, n, work):
+    shift = _LAYOUT_D2_SHIFT
+    pos_scale = _LAYOUT_SCALE
+    d2_bias = _LAYOUT_D2_BIAS
+    d2_limit = _LAYOUT_D2_LIMIT
+    force_num = _LAYOUT_FORCE_NUM
+    force_max = _LAYOUT_FORCE_MAX
+    cshift = _APPROX_SHIFT
+    ring = _APPROX_RING
+    reach = (ring + 1) << cshift
+    minx = work[0]
+    miny = work[1]
+    cells = _GRID_CELLS
+    head = [-1] * cells
+    cnt = [0] * cells
+    cx = [0] * cells
+    cy = [0] * cells
+    nxt = [-1] * n
+    for i in range(n):
+      b = (((x[i] - minx) >> cshift) & 63) | ((((y[i] - miny) >> cshift) & 63) << 6)
+      nxt[i] = head[b]
+      head[b] = i
+      cnt[b] += 1
+      cx[b] += (x[i] - minx) >> shift
+      cy[b] += (y[i] - miny) >> shift
+    for b in range(cells):
+      if cnt[b]:
+        cx[b] = minx + ((cx[b] // cnt[b]) << shift)
+        cy[b] = miny + ((cy[b] // cnt[b]) << shift)
+    near = (-1, 0, 1)
+    for i in range(1, n):
+      xi = x[i]
+      yi = y[i]
+      bx = ((xi - minx) >> cshift) & 63
+      by = ((yi - miny) >> cshift) & 63
+      fxs = 0
+      fys = 0
+      for oy in range(-ring, ring + 1):
+        row = ((by + oy) & 63) << 6
+        for ox in range(-ring, ring + 1):
+          b = ((bx + ox) & 63) | row
+          m = cnt[b]
+          if not m:
+            continue
+          if ox in near and oy in near:
+            j = head[b]
+            while j >= 0:
+              if j != i:
+                dx = xi - x[j]
+                dy = yi - y[j]
+                if -reach < dx < reach and -reach < dy < reach:
+                  sdx = dx >> shift
+                  sdy = dy >> shift
+                  d2 = sdx * sdx + sdy * sdy + d2_bias
+                  if d2 <= d2_limit:
+                    force = force_num // d2
+                    if force > force_max:
+                      force = force_max
+                    fxs += (dx * force) // pos_scale
+                    fys += (dy * force) // pos_scale
+              j = nxt[j]
+          else:
+            # the whole cell, at its centroid
+            dx = xi - cx[b]
+            dy = yi - cy[b]
+            if -reach < dx < reach and -reach < dy < reach:
+              sdx = dx >> shift
+              sdy = dy >> shift
+              d2 = sdx * sdx + sdy * sdy + d2_bias
+              if d2 <= d2_limit:
+                force = force_num // d2
+                if force > force_max:
+                  force = force_max
+                fxs += ((dx * force) // pos_scale) * m
+                fys += ((dy * force) // pos_scale) * m
+      vx[i] += fxs
+      vy[i] += fys
+
+
+LAYOUT_MODES = ('auto', 'pairs', 'grid', 'approx')
+# 'auto' picks all-pairs for small graphs and the approximate grid beyond
+# _AUTO_PAIRS_MAX nodes. Measured with run_bench (ms per frame):
+#   nodes   pairs   grid  approx
+#     120     3.7    5.5     3.9
+#     200    11.8   13.8     8.9
+#     300    18.8   27.3    15.8
+#     500    55.4   64.1    33.5
+#     600    79.7   69.6    35.3
+# The exact grid only overtakes all-pairs at about 600 nodes and is never
+# faster than approx, so auto does not use it; it stays available for an
+# exact layout of a large graph.
+_AUTO_PAIRS_MAX = 200
+
+
+def layout_engine(mode, n):
+  if mode == 'auto':
+    return 'pairs' if n <= _AUTO_PAIRS_MAX else 'approx'
+  return mode
+
+
+def _layout_repulse(mode, x, y, vx, vy, n, work=None):
+  # Add the repulsion between the n nodes at fixed-point x, y to vx, vy with
+  # the given engine. Returns the scratch array to pass in next time.
+  if mode == 'pairs':
+    _layout_repulse_int(x, y, vx, vy, n)
+    return work
+  approx = mode == 'approx'
+  work = _grid_work(work, n, approx)
+  minx = x[0]
+  miny = y[0]
+  for i in range(1, n):
+    if x[i] < minx:
+      minx = x[i]
+    if y[i] < miny:
+      miny = y[i]
+  work[0] = minx
+  work[1] = miny
+  if approx:
+    _layout_repulse_approx(x, y, vx, vy, n, work)
+  else:
+    _layout_repulse_grid(x, y, vx, vy, n, work)
+  return work
+
+
 def exists(path):
   try:
     os.stat(path)
@@ -179,35 +557,6 @@ def display_name(path_or_link):
   return name
 
 
-def clean_link(link):
-  link = link.strip()
-  bar = link.find('|')
-  if bar >= 0:
-    link = link[:bar].strip()
-  sharp = link.find('#')
-  if sharp >= 0:
-    link = link[:sharp].strip()
-  return link
-
-
-def parse_links(text):
-  links = []
-  pos = 0
-  while True:
-    start = text.find('[[', pos)
-    if start < 0:
-      break
-    end = text.find(']]', start + 2)
-    if end < 0:
-      break
-    if start == 0 or text[start - 1] != '!':
-      link = clean_link(text[start + 2:end])
-      if link:
-        links.append(link)
-    pos = end + 2
-  return links
-
-
 def resolve_root(arg):
   if not arg:
     return DEFAULT_ROOT
@@ -239,32 +588,31 @@ def resolve_link(base_file, link):
   link = clean_link(link)
   if not link:
     return None
-  tries = []
-  if link.startswith('/'):
-    tries.append(link)
-  else:
-    tries.append(join_path(dirname(base_file), link))
-    tries.append(join_path(VAULT_ROOT, link))
-  more = []
-  for p in tries:
-    more.append(p)
-    if not p.endswith('.md'):
-      more.append(p + '.md')
-  for p in more:
+  for p in link_candidates(base_file, link, VAULT_ROOT):
     p = norm_path(p)
     if exists(p) and not is_dir(p):
       return p
   return None
 
 
+def open_index():
+  # (index, existed) for the vault's link index. Without a `graph --index`
+  # run it starts empty and only serves the current session.
+  idx = link_index.link_index(VAULT_ROOT)
+  return idx, idx.load()
+
+
 class GraphCache:
-  def __init__(self):
+  def __init__(self, index=None):
     self.file_links = {}
     self.link_targets = {}
     self.file_hits = 0
     self.file_misses = 0
     self.resolve_hits = 0
     self.resolve_misses = 0
+    # Vault link index shared by every loader; outlives clear() since each
+    # entry is checked against the file's size and mtime anyway.
+    self.index = index
 
   def clear(self):
     self.file_links = {}
@@ -294,6 +642,7 @@ class GraphLoader:
     self.children = {}
     self.child_set = {}
     self.queue = []
+    self.queued = {}
     self.visited = {}
     self.files_loaded = 0
     self.errors = 0
@@ -302,6 +651,7 @@ class GraphLoader:
     root = self.add_node(root_file, root_file, True, 0, None)
     if root is not None:
       self.queue.append(root_file)
+      self.queued[root_file] = True
 
   def add_node(self, key, path, resolved, depth, parent):
     if key in self.node_index:
@@ -383,15 +733,17 @@ class GraphLoader:
       self.cache.file_hits += 1
       self.cache_hits += 1
       return entry[0], entry[1]
-    try:
-      #print('load')
-      with open(path, 'r') as f:
-        text = f.read()
-      ok = True
-      links = parse_links(text)
-    except Exception:
-      ok = False
-      links = None
+    if self.cache.index is not None:
+      ok, links = self.cache.index.links(path)
+    else:
+      try:
+        with open(path, 'r') as f:
+          text = f.read()
+        ok = True
+        links = parse_links(text)
+      except Exception:
+        ok = False
+        links = None
     self.cache.file_links[path] = (ok, links)
     self.cache.file_misses += 1
     self.cache_misses += 1
@@ -455,14 +807,10 @@ class GraphLoader:
           key = 'link:' + link
           child = self.add_node(key, None, False, self.nodes[idx]['depth'] + 1, idx)
         self.add_edge(idx, child)
-        if child is not None and resolved and resolved not in self.visited:
-          already = False
-          for q in self.queue:
-            if q == resolved:
-              already = True
-              break
-          if not already:
-            self.queue.append(resolved)
+        if child is not None and resolved and resolved not in self.visited \
+            and resolved not in self.queued:
+          self.queue.append(resolved)
+          self.queued[resolved] = True
       count += 1
     if not self.queue:
       self.done = True
@@ -470,13 +818,21 @@ class GraphLoader:
 
 
 class GraphApp:
-  def __init__(self, vs, root_file, max_nodes=90, max_depth=None):
+  def __init__(self, vs, root_file, max_nodes=90, max_depth=None, layout='auto'):
     self.vs = vs
     self.v = vs.v
     self.root_file = root_file
     self.max_depth = max_depth
-    self.cache = GraphCache()
-    self.loader = GraphLoader(root_file, max_nodes=max_nodes, max_depth=max_depth, cache=self.cache)
+    self.layout_mode = layout
+    self.layout_work = None
+    index, self.save_index = open_index()
+    self.cache = GraphCache(index)
+    # Edge and file caps grow with the node cap (220 and 80 at the default 90)
+    # so a big -n actually shows a big vault.
+    self.loader = GraphLoader(root_file, max_nodes=max_nodes,
+                              max_edges=max(220, max_nodes * 22 // 9),
+                              max_files=max(80, max_nodes * 8 // 9),
+                              max_depth=max_depth, cache=self.cache)
     self.running = True
     self.cam_x = 200.0
     self.cam_y = 126.0
@@ -1276,7 +1632,8 @@ class GraphApp:
     vy[0] = 0.0
 
     self.sync_layout_fixed(n)
-    _layout_repulse_int(self.layout_ix, self.layout_iy, self.layout_ivx, self.layout_ivy, n)
+    self.layout_work = _layout_repulse(layout_engine(self.layout_mode, n), self.layout_ix, self.layout_iy,
+                                       self.layout_ivx, self.layout_ivy, n, self.layout_work)
     inv_scale = 1.0 / _LAYOUT_SCALE
     for i in range(1, n):
       vx[i] = self.layout_ivx[i] * inv_scale
@@ -1770,15 +2127,23 @@ class GraphApp:
       else:
         pdeck.delay_tick(50)
     self.v.callback(None)
+    if self.save_index:
+      # Notes parsed this session are stored, so the next launch skips them.
+      try:
+        self.cache.index.save()
+      except OSError:
+        pass
 
 
 def run_test(vs, root, max_depth=None):
+  index, existed = open_index()
   loader = GraphLoader(
     root,
     max_nodes=120,
     max_edges=300,
     max_files=120,
     max_depth=max_depth,
+    cache=GraphCache(index),
   )
   while not loader.done:
     loader.step(4)
@@ -1790,11 +2155,81 @@ def run_test(vs, root, max_depth=None):
   print('nodes: {} edges: {} files: {} queue: {}'.format(
     len(loader.nodes), len(loader.edges), loader.files_loaded, len(loader.queue)), file=vs)
   print('capped: {} errors: {}'.format(loader.capped, loader.errors), file=vs)
+  print('index: {} ({} files)'.format(index.path if existed else 'none', len(index.files)), file=vs)
   for i in range(min(12, len(loader.nodes))):
     n = loader.nodes[i]
     print('{} {} {}'.format(i, 'R' if n['resolved'] else '?', n['name']), file=vs)
 
 
+def run_backlinks(vs, root):
+  index, existed = open_index()
+  if not existed:
+    # First use: index the vault once instead of reading it for one answer.
+    link_index.build(VAULT_ROOT, vs)
+    index, existed = open_index()
+  for path in index.backlinks(root):
+    print(path, file=vs)
+  try:
+    index.save()
+  except OSError:
+    pass
+
+
+def _bench_ticks():
+  try:
+    return time.ticks_us()
+  except AttributeError:
+    return int(time.time() * 1000000)
+
+
+def _bench_layout(n):
+  # A settled-looking layout: n nodes on a sunflower spiral about 16 px apart,
+  # root in the middle, in the same fixed point as layout_step.
+  x = array.array('i', bytearray(4 * n))
+  y = array.array('i', bytearray(4 * n))
+  for i in range(1, n):
+    r = 9.0 * math.sqrt(i)
+    a = i * 2.399963
+    x[i] = int(math.cos(a) * r * _LAYOUT_SCALE)
+    y[i] = int(math.sin(a) * r * _LAYOUT_SCALE)
+  return x, y
+
+
+def run_bench(vs, sizes=(90, 500, 2000), budget_ms=3000):
+  # Frame time of each repulsion engine at each size, and how far the
+  # approximate one strays from the exact forces (mean |dv| / mean |v|).
+  print('repulsion per frame, {}'.format('viper' if _have_viper else 'python'), file=vs)
+  print('{:>6} {:>10} {:>10} {:>10} {:>8}'.format('nodes', 'pairs ms', 'grid ms', 'approx ms', 'err %'), file=vs)
+  for n in sizes:
+    x, y = _bench_layout(n)
+    row = [n]
+    result = {}
+    for mode in ('pairs', 'grid', 'approx'):
+      work = None
+      frames = 0
+      total = 0
+      while frames < 1 or (frames < 20 and total < budget_ms * 1000):
+        vx = array.array('i', bytearray(4 * n))
+        vy = array.array('i', bytearray(4 * n))
+        t = _bench_ticks()
+        work = _layout_repulse(mode, x, y, vx, vy, n, work)
+        total += _bench_ticks() - t
+        frames += 1
+      result[mode] = (vx, vy)
+      row.append(total / frames / 1000.0)
+    ex, ey = result['pairs']
+    ax, ay = result['approx']
+    err = 0
+    mag = 0
+    for i in range(n):
+      err += abs(ax[i] - ex[i]) + abs(ay[i] - ey[i])
+      mag += abs(ex[i]) + abs(ey[i])
+    row.append(100.0 * err / mag if mag else 0.0)
+    if result['grid'] != result['pairs']:
+      row.append('grid differs!')
+    print('{:>6} {:>10.1f} {:>10.1f} {:>10.1f} {:>8.1f} {}'.format(*(row + [''])[:6]), file=vs)
+
+
 class VsArgumentParser(argparse.ArgumentParser):
   def __init__(self, vs):
     self._vs = vs
@@ -1819,6 +2254,9 @@ def normalize_cli_args(argv):
     elif a.startswith('--max-nodes='):
       out.append('--max-nodes')
       out.append(a[12:])
+    elif a.startswith('--layout='):
+      out.append('--layout')
+      out.append(a[9:])
     elif a.startswith('--depth='):
       out.append('--depth')
       out.append(a[8:])
@@ -1842,11 +2280,31 @@ def main(vs, args):
     default=None,
     help='maximum link depth to traverse (root depth is 0)',
   )
+  parser.add_argument(
+    '--layout',
+    default='auto',
+    help='repulsion engine: auto, pairs (all pairs), grid (exact, bucketed) or approx',
+  )
   parser.add_argument(
     '--test',
     action='store_true',
     help='run loader test instead of opening the UI',
   )
+  parser.add_argument(
+    '--bench',
+    action='store_true',
+    help='time the repulsion engines at 90, 500 and 2000 nodes',
+  )
+  parser.add_argument(
+    '--index',
+    action='store_true',
+    help='create or refresh the link index of the vault and exit',
+  )
+  parser.add_argument(
+    '--backlinks',
+    action='store_true',
+    help='list the notes that link to root and exit',
+  )
 
   try:
     ns = parser.parse_args(normalize_cli_args(args[1:]))
@@ -1857,7 +2315,23 @@ def main(vs, args):
     print('graph: --depth must be >= 0', file=vs)
     return
 
+  if ns.layout not in LAYOUT_MODES:
+    print('graph: --layout must be one of ' + ', '.join(LAYOUT_MODES), file=vs)
+    return
+
+  if ns.bench:
+    run_bench(vs)
+    return
+
+  if ns.index:
+    link_index.build(VAULT_ROOT, vs)
+    return
+
   root = resolve_root(ns.root)
+  if ns.backlinks:
+    run_backlinks(vs, root)
+    return
+
   if ns.test:
     run_test(vs, root, max_depth=ns.depth)
     return
@@ -1867,7 +2341,7 @@ def main(vs, args):
   v.print(el.erase_screen())
   v.print(el.home())
   v.print(el.display_mode(False))
-  app = GraphApp(vs, root, max_nodes=ns.max_nodes, max_depth=ns.depth)
+  app = GraphApp(vs, root, max_nodes=ns.max_nodes, max_depth=ns.depth, layout=ns.layout)
   app.loop()
   v.print(el.display_mode(True))
   print('Graph finished.', file=vs)
@@ -3,6 +3,7 @@ import sys
 import argparse
 import esclib as elib
 import re
+import dir_cache
 
 el = elib.esclib()
 
@@ -10,21 +11,19 @@ def print_vs():
   pass
 
 def _is_dir(path):
-  try:
-    st = os.stat(path)[0]
-    return (st & 0x4000) != 0
-  except Exception:
-    return False
+  return dir_cache.is_dir(path)
 
 def _iter_dir(path):
-  for name in os.listdir(path):
+  # (full path, name, is_dir) of each entry, from the shared listing cache.
+  for e in dir_cache.entries(path):
+    name = e[dir_cache.NAME]
     if path == "/" or path.endswith("/"):
       full = path + name
     elif path == ".":
       full = name
     else:
       full = path + "/" + name
-    yield full, name
+    yield full, name, e[dir_cache.IS_DIR]
 
 def _bre_compat(pattern):
   # GNU grep's default dialect (BRE) writes alternation/groups as \| \( \).
@@ -50,13 +49,190 @@ def _bre_compat(pattern):
     i += 1
   return ''.join(out)
 
-def _match_line(line, pat, ignore_case, regex):
+def _required_literal(p):
+  # Longest run of plain characters that every match of regex `p` (re
+  # dialect) must contain, or '' if there is none we can be sure of. Used to
+  # skip lines with bytes.find before running the regex. Anything inside a
+  # group, a class, an escape like \d, or a char made optional by ? * {..}
+  # breaks the run; a top-level | means no single literal is required.
+  best = ''
+  run = []
+  depth = 0
+  i = 0
+  n = len(p)
+  while i < n:
+    c = p[i]
+    lit = None
+    if c == '\\' and i + 1 < n:
+      nxt = p[i + 1]
+      i += 2
+      if nxt == 'n':
+        lit = '\n'
+      elif nxt == 't':
+        lit = '\t'
+      elif not (nxt.isalpha() or nxt.isdigit()):
+        lit = nxt
+      else:
+        # Any other escape ends the run, together with its argument: the
+        # digits of \xhh, \uhhhh, \Uhhhhhhhh, an octal \0oo or a backref
+        # \12, and \N{name}.
+        k = {'x': 2, 'u': 4, 'U': 8}.get(nxt, 2 if nxt.isdigit() else 0)
+        if nxt == 'N' and i < n and p[i] == '{':
+          j = p.find('}', i)
+          i = n if j == -1 else j + 1
+        digits = '0123456789abcdefABCDEF' if nxt in 'xuU' else '0123456789'
+        while k and i < n and p[i] in digits:
+          i += 1
+          k -= 1
+    elif c == '[':
+      j = i + 1
+      if j < n and p[j] == '^':
+        j += 1
+      if j < n and p[j] == ']':
+        j += 1
+      while j < n and p[j] != ']':
+        if p[j] == '\\':
+          j += 1
+        j += 1
+      i = j + 1
+    elif c == '{':
+      j = p.find('}', i)
+      i = n if j == -1 else j + 1
+    elif c == '|' and depth == 0:
+      return ''
+    else:
+      if c == '(':
+        depth += 1
+      elif c == ')':
+        depth -= 1
+      elif c not in '.^$*?+|':
+        lit = c
+      i += 1
+    q = p[i] if i < n else ''
+    if lit is not None and depth == 0 and not (q and q in '*?{'):
+      run.append(lit)
+      if q != '+':
+        continue
+    if len(run) > len(best):
+      best = ''.join(run)
+    run = []
+  if len(run) > len(best):
+    best = ''.join(run)
+  return best
+
+def _compile_patterns(patterns, ignore_case, regex, out):
+  # One (literal, compiled) pair per pattern: `literal` is the str a matching
+  # line must contain ('' if unknown), `compiled` a re object or None for a
+  # plain substring match on `literal`.
+  compiled = []
+  for pattern in patterns:
+    pat_src = pattern.lower() if ignore_case else pattern
+    # Linux-like default: pattern is a regex. MicroPython's `re` is a limited
+    # subset, so if the pattern can't compile, fall back to literal substring
+    # search instead of raising (which would waste a caller's retry/tokens).
+    if regex:
+      src = _bre_compat(pat_src)
+      try:
+        compiled.append((_required_literal(src), re.compile(src)))
+        continue
+      except Exception:
+        out.write("grep: unsupported regex, falling back to literal match "
+                  "(supported: . [] ^ $ ? * + | () \\d \\s \\w; "
+                  "not: {m,n}, \\b, lookarounds)\n")
+    compiled.append((pat_src, None))
+  return compiled
+
+def _match_line(line, compiled, ignore_case):
   if ignore_case:
     line = line.lower()
-  
-  if regex:
-    return pat.search(line)
-  return pat in line
+  for lit, pat in compiled:
+    if lit and lit not in line:
+      continue
+    if pat is None or pat.search(line):
+      return True
+  return False
+
+# Files are read in binary blocks of this size (cut back to a line end).
+_BLOCK = 16384
+
+def _read_blocks(f):
+  # Blocks of whole lines from binary file f; only the last may lack a '\n'.
+  # A NUL byte in the first block means a binary file: raise, and the file is
+  # skipped as it was when text-mode reading failed on it.
+  carry = b''
+  first = True
+  while True:
+    data = f.read(_BLOCK)
+    if first and b'\x00' in data:
+      raise ValueError('binary file')
+    first = False
+    if not data:
+      if carry:
+        yield carry
+      return
+    if carry:
+      data = carry + data
+    cut = data.rfind(b'\n')
+    if cut == -1:
+      carry = data
+      continue
+    carry = data[cut + 1:]
+    yield data[:cut + 1]
+
+def _decode(b):
+  # Line bytes to str, or None if not UTF-8. A CRLF line loses its '\r'.
+  if b[-1:] == b'\r':
+    b = b[:-1]
+  try:
+    return str(b, 'utf-8')
+  except Exception:
+    return None
+
+def _all_lines(blocks):
+  # (line number, text) for every line; undecodable lines are skipped.
+  ln = 0
+  for buf in blocks:
+    lines = buf.split(b'\n')
+    if lines[-1] == b'':
+      lines.pop()
+    for b in lines:
+      ln += 1
+      s = _decode(b)
+      if s is not None:
+        yield ln, s
+
+def _candidate_lines(blocks, needles, ignore_case):
+  # Like _all_lines, but only the lines containing one of `needles` (bytes),
+  # found with bytes.find on the whole block. Lines in between are neither
+  # split out nor decoded.
+  ln = 0
+  for buf in blocks:
+    hay = buf.lower() if ignore_case else buf
+    pos = 0   # lines before pos have been counted into ln
+    end = len(hay)
+    while pos < end:
+      hit = -1
+      for nd in needles:
+        i = hay.find(nd, pos)
+        if i != -1 and (hit == -1 or i < hit):
+          hit = i
+      if hit == -1:
+        break
+      ls = hay.rfind(b'\n', pos, hit) + 1
+      if ls == 0:
+        ls = pos
+      le = hay.find(b'\n', hit)
+      if le == -1:
+        le = end
+      ln += hay.count(b'\n', pos, ls) + 1
+      s = _decode(buf[ls:le])
+      if s is not None:
+        yield ln, s
+      pos = le + 1
+    if pos < end:
+      ln += hay.count(b'\n', pos, end)
+      if buf[-1:] != b'\n':
+        ln += 1
 
 def _file_size(path):
   try:
@@ -68,7 +244,13 @@ def grep_path(pattern, path=".", recursive=False, show_line_numbers=False,
               ignore_case=False, list_files_only=False, includes=None,
               max_bytes=None, out=None, regex=True, invert=False,
               after=0, before=0, count_only=False, max_count=None,
-              no_filename=False, stdin_text=None):
+              no_filename=False, stdin_text=None, use_index=True, hits=None,
+              stdin_sink=False):
+  # pattern is one pattern or a list of them (a line matches if any does).
+  # With stdin_sink, nothing is searched: the result is a generator to send
+  # piped stdin lines to (pstdin's pipe() protocol).
+  # With `hits` (a list), matching lines are appended to it as (path, line
+  # number, text) instead of being written to out.
   if out is None:
     out = sys.stdout
   if includes is None:
@@ -76,22 +258,47 @@ def grep_path(pattern, path=".", recursive=False, show_line_numbers=False,
   else:
     includes = includes.split(',')
 
-  pat_src = pattern.lower() if ignore_case else pattern
-  # Linux-like default: pattern is a regex. MicroPython's `re` is a limited
-  # subset, so if the pattern can't compile, fall back to literal substring
-  # search instead of raising (which would waste a caller's retry/tokens).
-  use_regex = regex
-  if use_regex:
+  patterns = [pattern] if isinstance(pattern, str) else pattern
+  compiled = _compile_patterns(patterns, ignore_case, regex, out)
+  # Lines without any required literal can be skipped unread when the output
+  # only needs matching lines. Non-ASCII literals are not folded by
+  # bytes.lower(), so -i with those checks every line.
+  needles = []
+  for lit, _pat in compiled:
+    b = lit.encode('utf-8')
+    if not lit or (ignore_case and len(b) != len(lit)):
+      needles = None
+      break
+    needles.append(b)
+  prefilter = needles is not None and not invert and not after and not before
+
+  # A trigram index over the search path (grep --index) rules out files that
+  # cannot contain a needle. Only used when files without a hit print nothing.
+  tidx = None
+  cand = None
+  piped = stdin_text is not None or stdin_sink
+  if use_index and needles and not invert and not count_only and not piped:
     try:
-      pat = re.compile(_bre_compat(pat_src))
+      import trigram_index
+      tidx = trigram_index.find(path)
+      if tidx is not None:
+        cand = tidx.lookup(needles)
+        if cand is None:
+          tidx = None
     except Exception:
-      out.write("grep: unsupported regex, falling back to literal match "
-                "(supported: . [] ^ $ ? * + | () \\d \\s \\w; "
-                "not: {m,n}, \\b, lookarounds)\n")
-      pat = pat_src
-      use_regex = False
-  else:
-    pat = pat_src
+      tidx = None
+
+  def indexed_out(fp):
+    # True if the index shows fp (unchanged since indexing) has no needle.
+    rel = dir_cache.relpath(tidx.root, dir_cache.abspath(fp))
+    if rel is None:
+      return False
+    try:
+      st = os.stat(fp)
+    except OSError:
+      return False
+    fid = tidx.fresh(rel, st[6], st[8])
+    return fid is not None and fid not in cand
 
   def allowed_file(p):
     #if p != 'tasks.md':
@@ -115,6 +322,10 @@ def grep_path(pattern, path=".", recursive=False, show_line_numbers=False,
   def emit(fp, ln, s, is_match):
     # Match lines use ':' separators, context lines '-' (like real grep).
     # fp is None for piped stdin, which carries no filename to prefix.
+    if hits is not None:
+      if is_match:
+        hits.append((fp, ln, s))
+      return
     sep = ":" if is_match else "-"
     if no_filename or fp is None:
       if show_line_numbers:
@@ -126,19 +337,23 @@ def grep_path(pattern, path=".", recursive=False, show_line_numbers=False,
     else:
       out.write("{}{}{}{} {}\n".format(el.set_font_color(1), fp, el.reset_font_color(), sep, s))
 
-  # Scan an iterable of lines. fp is the display name for output prefixes, or
-  # None for piped stdin (no filename shown). Used for both files and stdin.
-  def scan_lines(fp, line_source):
+  # Scan (line number, text) pairs sent to this generator, then None. fp is
+  # the display name for output prefixes, or None for piped stdin (no
+  # filename shown). The generator returns (StopIteration value) whether
+  # anything matched, and returns early once -l or -m has nothing more to
+  # print. Used for both files and stdin.
+  def scan_sink(fp):
     matched_this_file = False
     count = 0
     before_buf = []   # (ln, text) of the last `before` lines not yet printed
     after_left = 0    # context lines still owed after the last match
     last_printed = 0  # line number of the last written line (for '--' gaps)
-    ln = 0
-    for line in line_source:
-      ln += 1
-      s = line.rstrip("\n")
-      hit = bool(_match_line(s, pat, ignore_case, use_regex))
+    while True:
+      item = yield
+      if item is None:
+        break
+      ln, s = item
+      hit = _match_line(s, compiled, ignore_case)
       if invert:
         hit = not hit
       if hit and (max_count is None or count < max_count):
@@ -176,19 +391,55 @@ def grep_path(pattern, path=".", recursive=False, show_line_numbers=False,
         out.write("{}{}{}: {}\n".format(el.set_font_color(1), fp, el.reset_font_color(), count))
     return matched_this_file
 
+  # Feed an iterable of (line number, text) through scan_sink.
+  def scan_lines(fp, line_source):
+    sink = scan_sink(fp)
+    next(sink)
+    try:
+      for item in line_source:
+        sink.send(item)
+      sink.send(None)
+    except StopIteration as e:
+      return e.value
+    return False
+
+  # Streaming piped stdin (see pstdin): raw lines in, numbered here.
+  def stdin_scan():
+    sink = scan_sink(None)
+    next(sink)
+    ln = 0
+    try:
+      while True:
+        line = yield
+        if line is None:
+          break
+        ln += 1
+        if line[-1:] == "\n":
+          line = line[:-1]
+        if line[-1:] == "\r":
+          line = line[:-1]
+        sink.send((ln, line))
+      sink.send(None)
+    except StopIteration:
+      pass
+
   def scan_file(fp):
     if not allowed_file(fp):
       return False
+    if tidx is not None and indexed_out(fp):
+      return False
     try:
-      with open(fp, "r") as f:
-        return scan_lines(fp, f)
+      with open(fp, "rb") as f:
+        if prefilter:
+          return scan_lines(fp, _candidate_lines(_read_blocks(f), needles, ignore_case))
+        return scan_lines(fp, _all_lines(_read_blocks(f)))
     except Exception:
       return False
 
   def walk(p):
     if _is_dir(p):
-      for full, _name in _iter_dir(p):
-        if _is_dir(full):
+      for full, _name, is_dir in _iter_dir(p):
+        if is_dir:
           if recursive:
             walk(full)
         else:
@@ -196,25 +447,41 @@ def grep_path(pattern, path=".", recursive=False, show_line_numbers=False,
     else:
       scan_file(p)
 
+  if stdin_sink:
+    return stdin_scan()
+
   if stdin_text is not None:
     try:
-      scan_lines(None, iter(stdin_text.splitlines()))
+      lines = stdin_text.splitlines()
+      scan_lines(None, zip(range(1, len(lines) + 1), lines))
     except Exception:
       pass
     return
 
   walk(path)
 
+def find_in_files(pattern, path=".", ignore_case=False, regex=False):
+  # (path, line number, text) of every line under path matching pattern --
+  # grep -r for callers that want the hits, not printed output (pem's M-.
+  # looks up definitions in other files with this).
+  hits = []
+  grep_path(pattern, path=path, recursive=True, ignore_case=ignore_case,
+            regex=regex, hits=hits)
+  return hits
+
 def build_parser():
   parser = argparse.ArgumentParser(
     description="Simple grep implementation for MicroPython"
   )
-  parser.add_argument("pattern", help="Search pattern")
+  parser.add_argument("pattern", nargs="?", help="Search pattern (omit when using -e or --index)")
   parser.add_argument("path", nargs="*", help="Files or directories to search (default: .)")
   parser.add_argument("-r", "-R", "--recursive", action="store_true", help="Recursive search")
   # Pattern is a regex by default (Linux-like). -E is accepted as an alias and
-  # -e is kept for backward compatibility; both are no-ops now. Use -F for literal.
-  parser.add_argument("-e", "-E", "--regex", action="store_true", help="(default) treat pattern as a regex")
+  # is a no-op. -e gives a pattern, and may be repeated to match any of several
+  # in one pass. Use -F for literal.
+  parser.add_argument("-e", "--regexp", action="append", dest="patterns", metavar="PATTERN",
+                      help="Pattern to search for (repeat for several)")
+  parser.add_argument("-E", "--regex", action="store_true", help="(default) treat pattern as a regex")
   parser.add_argument("-F", "--fixed-strings", action="store_true", dest="fixed", help="Treat pattern as a literal string, not a regex")
   parser.add_argument("-v", "--invert-match", action="store_true", dest="invert", help="Select non-matching lines")
   parser.add_argument("-n", action="store_true", dest="show_line_numbers", help="Show line numbers")
@@ -239,6 +506,10 @@ def build_parser():
     default=None,
     help="Only search files with this extension (comma separated for multiple extensions)"
   )
+  parser.add_argument("--index", action="store_true", dest="build_index",
+                      help="Build or refresh the trigram index of the given directories")
+  parser.add_argument("--no-index", action="store_true", dest="no_index",
+                      help="Do not use a trigram index; read every file")
   parser.add_argument(
     "--max",
     type=int,
@@ -248,6 +519,54 @@ def build_parser():
   )
   return parser
 
+def _context(args):
+  # -C sets both sides; explicit -A/-B may extend one side further.
+  after = args.after or 0
+  before = args.before or 0
+  if args.context:
+    after = max(after, args.context)
+    before = max(before, args.context)
+  return after, before
+
+def _patterns_paths(args):
+  # With -e the patterns come from the options and every positional is a path.
+  # patterns is None when no pattern was given.
+  patterns = args.patterns
+  paths = args.path
+  if patterns:
+    if args.pattern is not None:
+      paths = [args.pattern] + paths
+  elif args.pattern is not None:
+    patterns = args.pattern
+  return patterns, paths
+
+def pipe(vs, argv):
+  # Streaming stdin entry point (see pstdin): a line sink when grep searches
+  # its input, None to run main() instead.
+  try:
+    args = build_parser().parse_args(argv[1:])
+  except SystemExit:
+    return iter(())   # usage error already shown: take no input
+  patterns, paths = _patterns_paths(args)
+  if args.build_index or patterns is None or (paths and paths != ["-"]):
+    return None
+  after, before = _context(args)
+  return grep_path(
+    patterns,
+    show_line_numbers=args.show_line_numbers,
+    ignore_case=args.ignore_case,
+    list_files_only=args.list_files_only,
+    out=vs,
+    regex=not args.fixed,
+    invert=args.invert,
+    after=after,
+    before=before,
+    count_only=args.count_only,
+    max_count=args.max_count,
+    no_filename=args.no_filename,
+    stdin_sink=True
+  )
+
 def main(vs, argv):
   parser = build_parser()
 
@@ -256,23 +575,33 @@ def main(vs, argv):
   except SystemExit:
     return 2
 
-  # -C sets both sides; explicit -A/-B may extend one side further.
-  after = args.after or 0
-  before = args.before or 0
-  if args.context:
-    after = max(after, args.context)
-    before = max(before, args.context)
+  after, before = _context(args)
+
+  # --index: (re)build the index of each directory given (default: cwd).
+  if args.build_index:
+    import trigram_index
+    paths = ([args.pattern] if args.pattern is not None else []) + args.path
+    for p in (paths if paths else ["."]):
+      trigram_index.build(p, vs)
+    return 0
+
+  patterns, paths = _patterns_paths(args)
+  if patterns is None:
+    try:
+      parser.error("no pattern given")
+    except SystemExit:
+      pass
+    return 2
 
   # No path (or an explicit '-') plus piped stdin from the shell: search that
   # instead of the filesystem. Without piped input, keep the Linux-unlike but
   # long-standing default of searching the cwd so interactive `grep pattern`
   # behaves as before.
-  paths = args.path
   if not paths or paths == ["-"]:
     import pstdin
     if pstdin.has():
       grep_path(
-        args.pattern,
+        patterns,
         show_line_numbers=args.show_line_numbers,
         ignore_case=args.ignore_case,
         list_files_only=args.list_files_only,
@@ -291,7 +620,7 @@ def main(vs, argv):
   paths = paths if paths else ["."]
   for p in paths:
     grep_path(
-      args.pattern,
+      patterns,
       path=p,
       recursive=args.recursive,
       show_line_numbers=args.show_line_numbers,
@@ -306,7 +635,8 @@ def main(vs, argv):
       before=before,
       count_only=args.count_only,
       max_count=args.max_count,
-      no_filename=args.no_filename
+      no_filename=args.no_filename,
+      use_index=not args.no_index
     )
   return 0
 
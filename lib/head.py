@@ -17,6 +17,8 @@ def _head_bytes(vs, data, n):
 
 
 def _head_lines(vs, lines, n):
+  if n <= 0:
+    return 0
   count = 0
   for line in lines:
     print(line.rstrip('\n'), file=vs)
@@ -26,6 +28,34 @@ def _head_lines(vs, lines, n):
   return 0
 
 
+def _head_bytes_sink(vs, n):
+  # Streaming stdin: keep up to n bytes, then stop reading.
+  data = b''
+  while len(data) < n:
+    line = yield
+    if line is None:
+      break
+    data += line.encode('utf-8')
+  _head_bytes(vs, data, n)
+
+
+def _head_lines_sink(vs, n):
+  # Streaming stdin: print lines as they arrive; returning after the n-th
+  # ends the stages feeding it. With n <= 0 it returns before taking any
+  # input, like _head_bytes_sink for -c 0.
+  if n <= 0:
+    return
+  count = 0
+  while True:
+    line = yield
+    if line is None:
+      return
+    print(line.rstrip('\n'), file=vs)
+    count += 1
+    if count >= n:
+      return
+
+
 def _head_file(vs, path, n, nbytes):
   try:
     if nbytes is not None:
@@ -38,15 +68,33 @@ def _head_file(vs, path, n, nbytes):
     return 1
 
 
-def main(vs, args_in):
+def _parse(args_in):
   parser = argparse.ArgumentParser(description='print first lines of files')
   parser.add_argument('-n', type=int, default=10, help='number of lines')
   parser.add_argument('-c', type=int, default=None, help='number of bytes')
   parser.add_argument('files', nargs='*', help='file paths')
-
   try:
-    args = parser.parse_args(args_in[1:])
+    return parser.parse_args(args_in[1:])
   except SystemExit:
+    return None
+
+
+def pipe(vs, args_in):
+  # Streaming stdin entry point (see pstdin): a line sink, or None to run
+  # main() instead.
+  args = _parse(args_in)
+  if args is None:
+    return iter(())   # usage error already shown: take no input
+  if args.files and args.files != ['-']:
+    return None
+  if args.c is not None:
+    return _head_bytes_sink(vs, args.c)
+  return _head_lines_sink(vs, args.n)
+
+
+def main(vs, args_in):
+  args = _parse(args_in)
+  if args is None:
     return
 
   # No file (or '-'): read piped stdin if the shell provided any.
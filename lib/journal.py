@@ -4,6 +4,7 @@ import re
 import datetime
 import time
 import math
+import ujson
 import mouse
 import esclib as elib
 import pdeck
@@ -14,6 +15,13 @@ import anm
 
 DAY_SEC = 60 * 60 * 24
 
+# Parsed entries of every journal file, with the size/mtime they were parsed
+# at; see JournalCache._cache_entry.
+JOURNAL_CACHE_FILE = '/config/journal_cache.json'
+JOURNAL_CACHE_VERSION = 1
+# Bytes hashed at the start and end of a file to tell an append from an edit.
+STAMP_BYTES = 256
+
 
 def file_exists(name):
   if name is None:
@@ -186,8 +194,57 @@ def iso_month_key(d):
   return '%04d-%02d' % (d[0], d[1])
 
 
+def hash_bytes(b):
+  h = 5381
+  for c in b:
+    h = (h * 33 + c) & 0xffffffff
+  return h
+
+
+def file_stamp(fh, size):
+  # (head hash, tail hash, ends with newline) of the first `size` bytes of
+  # binary file fh.
+  fh.seek(0)
+  head = fh.read(min(size, STAMP_BYTES))
+  fh.seek(max(0, size - STAMP_BYTES))
+  tail = fh.read(min(size, STAMP_BYTES))
+  return hash_bytes(head), hash_bytes(tail), tail[-1:] == b'\n'
+
+
+def load_journal_cache():
+  # {filename: entry}; empty if there is no cache or it is from another
+  # version of the format.
+  try:
+    with open(JOURNAL_CACHE_FILE, 'r') as f:
+      data = ujson.load(f)
+    if isinstance(data, dict) and data.get('version') == JOURNAL_CACHE_VERSION:
+      return data['files']
+  except Exception:
+    pass
+  return {}
+
+
+def save_journal_cache(files):
+  try:
+    with open(JOURNAL_CACHE_FILE, 'w') as f:
+      ujson.dump({'version': JOURNAL_CACHE_VERSION, 'files': files}, f)
+  except Exception:
+    pass
+
+
+def _date_or_none(v):
+  return tuple(v) if v else None
+
+
+def _copy_tasks(tasks):
+  out = {}
+  for task in tasks:
+    out[task] = dict(tasks[task])
+  return out
+
+
 class JournalCache:
-  def __init__(self, inputs):
+  def __init__(self, inputs, use_cache = True):
     self.month_list = (
       '', 'January', 'Febrary', 'March', 'April',
       'May', 'June', 'July', 'August', 'September',
@@ -196,6 +253,7 @@ class JournalCache:
     self.re_date = re.compile('^(\\#+)\\s+<(.+)>')
     self.re_item = re.compile('^-\\s*\[(.+)\]\\s+(.+)')
     self.filenames = expand_input_files(inputs)
+    self.use_cache = use_cache
     self.reset()
 
   def reset(self):
@@ -209,29 +267,107 @@ class JournalCache:
     self.loading = False
     self.done = False
     self._states = []
+    self._disk_cache = load_journal_cache() if self.use_cache else {}
+    self._cache_dirty = False
 
     for filename in self.filenames:
       try:
         st = os.stat(filename)
         size = st[6]
+        mtime = st[8]
       except Exception:
         size = 0
+        mtime = 0
       self.total_bytes += size
-      self._states.append({
+      state = {
         'filename': filename,
         'size': size,
+        'mtime': mtime,
         'fh': None,
+        'pos': 0,
         'done': False,
         'curdate': None,
         'first_date': None,
+        'latest': None,
         'default_date': parse_default_date_from_filename(filename),
         'reversed_order': 1,
         'reversed_known': False,
-        'pending_entries': []
-      })
+        'pending_entries': [],
+        'n': {},
+        't': {}
+      }
+      self._states.append(state)
+      self._restore_cached(state, self._disk_cache.get(filename))
 
-    self.loading = len(self._states) > 0
-    self.done = len(self._states) == 0
+    self.loading = not self._all_done()
+    self.done = not self.loading
+
+  def _restore_cached(self, state, entry):
+    # Reuse the cached parse of this file: as is if the file is unchanged,
+    # or as the starting point if it only had bytes appended.
+    if not entry:
+      return
+    size = state['size']
+    same = entry['size'] == size and entry['mtime'] == state['mtime']
+    if not same:
+      if size <= entry['size'] or not entry['append_ok']:
+        return
+      try:
+        with open(state['filename'], 'rb') as fh:
+          stamp = file_stamp(fh, entry['size'])
+      except Exception:
+        return
+      if stamp[0] != entry['head'] or stamp[1] != entry['tail']:
+        return
+    r = entry['resume']
+    state['curdate'] = _date_or_none(r['curdate'])
+    state['first_date'] = _date_or_none(r['first_date'])
+    state['reversed_order'] = r['reversed_order']
+    state['reversed_known'] = r['reversed_known']
+    state['pending_entries'] = [(e[0], e[1]) for e in r['pending']]
+    state['latest'] = None
+    self._note_date(state, _date_or_none(entry['latest']))
+    for task in entry['n']:
+      tdata = entry['n'][task]
+      for key in tdata:
+        val = tdata[key]
+        if isinstance(val, list):
+          val = (val[0], val[1])
+        self._put(state, 'n', task, parse_iso_date(key), val)
+    for task in entry['t']:
+      tdata = entry['t'][task]
+      for key in tdata:
+        self._put(state, 't', task, parse_iso_date(key), tdata[key])
+    state['pos'] = entry['size']
+    self.loaded_bytes += entry['size']
+    if same:
+      # Unchanged: only the last block is left, its entries are in the
+      # restored state.
+      self._finish_state(state)
+
+  def _cache_entry(self, state, fh):
+    # Called at the end of a file, before its last block is flushed: the
+    # entries stored so far plus the parser state, so the file can be
+    # restored without reading it, or continued if it grows.
+    head, tail, append_ok = file_stamp(fh, state['pos'])
+    self._disk_cache[state['filename']] = {
+      'size': state['pos'],
+      'mtime': state['mtime'],
+      'head': head,
+      'tail': tail,
+      'append_ok': append_ok,
+      'latest': state['latest'],
+      'resume': {
+        'curdate': state['curdate'],
+        'first_date': state['first_date'],
+        'reversed_order': state['reversed_order'],
+        'reversed_known': state['reversed_known'],
+        'pending': state['pending_entries']
+      },
+      'n': _copy_tasks(state['n']),
+      't': _copy_tasks(state['t'])
+    }
+    self._cache_dirty = True
 
   def progress(self):
     if self.done:
@@ -275,21 +411,36 @@ class JournalCache:
       self.months[month_key]['dirty'] = True
     self.pending_months[month_key] = True
 
-  def _store_numeric(self, task_name, d, fval):
+  def _note_date(self, state, d):
+    if d is None:
+      return
+    if self.latest_date is None or d > self.latest_date:
+      self.latest_date = d
+    if state['latest'] is None or d > state['latest']:
+      state['latest'] = d
+
+  def _put(self, state, kind, task_name, d, val):
+    # Store one entry in the month tables and in the file's own list (what
+    # gets cached). kind is 'n' (numeric) or 't' (text).
     month = self._ensure_month(d)
-    if task_name not in month['n_task_list']:
-      month['n_task_list'][task_name] = {}
+    tasks = month['n_task_list'] if kind == 'n' else month['task_list']
+    if task_name not in tasks:
+      tasks[task_name] = {}
+    key = iso_date_key(d)
+    tasks[task_name][key] = val
+    own = state[kind]
+    if task_name not in own:
+      own[task_name] = {}
+    own[task_name][key] = val
+    self._invalidate_month(iso_month_key(d))
+
+  def _store_numeric(self, state, task_name, d, fval):
     if task_name == 'Weight' and (not isinstance(fval, tuple)) and fval < 100:
       fval *= 2.204
-    month['n_task_list'][task_name][iso_date_key(d)] = fval
-    self._invalidate_month(iso_month_key(d))
+    self._put(state, 'n', task_name, d, fval)
 
-  def _store_text(self, task_name, d, result):
-    month = self._ensure_month(d)
-    if task_name not in month['task_list']:
-      month['task_list'][task_name] = {}
-    month['task_list'][task_name][iso_date_key(d)] = result
-    self._invalidate_month(iso_month_key(d))
+  def _store_text(self, state, task_name, d, result):
+    self._put(state, 't', task_name, d, result)
 
   def _flush_state_block(self, state):
     curdate = state['curdate']
@@ -305,9 +456,9 @@ class JournalCache:
         d = add_days_ymd(curdate, -offset)
         fval = self._parse_value(result)
         if fval is None:
-          self._store_text(task_name, d, result)
+          self._store_text(state, task_name, d, result)
         else:
-          self._store_numeric(task_name, d, fval)
+          self._store_numeric(state, task_name, d, fval)
     state['pending_entries'] = []
 
   def _close_state(self, state):
@@ -334,8 +485,7 @@ class JournalCache:
         newdate = parse_iso_date(date_string[0:10])
         if newdate is None:
           return
-        if self.latest_date is None or newdate > self.latest_date:
-          self.latest_date = newdate
+        self._note_date(state, newdate)
         if state['curdate'] is None:
           state['curdate'] = newdate
           state['first_date'] = newdate
@@ -366,8 +516,7 @@ class JournalCache:
       state['curdate'] = default_date
       if state['first_date'] is None:
         state['first_date'] = default_date
-      if self.latest_date is None or default_date > self.latest_date:
-        self.latest_date = default_date
+      self._note_date(state, default_date)
 
     state['pending_entries'].append((match.group(2), match.group(1)))
 
@@ -403,13 +552,20 @@ class JournalCache:
 
       if state['fh'] is None:
         try:
-          state['fh'] = open(state['filename'], 'r')
+          state['fh'] = open(state['filename'], 'rb')
+          if state['pos']:
+            # Appended to since it was cached: parse only the new bytes.
+            state['fh'].seek(state['pos'])
         except Exception:
           self._close_state(state)
           continue
 
       line = state['fh'].readline()
-      if line == '':
+      if line == b'':
+        try:
+          self._cache_entry(state, state['fh'])
+        except Exception:
+          pass
         self._finish_state(state)
         if self._all_done():
           self.done = True
@@ -420,6 +576,11 @@ class JournalCache:
         continue
 
       self.loaded_bytes += len(line)
+      state['pos'] += len(line)
+      try:
+        line = line.decode('utf-8')
+      except UnicodeError:
+        continue
       self._consume_line(state, line)
       line_count += 1
 
@@ -430,6 +591,10 @@ class JournalCache:
       self.done = True
       self.loading = False
 
+    if self.done and self._cache_dirty and self.use_cache:
+      save_journal_cache(self._disk_cache)
+      self._cache_dirty = False
+
     for month_key in self.pending_months:
       changed[month_key] = True
     self.pending_months = {}
@@ -1243,18 +1408,51 @@ def run_scan(vs, inputs):
       graph['max_label']), file = vs)
 
 
+def _load_months(cache):
+  while not cache.done:
+    cache.step(4000, 150)
+  months = {}
+  for key in cache.months:
+    m = cache.months[key]
+    months[key] = (m['task_list'], m['n_task_list'])
+  return months, cache.latest_date
+
+
+def run_verify(vs, inputs):
+  # Check the entry cache: load through it (updating it as usual), then parse
+  # every file from the start, and compare what the two produced.
+  cached = _load_months(JournalCache(inputs))
+  full = _load_months(JournalCache(inputs, use_cache = False))
+  if cached == full:
+    print('cache ok: %d months' % len(full[0]), file = vs)
+    return True
+  if cached[1] != full[1]:
+    print('latest differs: cached %s, parsed %s' % (cached[1], full[1]), file = vs)
+  for key in sorted(set(cached[0]) | set(full[0])):
+    if cached[0].get(key) != full[0].get(key):
+      print('month %s differs' % key, file = vs)
+  return False
+
+
 def main(vs, args):
   scan_only = False
+  verify = False
   org_filename = []
   for arg in args[1:]:
     if arg == '--scan':
       scan_only = True
+    elif arg == '--verify':
+      verify = True
     else:
       org_filename.append(arg)
 
   if len(org_filename) == 0:
     org_filename = ['/sd/Documents/journal.md']
 
+  if verify:
+    run_verify(vs, org_filename)
+    return
+
   if scan_only:
     run_scan(vs, org_filename)
     return
@@ -4,6 +4,7 @@ import re
 import argparse
 import time
 import pdeck_utils as pu
+import dir_cache
 
 def is_int(s):
   try:
@@ -15,11 +16,7 @@ def is_int(s):
 def _is_dir(path):
   if path == '.':
     return True
-  try:
-    st = os.stat(path)
-    return (st[0] & 0x4000) != 0  # stat.S_IFDIR (MicroPython uses bitmask)
-  except OSError:
-    return False
+  return dir_cache.is_dir(path)
 
 def _join_path(base, name):
   if base == '/':
@@ -55,18 +52,19 @@ def _split_query(q):
 
 def _collect_recursive(dirname, pat, out, reverse=False):
   try:
-    ret = sorted(os.listdir(dirname), reverse=reverse)
+    ret = sorted(dir_cache.entries(dirname), reverse=reverse)
   except Exception:
     return
 
+  # The listing says which entries are directories; no stat per file.
   filelist = []
-  for file in ret:
-    full = _join_path(dirname, file)
+  for e in ret:
+    file = e[dir_cache.NAME]
     match = pat.search(file)
     if match:
       filelist.append(file)
-    if _is_dir(full):
-      _collect_recursive(full, pat, out, reverse)
+    if e[dir_cache.IS_DIR]:
+      _collect_recursive(_join_path(dirname, file), pat, out, reverse)
 
   if len(filelist) > 0:
     out.append([dirname, filelist])
@@ -81,7 +79,7 @@ def list_file(q, recursive=False, reverse=False):
   dirname, filename, original = _split_query(q)
   try:
     if not _is_dir(original):
-      os.listdir(dirname)
+      dir_cache.entries(dirname)
   except Exception:
     print("Directory not found")
     return
@@ -96,7 +94,7 @@ def list_file(q, recursive=False, reverse=False):
     return out
 
   try:
-    ret = os.listdir(dirname)
+    ret = dir_cache.listdir(dirname)
   except Exception:
     print("Directory not found")
     return
@@ -115,12 +113,26 @@ def list_file(q, recursive=False, reverse=False):
 def _print_group(vs, dirname, filelist, detailed):
   print(f'File in {dirname}:', file=vs)
 
+  ents = {}
+  if detailed:
+    try:
+      for e in dir_cache.entries(dirname):
+        ents[e[dir_cache.NAME]] = e
+    except OSError:
+      pass
+
   for i, item in enumerate(filelist):
     if detailed:
-      st = os.stat(_join_path(dirname, item))
-      t = time.localtime(st[7]+pu.timezone*15*60)
-      dirmark = '[Dir]' if st[0]&0x4000 != 0 else ''
-      print(f'{i}: {dirmark} {item} {st[6]:,} {month_list[t[1]][:3]} {t[2]}, {t[0]} {t[3]:02}:{t[4]:02}:{t[5]:02}', file=vs)
+      e = ents.get(item)
+      if e is None:
+        st = os.stat(_join_path(dirname, item))
+        is_dir, size, mtime = st[0]&0x4000 != 0, st[6], st[7]
+      else:
+        is_dir, size = e[dir_cache.IS_DIR], e[dir_cache.SIZE]
+        mtime = dir_cache.mtime(dirname, e)
+      t = time.localtime(mtime+pu.timezone*15*60)
+      dirmark = '[Dir]' if is_dir else ''
+      print(f'{i}: {dirmark} {item} {size:,} {month_list[t[1]][:3]} {t[2]}, {t[0]} {t[3]:02}:{t[4]:02}:{t[5]:02}', file=vs)
     else:
       print(f'{item} ', end='', file=vs)
 
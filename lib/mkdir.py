@@ -1,5 +1,6 @@
 import pdeck
 import os
+import dir_cache
 def file_exists(name):
   if name == None:
     return False
@@ -18,6 +19,7 @@ def main(vs,args):
       print(f"{args[1]} Exists", file=vs)
     else:
       os.mkdir(args[1])
+      dir_cache.invalidate(args[1])
       print("Directry created", file = vs)
   except Exception as e:
     print("Error in makedir", file=vs)
@@ -1,6 +1,7 @@
 import pdeck
 import os
 import cpmv
+import dir_cache
 
 def main(vs,args):
   if len(args) != 3:
@@ -12,6 +13,8 @@ def main(vs,args):
   src, dst = ret
   print(f"{src} => {dst}", file=vs)
   os.rename(src, dst)    
+  dir_cache.invalidate(src)
+  dir_cache.invalidate(dst)
   os.sync()
   print("Renamed", file = vs)
 
@@ -0,0 +1,275 @@
+#
+# dir_cache -- process-wide cache of directory listings with file metadata
+# Copyright Nunomo LLC
+#
+# TAB completion, ls, grep -r and sync all list directories and then stat
+# every entry to tell files from directories (and for size/mtime). On the SD
+# card (FAT over SPI) each stat is a directory scan of its own, so a TAB in a
+# folder of a few hundred files, or a second `grep -r` over the same tree,
+# spends most of its time re-reading the same directory entries.
+#
+# This module keeps, per absolute directory path, the list of entries as
+# [name, is_dir, size, mtime]. It is filled with one os.ilistdir() pass where
+# available (MicroPython: type and size come with the listing; mtime is not,
+# so it is stat'ed lazily the first time someone asks for it), os.scandir()
+# on the PC, and listdir + stat otherwise.
+#
+# Commands that change the tree (cp, mv, rm, mkdir, rmdir, pem's save, the
+# gpt file tools) call invalidate() on what they touched. Anything else that
+# writes files is covered by MAX_AGE_MS: a listing older than that is read
+# again, so the cache is never stale for long. Users of the cache should not
+# rely on it where a stale answer is harmful (grep's index freshness check
+# still stats the file itself).
+#
+# The path helpers here (abspath, join, relpath, ms, scan_tree, find_index)
+# are also what the on-disk indexes, trigram_index and link_index, walk and
+# look up their trees with.
+
+import os
+import time
+
+# A listing is re-read after this long even without invalidate().
+MAX_AGE_MS = 30000
+
+# Memory bound: past this many cached entries the whole cache is dropped.
+MAX_ENTRIES = 4000
+
+# Entry fields.
+NAME = 0
+IS_DIR = 1
+SIZE = 2
+MTIME = 3
+
+_dirs = {}      # abs dir path -> (ticks_ms when read, [entry, ...])
+_count = 0      # entries held in _dirs
+
+
+def ms():
+  # Milliseconds; time.ticks_ms is MicroPython only.
+  try:
+    return time.ticks_ms()
+  except AttributeError:
+    return int(time.time() * 1000)
+
+
+def _age(t):
+  try:
+    return time.ticks_diff(ms(), t)
+  except AttributeError:
+    return ms() - t
+
+
+def abspath(path):
+  # Absolute, normalized path ('.' and '..' resolved). No os.path here.
+  if not path.startswith('/'):
+    cwd = os.getcwd()
+    path = cwd + ('' if cwd.endswith('/') else '/') + path
+  out = []
+  for part in path.split('/'):
+    if part == '' or part == '.':
+      continue
+    if part == '..':
+      if out:
+        out.pop()
+      continue
+    out.append(part)
+  return '/' + '/'.join(out)
+
+
+def join(base, name):
+  if not base or base == '/':
+    return '/' + name
+  return base + name if base.endswith('/') else base + '/' + name
+
+
+def _split(p):
+  # (parent, name) of an absolute path; ('/', '') for the root.
+  i = p.rfind('/')
+  return (p[:i] if i > 0 else '/'), p[i + 1:]
+
+
+def relpath(root, abs_path):
+  # abs_path relative to directory `root` (both absolute and normalized), or
+  # None if it is not below root.
+  if root == '/':
+    return abs_path[1:]
+  if abs_path.startswith(root + '/'):
+    return abs_path[len(root) + 1:]
+  return None
+
+
+def _read(p):
+  # Entries of directory p straight from the filesystem (OSError if missing).
+  out = []
+  if hasattr(os, 'ilistdir'):
+    for t in os.ilistdir(p):
+      # (name, type, inode[, size]); size is missing on some ports.
+      size = t[3] if len(t) > 3 else -1
+      out.append([t[0], (t[1] & 0x4000) != 0, size, None])
+  elif hasattr(os, 'scandir'):
+    with os.scandir(p) as it:
+      for e in it:
+        try:
+          st = e.stat()
+          out.append([e.name, e.is_dir(), st.st_size, int(st.st_mtime)])
+        except OSError:
+          out.append([e.name, False, -1, None])
+  else:
+    for name in os.listdir(p):
+      try:
+        st = os.stat(join(p, name))
+        out.append([name, (st[0] & 0x4000) != 0, st[6], st[8]])
+      except OSError:
+        out.append([name, False, -1, None])
+  return out
+
+
+def _lookup(p):
+  # Cached entries of abs dir p, or None if not cached (or too old).
+  hit = _dirs.get(p)
+  if hit is None:
+    return None
+  if _age(hit[0]) > MAX_AGE_MS:
+    _drop(p)
+    return None
+  return hit[1]
+
+
+def _drop(p):
+  global _count
+  hit = _dirs.pop(p, None)
+  if hit is not None:
+    _count -= len(hit[1])
+
+
+def entries(path):
+  """Entries [name, is_dir, size, mtime] of directory `path`, unsorted.
+  mtime may be None (see mtime()). Raises OSError like os.listdir().
+  The lists are shared: don't modify them."""
+  global _count
+  p = abspath(path)
+  ents = _lookup(p)
+  if ents is not None:
+    return ents
+  ents = _read(p)
+  if _count + len(ents) > MAX_ENTRIES:
+    clear()
+  _dirs[p] = (ms(), ents)
+  _count += len(ents)
+  return ents
+
+
+def listdir(path):
+  """os.listdir() through the cache."""
+  return [e[NAME] for e in entries(path)]
+
+
+def _entry(path):
+  # Entry of `path` from its parent's cached listing, or None if the parent
+  # isn't cached. False if the parent is cached and has no such name.
+  p = abspath(path)
+  parent, name = _split(p)
+  if not name:
+    return None
+  ents = _lookup(parent)
+  if ents is None:
+    return None
+  for e in ents:
+    if e[NAME] == name:
+      return e
+  return False
+
+
+def is_dir(path):
+  """True if `path` is a directory. Answered from the parent's listing when
+  that is cached, else with one os.stat()."""
+  e = _entry(path)
+  if e is False:
+    return False
+  if e is not None:
+    return e[IS_DIR]
+  try:
+    return (os.stat(path)[0] & 0x4000) != 0
+  except OSError:
+    return False
+
+
+def scan_tree(root, skip=()):
+  """(relative path, size, mtime) of every file below directory `root`,
+  paths '/' separated. Files and directories named in `skip` are left out.
+  Read straight from the filesystem, not the cache: the on-disk indexes
+  (grep's trigram index, graph's link index) compare these with what they
+  stored, so they must be current and carry the mtime."""
+  out = []
+  stack = ['']
+  while stack:
+    rel_dir = stack.pop()
+    d = join(root, rel_dir) if rel_dir else root
+    try:
+      names = os.listdir(d)
+    except OSError:
+      continue
+    for name in names:
+      if name in skip:
+        continue
+      rel = rel_dir + '/' + name if rel_dir else name
+      try:
+        st = os.stat(join(root, rel))
+      except OSError:
+        continue
+      if st[0] & 0x4000:
+        stack.append(rel)
+      else:
+        out.append((rel, st[6], st[8]))
+  return out
+
+
+def find_index(path, make):
+  """The index covering `path`: make(dir) for the directory `path` is or is
+  in, then for each parent, until one whose file (its .path) exists and
+  whose load() returns True. None if there is none."""
+  p = abspath(path)
+  if not is_dir(p):
+    p = _split(p)[0]
+  while True:
+    idx = make(p)
+    try:
+      os.stat(idx.path)
+      if idx.load():
+        return idx
+    except OSError:
+      pass
+    if p == '/':
+      return None
+    p = _split(p)[0]
+
+
+def mtime(dirname, e):
+  """mtime of entry `e` of directory `dirname`, stat'ed once if the listing
+  did not carry it."""
+  if e[MTIME] is None:
+    try:
+      st = os.stat(join(dirname, e[NAME]))
+      e[MTIME] = st[8]
+      if e[SIZE] < 0:
+        e[SIZE] = st[6]
+    except OSError:
+      e[MTIME] = 0
+  return e[MTIME]
+
+
+def invalidate(path):
+  """Forget what is cached about `path`: its parent's listing, its own
+  listing and everything below it (a removed or renamed directory)."""
+  p = abspath(path)
+  _drop(_split(p)[0])
+  pre = p if p.endswith('/') else p + '/'
+  for k in [k for k in _dirs if k == p or k.startswith(pre)]:
+    _drop(k)
+
+
+def clear():
+  """Forget everything."""
+  global _count
+  _dirs.clear()
+  _count = 0
@@ -7,13 +7,13 @@
 # back into its own namespace with `from erow import erow`, so every existing
 # `erow(...)` call site is unchanged.
 #
-# `_hl_line` (per-line syntax highlighting) is left in pem.py and imported here.
-# pem.py is always the entry point and defines `_hl_line` before it imports this
-# module, so the import cycle resolves cleanly.
+# Syntax highlighting lives in pem.py (editor_file), since a row's highlight
+# depends on the lexer state carried in from the rows above it. A row only
+# caches the result: hl_spans for (hl_in state, hl_key chars), and hl_bytes for
+# the rendered wrap segments.
 
 import array
 import pdeck
-from pem import _hl_line
 
 
 class erow:
@@ -33,6 +33,12 @@ class erow:
     self.updated = False
     self.hl_mode = None
     self.hl_bytes = {}
+    self.hl_key = None
+    self.hl_in = -1
+    self.hl_spans = None
+    # Index of the original file line this row was read from (see erow_store),
+    # or -1 for a row created by editing.
+    self.src = -1
     #self.update(True)
 
   def decode(self):
@@ -40,6 +46,7 @@ class erow:
 
   def update(self, skip_tab_scan = False):
     self.hl_bytes = {}
+    self.hl_key = None
     chars = self.chars
     n = len(chars)
     tab_size = self.tab_size
@@ -155,32 +162,23 @@ class erow:
       self.tab_detected = False
 
     self.updated = True
-    self.update_hl_bytes()
+
+  def release(self):
+    # Drop the per-line maps and highlight cache; they are rebuilt by update()
+    # on the next access. `len` stays valid since chars is untouched.
+    self.cbmap = self.bcmap = self.bdmap = self.dbmap = None
+    self.ex_chars = None
+    self.hl_bytes = {}
+    self.hl_key = None
+    self.hl_spans = None
+    self.updated = False
     
   def update_hl_bytes(self):
+    # Called when the wrap width changes: the rendered segments are keyed by
+    # their start column, so they have to go.
     if not self.updated:
       self.update()
-      return
-      
-    if self.hl_mode in ('md', 'py', 'c'):
-      cur = 0
-      while True:
-        next_stop = self.expanded_to_pos(cur, self.w)
-        #print(f"{idx}:{cur} {next_stop}, {self.get_len()}")
-        # Highlight the tab-expanded display slice, not the raw chars: a literal
-        # tab byte left in the output advances the display to its own tab stop,
-        # misaligning everything after it. (cur is always < len here -- the loop
-        # only continues while next_stop < len, and empty lines are never tabbed.)
-        if self.tab_detected:
-          d_start = self.bdmap[self.cbmap[cur]]
-          seg = self.ex_chars[d_start:d_start + self.w]
-        else:
-          seg = self.substr(cur, next_stop)
-        self.hl_bytes[cur] = _hl_line(seg, self.hl_mode)
-        if next_stop >= self.get_len():
-          break
-        cur = next_stop
-      
+    self.hl_bytes = {}
 
   def get_len(self):
     if not self.updated: #self.scanned:
@@ -0,0 +1,169 @@
+#
+# erow_store -- line-granular piece table backing the Pem editor's rows
+# Copyright Nunomo LLC
+#
+# editor_file used to build one `erow` per line at open time, and each erow
+# eventually allocated its four byte/char/display maps. On a large log that is
+# thousands of objects and several arrays per line before the first frame.
+#
+# erow_store keeps the file as it was read in one buffer that is never modified
+# plus an array of line-start offsets (the "original" piece). Each slot of the
+# row list is either a small int -- the index of an untouched original line --
+# or a live `erow` (the "add" piece) for a line that has been viewed or edited.
+# Slots are turned into erows on first access and swept back to ints (or have
+# their maps released) once they scroll far away, so memory tracks what is on
+# screen, not the file size. The buffer can be filled in chunks (begin /
+# read_chunk) so the first screen shows before the whole file is in.
+#
+# The class behaves like the plain list editor_file.rows used to be: len(),
+# indexing (incl. negative), slice get/set/del, insert, append and iteration
+# all work, and always hand back erow objects.
+
+import array
+from erow import erow
+
+
+class erow_store:
+  def __init__(self, tab_size, w, hl_mode=None):
+    self.tab_size = tab_size
+    self.w = w
+    self.hl_mode = hl_mode
+    self.buf = b''
+    # offs[k] is the start of original line k; offs[k+1]-1 is its '\n'
+    self.offs = array.array('I')
+    self.rows = []
+    self._sweep = 0
+
+  def load(self, data):
+    # Index the line starts of `data` (the whole file, as bytes). Only the
+    # offset array and one int per line are allocated here.
+    self.buf = data
+    offs = array.array('I', [0])
+    find = data.find
+    n = len(data)
+    pos = find(b'\n')
+    while pos != -1:
+      offs.append(pos + 1)
+      pos = find(b'\n', pos + 1)
+    if offs[-1] != n:
+      # last line has no trailing newline; give it a virtual one
+      offs.append(n + 1)
+    self.offs = offs
+    self.rows = list(range(len(offs) - 1))
+
+  def begin(self, size):
+    # Start a chunked load of a `size`-byte file: the buffer is allocated once
+    # and filled in place by read_chunk(), and rows appear as their newline
+    # arrives. (A short read leaves the buffer longer than the data; the tail
+    # is never indexed.)
+    self.buf = bytearray(size)
+    self.offs = array.array('I', [0])
+    self.rows = []
+    self.filled = 0
+
+  def read_chunk(self, f, n):
+    # Read up to n more bytes from f and index the lines they complete.
+    # Returns False once f is exhausted (the last line is indexed then).
+    buf = self.buf
+    start = self.filled
+    end = start + n
+    if end > len(buf):
+      end = len(buf)
+    got = f.readinto(memoryview(buf)[start:end]) if end > start else 0
+    if not got:
+      if self.offs[-1] != start:
+        # last line has no trailing newline; give it a virtual one
+        self.offs.append(start + 1)
+        self.rows.append(len(self.offs) - 2)
+      return False
+    self.filled = start + got
+    k = len(self.offs) - 1
+    offs = self.offs
+    find = buf.find
+    pos = find(b'\n', start, self.filled)
+    while pos != -1:
+      offs.append(pos + 1)
+      pos = find(b'\n', pos + 1, self.filled)
+    self.rows.extend(range(k, len(offs) - 1))
+    return True
+
+  def original_line(self, k):
+    start = self.offs[k]
+    end = self.offs[k + 1] - 1
+    if end > start and self.buf[end - 1] == 0x0d:
+      end -= 1  # CRLF file
+    return self.buf[start:end]
+
+  def _row(self, k):
+    row = erow(bytearray(self.original_line(k)), self.tab_size, self.w)
+    row.hl_mode = self.hl_mode
+    row.src = k
+    return row
+
+  def _materialize(self, i):
+    x = self.rows[i]
+    if type(x) is int:
+      x = self._row(x)
+      self.rows[i] = x
+    return x
+
+  def __len__(self):
+    return len(self.rows)
+
+  def __iter__(self):
+    for i in range(len(self.rows)):
+      x = self.rows[i]
+      # Iterating (e.g. save) must not materialize the whole file.
+      yield x if type(x) is not int else self._row(x)
+
+  def __getitem__(self, i):
+    if type(i) is slice:
+      return [self._materialize(j) for j in range(*i.indices(len(self.rows)))]
+    return self._materialize(i)
+
+  def __setitem__(self, i, v):
+    self.rows[i] = v
+
+  def __delitem__(self, i):
+    del self.rows[i]
+
+  def insert(self, i, row):
+    self.rows.insert(i, row)
+
+  def append(self, row):
+    self.rows.append(row)
+
+  def chars_at(self, i):
+    # The bytes of row i without materializing it.
+    x = self.rows[i]
+    if type(x) is int:
+      return self.original_line(x)
+    return x.chars
+
+  def evict(self, center, keep, budget=64):
+    # Sweep `budget` slots per call. Rows more than `keep` away from `center`
+    # go back to their compact form: an untouched original line becomes its int
+    # again, an edited one keeps its chars but drops the per-line maps.
+    # Returns True if anything was freed.
+    n = len(self.rows)
+    if n == 0:
+      return False
+    i = self._sweep
+    if i >= n:
+      i = 0
+    freed = False
+    rows = self.rows
+    for _ in range(budget if budget < n else n):
+      x = rows[i]
+      if type(x) is not int and (i < center - keep or i > center + keep):
+        if x.src >= 0 and x.chars == self.original_line(x.src):
+          rows[i] = x.src
+          freed = True
+        elif x.updated:
+          x.release()
+          freed = True
+      i += 1
+      if i >= n:
+        i = 0
+    self._sweep = i
+    return freed
@@ -33,6 +33,8 @@ import ujson
 import ubinascii
 import pdeck
 import pdeck_utils as pu
+import pstdin
+import dir_cache
 import pngwriter
 import ai_improve
 
@@ -321,7 +323,7 @@ def build_tools(app_list, agent=False, web_search=True, realtime=False,
   tools.append({
     "type": "function",
     "name": "command_with_return",
-    "description": "Run a device command (or any installed module) and return its captured output for non-graphical apps. GRAPHIC/interactive apps cannot run here (there is no screen to draw on): launch them with launch_app instead, setting reload=true after editing their source — launch_app's reload replaces the 'r' prefix. If a graphic app is run here by mistake it is detected and relaunched via launch_app automatically. This is your primary tool for TESTING AND VERIFYING CODE: after you write a script with write_file, run it here by name and read the output to confirm it works, see errors, and iterate. A runnable script/app is a module exposing main(vs, args); invoke it by its name plus arguments, e.g. 'temp_foo arg1' for /sd/py/temp_foo.py, or any existing app/command. IMPORTANT: if you EDIT a script and run it again, prefix the command with 'r ' to reload it (e.g. 'r temp_foo arg1') — without 'r' the previous, cached version runs instead of your new code. Built-in commands include: ls (glob patterns like 'word*'; 'ls -r path' lists recursively), cat (read file), head, tail, rm, mv, cp, mkdir, rmdir, grep (search in files), ping, curl. This not Linux, available options are limited. See README.md for available options for the commands. Simple pipes ('|') are supported: a stage's output is fed to the next command as stdin, and stdin-aware filters read it when given no file (grep, head, and tail, e.g. 'ls -r /sd/py | grep clock', 'curl -s URL | grep -i error | head -n 5', or 'cat log.txt | tail -n 20'). Other commands ignore piped stdin, so only pipe INTO grep/head/tail. Output redirect to a file is supported on the final stage: '> file' truncates, '>> file' appends (e.g. 'ls -r /sd/py > files.txt' or 'curl -s URL | grep -i error >> log.txt'); the written text is plain (color codes stripped) and capped at ~50KB. This is not Linux otherwise: no input redirect ('<'), backticks, '&&', or subshells; use one command per stage.",
+    "description": "Run a device command (or any installed module) and return its captured output for non-graphical apps. GRAPHIC/interactive apps cannot run here (there is no screen to draw on): launch them with launch_app instead, setting reload=true after editing their source — launch_app's reload replaces the 'r' prefix. If a graphic app is run here by mistake it is detected and relaunched via launch_app automatically. This is your primary tool for TESTING AND VERIFYING CODE: after you write a script with write_file, run it here by name and read the output to confirm it works, see errors, and iterate. A runnable script/app is a module exposing main(vs, args); invoke it by its name plus arguments, e.g. 'temp_foo arg1' for /sd/py/temp_foo.py, or any existing app/command. IMPORTANT: if you EDIT a script and run it again, prefix the command with 'r ' to reload it (e.g. 'r temp_foo arg1') — without 'r' the previous, cached version runs instead of your new code. Built-in commands include: ls (glob patterns like 'word*'; 'ls -r path' lists recursively), cat (read file), head, tail, rm, mv, cp, mkdir, rmdir, grep (search in files; after 'grep --index DIR', 'grep -r' under DIR reads only candidate files), graph --backlinks FILE (notes that [[link]] to FILE), ping, curl. This not Linux, available options are limited. See README.md for available options for the commands. Simple pipes ('|') are supported: a stage's output is fed to the next command as stdin, and stdin-aware filters read it line by line when given no file (grep, head, tail and cat, e.g. 'ls -r /sd/py | grep clock', 'curl -s URL | grep -i error | head -n 5', or 'cat log.txt | tail -n 20'). Other commands ignore piped stdin, so only pipe INTO grep/head/tail/cat. Output redirect to a file is supported on the final stage: '> file' truncates, '>> file' appends (e.g. 'ls -r /sd/py > files.txt' or 'curl -s URL | grep -i error >> log.txt'); the written text is plain (color codes stripped) and capped at ~50KB. This is not Linux otherwise: no input redirect ('<'), backticks, '&&', or subshells; use one command per stage.",
     "parameters": {
       "type": "object",
       "properties": {
@@ -936,9 +938,12 @@ class ToolExecBase:
     if parts and parts[0] in self.RECURSIVE_GUARD:
       return "Error: refusing to run '%s' recursively from inside the assistant." % parts[0]
     # Pipeline splitting/execution lives in pdeck_utils.run_pipeline: stages are
-    # split on top-level '|', each stage's captured output feeds the next as
-    # stdin via the pstdin bridge, a trailing '> file'/'>> file' on the final
-    # stage writes output to a file, and bare '2>&1' redirects are dropped.
+    # split on top-level '|', each stage's output feeds the next as stdin via
+    # the pstdin bridge (streamed line by line into grep/head/tail/cat once
+    # pstdin.install() has replaced run_stages), a trailing '> file'/'>> file'
+    # on the final stage writes output to a file, and bare '2>&1' redirects
+    # are dropped.
+    pstdin.install()
     cap, result = pu.run_pipeline(command, AgentCaptureStream)
     if cap is None:
       return "Error: " + result
@@ -1002,6 +1007,9 @@ class ToolExecBase:
         backup_path = None  # no existing file: this is a fresh create, not an update
       with open(path, "w") as f:
         f.write(content)
+      dir_cache.invalidate(path)
+      if backup_path:
+        dir_cache.invalidate(backup_path)
       # Show the user what changed (frontends that have a screen override the hook).
       self._show_write(path, backup_path, content)
       return "Written %d bytes to %s%s%s" % (len(content), path, backup_msg,
@@ -1056,6 +1064,9 @@ class ToolExecBase:
         f.write(content)
     except Exception as e:
       return "Error: %s" % str(e)
+    dir_cache.invalidate(path)
+    if backup_path:
+      dir_cache.invalidate(backup_path)
     # Show the user what changed (frontends that have a screen override the hook).
     self._show_write(path, backup_path, content)
     return "Edited %s%s%s" % (path,
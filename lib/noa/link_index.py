@@ -0,0 +1,266 @@
+#
+# link_index -- on-disk index of the [[links]] between markdown notes
+# Copyright Nunomo LLC
+#
+# The graph app used to open and parse every note it visited on each launch,
+# and nothing else could answer "which notes link here" without reading the
+# whole vault.
+#
+# `graph --index` writes VAULT/.linkindex: every file under the vault with its
+# size and mtime, and for markdown files the raw [[links]] they contain. A
+# note whose size or mtime no longer matches is parsed again, so callers can
+# trust an entry after one stat instead of reading the file. Backlinks are
+# not stored: they are derived on first use by resolving every stored link
+# against the indexed file list (dictionary lookups, no SD access).
+#
+# Files added after the last `graph --index` are unknown to the index until
+# the next run (or until the graph app visits them); everything else is
+# checked against the file on disk before it is used.
+#
+# File layout: JSON {"version": 1, "files": {rel: [size, mtime, links]}},
+# rel '/' separated and relative to the index's directory, links None for
+# files that are not markdown or could not be read.
+
+import os
+try:
+  import ujson
+except ImportError:
+  import json as ujson
+import dir_cache
+
+INDEX_NAME = '.linkindex'
+VERSION = 1
+_SKIP = (INDEX_NAME, INDEX_NAME + '.tmp')
+
+
+def clean_link(link):
+  link = link.strip()
+  bar = link.find('|')
+  if bar >= 0:
+    link = link[:bar].strip()
+  sharp = link.find('#')
+  if sharp >= 0:
+    link = link[:sharp].strip()
+  return link
+
+
+def parse_links(text):
+  links = []
+  pos = 0
+  while True:
+    start = text.find('[[', pos)
+    if start < 0:
+      break
+    end = text.find(']]', start + 2)
+    if end < 0:
+      break
+    if start == 0 or text[start - 1] != '!':
+      link = clean_link(text[start + 2:end])
+      if link:
+        links.append(link)
+    pos = end + 2
+  return links
+
+
+def link_candidates(base_file, link, vault):
+  # Paths a cleaned link may refer to, in the order they are tried: next to
+  # the linking note, then from the vault root, each as written and with .md.
+  # Not normalized.
+  tries = []
+  if link.startswith('/'):
+    tries.append(link)
+  else:
+    i = base_file.rfind('/')
+    tries.append(dir_cache.join(base_file[:i] if i > 0 else '/', link))
+    tries.append(dir_cache.join(vault, link))
+  out = []
+  for p in tries:
+    out.append(p)
+    if not p.endswith('.md'):
+      out.append(p + '.md')
+  return out
+
+
+class link_index:
+  def __init__(self, root):
+    self.root = root            # absolute directory the index covers (vault)
+    self.path = dir_cache.join(root, INDEX_NAME)
+    self.files = {}             # relative path -> [size, mtime, links or None]
+    self.dirty = False
+    self._back = None           # absolute target -> [absolute sources]
+
+  def load(self):
+    # Read the index. Returns False if there is no usable one.
+    try:
+      f = open(self.path, 'r')
+    except OSError:
+      return False
+    try:
+      data = ujson.load(f)
+    except ValueError:
+      return False
+    finally:
+      f.close()
+    if type(data) is not dict or data.get('version') != VERSION:
+      return False
+    self.files = data.get('files') or {}
+    self.dirty = False
+    self._back = None
+    return True
+
+  def save(self):
+    # Write the index back if anything changed since load().
+    if not self.dirty:
+      return False
+    tmp = self.path + '.tmp'
+    with open(tmp, 'w') as f:
+      ujson.dump({'version': VERSION, 'files': self.files}, f)
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+    os.rename(tmp, self.path)
+    self.dirty = False
+    return True
+
+  def _parse(self, path):
+    try:
+      with open(path, 'r') as f:
+        return parse_links(f.read())
+    except Exception:
+      return None
+
+  def links(self, path):
+    # (ok, links) of note `path` (absolute, normalized), like reading and
+    # parsing it, but the file is only opened when the index entry is
+    # missing or stale.
+    try:
+      st = os.stat(path)
+    except OSError:
+      return False, None
+    rel = dir_cache.relpath(self.root, path)
+    e = self.files.get(rel) if rel is not None else None
+    if e is not None and e[2] is not None and e[0] == st[6] and e[1] == st[8]:
+      return True, e[2]
+    links = self._parse(path)
+    if rel is not None:
+      self.files[rel] = [st[6], st[8], links]
+      self.dirty = True
+      self._back = None
+    return links is not None, links
+
+  def refresh(self):
+    # Bring the whole index up to date: walk the tree, parse notes that are
+    # new or changed, drop files that are gone. Returns (files, notes read).
+    old = self.files
+    files = {}
+    nread = 0
+    kept = 0
+    for rel, size, mtime in dir_cache.scan_tree(self.root, _SKIP):
+      e = old.get(rel)
+      if e is not None and e[0] == size and e[1] == mtime:
+        files[rel] = e
+        kept += 1
+        continue
+      links = None
+      if rel.endswith('.md'):
+        links = self._parse(dir_cache.join(self.root, rel))
+        nread += 1
+      files[rel] = [size, mtime, links]
+    if kept != len(files) or kept != len(old):
+      self.dirty = True
+    self.files = files
+    self._back = None
+    return len(files), nread
+
+  def _exists(self, p):
+    # Normalized absolute path p is a file: by the index below the root,
+    # by stat outside it.
+    rel = dir_cache.relpath(self.root, p)
+    if rel is not None:
+      return rel in self.files
+    try:
+      return (os.stat(p)[0] & 0x4000) == 0
+    except OSError:
+      return False
+
+  def resolve(self, base_file, link):
+    # Target of `link` in note base_file, as the graph app resolves it but
+    # looked up in the index. None if it does not resolve.
+    link = clean_link(link)
+    if not link:
+      return None
+    for p in link_candidates(base_file, link, self.root):
+      p = dir_cache.abspath(p)
+      if self._exists(p):
+        return p
+    return None
+
+  def _backlinks_map(self):
+    back = {}
+    for rel in self.files:
+      links = self.files[rel][2]
+      if not links:
+        continue
+      src = dir_cache.join(self.root, rel)
+      for link in links:
+        t = self.resolve(src, link)
+        if t is None or t == src:
+          continue
+        lst = back.get(t)
+        if lst is None:
+          back[t] = [src]
+        elif lst[-1] != src:
+          lst.append(src)
+    return back
+
+  def backlinks(self, path):
+    # Sorted absolute paths of the notes linking to `path`. Each one is
+    # checked against the file on disk (and re-parsed if it changed) before
+    # it is reported.
+    target = dir_cache.abspath(path)
+    if self._back is None:
+      self._back = self._backlinks_map()
+    srcs = self._back.get(target, ())
+    out = []
+    changed = False
+    for src in srcs:
+      rel = dir_cache.relpath(self.root, src)
+      e = self.files.get(rel)
+      ok, links = self.links(src)
+      if self.files.get(rel) is not e:
+        changed = True      # re-parsed: the map is out of date
+      if not ok:
+        continue
+      for link in links:
+        if self.resolve(src, link) == target:
+          out.append(src)
+          break
+    if changed:
+      self._back = None
+    out.sort()
+    return out
+
+
+def find(path):
+  # The loaded index covering `path` (the path itself or a parent holding an
+  # INDEX_NAME file), or None.
+  return dir_cache.find_index(path, link_index)
+
+
+def build(root, out=None):
+  # `graph --index`: create or refresh root's index and report.
+  root = dir_cache.abspath(root)
+  if not dir_cache.is_dir(root):
+    if out is not None:
+      out.write('graph: --index needs a directory: {}\n'.format(root))
+    return None
+  t = dir_cache.ms()
+  idx = link_index(root)
+  idx.load()
+  nfiles, nread = idx.refresh()
+  idx.save()
+  if out is not None:
+    out.write('indexed {} files ({} notes read) in {}ms -> {}\n'.format(
+      nfiles, nread, (dir_cache.ms() - t) & 0x3fffffff, idx.path))
+  return idx
@@ -11,6 +11,7 @@ import os
 import pdeck
 import pdeck_utils
 import sys
+import dir_cache
 
 _DB = None
 _DB_PATH = '/sd/lib/data/apps_db.json'
@@ -64,13 +65,6 @@ def _current_token(cmd, cursor):
   return idx, '', cursor, cursor, toks
 
 
-def _is_dir(path):
-  try:
-    return os.stat(path)[0] & 0x4000 != 0
-  except OSError:
-    return False
-
-
 # Each source returns a list of (value, label) tuples. `value` is what gets
 # spliced into the command; `label` is what shows in the menu.
 
@@ -107,17 +101,18 @@ def _candidates_files(prefix):
     base = '.'
     base_clean = base.rstrip('/') if base != '/' else '/'
   try:
-    print(base_clean)
-    entries = os.listdir(base_clean)
+    # The cached listing carries each entry's type: no stat per entry, and
+    # repeated TABs in the same folder don't touch the SD card at all.
+    entries = dir_cache.entries(base_clean)
   except OSError:
     return []
   out = []
-  #base_clean = base.rstrip('/') if base != '/' else '/'
   for e in entries:
-    if not e.startswith(name_part):
+    name = e[dir_cache.NAME]
+    if not name.startswith(name_part):
       continue
-    full = dir_part + e
-    if _is_dir(base_clean + ('' if base_clean == '/' else '/') + e):
+    full = dir_part + name
+    if e[dir_cache.IS_DIR]:
       full += '/'
     out.append((full, full))
   out.sort()
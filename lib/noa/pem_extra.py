@@ -38,8 +38,8 @@ def stt(editor):
   lines = newstr.split('\n')
   lines = lines[1:]
   newstr = ' '.join(lines)
-  row = editor.file.rows[editor.file_row]
-  row.insert_str(editor.file_col, newstr)
+  editor.file.undo.record(editor, 'other')
+  editor.file.insert_str(editor.file_row, editor.file_col, newstr)
   editor.file_col += len(newstr)
   editor.jump_to_position(editor.file_row, editor.file_col, -1)
   
@@ -59,6 +59,7 @@ def toggle_checkbox(editor):
     return
   newchar = b" " if checkbox[1] != ord(" ") else b"X"
    
-  newchars = row.substr(0,ret[0]) + b"[" + newchar + b"]" + row.substr(ret[0]+3,-1) 
-  row.update_str(newchars)
+  editor.file.undo.record(editor, 'other')
+  editor.file.delete_text(editor.file_row, ret[0] + 1, editor.file_row, ret[0] + 2)
+  editor.file.insert_text(editor.file_row, ret[0] + 1, newchar)
 
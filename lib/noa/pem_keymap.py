@@ -22,8 +22,8 @@ def today(editor):
   t = time.gmtime(time.time() + 60*15*pdeck_utils.timezone)
   week_list = ("Mon", "Tue", "Wed" ,"Thu", "Fri", "Sat", "Sun" )
   format_date = f'<{t[0]:04}-{t[1]:02}-{t[2]:02} {week_list[t[6]]}>'
-  row = editor.file.rows[editor.file_row]
-  row.insert_str(editor.file_col, format_date)
+  editor.file.undo.record(editor, 'other')
+  editor.file.insert_str(editor.file_row, editor.file_col, format_date)
   editor.file_col += len(format_date)
   editor.jump_to_position(editor.file_row, editor.file_col, -1)
 
@@ -20,6 +20,7 @@ map = {
   'delete': [ b'\x04', b'\x1b[3~'],  
   'search': [ b'\x13' ],
   'rev_search': [ b'\x12'],
+  'search_regex': [ b'\x1br' ],     # M-r in search: toggle regexp
   'ime_jp_toggle': [ b'\x1b`',b'\x1b~'],
   'replace': [ b'\x1b%' ],
   'mark': [ b'\x1b\x20' ],
@@ -31,6 +32,7 @@ map = {
   'goto_line': [ b'\x1bg'],
   'ref_def': [ b'\x1b.' ],
   'ref_sym': [ b'\x1b/' ],
+  'backlinks': [ b'\x1b,' ],
   'top': [ b'\x1b<' ],
   'bottom': [ b'\x1b>' ],
   'recover_yank': [ b'\x1by' ],
@@ -1,5 +1,6 @@
 import struct
 import io
+import array
 
 
 try:
@@ -17,65 +18,60 @@ _BAYER = bytes([
   240, 112, 208,  80,
 ])
 
+# Adam7 passes: x0, y0, dx, dy
+_ADAM7 = (
+  (0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4),
+  (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2),
+)
+
+# The decoder never holds the whole image: IDAT chunks are inflated as they
+# are read, one scanline at a time is unfiltered against the previous one,
+# converted to gray, averaged into the destination row and dithered straight
+# into the xbm. Working memory is a few rows of the source width plus the
+# 1-bit output. Interlaced images need their pixels gathered across passes,
+# so they keep a destination-sized accumulator instead.
+
 
 try:
-  # Viper version — native integers and ptr8 pointer access
+  # Viper version — native integers and ptr8 pointer access.
+  # cur/prev hold one scanline each with the filter byte at [0].
   @micropython.viper
-  def _unfilter(raw, out, h: int, stride: int, bpp: int):
-    r = ptr8(raw)
-    o = ptr8(out)
-    pos: int = 0
-    for y in range(h):
-      filt: int = r[pos]
-      pos += 1
-      src: int = pos
-      dst: int = y * stride
-      pos += stride
-
-      # Copy raw row into out
-      i: int = 0
-      while i < stride:
-        o[dst + i] = r[src + i]
+  def _unfilter_row(cur, prev, stride: int, bpp: int):
+    o = ptr8(cur)
+    p = ptr8(prev)
+    filt: int = o[0]
+    end: int = stride + 1
+    i: int = 1
+    if filt == 1:    # Sub
+      i = bpp + 1
+      while i < end:
+        o[i] = (o[i] + o[i - bpp]) & 0xFF
+        i += 1
+    elif filt == 2:  # Up
+      while i < end:
+        o[i] = (o[i] + p[i]) & 0xFF
+        i += 1
+    elif filt == 3:  # Average
+      while i < end:
+        a: int = o[i - bpp] if i > bpp else 0
+        o[i] = (o[i] + ((a + p[i]) >> 1)) & 0xFF
+        i += 1
+    elif filt == 4:  # Paeth
+      while i < end:
+        a = o[i - bpp] if i > bpp else 0
+        b: int = p[i]
+        c: int = p[i - bpp] if i > bpp else 0
+        # Inline Paeth predictor
+        q: int = a + b - c
+        pa: int = q - a if q >= a else a - q
+        pb: int = q - b if q >= b else b - q
+        pc: int = q - c if q >= c else c - q
+        pr: int = 0
+        if pa <= pb and pa <= pc: pr = a
+        elif pb <= pc: pr = b
+        else: pr = c
+        o[i] = (o[i] + pr) & 0xFF
         i += 1
-
-      if filt == 1:    # Sub
-        i = bpp
-        while i < stride:
-          o[dst + i] = (o[dst + i] + o[dst + i - bpp]) & 0xFF
-          i += 1
-      elif filt == 2:  # Up
-        if y > 0:
-          prev: int = (y - 1) * stride
-          i = 0
-          while i < stride:
-            o[dst + i] = (o[dst + i] + o[prev + i]) & 0xFF
-            i += 1
-      elif filt == 3:  # Average
-        prev2: int = (y - 1) * stride if y > 0 else -1
-        i = 0
-        while i < stride:
-          a: int = o[dst + i - bpp] if i >= bpp else 0
-          b: int = o[prev2 + i] if prev2 >= 0 else 0
-          o[dst + i] = (o[dst + i] + ((a + b) >> 1)) & 0xFF
-          i += 1
-      elif filt == 4:  # Paeth
-        prev3: int = (y - 1) * stride if y > 0 else -1
-        i = 0
-        while i < stride:
-          a = o[dst + i - bpp] if i >= bpp else 0
-          b = o[prev3 + i] if prev3 >= 0 else 0
-          c: int = o[prev3 + i - bpp] if (prev3 >= 0 and i >= bpp) else 0
-          # Inline Paeth predictor
-          p: int = a + b - c
-          pa: int = p - a if p >= a else a - p
-          pb: int = p - b if p >= b else b - p
-          pc: int = p - c if p >= c else c - p
-          pr: int = 0
-          if pa <= pb and pa <= pc: pr = a
-          elif pb <= pc: pr = b
-          else: pr = c
-          o[dst + i] = (o[dst + i] + pr) & 0xFF
-          i += 1
 
 except:
   # CPython fallback
@@ -88,32 +84,24 @@ except:
     if pb <= pc: return b
     return c
 
-  def _unfilter(raw, out, h, stride, bpp):
-    prev = bytearray(stride)
-    pos = 0
-    for y in range(h):
-      filt = raw[pos]
-      pos += 1
-      row = bytearray(raw[pos:pos + stride])
-      pos += stride
-      if filt == 1:
-        for i in range(bpp, stride):
-          row[i] = (row[i] + row[i - bpp]) & 0xFF
-      elif filt == 2:
-        for i in range(stride):
-          row[i] = (row[i] + prev[i]) & 0xFF
-      elif filt == 3:
-        for i in range(stride):
-          a = row[i - bpp] if i >= bpp else 0
-          row[i] = (row[i] + ((a + prev[i]) >> 1)) & 0xFF
-      elif filt == 4:
-        for i in range(stride):
-          a = row[i - bpp] if i >= bpp else 0
-          b = prev[i]
-          c = prev[i - bpp] if i >= bpp else 0
-          row[i] = (row[i] + _paeth(a, b, c)) & 0xFF
-      out[y * stride:y * stride + stride] = row
-      prev = row
+  def _unfilter_row(cur, prev, stride, bpp):
+    filt = cur[0]
+    end = stride + 1
+    if filt == 1:
+      for i in range(bpp + 1, end):
+        cur[i] = (cur[i] + cur[i - bpp]) & 0xFF
+    elif filt == 2:
+      for i in range(1, end):
+        cur[i] = (cur[i] + prev[i]) & 0xFF
+    elif filt == 3:
+      for i in range(1, end):
+        a = cur[i - bpp] if i > bpp else 0
+        cur[i] = (cur[i] + ((a + prev[i]) >> 1)) & 0xFF
+    elif filt == 4:
+      for i in range(1, end):
+        a = cur[i - bpp] if i > bpp else 0
+        c = prev[i - bpp] if i > bpp else 0
+        cur[i] = (cur[i] + _paeth(a, prev[i], c)) & 0xFF
 
 
 try:
@@ -161,21 +149,6 @@ try:
         x += 1
       y += 1
 
-  @micropython.viper
-  def _scale_nn(src, dst, sw: int, dw: int, dh: int, inv_s: int):
-    s = ptr8(src)
-    d = ptr8(dst)
-    dy: int = 0
-    while dy < dh:
-      sy: int = (dy * inv_s) >> 16
-      sr: int = sy * sw
-      dr: int = dy * dw
-      dx: int = 0
-      while dx < dw:
-        d[dr + dx] = s[sr + ((dx * inv_s) >> 16)]
-        dx += 1
-      dy += 1
-
   @micropython.viper
   def _dither(gray, xbm, dw: int, dh: int, xs: int, bayer):
     g = ptr8(gray)
@@ -223,6 +196,54 @@ try:
         x += 1
       y += 1
 
+  @micropython.viper
+  def _acc_row(gray, acc, xmap, w: int, x0: int, step: int):
+    # acc[xmap[x0 + i * step]] += gray[i] for the w pixels of a row.
+    g = ptr8(gray)
+    a = ptr32(acc)
+    m = ptr16(xmap)
+    i: int = 0
+    x: int = x0
+    while i < w:
+      k: int = m[x]
+      a[k] = a[k] + g[i]
+      x += step
+      i += 1
+
+  @micropython.viper
+  def _avg_row(acc, ncol, out, dw: int, nrows: int):
+    # out = acc / pixel count, and clear acc for the next row.
+    a = ptr32(acc)
+    c = ptr16(ncol)
+    o = ptr8(out)
+    x: int = 0
+    while x < dw:
+      o[x] = a[x] // (c[x] * nrows)
+      a[x] = 0
+      x += 1
+
+  @micropython.viper
+  def _dither_fs(gray, xrow, ecur, enext, dw: int):
+    # Floyd-Steinberg on one row. Errors are in 1/16 levels, ecur/enext are
+    # indexed x + 1 and ecur is left cleared for reuse.
+    g = ptr8(gray)
+    x8 = ptr8(xrow)
+    e = ptr32(ecur)
+    n = ptr32(enext)
+    x: int = 0
+    while x < dw:
+      v: int = (g[x] << 4) + e[x + 1]
+      e[x + 1] = 0
+      if v >= 2048:
+        x8[x >> 3] |= 0x80 >> (x & 7)
+        v -= 4080
+      e[x + 2] += (v * 7) >> 4
+      n[x] += (v * 3) >> 4
+      n[x + 1] += (v * 5) >> 4
+      n[x + 2] += v >> 4
+      x += 1
+    e[dw + 1] = 0
+
 except:
   def _to_gray_rgb8(out, gray, w, h, stride):
     for y in range(h):
@@ -244,12 +265,6 @@ except:
       for x in range(w):
         gray[gi + x] = out[ro + x]
 
-  def _scale_nn(src, dst, sw, dw, dh, inv_s):
-    for dy in range(dh):
-      sr = ((dy * inv_s) >> 16) * sw; dr = dy * dw
-      for dx in range(dw):
-        dst[dr + dx] = src[sr + ((dx * inv_s) >> 16)]
-
   def _dither(gray, xbm, dw, dh, xs, bayer):
     for y in range(dh):
       gi = y * dw; xr = y * xs; by = (y & 3) << 2
@@ -270,14 +285,284 @@ except:
       for x in range(w):
         gray[gi + x] = out[ro + x * 2]
 
+  def _acc_row(gray, acc, xmap, w, x0, step):
+    x = x0
+    for i in range(w):
+      acc[xmap[x]] += gray[i]
+      x += step
+
+  def _avg_row(acc, ncol, out, dw, nrows):
+    for x in range(dw):
+      out[x] = acc[x] // (ncol[x] * nrows)
+      acc[x] = 0
+
+  def _dither_fs(gray, xrow, ecur, enext, dw):
+    for x in range(dw):
+      v = (gray[x] << 4) + ecur[x + 1]
+      ecur[x + 1] = 0
+      if v >= 2048:
+        xrow[x >> 3] |= 0x80 >> (x & 7)
+        v -= 4080
+      ecur[x + 2] += (v * 7) >> 4
+      enext[x] += (v * 3) >> 4
+      enext[x + 1] += (v * 5) >> 4
+      enext[x + 2] += v >> 4
+    ecur[dw + 1] = 0
+
+
+def _to_gray_any(row, gray, w, ct, bd, bpp, palette):
+  # Indexed, sub-8-bit and 16-bit rows (slow path)
+  for x in range(w):
+    if ct == 0:
+      if bd == 16: g = row[x * 2]
+      else:
+        mask = (1 << bd) - 1
+        g = ((row[x * bd // 8] >> (8 - bd - (x * bd % 8))) & mask) * (255 // mask)
+    elif ct == 2:
+      o = x * 6
+      g = (row[o] * 77 + row[o + 2] * 150 + row[o + 4] * 29) >> 8
+    elif ct == 3:
+      if bd == 8: pi = row[x] * 3
+      else:
+        mask = (1 << bd) - 1
+        pi = ((row[x * bd // 8] >> (8 - bd - (x * bd % 8))) & mask) * 3
+      g = (palette[pi] * 77 + palette[pi + 1] * 150 + palette[pi + 2] * 29) >> 8
+    elif ct == 4:
+      g = row[x * bpp]
+    elif ct == 6:
+      o = x * 8
+      g = (row[o] * 77 + row[o + 2] * 150 + row[o + 4] * 29) >> 8
+    else: g = 0
+    gray[x] = g
+
+
+def _gray_row(row, gray, w, ct, bd, bpp, palette):
+  # Native fast paths for the common types
+  if ct == 2 and bd == 8:
+    _to_gray_rgb8(row, gray, w, 1, 0)
+  elif ct == 6 and bd == 8:
+    _to_gray_rgba8(row, gray, w, 1, 0)
+  elif ct == 0 and bd == 8:
+    _to_gray_g8(row, gray, w, 1, 0)
+  elif ct == 3 and bd == 8 and palette:
+    _to_gray_indexed8(row, gray, palette, w, 1, 0)
+  elif ct == 4 and bd == 8:
+    _to_gray_ga8(row, gray, w, 1, 0)
+  else:
+    _to_gray_any(row, gray, w, ct, bd, bpp, palette)
+
+
+class _idat_stream(io.IOBase):
+  # The payload of consecutive IDAT chunks as one stream, read from the
+  # file as the inflater asks for it.
+  def __init__(self, f, length):
+    self.f = f
+    self.left = length
+    self.done = False
+
+  def _next_chunk(self):
+    self.f.read(4)  # CRC
+    hdr = self.f.read(8)
+    if len(hdr) < 8 or hdr[4:8] != b'IDAT':
+      self.done = True
+      return
+    self.left = struct.unpack(">I", hdr[:4])[0]
+
+  def readinto(self, buf):
+    while self.left == 0 and not self.done:
+      self._next_chunk()
+    if self.done:
+      return 0
+    n = len(buf)
+    if n > self.left:
+      n = self.left
+    got = self.f.readinto(memoryview(buf)[:n])
+    if not got:
+      self.done = True
+      return 0
+    self.left -= got
+    return got
+
+  def read(self, n):
+    buf = bytearray(n)
+    got = self.readinto(buf)
+    return bytes(buf[:got])
+
+
+class _inflater:
+  # Inflated image data, handed out in exact-size pieces.
+  def __init__(self, src):
+    self.src = src
+    self.d = None
+    self.z = None
+    if _HAS_DEFLATE:
+      self.d = deflate.DeflateIO(src, deflate.ZLIB)
+    elif hasattr(zlib, 'decompressobj'):
+      self.z = zlib.decompressobj()
+      self.buf = b''
+      self.pos = 0
+    else:
+      self.d = zlib.DecompIO(src, 15)
+
+  def readinto(self, mv):
+    # Fill memoryview mv; returns the byte count (short only at the end).
+    n = len(mv)
+    got = 0
+    if self.d is not None:
+      while got < n:
+        r = self.d.readinto(mv[got:])
+        if not r:
+          break
+        got += r
+      return got
+    z = self.z
+    while got < n:
+      if self.pos >= len(self.buf):
+        if z.unconsumed_tail:
+          self.buf = z.decompress(z.unconsumed_tail, 65536)
+        else:
+          data = self.src.read(4096)
+          if not data:
+            break
+          self.buf = z.decompress(data, 65536)
+        self.pos = 0
+        continue
+      k = len(self.buf) - self.pos
+      if k > n - got:
+        k = n - got
+      mv[got:got + k] = self.buf[self.pos:self.pos + k]
+      self.pos += k
+      got += k
+    return got
+
+
+class _downscaler:
+  # Area-averaging reduction of gray rows (w x h) to dw x dh, dithered into
+  # the xbm as each destination row completes. Every destination pixel is
+  # the mean of the block of source pixels that map onto it.
+  def __init__(self, w, h, dw, dh, xbm, dither):
+    self.w = w
+    self.h = h
+    self.dw = dw
+    self.dh = dh
+    self.xbm = memoryview(xbm)
+    self.xs = (dw + 7) // 8
+    self.fs = dither == 'fs'
+    self.scaled = dw != w or dh != h
+    self.out = bytearray(dw)
+    if self.fs:
+      self.ecur = array.array('i', bytearray(4 * (dw + 2)))
+      self.enext = array.array('i', bytearray(4 * (dw + 2)))
+    else:
+      bayer = memoryview(_BAYER)
+      self.bayer = [bayer[k * 4:] for k in range(4)]
+    if self.scaled:
+      self.xmap = array.array('H', bytearray(2 * w))
+      self.ncol = array.array('H', bytearray(2 * dw))
+      for x in range(w):
+        dx = x * dw // w
+        self.xmap[x] = dx
+        self.ncol[dx] += 1
+      self.acc = array.array('I', bytearray(4 * dw))
+      self.dy = 0
+      self.nrows = 0
+
+  def dither_row(self, gray, dy):
+    xs = self.xs
+    row = self.xbm[dy * xs:dy * xs + xs]
+    if self.fs:
+      _dither_fs(gray, row, self.ecur, self.enext, self.dw)
+      self.ecur, self.enext = self.enext, self.ecur
+    else:
+      _dither(gray, row, self.dw, 1, xs, self.bayer[dy & 3])
+
+  def row(self, gray, y):
+    # Source row y (in order, 0..h-1).
+    if not self.scaled:
+      self.dither_row(gray, y)
+      return
+    _acc_row(gray, self.acc, self.xmap, self.w, 0, 1)
+    self.nrows += 1
+    if y + 1 == self.h or (y + 1) * self.dh // self.h != self.dy:
+      _avg_row(self.acc, self.ncol, self.out, self.dw, self.nrows)
+      self.dither_row(self.out, self.dy)
+      self.dy += 1
+      self.nrows = 0
+
+
+def _decode_rows(src, sink, w, h, stride, bpp, ct, bd, palette):
+  cur = bytearray(stride + 1)
+  prev = bytearray(stride + 1)
+  gray = bytearray(w)
+  for y in range(h):
+    if src.readinto(memoryview(cur)) < stride + 1:
+      raise ValueError("Truncated PNG data")
+    _unfilter_row(cur, prev, stride, bpp)
+    _gray_row(memoryview(cur)[1:], gray, w, ct, bd, bpp, palette)
+    sink.row(gray, y)
+    cur, prev = prev, cur
+
+
+def _decode_adam7(src, sink, w, h, bits, bpp, ct, bd, palette):
+  # Every pass is a small image of its own; its pixels are summed into a
+  # destination-sized accumulator (or stored, when not scaling) and the
+  # result is dithered row by row at the end.
+  dw = sink.dw
+  dh = sink.dh
+  if sink.scaled:
+    acc = array.array('I', bytearray(4 * dw * dh))
+    ymap = array.array('H', bytearray(2 * h))
+    nrow = array.array('H', bytearray(2 * dh))
+    for y in range(h):
+      dy = y * dh // h
+      ymap[y] = dy
+      nrow[dy] += 1
+  else:
+    img = bytearray(w * h)
+  gray = bytearray(w)
+  for x0, y0, dx, dy in _ADAM7:
+    pw = (w - x0 + dx - 1) // dx
+    ph = (h - y0 + dy - 1) // dy
+    if pw <= 0 or ph <= 0:
+      continue
+    stride = (pw * bits + 7) // 8
+    cur = bytearray(stride + 1)
+    prev = bytearray(stride + 1)
+    y = y0
+    for _ in range(ph):
+      if src.readinto(memoryview(cur)) < stride + 1:
+        raise ValueError("Truncated PNG data")
+      _unfilter_row(cur, prev, stride, bpp)
+      _gray_row(memoryview(cur)[1:], gray, pw, ct, bd, bpp, palette)
+      if sink.scaled:
+        _acc_row(gray, memoryview(acc)[ymap[y] * dw:], sink.xmap, pw, x0, dx)
+      else:
+        base = y * w
+        x = x0
+        for i in range(pw):
+          img[base + x] = gray[i]
+          x += dx
+      cur, prev = prev, cur
+      y += dy
+  if sink.scaled:
+    out = sink.out
+    for y in range(dh):
+      _avg_row(memoryview(acc)[y * dw:], sink.ncol, out, dw, nrow[y])
+      sink.dither_row(out, y)
+  else:
+    for y in range(h):
+      sink.dither_row(memoryview(img)[y * w:], y)
+
 
-def read(filename, max_w=None, max_h=None, bench=False):
+def read(filename, max_w=None, max_h=None, bench=False, dither='bayer'):
   """Read a PNG file, return (name, width, height, xbm_data, num_frames).
-  
+
   Same tuple format as xbmreader.read()/read_xbmr().
   Color PNG is converted to grayscale, then dithered to 1-bit.
   xbm_data is MSB-first packed (8 pixels per byte), compatible with draw_xbm().
-  If max_w/max_h are given, scales down to fit.
+  If max_w/max_h are given, scales down to fit (area average).
+  dither is 'bayer' (ordered, default) or 'fs' (Floyd-Steinberg).
+  Interlaced (Adam7) images are supported.
   Pass bench=True to print timing for each step.
   """
   from benchmark import benchmark
@@ -290,115 +575,57 @@ def read(filename, max_w=None, max_h=None, bench=False):
 
     w = h = 0
     bd = ct = 0
+    interlace = 0
     palette = None
-    idat_chunks = []
 
+    # Header chunks up to the first IDAT; the image data is streamed.
     while True:
       hdr = f.read(8)
-      if len(hdr) < 8: break
+      if len(hdr) < 8:
+        raise ValueError("No image data")
       length = struct.unpack(">I", hdr[:4])[0]
       ctype = hdr[4:8]
+      if ctype == b'IDAT':
+        break
       body = f.read(length)
       f.read(4)  # CRC
 
       if ctype == b'IHDR':
         w, h, bd, ct = struct.unpack(">IIbB", body[:10])
-        if body[12] != 0:
-          raise ValueError("Interlaced PNG not supported")
+        interlace = body[12]
       elif ctype == b'PLTE':
         palette = body
-      elif ctype == b'IDAT':
-        idat_chunks.append(body)
       elif ctype == b'IEND':
-        break
-
-  bm.add_bench('parse')
-
-  # Decompress all IDAT data
-  compressed = b''.join(idat_chunks)
-  if _HAS_DEFLATE:
-    stream = io.BytesIO(compressed)
-    d = deflate.DeflateIO(stream, deflate.ZLIB)
-    raw = d.read()
-  else:
-    raw = zlib.decompress(compressed)
-  bm.add_bench('decompress')
-
-  # Bytes per pixel and scanline stride
-  if ct == 0:    bpp = 1 if bd <= 8 else 2
-  elif ct == 2:  bpp = 3 if bd <= 8 else 6
-  elif ct == 3:  bpp = 1
-  elif ct == 4:  bpp = 2 if bd <= 8 else 4
-  elif ct == 6:  bpp = 4 if bd <= 8 else 8
-  else: raise ValueError(f"Unsupported color type {ct}")
-
-  stride = (w * bd + 7) // 8 if bd < 8 else w * bpp
-
-  # Step 1: Reverse filters (native)
-  out = bytearray(h * stride)
-  _unfilter(raw, out, h, stride, bpp)
-  del raw
-  bm.add_bench('unfilter')
-
-  # Step 2: Convert to grayscale (native fast paths for common types)
-  gray = bytearray(w * h)
-  if ct == 2 and bd == 8:
-    _to_gray_rgb8(out, gray, w, h, stride)
-  elif ct == 6 and bd == 8:
-    _to_gray_rgba8(out, gray, w, h, stride)
-  elif ct == 0 and bd == 8:
-    _to_gray_g8(out, gray, w, h, stride)
-  elif ct == 3 and bd == 8 and palette:
-    _to_gray_indexed8(out, gray, palette, w, h, stride)
-  elif ct == 4 and bd == 8:
-    _to_gray_ga8(out, gray, w, h, stride)
-  else:
-    print(f'pngreader: slow fallback ct={ct} bd={bd}')
-    # Fallback for indexed, sub-8-bit, 16-bit
-    for y in range(h):
-      ro = y * stride
-      gi = y * w
-      for x in range(w):
-        if ct == 0:
-          if bd == 16: g = out[ro + x * 2]
-          else:
-            mask = (1 << bd) - 1
-            g = ((out[ro + x * bd // 8] >> (8 - bd - (x * bd % 8))) & mask) * (255 // mask)
-        elif ct == 2:
-          o = ro + x * 6
-          g = (out[o] * 77 + out[o + 2] * 150 + out[o + 4] * 29) >> 8
-        elif ct == 3:
-          if bd == 8: pi = out[ro + x] * 3
-          else:
-            mask = (1 << bd) - 1
-            pi = ((out[ro + x * bd // 8] >> (8 - bd - (x * bd % 8))) & mask) * 3
-          g = (palette[pi] * 77 + palette[pi + 1] * 150 + palette[pi + 2] * 29) >> 8
-        elif ct == 4:
-          g = out[ro + x * bpp]
-        elif ct == 6:
-          o = ro + x * 8
-          g = (out[o] * 77 + out[o + 2] * 150 + out[o + 4] * 29) >> 8
-        else: g = 0
-        gray[gi + x] = g
-  del out
-  bm.add_bench('grayscale')
-
-  # Step 3: Scale to fit if specified (native)
-  dw, dh = w, h
-  if max_w and max_h and (w > max_w or h > max_h):
-    s = min(max_w / w, max_h / h)
-    dw, dh = int(w * s), int(h * s)
-    sc = bytearray(dw * dh)
-    inv_s = int((1 << 16) / s)
-    _scale_nn(gray, sc, w, dw, dh, inv_s)
-    gray = sc
-    bm.add_bench('scale')
-
-  # Step 4: Bayer dither to 1-bit XBM (native)
-  xs = (dw + 7) // 8
-  xbm = bytearray(xs * dh)
-  _dither(gray, xbm, dw, dh, xs, _BAYER)
-  bm.add_bench('dither')
+        raise ValueError("No image data")
+
+    bm.add_bench('parse')
+
+    # Bytes per pixel and scanline stride
+    if ct == 0:    bpp = 1 if bd <= 8 else 2
+    elif ct == 2:  bpp = 3 if bd <= 8 else 6
+    elif ct == 3:  bpp = 1
+    elif ct == 4:  bpp = 2 if bd <= 8 else 4
+    elif ct == 6:  bpp = 4 if bd <= 8 else 8
+    else: raise ValueError(f"Unsupported color type {ct}")
+    bits = bd if bd < 8 else bpp * 8
+
+    if bd != 8 or (ct == 3 and not palette):
+      print(f'pngreader: slow fallback ct={ct} bd={bd}')
+
+    # Destination size: scale to fit if specified
+    dw, dh = w, h
+    if max_w and max_h and (w > max_w or h > max_h):
+      s = min(max_w / w, max_h / h)
+      dw, dh = max(1, int(w * s)), max(1, int(h * s))
+
+    xbm = bytearray(((dw + 7) // 8) * dh)
+    sink = _downscaler(w, h, dw, dh, xbm, dither)
+    src = _inflater(_idat_stream(f, length))
+    if interlace:
+      _decode_adam7(src, sink, w, h, bits, bpp, ct, bd, palette)
+    else:
+      _decode_rows(src, sink, w, h, (w * bits + 7) // 8, bpp, ct, bd, palette)
+    bm.add_bench('decode')
 
   name = filename
   try:
@@ -8,9 +8,33 @@
 #
 # Semantics are read-once: take() consumes the buffer so stale stdin can't leak
 # into an unrelated later command.
+#
+# Streaming pipes. Capturing a whole stage before the next one starts costs
+# memory for the entire output and truncates it at the capture cap, and
+# `cat big.log | head` reads the whole log for ten lines. A filter module can
+# also provide pipe(vs, args): it parses its arguments and returns a generator
+# that is sent the previous stage's output one line at a time (each line with
+# its '\n', the last one possibly without), then None at the end of input, and
+# writes its own output to vs as it goes. pipe() returns None when those
+# arguments do not read stdin (a file argument); main() then runs as usual.
+#
+# run_stages() (installed in place of pdeck_utils.run_stages by install())
+# connects such stages with line_stream objects, so a pipeline holds one
+# partial line per stage instead of whole outputs. When a generator returns
+# early (head has its lines, grep -m its matches), the next write from
+# upstream raises broken_pipe, which ends that stage too; the driver treats it
+# as a normal finish. Stages without pipe() still get their input captured and
+# fed() in one piece, as before.
+
+import io
+import sys
 
 _buf = None
 
+# A single line longer than this is passed on in pieces, so a producer that
+# never writes a newline can't grow a partial line without bound.
+LINE_MAX = 8192
+
 
 def feed(text):
   """Store text for the next command to consume as stdin."""
@@ -34,3 +58,188 @@ def take():
   b = _buf
   _buf = None
   return b
+
+
+class broken_pipe(BaseException):
+  """Raised by line_stream.write() once the reading stage has finished.
+  A BaseException, so a command's own `except Exception` doesn't swallow it
+  and keep producing output nobody reads."""
+  pass
+
+
+class line_stream(io.IOBase):
+  """The `vs` of a stage whose output goes to a streaming stage: write()
+  splits the text into lines and sends each one to that stage's generator."""
+
+  def __init__(self, sink, name, out):
+    self.sink = sink      # generator from the reading module's pipe()
+    self.name = name      # reading module, for error messages
+    self.out = out        # the reading stage's own output stream
+    self._part = ''
+    self._total = 0
+    self.done = False
+    try:
+      next(sink)
+    except StopIteration:
+      self.done = True    # e.g. head -n 0: wants no input at all
+    except Exception as e:
+      self._error(e)
+
+  def _error(self, e):
+    self.done = True
+    try:
+      self.out.write("\nError running '%s':\n" % self.name)
+      sys.print_exception(e, self.out)
+    except broken_pipe:
+      pass
+
+  def _send(self, line):
+    try:
+      self.sink.send(line)
+    except StopIteration:
+      self.done = True
+      raise broken_pipe()
+    except broken_pipe:
+      self.done = True    # the stage after it finished first
+      raise
+    except Exception as e:
+      self._error(e)
+      raise broken_pipe()
+
+  def write(self, data):
+    if self.done:
+      raise broken_pipe()
+    if isinstance(data, (bytes, bytearray)):
+      data = data.decode('utf-8', 'replace')
+    self._total += len(data)
+    start = 0
+    while True:
+      nl = data.find('\n', start)
+      if nl < 0:
+        break
+      line = data[start:nl + 1]
+      if self._part:
+        line = self._part + line
+        self._part = ''
+      self._send(line)
+      start = nl + 1
+    if start < len(data):
+      self._part += data[start:] if start else data
+      while len(self._part) > LINE_MAX:
+        piece = self._part[:LINE_MAX]
+        self._part = self._part[LINE_MAX:]
+        self._send(piece)
+
+  def read(self, n=1):
+    return ''
+
+  def getvalue(self):
+    return ''
+
+  def finish(self):
+    """End of input: pass on the last partial line, then None."""
+    if self.done:
+      return
+    try:
+      if self._part:
+        line = self._part
+        self._part = ''
+        self._send(line)
+      self._send(None)
+    except broken_pipe:
+      pass
+    self.done = True
+
+
+def _import(modname):
+  exec("import %s" % modname, {})
+  return sys.modules[modname]
+
+
+def _run_main(parts, vs):
+  modname = parts[0]
+  try:
+    _import(modname).main(vs, parts)
+  except broken_pipe:
+    pass                  # the rest of the pipeline has what it wanted
+  except BaseException as e:
+    # Catch BaseException, not just Exception: a module that calls sys.exit()/
+    # quit() (SystemExit) or raises KeyboardInterrupt would otherwise escape
+    # and kill the caller. Capture the full traceback so the model can debug.
+    try:
+      vs.write("\nError running '%s':\n" % modname)
+      sys.print_exception(e, vs)
+    except broken_pipe:
+      pass
+
+
+def run_stages(stages, make_stream=None):
+  """Run pre-split pipeline stages (a list of argv lists), like
+  pdeck_utils.run_stages(), but streaming: trailing stages whose module has
+  pipe() read their input line by line as it is written. Stages before the
+  last non-streaming one are captured and fed as before.
+  make_stream() must return a stream with write()/getvalue(); it is the
+  final output, and the capture for non-streaming stages. Returns
+  (last_stream, output) on success, (None, error message) on failure."""
+  if make_stream is None:
+    import pdeck_utils
+    make_stream = pdeck_utils.CaptureStream
+  if not stages:
+    return None, "empty command"
+  take()  # clear any stale stdin left by a previous run
+
+  for parts in stages:
+    if not parts:
+      return None, "empty command in pipeline"
+    # 'r' prefix forces a fresh re-import of the module, exactly like the
+    # device shell (process_prefix). Essential after editing a script you
+    # already ran, since MicroPython otherwise reuses the cached module.
+    if parts[0] == 'r' and len(parts) > 1:
+      parts.pop(0)
+      if parts[0] in sys.modules:
+        del sys.modules[parts[0]]
+
+  cap = make_stream()
+  out = cap
+  # Connect streaming stages from the end; the first stage has no input.
+  sinks = []
+  last = len(stages) - 1
+  while last > 0:
+    parts = stages[last]
+    try:
+      pipe = getattr(_import(parts[0]), 'pipe', None)
+      gen = pipe(out, parts) if pipe is not None else None
+    except BaseException:
+      gen = None          # main() runs it and reports the error
+    if gen is None:
+      break
+    out = line_stream(gen, parts[0], out)
+    sinks.append(out)
+    last -= 1
+
+  # Stages 0..last run to completion in turn; stage `last` writes to out.
+  prev_output = None
+  for i in range(last + 1):
+    vs = out if i == last else make_stream()
+    if prev_output is not None:
+      feed(prev_output)
+    try:
+      _run_main(stages[i], vs)
+    finally:
+      take()  # don't leak stdin to a command that never read it
+    if i < last:
+      prev_output = vs.getvalue()
+
+  # End of input, nearest the producer first: a stage's final output (tail)
+  # reaches the next stage before that one is finished.
+  for s in reversed(sinks):
+    s.finish()
+  return cap, cap.getvalue()
+
+
+def install():
+  """Make pdeck_utils.run_stages the streaming driver above. The shell and
+  pdeck_utils.run_pipeline() (redirects included) look it up at call time,
+  so every later pipeline streams."""
+  import pdeck_utils
+  pdeck_utils.run_stages = run_stages
@@ -0,0 +1,207 @@
+#
+# search_index -- per-buffer match index for the Pem editor's search
+# Copyright Nunomo LLC
+#
+# Search used to walk the rows from the cursor on every keypress, decoding and
+# lowercasing each one (erow.search), so a search-next near the end of a large
+# file redid the whole buffer and there was no way to tell how many hits there
+# were.
+#
+# A search_index is built once per query over the buffer's raw row bytes
+# (erow_store.chars_at, so rows are not materialized). It keeps the rows that
+# contain a hit as a sorted list, with the hits of each row next to it, which
+# gives the total count, "n of N" for any hit, and next/previous hit by binary
+# search. editor_file calls touch() on every edit, which rescans just the
+# changed rows and shifts the ones below.
+#
+# Queries follow the old rules: all-lowercase means case-insensitive. A regex
+# query uses grep's dialect (`_bre_compat`, so `\|` `\(` `\)` work too); one
+# that doesn't compile falls back to a literal match and sets `error`.
+
+import re
+
+# Rows scanned between polls for a keypress while building.
+POLL_ROWS = 512
+
+
+def _bisect(a, x):
+  # First index i with a[i] >= x (a sorted). MicroPython has no bisect module.
+  lo = 0
+  hi = len(a)
+  while lo < hi:
+    mid = (lo + hi) >> 1
+    if a[mid] < x:
+      lo = mid + 1
+    else:
+      hi = mid
+  return lo
+
+
+class search_index:
+  def __init__(self, query, regex=False):
+    self.query = query
+    self.regex = regex            # as requested (see `error` for fallback)
+    self.fold = query.lower() == query
+    self.error = None
+    self.pat = None
+    if regex:
+      from grep import _bre_compat
+      try:
+        self.pat = re.compile(_bre_compat(query))
+      except Exception:
+        self.error = 'bad regex, literal match'
+    self.needle = query.encode('utf-8')
+    self.nchars = len(query)
+    self.rows = []      # row numbers with at least one hit, ascending
+    self.hits = []      # hits[k]: tuple of (col, ncols) for rows[k]
+    self.total = 0
+    self.complete = False
+    self._before = None # _before[k]: number of hits in rows[:k]
+
+  def scan(self, b):
+    # Hits in one row (bytes), as (char column, length in chars) pairs.
+    if not b:
+      return ()
+    out = []
+    if self.pat is not None:
+      try:
+        s = str(b, 'utf-8')
+      except Exception:
+        return ()
+      if self.fold:
+        s = s.lower()
+      anchored = self.query[:1] == '^'
+      pos = 0
+      n = len(s)
+      while pos <= n:
+        # MicroPython's search() takes no pos argument, so search the tail.
+        m = self.pat.search(s[pos:] if pos else s)
+        if m is None:
+          break
+        st = pos + m.start(0)
+        en = pos + m.end(0)
+        if en > st:
+          out.append((st, en - st))
+        if anchored:
+          break
+        pos = en if en > st else st + 1
+      return out
+    if self.fold:
+      b = b.lower()
+    needle = self.needle
+    if not needle:
+      return ()
+    step = len(needle)
+    i = b.find(needle)
+    if i == -1:
+      return ()
+    # Byte offsets are columns unless the row has multi-byte chars.
+    try:
+      wide = len(str(b, 'utf-8')) != len(b)
+    except Exception:
+      return ()
+    while i != -1:
+      out.append((len(str(b[:i], 'utf-8')) if wide else i, self.nchars))
+      i = b.find(needle, i + step)
+    return out
+
+  def build(self, store, poll=None, prev=None):
+    # Index every row of `store`. With `prev` (an index for a prefix of this
+    # literal query) only the rows it hit are rescanned. Returns False if
+    # poll() reported a keypress first; the index is then left incomplete.
+    rows = []
+    hits = []
+    total = 0
+    src = prev.rows if prev is not None else range(len(store))
+    k = 0
+    for i in src:
+      k += 1
+      if poll and k % POLL_ROWS == 0 and poll():
+        return False
+      h = self.scan(store.chars_at(i))
+      if h:
+        rows.append(i)
+        hits.append(h)
+        total += len(h)
+    self.rows = rows
+    self.hits = hits
+    self.total = total
+    self._before = None
+    self.complete = True
+    return True
+
+  def touch(self, store, r, delta):
+    # Row r changed and `delta` rows were inserted after it (or -delta
+    # removed). Rescan r and the new rows; shift the hits below.
+    gone = -delta if delta < 0 else 0
+    lo = _bisect(self.rows, r)
+    hi = _bisect(self.rows, r + 1 + gone)
+    for k in range(lo, hi):
+      self.total -= len(self.hits[k])
+    del self.rows[lo:hi]
+    del self.hits[lo:hi]
+    if delta:
+      rows = self.rows
+      for k in range(lo, len(rows)):
+        rows[k] += delta
+    new_rows = []
+    new_hits = []
+    for i in range(r, r + 1 + (delta if delta > 0 else 0)):
+      h = self.scan(store.chars_at(i))
+      if h:
+        new_rows.append(i)
+        new_hits.append(h)
+        self.total += len(h)
+    self.rows[lo:lo] = new_rows
+    self.hits[lo:lo] = new_hits
+    self._before = None
+
+  def at(self, r):
+    # Hits of row r, or None.
+    k = _bisect(self.rows, r)
+    if k < len(self.rows) and self.rows[k] == r:
+      return self.hits[k]
+    return None
+
+  def next(self, r, c):
+    # First hit at or after (r, c) as (row, col, ncols), or None.
+    rows = self.rows
+    k = _bisect(rows, r)
+    while k < len(rows):
+      for col, n in self.hits[k]:
+        if rows[k] > r or col >= c:
+          return (rows[k], col, n)
+      k += 1
+    return None
+
+  def prev(self, r, c):
+    # Last hit at or before (r, c), or None.
+    rows = self.rows
+    k = _bisect(rows, r + 1) - 1
+    while k >= 0:
+      h = self.hits[k]
+      for j in range(len(h) - 1, -1, -1):
+        if rows[k] < r or h[j][0] <= c:
+          return (rows[k], h[j][0], h[j][1])
+      k -= 1
+    return None
+
+  def rank(self, r, c):
+    # 1-based number of the hit at (r, c) among all hits (0 if none there).
+    k = _bisect(self.rows, r)
+    if k >= len(self.rows) or self.rows[k] != r:
+      return 0
+    if self._before is None:
+      before = [0] * (len(self.rows) + 1)
+      t = 0
+      for j in range(len(self.hits)):
+        before[j] = t
+        t += len(self.hits[j])
+      before[len(self.hits)] = t
+      self._before = before
+    j = 0
+    for col, n in self.hits[k]:
+      j += 1
+      if col == c:
+        return self._before[k] + j
+    return 0
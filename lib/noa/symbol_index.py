@@ -0,0 +1,114 @@
+#
+# symbol_index -- identifier index for the Pem editor's TAB completion
+# Copyright Nunomo LLC
+#
+# Completion used to search every row for the typed prefix, run get_symbol on
+# each hit, stop after 20 and dedup with set(), so it got slower with the file
+# and the candidates came out in no particular order.
+#
+# A symbol_index counts every identifier in a buffer ({symbol: occurrences})
+# and keeps the distinct symbols in a sorted list, so the candidates for a
+# prefix are one binary search away and can be ranked by how often they occur.
+# It is built on the first completion in a buffer; after that editor_file
+# removes the symbols of rows before it edits them and adds them back after,
+# so it stays current without rescanning the file.
+
+import re
+from re_findall import findall
+from search_index import _bisect
+
+_ID = re.compile('[A-Za-z0-9_]+')
+
+# Rows scanned between polls for a keypress while building.
+POLL_ROWS = 512
+
+
+def _symbols(b):
+  # Identifiers in one row (bytes): at least two chars, not starting with a
+  # digit.
+  if not b:
+    return ()
+  try:
+    s = str(b, 'utf-8')
+  except Exception:
+    return ()
+  return [w for w in findall(_ID, s) if len(w) > 1 and not ('0' <= w[0] <= '9')]
+
+
+class symbol_index:
+  def __init__(self):
+    self.count = {}     # symbol -> occurrences
+    self.keys = []      # distinct symbols, sorted
+    self.complete = False
+
+  def add(self, sym, n=1):
+    c = self.count.get(sym, 0)
+    if c == 0:
+      k = _bisect(self.keys, sym)
+      self.keys.insert(k, sym)
+    self.count[sym] = c + n
+
+  def remove(self, sym):
+    c = self.count.get(sym, 0)
+    if c <= 1:
+      if c:
+        del self.count[sym]
+        k = _bisect(self.keys, sym)
+        del self.keys[k]
+      return
+    self.count[sym] = c - 1
+
+  def add_rows(self, store, r1, r2):
+    for i in range(r1, r2):
+      for w in _symbols(store.chars_at(i)):
+        self.add(w)
+
+  def remove_rows(self, store, r1, r2):
+    for i in range(r1, r2):
+      for w in _symbols(store.chars_at(i)):
+        self.remove(w)
+
+  def build(self, store, poll=None):
+    # Count every row of `store`. Returns False if poll() reported a keypress
+    # first; the index is then left empty.
+    count = {}
+    get = count.get
+    for i in range(len(store)):
+      if poll and i % POLL_ROWS == POLL_ROWS - 1 and poll():
+        return False
+      for w in _symbols(store.chars_at(i)):
+        count[w] = get(w, 0) + 1
+    self.count = count
+    self.keys = sorted(count)
+    self.complete = True
+    return True
+
+  def matches(self, prefix):
+    # (symbol, count) for every symbol longer than prefix that starts with it.
+    keys = self.keys
+    k = _bisect(keys, prefix)
+    n = len(prefix)
+    out = []
+    while k < len(keys) and keys[k][:n] == prefix:
+      if len(keys[k]) > n:
+        out.append((keys[k], self.count[keys[k]]))
+      k += 1
+    return out
+
+
+def complete(prefix, own, others=(), extra=(), limit=20):
+  # Candidates for prefix, most frequent first. `own` is the buffer's
+  # symbol_index, `others` those of other buffers (they count half as much),
+  # `extra` a list of plain words that only fill in after them.
+  score = {}
+  for sym, c in own.matches(prefix):
+    score[sym] = c * 2
+  for idx in others:
+    for sym, c in idx.matches(prefix):
+      score[sym] = score.get(sym, 0) + c
+  n = len(prefix)
+  for w in extra:
+    if len(w) > n and w[:n] == prefix and w not in score:
+      score[w] = 0
+  ranked = sorted(score, key=lambda s: (-score[s], s))
+  return ranked[:limit]
@@ -0,0 +1,268 @@
+#
+# trigram_index -- on-disk trigram index that lets grep skip files
+# Copyright Nunomo LLC
+#
+# `grep -r` used to open and read every file under the search path, which on
+# a notes tree of a few hundred markdown files means seconds of SD card I/O
+# for a word that is in two of them.
+#
+# `grep --index DIR` writes DIR/.grepindex: every file under DIR (up to
+# MAX_FILE) with its size and mtime, and for every 3-byte sequence (trigram,
+# ASCII-lowercased) the list of files containing it. A literal a line must contain can only be
+# in files that have all of its trigrams, so grep intersects a few posting
+# lists and reads just those files. Running `grep --index` again only re-reads
+# files whose size or mtime changed.
+#
+# The index is never trusted blindly: grep still walks the tree, and a file
+# that is missing from the index or whose size or mtime differs is scanned as
+# usual.
+# Any search below DIR (grep, the gpt tools' command_with_return grep, pem's
+# M-. fallback) finds the index by looking in the search path and its parents.
+#
+# File layout (little-endian):
+#   MAGIC, then '<III': file count, trigram count, byte length of file table
+#   file table: per file '<IIH' size, mtime, path length, then the path
+#     (utf-8, relative to DIR, '/' separated); file ids are table positions
+#   trigram table: per trigram, sorted by key, array('I') key, first, count
+#   postings: array('H') file ids; trigram k owns postings[first:first+count]
+
+import os
+import array
+import struct
+import dir_cache
+
+INDEX_NAME = '.grepindex'
+MAGIC = b'PDTRI1\n'
+_SKIP = (INDEX_NAME, INDEX_NAME + '.tmp')
+
+# Files bigger than this are left out of the index, so grep always reads
+# them. Files with a NUL byte near the start are listed without trigrams
+# (grep skips binary files anyway).
+MAX_FILE = 1024 * 1024
+_BLOCK = 4096
+
+
+def trigrams(data, out=None):
+  # Set of trigram keys (b0 << 16 | b1 << 8 | b2) of bytes `data`, lowercased.
+  if out is None:
+    out = set()
+  add = out.add
+  k = 0
+  n = 0
+  for c in data.lower():
+    k = ((k << 8) | c) & 0xffffff
+    n += 1
+    if n >= 3:
+      add(k)
+  return out
+
+
+def _file_trigrams(path):
+  keys = set()
+  tail = b''
+  with open(path, 'rb') as f:
+    first = True
+    while True:
+      data = f.read(_BLOCK)
+      if not data:
+        break
+      if first and b'\x00' in data:
+        return ()
+      first = False
+      # Carry two bytes so trigrams across block edges are counted.
+      trigrams(tail + data, keys)
+      tail = data[-2:]
+  return keys
+
+
+class trigram_index:
+  def __init__(self, root):
+    self.root = root            # absolute directory the index covers
+    self.path = dir_cache.join(root, INDEX_NAME)
+    self.files = {}             # relative path -> (id, size, mtime)
+    self.names = []             # id -> relative path
+    self.ntri = 0
+    self._table_pos = 0
+    self._post_pos = 0
+
+  def load(self):
+    # Read the header and file table. Returns False if there is no usable
+    # index. Posting lists stay on disk until lookup().
+    try:
+      f = open(self.path, 'rb')
+    except OSError:
+      return False
+    try:
+      if f.read(len(MAGIC)) != MAGIC:
+        return False
+      nfiles, ntri, flen = struct.unpack('<III', f.read(12))
+      blob = f.read(flen)
+    finally:
+      f.close()
+    files = {}
+    names = []
+    p = 0
+    for i in range(nfiles):
+      size, mtime, ln = struct.unpack_from('<IIH', blob, p)
+      p += 10
+      rel = str(blob[p:p + ln], 'utf-8')
+      p += ln
+      files[rel] = (i, size, mtime)
+      names.append(rel)
+    self.files = files
+    self.names = names
+    self.ntri = ntri
+    self._table_pos = len(MAGIC) + 12 + flen
+    self._post_pos = self._table_pos + ntri * 12
+    return True
+
+  def fresh(self, rel, size, mtime):
+    # File id if rel is indexed and still has the indexed size and mtime,
+    # else None.
+    e = self.files.get(rel)
+    if e is None or e[1] != size or e[2] != mtime & 0xffffffff:
+      return None
+    return e[0]
+
+  def _postings(self, f, key):
+    # File ids containing trigram `key`, by binary search over the table.
+    lo = 0
+    hi = self.ntri
+    while lo < hi:
+      mid = (lo + hi) >> 1
+      f.seek(self._table_pos + mid * 12)
+      k, first, count = struct.unpack('<III', f.read(12))
+      if k == key:
+        f.seek(self._post_pos + first * 2)
+        ids = array.array('H', f.read(count * 2))
+        return ids
+      if k < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    return ()
+
+  def lookup(self, needles):
+    # Set of file ids that may contain any of `needles` (bytes), or None if
+    # some needle is shorter than a trigram and nothing can be ruled out.
+    for nd in needles:
+      if len(nd) < 3:
+        return None
+    out = set()
+    with open(self.path, 'rb') as f:
+      for nd in needles:
+        keys = trigrams(nd)
+        ids = None
+        for key in keys:
+          p = self._postings(f, key)
+          ids = set(p) if ids is None else ids.intersection(p)
+          if not ids:
+            break
+        if ids:
+          out.update(ids)
+    return out
+
+  def build(self):
+    # Create or refresh the index. Unchanged files (same size and mtime)
+    # keep their posting entries; the rest are read again. Returns
+    # (files, files read, trigrams).
+    old = trigram_index(self.root)
+    have_old = old.load()
+    # Files over MAX_FILE, and past the 16-bit file ids, are left out (so
+    # always scanned).
+    entries = [e for e in dir_cache.scan_tree(self.root, _SKIP)
+               if e[1] <= MAX_FILE][:0xffff]
+    remap = {}    # old id -> new id, for files that did not change
+    todo = []     # new ids of files to read
+    for i in range(len(entries)):
+      rel, size, mtime = entries[i]
+      e = old.files.get(rel) if have_old else None
+      if e is not None and e[1] == size and e[2] == mtime & 0xffffffff:
+        remap[e[0]] = i
+      else:
+        todo.append(i)
+
+    post = {}   # trigram -> array('H') of new file ids
+    if remap:
+      with open(old.path, 'rb') as f:
+        f.seek(old._table_pos)
+        table = array.array('I', f.read(old.ntri * 12))
+        for t in range(old.ntri):
+          key = table[t * 3]
+          count = table[t * 3 + 2]
+          f.seek(old._post_pos + table[t * 3 + 1] * 2)
+          ids = array.array('H')
+          for fid in array.array('H', f.read(count * 2)):
+            j = remap.get(fid)
+            if j is not None:
+              ids.append(j)
+          if ids:
+            post[key] = ids
+        table = None
+    old = None
+
+    for i in todo:
+      rel, size, mtime = entries[i]
+      try:
+        keys = _file_trigrams(dir_cache.join(self.root, rel))
+      except OSError:
+        keys = ()
+      for key in keys:
+        ids = post.get(key)
+        if ids is None:
+          post[key] = array.array('H', [i])
+        else:
+          ids.append(i)
+
+    self._write(entries, post)
+    return len(entries), len(todo), len(post)
+
+  def _write(self, entries, post):
+    table = bytearray()
+    for rel, size, mtime in entries:
+      b = rel.encode('utf-8')
+      table.extend(struct.pack('<IIH', size, mtime & 0xffffffff, len(b)))
+      table.extend(b)
+    keys = sorted(post)
+    tmp = self.path + '.tmp'
+    with open(tmp, 'wb') as f:
+      f.write(MAGIC)
+      f.write(struct.pack('<III', len(entries), len(keys), len(table)))
+      f.write(table)
+      row = array.array('I', [0, 0, 0])
+      first = 0
+      for key in keys:
+        row[0] = key
+        row[1] = first
+        row[2] = len(post[key])
+        f.write(row)
+        first += row[2]
+      for key in keys:
+        f.write(post[key])
+    try:
+      os.remove(self.path)
+    except OSError:
+      pass
+    os.rename(tmp, self.path)
+
+
+def find(path):
+  # The loaded index covering `path` (the path itself or a parent holding an
+  # INDEX_NAME file), or None.
+  return dir_cache.find_index(path, trigram_index)
+
+
+def build(path, out=None):
+  # `grep --index path`: create or refresh path's index and report.
+  root = dir_cache.abspath(path)
+  if not dir_cache.is_dir(root):
+    if out is not None:
+      out.write('grep: --index needs a directory: {}\n'.format(path))
+    return None
+  t = dir_cache.ms()
+  idx = trigram_index(root)
+  nfiles, nread, ntri = idx.build()
+  if out is not None:
+    out.write('indexed {} files ({} read) in {}ms, {} trigrams -> {}\n'.format(
+      nfiles, nread, (dir_cache.ms() - t) & 0x3fffffff, ntri, idx.path))
+  return idx
@@ -5,9 +5,9 @@
 import sys
 
 # When launched as `python -m pem` (or `pem.py`) this file runs as __main__, so
-# erow's `from pem import _hl_line` would re-import it under the name `pem` and
-# hit a circular import. Alias `pem` to the running __main__ module so that
-# import resolves to us. PC-only: on the device pem is imported as `pem`.
+# a helper module doing `import pem` would load a second copy of it. Alias `pem`
+# to the running __main__ module so that import resolves to us. PC-only: on the
+# device pem is imported as `pem`.
 if __name__ == '__main__':
   sys.modules.setdefault('pem', sys.modules['__main__'])
 
@@ -37,6 +37,8 @@ except ImportError:
     time.sleep_ms = lambda ms: time.sleep(ms / 1000)
   if not hasattr(time, 'ticks_us'):
     time.ticks_us = lambda: int(time.perf_counter() * 1000000)
+  if not hasattr(time, 'ticks_diff'):
+    time.ticks_diff = lambda a, b: a - b
 
   class _pdeck_shim:
     # Stand-in for the device's native `pdeck` module. Only the calls reachable
@@ -140,6 +142,7 @@ import time
 import esclib as elib
 import argparse
 import array
+import dir_cache
 
 # Where the "resume last file" state is stored. The device keeps it under
 # /config; on CPython that path doesn't exist, so use the home directory.
@@ -263,6 +266,7 @@ if pdeck_enabled:
   _HL_HEADING = b'\x1b[1m'
   _HL_EMPH    = b'\x1b[1m'
   _HL_LINK    = b'\x1b[1m'
+  _HL_MATCH   = b'\x1b[7m'
 else:
   # Desktop terminals support ANSI color, so give each token type its own hue.
   _HL_KEYWORD = b'\x1b[38;5;204m'    # pink   keywords
@@ -271,6 +275,7 @@ else:
   _HL_HEADING = b'\x1b[1;38;5;39m'   # bold blue   md headings
   _HL_EMPH    = b'\x1b[1;38;5;214m'  # bold orange md **emphasis**
   _HL_LINK    = b'\x1b[4;38;5;81m'   # underlined cyan md links
+  _HL_MATCH   = b'\x1b[30;48;5;222m' # black on yellow  search hits
 _B_HL_ON = _HL_KEYWORD  # backward-compatible alias
 
 def _is_id_cont(c):
@@ -279,195 +284,269 @@ def _is_id_cont(c):
 def _is_id_cont_b(c):
   return (65 <= c <= 90) or (97 <= c <= 122) or (48 <= c <= 57) or c == 95
 
-def _hl_md(b):
+# Each lexer takes one line (bytes) and the lexer state carried in from the end
+# of the previous line, and returns (spans, state_out). spans is a sorted list
+# of non-overlapping (start, end, sgr) byte ranges; state 0 means "nothing
+# open". Multi-line constructs (py triple-quoted strings, C block comments, md
+# fenced code) are the only things carried between lines.
+_PY_SQ3 = 1   # inside a ''' string
+_PY_DQ3 = 2   # inside a """ string
+_C_BLOCK = 1  # inside /* */
+_MD_FENCE = 1 # inside a ``` code block
+
+def _lex_md(b, state):
   if type(b) is not bytes:
     b = bytes(b)
+  spans = []
+  add = spans.append
+  n = len(b)
+  if b[:3] == b'```':
+    if n and _HL_STRING is not None:
+      add((0, n, _HL_STRING))
+    return spans, 0 if state else _MD_FENCE
+  if state:
+    if n and _HL_STRING is not None:
+      add((0, n, _HL_STRING))
+    return spans, state
   if not b:
-    return None
-  if b[0] == 35:  # '#' heading — wrap whole line
+    return spans, 0
+  if b[0] == 35:  # '#' heading -- wrap whole line
     idx = 0
     while len(b) > idx and b[idx] == 35:
       idx += 1
     # if # is not followed by space, it's a tag.
     if len(b) > idx and b[idx] == 0x20:
-      return b''.join([_HL_HEADING, b, _B_HL_OFF])
+      add((0, n, _HL_HEADING))
+      return spans, 0
 
   if b'**' not in b and b'[' not in b and b'#' not in b:
-    return None
-  parts = []
-  append = parts.append
+    return spans, 0
   i = 0
-  n = len(b)
-  modified = False
   while i < n:
     c = b[i]
     if c == 42 and i + 1 < n and b[i + 1] == 42:  # '**'
       j = b.find(b'**', i + 2)
       if j != -1:
-        append(_HL_EMPH); append(b[i:j + 2]); append(_B_HL_OFF)
-        modified = True
+        add((i, j + 2, _HL_EMPH))
         i = j + 2
         continue
     elif c == 91:  # '['
       if i > 0 and b[i-1] == 0x1b:
-        append(b[i:i+1])
         i += 1
         continue
       if i + 1 < n and b[i + 1] == 91:  # '[['
         j = b.find(b']]', i + 2)
         if j != -1:
-          append(_HL_LINK); append(b[i:j + 2]); append(_B_HL_OFF)
-          modified = True
+          add((i, j + 2, _HL_LINK))
           i = j + 2
           continue
       else:
         j = b.find(b']', i + 1)
         if j != -1:
-          append(_HL_LINK); append(b[i:j + 1]); append(_B_HL_OFF)
-          modified = True
+          add((i, j + 1, _HL_LINK))
           i = j + 1
           continue
     elif c == 35:  # '#'
       j = b.find(b' ', i + 1)
       if j == -1:
         j=len(b)-1
-      append(_HL_HEADING); append(b[i:j + 1]); append(_B_HL_OFF)
-      modified = True
+      add((i, j + 1, _HL_HEADING))
       i = j + 1
       continue
-
-    append(b[i:i + 1])
     i += 1
-  if not modified:
-    return None
-  return b''.join(parts)
+  return spans, 0
+
+def _lex_quoted(b, i, n):
+  # End of the ' or " literal starting at b[i] (backslash escapes the next
+  # byte; unterminated runs to end of line).
+  c = b[i]
+  j = i + 1
+  while j < n:
+    if b[j] == 92:
+      j += 2
+      continue
+    if b[j] == c:
+      return j + 1
+    j += 1
+  return n
 
-def _hl_py(b):
+def _lex_py(b, state):
   if type(b) is not bytes:
     b = bytes(b)
-  parts = []
-  append = parts.append
+  spans = []
+  add = spans.append
   i = 0
   n = len(b)
-  modified = False
+  if state:
+    j = b.find(b"'''" if state == _PY_SQ3 else b'"""')
+    i = n if j == -1 else j + 3
+    if i and _HL_STRING is not None:
+      add((0, i, _HL_STRING))
+    if j == -1:
+      return spans, state
+    state = 0
   while i < n:
     c = b[i]
     if c == 35:  # '#' comment runs to end of line
-      if _HL_COMMENT is None:
-        append(b[i:])
-      else:
-        append(_HL_COMMENT); append(b[i:]); append(_B_HL_OFF)
-        modified = True
+      if _HL_COMMENT is not None:
+        add((i, n, _HL_COMMENT))
       break
-    if _HL_STRING is not None and (c == 34 or c == 39):  # " or ' string literal
-      j = i + 1
-      while j < n:
-        if b[j] == 92:  # backslash escapes the next byte
-          j += 2
-          continue
-        if b[j] == c:
-          j += 1
-          break
-        j += 1
-      append(_HL_STRING); append(b[i:j]); append(_B_HL_OFF)
-      modified = True
+    if c == 34 or c == 39:  # " or ' string literal
+      if i + 2 < n and b[i + 1] == c and b[i + 2] == c:  # triple quote
+        j = b.find(b[i:i + 3], i + 3)
+        if j == -1:
+          j = n
+          state = _PY_SQ3 if c == 39 else _PY_DQ3
+        else:
+          j += 3
+      else:
+        j = _lex_quoted(b, i, n)
+      if _HL_STRING is not None:
+        add((i, j, _HL_STRING))
       i = j
       continue
     if (65 <= c <= 90) or (97 <= c <= 122) or c == 95:  # isalpha or '_'
       j = i + 1
       while j < n and _is_id_cont_b(b[j]):
         j += 1
-      word = b[i:j]
-      if word in _PY_KEYWORDS_B:
-        append(_HL_KEYWORD)
-        append(word)
-        append(_B_HL_OFF)
-        modified = True
-      else:
-        append(word)
+      if b[i:j] in _PY_KEYWORDS_B:
+        add((i, j, _HL_KEYWORD))
       i = j
     else:
-      append(b[i:i + 1])
       i += 1
-  if not modified:
-    return None
-  return b''.join(parts)
+  return spans, state
 
-def _hl_c(b):
-  # Like _hl_py but with C tokens: // and /* */ comments, "..."/'...' literals,
+def _lex_c(b, state):
+  # Like _lex_py but with C tokens: // and /* */ comments, "..."/'...' literals,
   # C keywords. Note '#' is a preprocessor directive in C, not a comment.
   if type(b) is not bytes:
     b = bytes(b)
-  parts = []
-  append = parts.append
+  spans = []
+  add = spans.append
   i = 0
   n = len(b)
-  modified = False
+  if state:
+    j = b.find(b'*/')
+    i = n if j == -1 else j + 2
+    if i and _HL_COMMENT is not None:
+      add((0, i, _HL_COMMENT))
+    if j == -1:
+      return spans, state
+    state = 0
   while i < n:
     c = b[i]
     if c == 47 and i + 1 < n and b[i + 1] == 47:  # '//' line comment
-      if _HL_COMMENT is None:
-        append(b[i:])
-      else:
-        append(_HL_COMMENT); append(b[i:]); append(_B_HL_OFF)
-        modified = True
+      if _HL_COMMENT is not None:
+        add((i, n, _HL_COMMENT))
       break
     if c == 47 and i + 1 < n and b[i + 1] == 42:  # '/*' block comment
       j = b.find(b'*/', i + 2)
-      end = (j + 2) if j != -1 else n   # unterminated -> to end of line
-      if _HL_COMMENT is None:
-        append(b[i:end])
+      if j == -1:   # unterminated -> continues on the next line
+        end = n
+        state = _C_BLOCK
       else:
-        append(_HL_COMMENT); append(b[i:end]); append(_B_HL_OFF)
-        modified = True
+        end = j + 2
+      if _HL_COMMENT is not None:
+        add((i, end, _HL_COMMENT))
       i = end
       continue
-    if _HL_STRING is not None and (c == 34 or c == 39):  # " string or ' char
-      j = i + 1
-      while j < n:
-        if b[j] == 92:  # backslash escapes the next byte
-          j += 2
-          continue
-        if b[j] == c:
-          j += 1
-          break
-        j += 1
-      append(_HL_STRING); append(b[i:j]); append(_B_HL_OFF)
-      modified = True
+    if c == 34 or c == 39:  # " string or ' char
+      j = _lex_quoted(b, i, n)
+      if _HL_STRING is not None:
+        add((i, j, _HL_STRING))
       i = j
       continue
     if (65 <= c <= 90) or (97 <= c <= 122) or c == 95:  # isalpha or '_'
       j = i + 1
       while j < n and _is_id_cont_b(b[j]):
         j += 1
-      word = b[i:j]
-      if word in _C_KEYWORDS_B:
-        append(_HL_KEYWORD)
-        append(word)
-        append(_B_HL_OFF)
-        modified = True
-      else:
-        append(word)
+      if b[i:j] in _C_KEYWORDS_B:
+        add((i, j, _HL_KEYWORD))
       i = j
     else:
-      append(b[i:i + 1])
       i += 1
-  if not modified:
-    return None
+  return spans, state
+
+_HL_LEXERS = {'py': _lex_py, 'c': _lex_c, 'md': _lex_md}
+
+def _hl_next_state(mode, b, state):
+  # State at the end of line b without building spans. Most lines can't open
+  # or close a multi-line construct, which a substring test rules out.
+  if mode == 'py':
+    if state == 0:
+      if b"'''" not in b and b'"""' not in b:
+        return 0
+    elif (b"'''" if state == _PY_SQ3 else b'"""') not in b:
+      return state
+  elif mode == 'c':
+    if state == 0:
+      if b'/*' not in b:
+        return 0
+    elif b'*/' not in b:
+      return state
+  elif mode == 'md':
+    if b[:3] != b'```':
+      return state
+    return 0 if state else _MD_FENCE
+  else:
+    return 0
+  return _HL_LEXERS[mode](b, state)[1]
+
+def _hl_apply(b, spans, start=0, end=None):
+  # Render b[start:end] with the (clipped) spans wrapped in their SGRs.
+  if end is None or end > len(b):
+    end = len(b)
+  parts = []
+  append = parts.append
+  pos = start
+  for s, e, sgr in spans:
+    if e <= pos:
+      continue
+    if s >= end:
+      break
+    if s < pos:
+      s = pos
+    if e > end:
+      e = end
+    if s > pos:
+      append(b[pos:s])
+    append(sgr); append(b[s:e]); append(_B_HL_OFF)
+    pos = e
+  if not parts:
+    return b[start:end]
+  append(b[pos:end])
   return b''.join(parts)
 
+def _hl_overlay(spans, marks, sgr):
+  # Lay the (start, end) ranges in marks over spans, styled sgr; the parts of
+  # spans they cover are cut away. Both inputs sorted and non-overlapping.
+  spans = list(spans)
+  out = []
+  k = 0
+  for ms, me in marks:
+    while k < len(spans) and spans[k][1] <= ms:
+      out.append(spans[k])
+      k += 1
+    while k < len(spans) and spans[k][0] < me:
+      s, e, g = spans[k]
+      if s < ms:
+        out.append((s, ms, g))
+      if e > me:
+        spans[k] = (me, e, g)
+        break
+      k += 1
+    out.append((ms, me, sgr))
+  out.extend(spans[k:])
+  return out
+
 def _hl_line(line_bytes, mode):
+  # Stateless one-line highlight (used where no buffer context is available).
   if not line_bytes:
     return line_bytes
-  if mode == 'py':
-    out = _hl_py(line_bytes)
-  elif mode == 'md':
-    out = _hl_md(line_bytes)
-  elif mode == 'c':
-    out = _hl_c(line_bytes)
-  else:
+  lex = _HL_LEXERS.get(mode)
+  if lex is None:
     return line_bytes
-  return line_bytes if out is None else out
+  return _hl_apply(line_bytes, lex(line_bytes, 0)[0])
 
 class editor:
   def __init__(self,v, japanese):
@@ -485,6 +564,7 @@ class editor:
     self.in_ext_mode = False
     self.pending_keys = None
     self._chord_items = []
+    self._ref_hits = None          # (path, row, col) choices for M-. across files
     self._chord_saved_scroll = None
     self.should_quit = False
 
@@ -632,25 +712,27 @@ class editor:
       return (False, 'line_from %d is past end of file (%d lines)' % (line_from, nrows))
     if line_to > nrows:
       line_to = nrows
-    # Build the replacement rows from `content` (newline-separated). An empty
-    # string deletes the range outright (no blank line left behind); the
-    # at-least-one-row safeguard below keeps an emptied file valid.
-    new_rows = []
-    if content != "":
-      for ln in content.split('\n'):
-        row = erow(ln.encode('utf-8'), f.tab_size, f.w)
-        row.hl_mode = f.mode
-        new_rows.append(row)
-    # Snapshot for undo BEFORE mutating so the user can C-z the AI's edit.
+    # `content` (newline-separated) replaces the range. An empty string deletes
+    # the range outright (no blank line left behind); an emptied file keeps one
+    # empty row for the renderer/cursor logic.
+    n_new = 0 if content == "" else content.count('\n') + 1
+    # Start an undo group BEFORE mutating so the user can C-z the AI's edit.
     f.undo.record(self, 'other')
-    f.rows[line_from - 1:line_to] = new_rows
-    # A file must always have at least one row for the renderer/cursor logic.
-    if len(f.rows) == 0:
-      row = erow(b"", f.tab_size, f.w)
-      row.hl_mode = f.mode
-      f.rows.append(row)
-    f.modified = True
-    f.num_updated = 0  # force syntax re-highlight from the top
+    last = nrows - 1
+    if line_from > nrows:
+      if content != "":
+        f.insert_text(last, f.rows[last].get_len(), "\n" + content)
+    elif line_to < nrows:
+      f.delete_text(line_from - 1, 0, line_to, 0)
+      if content != "":
+        f.insert_text(line_from - 1, 0, content + "\n")
+    elif content != "":
+      f.delete_text(line_from - 1, 0, last, f.rows[last].get_len())
+      f.insert_text(line_from - 1, 0, content)
+    elif line_from > 1:
+      f.delete_text(line_from - 2, f.rows[line_from - 2].get_len(), last, f.rows[last].get_len())
+    else:
+      f.delete_text(0, 0, last, f.rows[last].get_len())
     # Clamp the cursor into the (possibly shorter) buffer.
     if self.file_row >= len(f.rows):
       self.file_row = len(f.rows) - 1
@@ -658,11 +740,11 @@ class editor:
     rlen = f.rows[self.file_row].get_len()
     if self.file_col > rlen:
       self.file_col = rlen
-    if len(new_rows) == 0:
+    if n_new == 0:
       return (True, 'deleted lines %d-%d; file now has %d line(s)'
                     % (line_from, line_to, len(f.rows)))
     return (True, 'replaced lines %d-%d with %d line(s); file now has %d line(s)'
-                  % (line_from, line_to, len(new_rows), len(f.rows)))
+                  % (line_from, line_to, n_new, len(f.rows)))
 
   def pub_read_content(self, line_from=1, line_to=None):
     # Remote/AI read-only access to the CURRENT file's text. Safe to call from
@@ -670,6 +752,8 @@ class editor:
     # are 1-based and INCLUSIVE; line_to=None (or beyond EOF) reads to the end.
     # Returns (ok: bool, text-or-error: str). The text is newline-joined.
     f = self.file
+    if f.load_file is not None:
+      return (False, 'file is still loading; try again')
     nrows = len(f.rows)
     try:
       line_from = int(line_from)
@@ -690,9 +774,11 @@ class editor:
       return (True, '')  # range starts past EOF -> empty
     if line_to < line_from:
       return (False, 'invalid range: need line_from <= line_to')
+    # chars_at, not rows[i]: materializing a row writes into the row store,
+    # which the editor task may be changing at the same time.
     lines = []
     for i in range(line_from - 1, line_to):
-      lines.append(f.rows[i].decode())
+      lines.append(bytes(f.rows.chars_at(i)).decode('utf-8'))
     return (True, '\n'.join(lines))
 
   def pub_switch_buffer(self, filename, timeout_ms=4000):
@@ -752,10 +838,22 @@ class editor:
   def open(self, filename, linenum=0, colnum=0):
     self.file = editor_file(self.v, filename, self.text_height, self.text_width - 1, self.tab_size)
     self.file_row, self.file_col = self.file.open(linenum, colnum)
-    self.v.background_update=self.file.background_update
+    self.v.background_update=self.background_update
     self.render_main_text(True)
     self.jump_to_position(self.file_row, self.file_col, 1, False)
 
+  def background_update(self):
+    # Idle hook for the screen interface: lets the current buffer stream in the
+    # rest of its file and catch its highlight state up, and redraws when the
+    # screen is out of date (load finished, or a frame was drawn with guessed
+    # highlight states after a far jump).
+    busy = self.file.background_update()
+    if self.file.redraw_pending:
+      self.file.redraw_pending = False
+      if self.mode == self.MODE_NORMAL:
+        self.refresh_screen()
+    return busy
+
   def setup_screen(self):
     self.v.set_raw_mode(True)
     #self.v.print(el.wraparound_mode(False))
@@ -896,7 +994,7 @@ class editor:
         filename = self.file.filename
         if filename == None:
           filename = '** New file **'
-        filestat = f"{'*' if self.file.modified else '-'} L:{self.file_row+1}/{len(self.file.rows)} C:{self.file_col+1}"
+        filestat = f"{'*' if self.file.modified else '-'} L:{self.file_row+1}/{len(self.file.rows)}{'+' if self.file.load_file else ''} C:{self.file_col+1}"
 
         max_filename_length = self.file.w - (len(filestat) + 5 + 2 + 2 + 1 + 2)
         if len(filename) > max_filename_length:
@@ -910,9 +1008,14 @@ class editor:
         stbout.append(statline)
         self.v.print(''.join(stbout))
       if self.mode == self.MODE_SEARCH:
-        searchstat = f"Search: {self.search_info.query_str}"
+        searchstat = f"{'Regexp search' if self.search_info.regex else 'Search'}: {self.search_info.query_str}"
+        idx = self.file.sidx
         if self.search_info.matched_query == None:
           searchstat += " : Not found"
+        elif idx is not None and self.search_info.query_str:
+          searchstat += f" [{self.search_info.index}/{idx.total}]"
+        if idx is not None and idx.error:
+          searchstat += f" ({idx.error})"
         statline = searchstat + " " * (self.text_width - len(searchstat))
         self.v.print(statline)
 
@@ -1085,40 +1188,52 @@ class editor:
     else:
       self.search_info.last_direction = direction
 
-    row = self.file_row
-    col = self.file_col
-
     query = self.search_info.query_str
     self.search_info.matched_query = None
-    #print(f"Query: {row},{col},{direction} q={query}")
-    num_found = 0
-    if direction == 1:
-      r_goal = len(self.file.rows)
-    if direction == -1:
-      r_goal = -1
-    
     self.search_info.aborted = False
-    for idx in range(row, r_goal, direction):
-      if self.v.poll():
-        #keyboard interrupt
-        print(f"Aborting {query}")
-        self.search_info.aborted = True
-        return  
-      row = self.file.rows[idx]
-      #print(f" searching.. row {idx} col {col} dir {direction}")
-      result, self.search_info.matched_query = row.search(col, query, direction)
-
-      # Reset col for the second line and the rest
-      if direction == 1:
-        col = 0 
-      else:
-        col = -1
+    if not query:
+      self.search_info.matched_query = ""
+      return
+    idx = self.get_search_index(query)
+    if idx is None:
+      #keyboard interrupt
+      print(f"Aborting {query}")
+      self.search_info.aborted = True
+      return
+    if direction == 1:
+      hit = idx.next(self.file_row, self.file_col)
+    else:
+      hit = idx.prev(self.file_row, self.file_col)
+    if hit is None:
+      return
+    r, c, n = hit
+    self.search_info.matched_query = self.file.rows[r].substr(c, c + n).decode('utf-8')
+    self.search_info.index = idx.rank(r, c)
+    self.jump_to_position(r, c, direction)
+
+  def get_search_index(self, query):
+    # The current buffer's match index for query, built on first use. Typing
+    # more of a literal query only rescans the rows the shorter one hit.
+    # Returns None if a keypress interrupted the build.
+    f = self.file
+    regex = self.search_info.regex
+    idx = f.sidx
+    if idx is not None and idx.query == query and idx.regex == regex:
+      return idx
+    new = search_index(query, regex)
+    prev = None
+    if idx is not None and new.pat is None and idx.pat is None and idx.query \
+        and query.startswith(idx.query) and idx.fold == new.fold:
+      prev = idx
+    f.sidx = None
+    if not new.build(f.rows, self.v.poll, prev):
+      return None
+    f.sidx = new
+    return new
 
-      if result != None:
-        num_found += 1
-        #print(f"{query} found at {idx},{result}")
-        self.jump_to_position(idx, result, direction)
-        break
+  def close_search(self):
+    self.search_info.close()
+    self.file.sidx = None
 
   def jump_to_position(self, r, c, direction = 1, stay_if_possible = True):
     if len(self.file.rows) < 2:
@@ -1165,6 +1280,8 @@ class editor:
     self.search_exec(1)
     if self.search_info.matched_query:
       self.open_input_line_dialog("Replace","Replace? y/n (q for quit)", self.process_replace_yn, ["y","n","q"])
+    else:
+      self.file.sidx = None
     
   def process_revert_yn(self, answer):
     if answer.chars == b"n":
@@ -1200,19 +1317,21 @@ class editor:
     #print(f"Answer: {answer.decode()}")
     if answer.chars == b"q":
       self.recall_pos(self.search_info.saved_pos)
-      self.search_info.close()
+      self.close_search()
       return
     if answer.chars == b"y":
       self.file.undo.record(self, 'other')
-      row = self.file.rows[self.file_row]
-      row.delete_str(self.file_col, len(self.search_info.query_str))
-      row.insert_str(self.file_col, self.search_info.replace_str)
+      r, c = self.file_row, self.file_col
+      self.file.delete_text(r, c, r, c + len(self.search_info.query_str))
+      self.file.insert_text(r, c, self.search_info.replace_str)
       
     for i in range(0, len(self.search_info.replace_str)):
        self.cursor_move(0,1)
     self.search_exec(1)
     if self.search_info.matched_query:
       self.open_input_line_dialog("Replace","Replace? y/n (q for quit)", self.process_replace_yn, ["y","n","q"])
+    else:
+      self.file.sidx = None
     return
 
   def process_goto_line(self, num):
@@ -1323,9 +1442,78 @@ class editor:
       self.filename = None
       self.file.filename = None
     else:
-      self.set_message(f"{total} bytes written")
+      self.set_message(self.saved_message(total))
     return
     
+  def saved_message(self, total):
+    # "N bytes written", plus the write rate so SD card cost is visible.
+    ms = self.file.save_ms
+    if ms <= 0:
+      return f"{total} bytes written"
+    return f"{total} bytes written in {ms}ms ({total // ms} KB/s)"
+
+  def ref_in_files(self, query):
+    # M-. fallback: find `query` in the other files under this buffer's
+    # directory and jump there (or offer a list). Only done when the tree has
+    # a grep trigram index: reading every file unindexed would stall the
+    # editor on a large card.
+    if not self.file.filename:
+      return
+    try:
+      import grep
+      import trigram_index
+      root = _dirname(self.file.filename)
+      if trigram_index.find(root) is None:
+        return
+      me = dir_cache.abspath(self.file.filename)
+      hits = [h for h in grep.find_in_files(query, root)
+              if dir_cache.abspath(h[0]) != me]
+    except Exception as e:
+      print(e)
+      return
+    if not hits:
+      self.set_message("Not found in files under " + root)
+      return
+    self.scroll_row, self.scroll_col, self.file_row, self.file_col = self.search_info.saved_pos
+    self.mode = self.MODE_NORMAL
+    self.close_search()
+    self._ref_hits = [(h[0], h[1] - 1, max(h[2].find(query), 0)) for h in hits]
+    if len(hits) == 1:
+      self.process_ref_select(0, hits[0][0])
+      return
+    paths = [h[0] for h in hits]
+    disp = [_trim_path(h[0], 24) + ':' + str(h[1]) + ' ' + h[2].strip() for h in hits]
+    self.open_select_dialog(paths, min(len(hits), 5), query, self.process_ref_select, dlist=disp)
+
+  def show_backlinks(self):
+    # M-, : notes whose [[links]] point at this buffer, from the link index
+    # `graph --index` keeps at the vault root (no index, no search: reading
+    # every note would stall the editor).
+    if not self.file.filename:
+      return
+    try:
+      import link_index
+      idx = link_index.find(_dirname(self.file.filename))
+      if idx is None:
+        self.set_message("No link index (run graph --index)")
+        return
+      paths = idx.backlinks(self.file.filename)
+      idx.save()
+    except Exception as e:
+      print(e)
+      return
+    if not paths:
+      self.set_message("No backlinks")
+      return
+    self._ref_hits = [(p, 0, 0) for p in paths]
+    disp = [_trim_path(p, 40) for p in paths]
+    self.open_select_dialog(paths, min(len(paths), 5), "Backlinks", self.process_ref_select, dlist=disp)
+
+  def process_ref_select(self, idx, item):
+    path, row, col = self._ref_hits[idx]
+    self._ref_hits = None
+    self.process_open_file(path.encode('utf-8'), row, col)
+
   def process_yank_select(self, idx, item):
     #print("process_yank_select")
     self.yankbuf.curbuf = item
@@ -1386,7 +1574,7 @@ class editor:
     #print("process_file_select")
     self.file_list.insert(0,self.file)
     self.file = self.file_list[idx+1]
-    self.v.background_update=self.file.background_update
+    self.v.background_update=self.background_update
     self.file.w = self.text_width - 1
     self.file.h = self.text_height
     del self.file_list[idx+1]
@@ -1405,7 +1593,7 @@ class editor:
       self.text_height += 1
       self.file.h += 1
       self.sl_info = None
-      self.search_info.close()
+      self.close_search()
       return
       
     if self.input_answer_list:
@@ -1582,9 +1770,8 @@ class editor:
   def process_comp_select(self, idx, comp):
     self.file.undo.record(self, 'other')
     pos, sym = self.file.get_symbol(self.file_row, self.file_col)
-    row = self.file.rows[self.file_row]
-    row.delete_str(pos,len(sym))
-    row.insert_str(pos,comp)
+    self.file.delete_text(self.file_row, pos, self.file_row, pos + len(sym))
+    self.file.insert_text(self.file_row, pos, comp)
     #print(f"Replaced to {comp}")
     #self.cursor_move(0,pos - self.file_col + len(comp))
     self.file_col += pos - self.file_col + len(comp)
@@ -1599,7 +1786,15 @@ class editor:
       if self.search_info.matched_query != None:
         self.search_info.last_query_str = self.search_info.query_str
       self.mode = self.MODE_NORMAL
-      self.search_info.close()
+      self.close_search()
+      return
+
+    #M-r toggles regexp search and redoes it from where it started
+    if keys in km.map['search_regex']:
+      self.search_info.regex = not self.search_info.regex
+      self.file_row = self.search_info.saved_pos[2]
+      self.file_col = self.search_info.saved_pos[3]
+      self.search_exec()
       return
 
     #Arrow keys (or any escape sequences, some control keys) to quit
@@ -1613,7 +1808,7 @@ class editor:
         self.search_info.last_query_str = self.search_info.query_str
         #print(f"Record last query = {self.search_info.last_query_str}")
       self.mode = self.MODE_NORMAL
-      self.search_info.close()
+      self.close_search()
       return
 
     #Ctrl-s (Next)
@@ -1666,7 +1861,10 @@ class editor:
     elif keys[0] >= 0x20:
 
       self.search_info.query_str += keys.decode("utf-8")
-      if self.search_info.aborted or self.search_info.matched_query or len(self.search_info.query_str) == 1:
+      # A longer literal query can't match where the shorter one didn't, but a
+      # longer regexp can.
+      if self.search_info.aborted or self.search_info.matched_query or self.search_info.regex \
+          or len(self.search_info.query_str) == 1:
         self.search_exec()
 
   def set_message(self, message):
@@ -1753,6 +1951,9 @@ class editor:
     else:
       keys = self.v.read(1)
 
+    # A file still streaming in is finished before anything acts on it.
+    self.file.finish_load()
+
     # Remote AI edits are serviced here (read() synthesizes REMOTE_EDIT_KEY when
     # edit_pending_list is non-empty), so the buffer is only mutated on this,
     # the editor's own, thread. Mirrors the open_pending_list / C-x C-f path.
@@ -1835,7 +2036,7 @@ class editor:
       if self.search_info.matched_query != None:
         self.search_info.last_query_str = self.search_info.query_str
       self.mode = self.MODE_NORMAL
-      self.search_info.close()
+      self.close_search()
 
     if self.mode == self.MODE_SEARCH:
       return self.process_search(keys)
@@ -1909,7 +2110,7 @@ class editor:
         if total == 0:
           self.set_message('File write error')
         else:
-          self.set_message(f"{total} bytes written")
+          self.set_message(self.saved_message(total))
     # C-x C-v to revert change
     if keys in km.map['revert']:
       self.open_input_line_dialog("Revert","Revert current file? y/n", self.process_revert_yn, ["y","n"])
@@ -2061,8 +2262,17 @@ class editor:
           self.file_col = 0
 
         self.search_exec(1)
+        # Not defined in this buffer: look in the files around it when their
+        # tree has a grep index (grep --index).
+        if keys in km.map['ref_def'] and self.search_info.matched_query is None \
+            and not self.search_info.aborted:
+          self.ref_in_files(self.search_info.query_str)
+
 
 
+    # Escape + , : Notes linking to this one
+    elif keys in km.map.get('backlinks', []):
+      self.show_backlinks()
 
     # Escape + < : Go to the top
     elif keys in km.map['top']:
@@ -2232,7 +2442,7 @@ class editor:
           tab_process = False
           pos, sym = self.file.get_symbol(self.file_row, self.file_col)
           if sym:
-            complist = self.file.get_comp_list(sym)
+            complist = self.file.get_comp_list(sym, self.file_list)
             if not complist:
               return
             if len(complist) == 0:
@@ -2309,40 +2519,86 @@ def _edit_class(keys):
   return 'sep'
 
 class undo_history:
-  # Snapshot-based undo/redo with word/line coalescing. erow.chars is
-  # copy-on-write (every edit reassigns it, never mutates in place), so a
-  # snapshot can store line references cheaply and unchanged lines are shared
-  # across snapshots.
-  def __init__(self, limit=40):
-    self.limit = limit
+  # Operation-log undo/redo with word/line coalescing. editor_file's journaled
+  # primitives (insert_text / delete_text) log one record per edit:
+  #   ('i', r1, c1, r2, c2, text)  text was inserted, now spans (r1,c1)-(r2,c2)
+  #   ('d', r1, c1, r2, c2, text)  text that spanned (r1,c1)-(r2,c2) was deleted
+  # Rows are separated by b'\n' inside text. A group is
+  #   [cursor_before, cursor_after, ops, bytes]
+  # and undo/redo replay its ops in reverse/forward order, touching only the
+  # rows those ops cover. History is capped by the bytes it holds rather than
+  # by a group count.
+  OP_COST = 48   # rough per-record overhead on top of the text itself
+
+  def __init__(self, limit_bytes=65536):
+    self.limit_bytes = limit_bytes
     self.undo = []
     self.redo = []
+    self.nbytes = 0
+    self.replaying = False
+    self.open = False
     self.last_kind = None
     self.last_class = None
     self.exp_row = -1
     self.exp_col = -1
 
-  def _snap(self, ed):
-    return ([r.chars for r in ed.file.rows],
-            ed.file_row, ed.file_col, ed.scroll_row, ed.scroll_col)
-
-  def _restore(self, ed, snap):
-    rows, fr, fc, sr, sc = snap
-    newrows = []
-    for cb in rows:
-      row = erow(bytearray(cb), ed.file.tab_size, ed.file.w)
-      row.hl_mode = ed.file.mode
-      newrows.append(row)
-    ed.file.rows = newrows
-    ed.file.num_updated = 0
-    ed.file_row, ed.file_col = fr, fc
-    ed.scroll_row, ed.scroll_col = sr, sc
-    ed.dmod = True
+  def _pos(self, ed):
+    return (ed.file_row, ed.file_col, ed.scroll_row, ed.scroll_col)
+
+  def _drop_redo(self):
+    for g in self.redo:
+      self.nbytes -= g[3]
+    self.redo = []
+
+  def _new_group(self, pos):
+    self.undo.append([pos, None, [], 0])
+    self._drop_redo()
+    self.open = True
+    self._trim()
+
+  def _trim(self):
+    # Drop the oldest groups until we're back under the byte cap. The group
+    # being built is never dropped.
+    while self.nbytes > self.limit_bytes and len(self.undo) > 1:
+      self.nbytes -= self.undo.pop(0)[3]
+
+  def log(self, op):
+    # Called by editor_file for every journaled edit.
+    if self.replaying:
+      return
+    if not self.open or not self.undo:
+      # An edit nobody announced with record(): give it its own group so
+      # positions in older records stay consistent.
+      self._new_group((op[1], op[2], -1, -1))
+    g = self.undo[-1]
+    ops = g[2]
+    merged = None
+    if ops and op[1] == op[3]:
+      # Typing or deleting char by char: extend the previous same-row record
+      # instead of adding one per keystroke.
+      last = ops[-1]
+      k, r, c1, _, c2, text = op
+      if last[0] == k and last[1] == last[3] == r:
+        if k == 'i' and last[4] == c1:
+          merged = (k, r, last[2], r, c2, last[5] + text)
+        elif k == 'd' and last[2] == c2:      # backspace
+          merged = (k, r, c1, r, c1 + (c2 - c1) + (last[4] - last[2]), text + last[5])
+        elif k == 'd' and last[2] == c1:      # forward delete
+          merged = (k, r, c1, r, last[4] + (c2 - c1), last[5] + text)
+    if merged:
+      ops[-1] = merged
+      cost = len(op[5])
+    else:
+      ops.append(op)
+      cost = len(op[5]) + self.OP_COST
+    g[3] += cost
+    self.nbytes += cost
+    self._trim()
 
   def record(self, ed, kind, cclass=None):
-    # Call BEFORE a mutation. Start a new undo group (push a snapshot of the
-    # pre-edit state) or coalesce with the current one for word/line granularity.
-    brk = (not self.undo) or kind != self.last_kind or kind == 'other'
+    # Call BEFORE a mutation. Start a new undo group (remember the caret) or
+    # coalesce with the current one for word/line granularity.
+    brk = (not self.undo) or (not self.open) or kind != self.last_kind or kind == 'other'
     if not brk:
       if kind == 'insert':
         if cclass == 'nl' or self.last_class == 'nl':
@@ -2355,10 +2611,13 @@ class undo_history:
         if ed.file_row != self.exp_row:
           brk = True
     if brk:
-      self.undo.append(self._snap(ed))
-      if len(self.undo) > self.limit:
-        self.undo.pop(0)
-      self.redo = []
+      if self.undo and not self.undo[-1][2]:
+        # previous group never received an edit; reuse it
+        self.undo[-1][0] = self._pos(ed)
+        self._drop_redo()
+        self.open = True
+      else:
+        self._new_group(self._pos(ed))
     self.last_kind = kind
     self.last_class = cclass
     # Predict the caret after this edit so the next one can test contiguity.
@@ -2370,24 +2629,83 @@ class undo_history:
       self.exp_row, self.exp_col = -1, -1
 
   def _reset_group(self):
+    self.open = False
     self.last_kind = None
     self.last_class = None
     self.exp_row = -1
     self.exp_col = -1
 
+  def _clear(self, ed):
+    self.undo = []
+    self.redo = []
+    self.nbytes = 0
+    self._reset_group()
+    ed.set_message("Undo history out of sync; cleared")
+
+  def _apply(self, ed, op, forward):
+    # Apply (forward=True) or revert one record. Returns False if the buffer no
+    # longer matches the record (it was changed behind the journal's back).
+    kind, r1, c1, r2, c2, text = op
+    f = ed.file
+    if (kind == 'i') == forward:
+      if r1 >= len(f.rows) or c1 > f.rows[r1].get_len():
+        return False
+      f._ins(r1, c1, text)
+    else:
+      if r2 >= len(f.rows) or f.region_bytes(r1, c1, r2, c2) != text:
+        return False
+      f._del(r1, c1, r2, c2)
+    return True
+
+  def _replay(self, ed, g, forward):
+    ops = g[2] if forward else g[2][::-1]
+    self.replaying = True
+    try:
+      for op in ops:
+        if not self._apply(ed, op, forward):
+          return False
+    finally:
+      self.replaying = False
+    ed.file.modified = True
+    return True
+
+  def _set_pos(self, ed, pos):
+    fr, fc, sr, sc = pos
+    f = ed.file
+    if fr >= len(f.rows):
+      fr = len(f.rows) - 1
+    rlen = f.rows[fr].get_len()
+    ed.file_row, ed.file_col = fr, fc if fc <= rlen else rlen
+    if sr >= 0:
+      ed.scroll_row, ed.scroll_col = sr, sc
+    else:
+      ed.jump_to_position(ed.file_row, ed.file_col, 1, False)
+    ed.dmod = True
+
   def undo_one(self, ed):
+    while self.undo and not self.undo[-1][2]:
+      self.undo.pop()   # record() with no edit after it
     if not self.undo:
       return False
-    self.redo.append(self._snap(ed))
-    self._restore(ed, self.undo.pop())
+    g = self.undo.pop()
+    g[1] = self._pos(ed)
+    if not self._replay(ed, g, False):
+      self._clear(ed)
+      return True
+    self.redo.append(g)
+    self._set_pos(ed, g[0])
     self._reset_group()
     return True
 
   def redo_one(self, ed):
     if not self.redo:
       return False
-    self.undo.append(self._snap(ed))
-    self._restore(ed, self.redo.pop())
+    g = self.redo.pop()
+    if not self._replay(ed, g, True):
+      self._clear(ed)
+      return True
+    self.undo.append(g)
+    self._set_pos(ed, g[1])
     self._reset_group()
     return True
 
@@ -2430,6 +2748,21 @@ class input_line_info:
     self.line = erow(default_str, 2) # dummy tab_size
     self.cur = self.line.get_len()   # start the caret after any prefilled text
 
+_APP_NAMES = None
+
+def _app_names():
+  # Command names from the shell's completion DB, offered as the lowest-ranked
+  # completions. Empty where pdeck_complete can't be loaded (desktop).
+  global _APP_NAMES
+  if _APP_NAMES is None:
+    try:
+      import pdeck_complete
+      _APP_NAMES = sorted(pdeck_complete._load_db())
+    except Exception:
+      _APP_NAMES = []
+  return _APP_NAMES
+
+
 class search_info:
   def __init__(self):
     self.saved_pos = []
@@ -2443,6 +2776,7 @@ class search_info:
     self.last_direction = 1
     self.isreplace = False
     self.aborted = False
+    self.regex = False
 
   def start_search(self,pos, direction, replace = False):
     self.saved_pos = pos
@@ -2452,6 +2786,7 @@ class search_info:
     self.index = 0
     self.last_direction = direction
     self.isreplace = replace
+    self.regex = False
   def close(self):
     self.start_search(None, 1)
     
@@ -2461,25 +2796,31 @@ class editor_file:
     self.input_method = IM_EN
     self.im_session = None
     self.tab_size = tab_size
-    self.rows = []
+    # Rows are backed by the file buffer and only become erows when viewed or
+    # edited (see erow_store).
+    self.rows = erow_store(tab_size, w)
+    self.view_row = 0
     self.pos_history = []
     self.phistory_cur = 0
     self.saved_pos = None
-    self.undo = undo_history(40)   # per-buffer undo/redo
+    self.undo = undo_history()     # per-buffer undo/redo, capped in bytes
+    self.sidx = None               # search_index of the active search
+    self.symidx = None             # symbol_index for completion, on first use
+    self.load_file = None          # open while the file streams in (see open)
+    self.redraw_pending = False    # background work changed what's on screen
+    self.save_ms = 0               # duration of the last save
     self.mark_row = None           # region mark (set by C-Space), per-buffer
     self.mark_col = 0
     self.h = h
     self.w = w
     self.modified = False
     self.filename = filename
-    self.v.background_update=self.background_update
 
   def open(self, linenum = 0, colnum = 0):
     
     filename = self.filename
     
     self.mode = "txt"
-    self.num_updated = 0
     self.period_regex = {}
     self.period_regex['py'] = re.compile("([A-Za-z0-9_]+)")
     self.period_regex['c'] = re.compile("([A-Za-z0-9_]+)")
@@ -2493,43 +2834,179 @@ class editor_file:
       elif fn.endswith(".c") or fn.endswith(".h") or fn.endswith(".cpp") \
            or fn.endswith(".cc") or fn.endswith(".hpp"):
         self.mode = "c"
+    self.rows.hl_mode = self.mode
+    self.hl_reset()
     if file_exists(filename):
       if pdeck_enabled:
         pdeck.shared_filelist(filename)
       try:
-        with open(filename, "r") as f:
-          for line in f:
-            if line[-1] in ('\n', '\r'):
-              if len(line) > 1 and line[-2] in ('\r','\n'):
-                line = line[:-2]
-              else:
-                line = line[:-1]
-            row = erow(line.encode('utf-8'), self.tab_size, self.w)
-            row.hl_mode = self.mode
-            self.rows.append(row)
+        # Binary chunks into one buffer; lines are indexed, not split, so no
+        # per-line objects are created until a row is shown or edited. Only
+        # enough is read here to show the screen at linenum; background_update
+        # streams in the rest.
+        self.load_file = open(filename, "rb")
+        self.rows.begin(os.stat(filename)[6])
+        want = linenum + self.h + 1
+        while len(self.rows) < want and self.load_step():
+          pass
         #self.jump_to_position(linenum, colnum, 1, False)
         #self.save_last_filename(linenum, colnum)
       except:
-        row = erow(b"", self.tab_size, self.w)
-        row.hl_mode = self.mode
-        self.rows.append(row)
-    else:
+        self.rows.load(b'')
+        self.load_done()
+    if self.load_file is None:
+      self.load_done()
+    
+    return linenum, colnum      
+
+  LOAD_CHUNK = 16384    # bytes read per load step
+
+  def load_step(self):
+    # Read the next chunk of the file being opened. Returns False when the
+    # whole file is in.
+    if self.rows.read_chunk(self.load_file, self.LOAD_CHUNK):
+      n = len(self.rows) - len(self.hl_out)
+      if n > 0:
+        self.hl_out.extend(b'\xff' * n)
+      return True
+    self.load_done()
+    return False
+
+  def load_done(self):
+    if self.load_file is not None:
+      self.load_file.close()
+      self.load_file = None
+    if len(self.rows) == 0:
       row = erow(b"", self.tab_size, self.w)
       row.hl_mode = self.mode
       self.rows.append(row)
-    
-    return linenum, colnum      
+    n = len(self.rows) - len(self.hl_out)
+    if n > 0:
+      self.hl_out.extend(b'\xff' * n)
+
+  def finish_load(self):
+    # Everything but drawing the first screen needs the whole file.
+    while self.load_file is not None:
+      self.load_step()
 
   def background_update(self):
-    if self.num_updated < len(self.rows):
-      for i in range(self.num_updated, self.num_updated+3):
-        if i < len(self.rows):
-          self.rows[i].w = self.w
-          self.rows[i].update_hl_bytes()
-      self.num_updated += 3
-      #print('update')
+    # Carry the lexer state down to just past the viewport, then sweep rows far
+    # outside it back to their compact form. Visible rows are lexed on demand
+    # by the renderer, so there is no per-row pre-highlighting here. A file
+    # still loading gets one more chunk per tick first.
+    if self.load_file is not None:
+      if not self.load_step():
+        self.redraw_pending = True   # the row count on the status line
       return True
-    return False
+    goal = self.view_row + self.h * 2
+    if goal > len(self.rows):
+      goal = len(self.rows)
+    if self.mode in _HL_LEXERS and self.hl_upto < goal:
+      limit = self.hl_upto + self.HL_BG_ROWS
+      self._hl_advance(limit if limit < goal else goal)
+      if self.hl_pending and self.hl_upto >= goal:
+        # The last frame was drawn with guessed states; redraw it.
+        self.hl_pending = False
+        self.redraw_pending = True
+      return True
+    return self.rows.evict(self.view_row, self.h * 4)
+
+  # ---- Syntax highlight state ----
+  # hl_out[i] is the lexer state at the end of row i (0xff = not lexed yet).
+  # Rows [0, hl_upto) are known good. An edit pulls hl_upto back to the edited
+  # row; rows from there to hl_dirty were touched, and rows after it up to
+  # hl_valid_end still hold what was lexed before the edit. Re-lexing stops as
+  # soon as a row past hl_dirty comes out with the same state as before.
+  HL_SYNC_ROWS = 1000   # rows the renderer may lex synchronously
+  HL_BG_ROWS = 200      # rows background_update lexes per tick
+
+  def hl_reset(self):
+    self.hl_out = bytearray(len(self.rows))
+    for i in range(len(self.hl_out)):
+      self.hl_out[i] = 0xff
+    self.hl_upto = 0
+    self.hl_dirty = 0
+    self.hl_valid_end = 0
+    self.hl_pending = False
+
+  def _touch(self, r, delta):
+    # Row r changed and `delta` rows were inserted after it (or -delta removed):
+    # bring the per-row highlight state, search hits and symbols along.
+    self._hl_touch(r, delta)
+    if self.sidx is not None:
+      self.sidx.touch(self.rows, r, delta)
+    if self.symidx is not None:
+      self.symidx.add_rows(self.rows, r, r + 1 + (delta if delta > 0 else 0))
+
+  def _ex_off(self, row, c):
+    # Offset of char column c in row.get_ex_chars() (what the renderer slices).
+    if c >= len(row.cbmap):
+      return len(row.get_ex_chars())
+    b = row.cbmap[c]
+    return row.bdmap[b] if row.tab_detected else b
+
+  def _hl_touch(self, r, delta):
+    # Row r changed and `delta` rows were inserted after it (or -delta removed).
+    if delta > 0:
+      self.hl_out[r + 1:r + 1] = b'\xff' * delta
+    elif delta < 0:
+      del self.hl_out[r + 1:r + 1 - delta]
+    if self.hl_valid_end > r + 1:
+      self.hl_valid_end += delta
+      if self.hl_valid_end < r + 1:
+        self.hl_valid_end = r + 1
+    dirty = self.hl_dirty + delta if self.hl_dirty > r + 1 else self.hl_dirty
+    end = r + 1 + (delta if delta > 0 else 0)
+    self.hl_dirty = dirty if dirty > end else end
+    if self.hl_upto > r:
+      self.hl_upto = r
+
+  def _hl_advance(self, limit):
+    out = self.hl_out
+    if limit > len(out):
+      limit = len(out)
+    rows = self.rows
+    mode = self.mode
+    j = self.hl_upto
+    st = out[j - 1] if j > 0 else 0
+    while j < limit:
+      st = _hl_next_state(mode, rows.chars_at(j), st)
+      if j >= self.hl_dirty and j < self.hl_valid_end and out[j] == st:
+        # Back in step with the pre-edit lexing: the rest is still valid.
+        j = self.hl_valid_end
+        break
+      out[j] = st
+      j += 1
+    self.hl_upto = j
+    if self.hl_valid_end < j:
+      self.hl_valid_end = j
+    if self.hl_dirty < j:
+      self.hl_dirty = j
+
+  def hl_state(self, i):
+    # Lexer state at the start of row i. If the known-good prefix is too far
+    # above, use the last state seen there and let background_update fix it.
+    if i == 0:
+      return 0
+    if self.hl_upto < i:
+      if i - self.hl_upto > self.HL_SYNC_ROWS:
+        self.hl_pending = True
+        st = self.hl_out[i - 1]
+        return 0 if st == 0xff else st
+      self._hl_advance(i)
+    return self.hl_out[i - 1]
+
+  def hl_spans(self, i, row):
+    # Highlight spans of row i over its tab-expanded chars, cached on the row
+    # for (state in, chars).
+    st = self.hl_state(i)
+    ex = row.get_ex_chars()
+    if row.hl_key is not ex or row.hl_in != st:
+      row.hl_spans = _HL_LEXERS[self.mode](ex, st)[0]
+      row.hl_key = ex
+      row.hl_in = st
+      row.hl_bytes = {}
+    return row.hl_spans
 
   def push_pos_history(self, pos):
     # If current entry is same, do nothing
@@ -2574,21 +3051,79 @@ class editor_file:
       except Exception as e:
         print(e)
 
+  SAVE_BUF = 16384      # bytes per write() when saving
+  _save_buf = None      # shared by all buffers, allocated on first save
+
   def save(self):
+    # Rows are packed into one reusable buffer and written a buffer at a time
+    # to a temp file, which then replaces the file, so a failed save leaves
+    # the old contents intact. self.save_ms gets the time it took.
     if self.filename == None:
       return
+    self.finish_load()
+    buf = editor_file._save_buf
+    if buf is None:
+      buf = editor_file._save_buf = bytearray(self.SAVE_BUF)
+    mv = memoryview(buf)
+    size = len(buf)
+    target = self.filename
+    if not pdeck_enabled:
+      target = os.path.realpath(target)   # write through a symlink, not over it
+    tmp = target + ".tmp"
+    t0 = time.ticks_us()
     total_bytes = 0
     try:
-      with open(self.filename, "wb") as f:
-        for row in self.rows:
-          f.write(row.chars)
-          f.write(b"\n")
-          total_bytes += len(row.chars) + 1
+      try:
+        f = open(tmp, "wb")
+      except OSError:
+        # Can't create files next to it (read-only directory): write in place.
+        tmp = None
+        f = open(target, "wb")
+      with f:
+        rows = self.rows
+        fill = 0
+        for i in range(len(rows)):
+          chars = rows.chars_at(i)
+          n = len(chars) + 1
+          if fill + n > size:
+            f.write(mv[:fill])
+            fill = 0
+            if n > size:
+              f.write(chars)
+              f.write(b"\n")
+              total_bytes += n
+              continue
+          mv[fill:fill + n - 1] = chars
+          buf[fill + n - 1] = 10
+          fill += n
+          total_bytes += n
+        if fill:
+          f.write(mv[:fill])
+      if tmp is not None:
+        if not pdeck_enabled:
+          try:
+            os.chmod(tmp, os.stat(target).st_mode)   # keep e.g. the exec bit
+          except OSError:
+            pass
+        try:
+          os.rename(tmp, target)
+        except OSError:
+          # FAT (the device's SD card) won't rename over an existing file.
+          os.remove(target)
+          os.rename(tmp, target)
+      # A new file, or a new size: ls / TAB completion must see it.
+      dir_cache.invalidate(target)
       self.modified = False
       if hasattr(os, 'sync'):  # POSIX/MicroPython only; absent on Windows
         os.sync()
     except:
+      if tmp is not None:
+        try:
+          os.remove(tmp)
+        except OSError:
+          pass
       return 0
+    self.save_ms = time.ticks_diff(time.ticks_us(), t0) // 1000
     return total_bytes
 
   def get_indent(self, r):
@@ -2751,6 +3286,7 @@ class editor_file:
     line_count = 0
 
     lnl = self.gen_line_num_list(filerow, filecol,0, self.h - 1)
+    self.view_row = filerow
     region = self._selection_region(currow, curcol)
     bm.add_bench('num_list')
 
@@ -2763,7 +3299,6 @@ class editor_file:
         if row.w != self.w:
           row.w = self.w
           row.update_hl_bytes()
-          self.num_updated = 0
         #print(f"exchars: {row.get_ex_chars()}")
 
         # Trim the row to one display line.
@@ -2786,17 +3321,31 @@ class editor_file:
           else:
             out_line = row.substr(ln[2], expos)
 
-          if self.mode in ('md', 'py', 'c'):
-            #if not row.tab_detected and expos >= len(row.cbmap):
-            if self.input_method != IM_JP and ln[1] != filerow:
+          hits = self.sidx.at(ln[1]) if self.sidx is not None else None
+          if self.input_method == IM_JP:
+            if self.mode in _HL_LEXERS:
+              out_line = _hl_line(out_line, self.mode)
+          elif hits or self.mode in _HL_LEXERS:
+            # Lex the whole row with the state carried in from above, then
+            # clip the spans to this wrapped segment of the (tab-expanded)
+            # chars that out_line holds.
+            spans = self.hl_spans(ln[1], row) if self.mode in _HL_LEXERS else ()
+            if hits or not ln[2] in row.hl_bytes:
+              if row.tab_detected:
+                sb = d_start
+                se = d_start + self.w
+              else:
+                nb = len(row.cbmap)
+                sb = row.cbmap[ln[2]] if ln[2] < nb else len(row.chars)
+                se = row.cbmap[expos] if expos < nb else len(row.chars)
+            if hits:
+              # Search hits on top; not cached, they go away with the search.
+              marks = [(self._ex_off(row, c), self._ex_off(row, c + n)) for c, n in hits]
+              out_line = _hl_apply(row.get_ex_chars(), _hl_overlay(spans, marks, _HL_MATCH), sb, se)
+            else:
               if not ln[2] in row.hl_bytes:
-                # Highlight the visible (tab-expanded) segment that out_line
-                # already holds -- not bytes(row.chars), which kept literal tabs
-                # and highlighted the whole row instead of this wrapped segment.
-                row.hl_bytes[ln[2]] = _hl_line(out_line, self.mode)
+                row.hl_bytes[ln[2]] = _hl_apply(row.get_ex_chars(), spans, sb, se)
               out_line = row.hl_bytes[ln[2]]
-            else:
-              out_line = _hl_line(out_line, self.mode)
         out_buf.extend(out_line)
         out_buf.extend(el.erase_to_end_of_current_line().encode('utf-8'))
         #print(f"outbuf: {out_line}")
@@ -2883,15 +3432,77 @@ class editor_file:
       return None    
     return (file_row, file_col)
 
-  def insert_str(self, r, c, str):
+  # ---- Edit primitives ----
+  # Every buffer mutation goes through insert_text / delete_text so the undo
+  # journal sees it. _ins / _del do the actual work (and are what undo/redo
+  # replay); positions are (row, char column), rows are split on b'\n'.
+
+  def _new_row(self, chars):
+    row = erow(chars, self.tab_size, self.w)
+    row.hl_mode = self.mode
+    return row
+
+  def _ins(self, r, c, text):
+    if self.symidx is not None:
+      self.symidx.remove_rows(self.rows, r, r + 1)
+    row = self.rows[r]
+    tail = row.get_len() - c
+    parts = text.split(b'\n')
+    if len(parts) == 1:
+      row.insert_str(c, text)
+      self._touch(r, 0)
+      return (r, row.get_len() - tail)
+    rest = row.substr(c, -1)
+    row.update_str(row.substr(0, c) + parts[0])
+    new = [self._new_row(bytearray(p)) for p in parts[1:-1]]
+    last = self._new_row(bytearray(parts[-1]) + rest)
+    new.append(last)
+    self.rows[r + 1:r + 1] = new
+    self._touch(r, len(new))
+    return (r + len(new), last.get_len() - tail)
+
+  def _del(self, r1, c1, r2, c2):
+    if self.symidx is not None:
+      self.symidx.remove_rows(self.rows, r1, r2 + 1)
+    if r1 == r2:
+      self.rows[r1].delete_str(c1, c2 - c1)
+    else:
+      newchars = self.rows[r1].substr(0, c1)
+      newchars.extend(self.rows[r2].substr(c2, -1))
+      self.rows[r1].update_str(newchars)
+      del self.rows[r1 + 1 : r2 + 1]
+    self._touch(r1, r1 - r2)
+
+  def insert_text(self, r, c, text):
+    # Insert text (str or bytes, may span lines) at (r,c); returns the end
+    # position of the inserted text.
+    if not isinstance(text, (bytes, bytearray)):
+      text = text.encode('utf-8')
+    if not text:
+      return (r, c)
     self.modified = True
-    self.rows[r].insert_str(c,str)
+    r2, c2 = self._ins(r, c, text)
+    self.undo.log(('i', r, c, r2, c2, bytes(text)))
+    return (r2, c2)
 
-  def insert_return(self, r, c, auto_indent = True):
+  def delete_text(self, r1, c1, r2, c2):
+    # Delete the (ordered) range (r1,c1)-(r2,c2).
+    if r1 == r2 and c1 >= c2:
+      return
     self.modified = True
-    newrow = erow(self.rows[r].substr(c,-1), self.tab_size, self.w)
-    newrow.hl_mode = self.mode
+    text = self.region_bytes(r1, c1, r2, c2)
+    self._del(r1, c1, r2, c2)
+    self.undo.log(('d', r1, c1, r2, c2, text))
+
+  def replace_row(self, r, chars):
+    # Replace the whole content of row r.
+    self.delete_text(r, 0, r, self.rows[r].get_len())
+    self.insert_text(r, 0, chars)
+
+  def insert_str(self, r, c, str):
+    self.insert_text(r, c, str)
 
+  def insert_return(self, r, c, auto_indent = True):
     # Auto indent for Python
     ind = 0
     if auto_indent and self.mode in ("py", "c") and c != 0:
@@ -2900,51 +3511,34 @@ class editor_file:
       if self.rows[r].at(c-1) == b":":
         ind += 2
       #print(f"Auto indent ind = {ind}")
-      if ind != -1:
-        newrow.insert_str(0," "*ind)
 
-    self.rows[r].update_str(self.rows[r].substr(0,c))
-    self.rows.insert(r+1, newrow)
+    self.insert_text(r, c, b"\n" + b" "*ind)
     return (r+1, ind)
 
-  def get_comp_list(self, sym):
-    row = 0
-    col = 0
-    query = sym
-    comp_list = []
-    #print(f"CompQuery: {row},{col} q={query}")
-    r_goal = len(self.rows)
-
-    for idx in range(row, r_goal):
-      if self.v.poll():
-        #keyboard interrupt
+  def get_comp_list(self, sym, others = ()):
+    # Ranked completions for sym: this buffer's symbols first, then those of
+    # the other open buffers in the same mode, then shell command names.
+    # Returns None if a keypress interrupted building an index.
+    idx = self.get_symbol_index()
+    if idx is None:
+      return None
+    seeds = []
+    for f in others:
+      if f.mode == self.mode:
+        x = f.get_symbol_index()
+        if x is None:
+          return None
+        seeds.append(x)
+    return complete(sym, idx, seeds, _app_names())
+
+  def get_symbol_index(self):
+    # Built on the first completion, then kept current by _ins/_del.
+    if self.symidx is None:
+      idx = symbol_index()
+      if not idx.build(self.rows, self.v.poll):
         return None
-      row = self.rows[idx]
-      #print(f" searching.. row {idx} col {col} dir {direction}")
-
-      col = 0 
-
-      while True:
-        result, matched_string = row.search(col, query, 1, True)
-
-
-        if result != None:
-          pos, sym = self.get_symbol(idx,result)
-          if sym:
-            #print(f"Comp:maybe {sym}")
-            if len(sym) > len(query) and query == sym[:len(query)]:
-              comp_list.append(sym)
-            col = result + 1
-            if len(comp_list) > 20:
-              break
-          else:
-            # error to get symbol
-            break
-        else:
-          break
-    if len(comp_list) > 0:
-      comp_list = list(set(comp_list))
-    return comp_list
+      self.symidx = idx
+    return self.symidx
 
   def get_symbol(self, r,c, search_list = None):
     line = self.rows[r]
@@ -2979,82 +3573,61 @@ class editor_file:
   def extract_region(self, r1, c1, r2, c2):
     # Text of the region (r1,c1)..(r2,c2), assumed already ordered. Multi-line
     # joins with '\n', matching how yank() re-inserts.
+    return self.region_bytes(r1, c1, r2, c2).decode('utf-8')
+
+  def region_bytes(self, r1, c1, r2, c2):
     if r1 == r2:
-      return self.rows[r1].substr(c1, c2).decode('utf-8')
-    parts = [self.rows[r1].substr(c1, -1).decode('utf-8')]
+      return bytes(self.rows[r1].substr(c1, c2))
+    parts = [bytes(self.rows[r1].substr(c1, -1))]
     for r in range(r1 + 1, r2):
-      parts.append(self.rows[r].decode())
-    parts.append(self.rows[r2].substr(0, c2).decode('utf-8'))
-    return "\n".join(parts)
+      parts.append(bytes(self.rows.chars_at(r)))
+    parts.append(bytes(self.rows[r2].substr(0, c2)))
+    return b"\n".join(parts)
 
   def delete_region(self, r1, c1, r2, c2):
-    self.modified = True
-    if r1 == r2:
-      self.rows[r1].delete_str(c1, c2 - c1)
-    else:
-      newchars = self.rows[r1].substr(0, c1)
-      newchars.extend(self.rows[r2].substr(c2, -1))
-      self.rows[r1].update_str(newchars)
-      del self.rows[r1 + 1 : r2 + 1]
+    self.delete_text(r1, c1, r2, c2)
     return (r1, c1)
 
   def yank(self, r, c, yankbuf):
-    self.modified = True
     if yankbuf.curbuf != None:
-      line_str = yankbuf.curbuf
-      while True:
-        pos = line_str.find("\n")
-        if pos != -1:
-          #print(f"return found at {pos}")
-          self.rows[r].insert_str(c, line_str[:pos])
-          self.insert_return(r, c+pos, False)
-          line_str = line_str[pos+1:]
-          r += 1
-          c = 0
-        else:        
-          self.rows[r].insert_str(c, line_str)
-          c += len(line_str)
-          break
+      r, c = self.insert_text(r, c, yankbuf.curbuf)
     return (r,c)
         
   def erase_to_the_end(self, r, c, yankbuf):
-    self.modified = True
     if c == 0 and r < len(self.rows) - 1:
-      yankbuf.add_str(self.rows[r].chars.decode('utf-8'))
+      yankbuf.add_str(self.rows[r].decode())
       yankbuf.add_str("\n")
-      del self.rows[r]
+      self.delete_text(r, 0, r + 1, 0)
     elif c == self.rows[r].get_len() and len(self.rows)-1 > r:
-      self.rows[r].insert_str(c,self.rows[r+1].chars)
       yankbuf.add_str("\n")
-      del self.rows[r+1]
+      self.delete_text(r, c, r + 1, 0)
     else:
       yankbuf.add_str(self.rows[r].substr(c, -1).decode('utf-8'))
-      self.rows[r].erase_to_the_end(c)
+      self.delete_text(r, c, r, self.rows[r].get_len())
 
   def delete_one_char_bs(self, r, c):
-    self.modified = True
     if c == 0:
       if r == 0:
         return (r,c)
       col = self.rows[r - 1].get_len()
-      self.rows[r-1].insert_str(self.rows[r-1].get_len(), self.rows[r].chars)
-      del self.rows[r]
+      self.delete_text(r - 1, col, r, 0)
       return (r-1, col)
     else:
-      self.rows[r].delete_str(c - 1,1)
+      self.delete_text(r, c - 1, r, c)
       return (r, c - 1)      
 
   def delete_one_char_del(self, r, c, yankbuf):
-    self.modified = True
-    if self.rows[r].get_len() == 0:
-      if len(self.rows) > 1:
-        del self.rows[r]
-    elif c == self.rows[r].get_len() and len(self.rows)-1 > r:
-      self.rows[r].insert_str(c,self.rows[r+1].chars)
-      del self.rows[r+1]
+    rlen = self.rows[r].get_len()
+    if rlen == 0:
+      if r < len(self.rows) - 1:
+        self.delete_text(r, 0, r + 1, 0)
+      elif r > 0:
+        self.delete_text(r - 1, self.rows[r - 1].get_len(), r, 0)
+    elif c == rlen and len(self.rows)-1 > r:
+      self.delete_text(r, c, r + 1, 0)
     else:
       yankbuf.add_str(self.rows[r].at(c).decode('utf-8'))
-      self.rows[r].delete_str(c,1)
+      self.delete_text(r, c, r, c + 1)
     return (r, c)
 
 class yank_buffer:
@@ -3083,6 +3656,9 @@ class yank_buffer:
 
 
 from erow import erow
+from erow_store import erow_store
+from search_index import search_index
+from symbol_index import symbol_index, complete
 
 if pdeck_enabled:
   class screen_interface:
@@ -3162,6 +3738,8 @@ else:
       # callable here to run while read() waits, so background work is applied
       # without needing a keystroke.
       self.idle_callback = None
+      # Set by the editor, as on device; returns True while it has more to do.
+      self.background_update = None
     def poll(self):
       return False
 
@@ -3197,9 +3775,13 @@ else:
       # Wait for a keypress, but wake periodically so queued remote-open requests
       # (pushed onto open_pending_list by the pem_client server) get serviced.
       # Stdin always has priority, so this never interrupts an escape sequence.
+      busy = False
       while True:
-        r, _, _ = select.select([self.fd], [], [],
-                                0 if ((open_pending_list or edit_pending_list or switch_pending_list) and self.allow_remote_open) else 0.2)
+        if (open_pending_list or edit_pending_list or switch_pending_list) and self.allow_remote_open:
+          timeout = 0
+        else:
+          timeout = 0.01 if busy else 0.2
+        r, _, _ = select.select([self.fd], [], [], timeout)
         if r:
           break
         if open_pending_list and self.allow_remote_open:
@@ -3211,6 +3793,7 @@ else:
             self.idle_callback()
           except Exception:
             pass
+        busy = bool(self.background_update and self.background_update())
       b = os.read(self.fd, 1)
       # Assemble a full UTF-8 character (e.g. Japanese via the OS IME); the
       # continuation bytes are already available on the fd.
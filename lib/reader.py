@@ -12,6 +12,8 @@
 
 import fontloader
 import os
+import array
+import struct
 import time
 import ujson
 import pdeck
@@ -25,6 +27,9 @@ except:
   pu = None
 
 READER_STATE_FILE = "/config/reader_state.json"
+# One file per book with its layout checkpoints (see BookLayout.save_cache).
+READER_CACHE_DIR = "/config/reader_cache"
+_CACHE_MAGIC = b"PDRL1\n"
 
 KEY_UP = b'\x1b[A'
 KEY_DOWN = b'\x1b[B'
@@ -35,13 +40,11 @@ KEY_BS = b'\b'
 KEY_PAGE_UP = b'\x1b[5~'
 KEY_PAGE_DOWN = b'\x1b[6~'
 
-
-def _read_text_file(path):
-  # Read as bytes first, then decode UTF-8 with replacement
-  with open(path, "rb") as f:
-    data = f.read()
-
-  return data.decode("utf-8")
+# Bytes of source text wrapped in one step. Every step starts at a checkpoint
+# (byte offset, y) so any part of a book can be wrapped again on demand.
+WRAP_CHUNK = 2048
+# A Markdown table is never split across steps, up to this many bytes.
+WRAP_CHUNK_MAX = 16 * WRAP_CHUNK
 
 
 def _load_state():
@@ -65,6 +68,15 @@ def _save_state(state):
     pass
 
 
+def _cache_file(path):
+  # Cache file name for a book: a hash of its path (the path itself is in
+  # the cache key, so a collision only costs a re-wrap).
+  h = 5381
+  for c in path.encode("utf-8"):
+    h = (h * 33 + c) & 0xffffffff
+  return "{}/{:08x}.lay".format(READER_CACHE_DIR, h)
+
+
 def _split_lines(text):
   # Preserve paragraphs but normalize line endings
   text = text.replace("\r\n", "\n").replace("\r", "\n")
@@ -660,6 +672,191 @@ def _wrap_line(v, line, height, max_width, vertical, pre, font, japanese=False,
   return out if out else [_slice_segments(segments, 0, n)]
 
 
+class BookLayout:
+  """Wrapped layout of one file, built a chunk at a time.
+
+  Only sparse checkpoints are kept for the whole file: the byte offset and
+  pixel y where each WRAP_CHUNK-sized run of source lines starts. Wrapped
+  lines themselves exist just for a window around the scroll position
+  (`view`), rebuilt from the nearest checkpoint when the view moves out of
+  it. advance() wraps the next chunk past the frontier; the reader calls it
+  while idle, so front_y grows until it is the height of the whole file.
+  """
+
+  def __init__(self, path, wrap, height_of, markdown):
+    self.wrap = wrap            # source lines -> wrapped lines
+    self.height_of = height_of  # wrapped line -> height in px
+    self.markdown = markdown
+    self.f = open(path, "rb")
+    self.size = os.stat(path)[6]
+    self.ck_off = array.array('I')
+    self.ck_y = array.array('i')
+    self.front_off = 0          # first byte not wrapped yet
+    self.front_y = 0            # y where it goes
+    self.done = False
+    # (y0, y1, lines, offsets, at_eof): wrapped lines covering [y0, y1).
+    # Replaced as a whole so update() always sees a consistent one.
+    self.view = None
+    self.cache_path = None
+    self.cache_key = None
+    self.saved_count = -1       # checkpoints in the cache file
+
+  def close(self):
+    if self.f:
+      self.f.close()
+      self.f = None
+
+  def head(self, n=4096):
+    # The first n bytes as text, cut at a character boundary.
+    self.f.seek(0)
+    data = self.f.read(n)
+    if len(data) == n and data[-1] >= 0x80:
+      # Back over at most three continuation bytes to the lead byte of the
+      # last character, and drop that character if it is cut short.
+      i = len(data) - 1
+      while i > 0 and i > len(data) - 4 and data[i] < 0xC0:
+        i -= 1
+      c = data[i]
+      if c >= 0xC0 and len(data) - i < (2 if c < 0xE0 else 3 if c < 0xF0 else 4):
+        data = data[:i]
+    return data.decode("utf-8")
+
+  def _read(self, off):
+    # Source lines from byte `off` up to a line break about WRAP_CHUNK bytes
+    # later, and the offset after it (size + 1 once the file is exhausted).
+    f = self.f
+    f.seek(off)
+    data = b""
+    while True:
+      block = f.read(WRAP_CHUNK)
+      if not block:
+        return _split_lines(data.decode("utf-8")), self.size + 1
+      data += block
+      cut = data.rfind(b"\n")
+      if cut < 0:
+        continue
+      text = data[:cut]
+      if text.endswith(b"\r"):
+        text = text[:-1]
+      lines = _split_lines(text.decode("utf-8"))
+      if self.markdown and len(data) < WRAP_CHUNK_MAX and _parse_md_table_row(lines[-1]):
+        # The chunk ends in a table; keep it in one piece.
+        continue
+      return lines, off + cut + 1
+
+  def load_cache(self, cache_path, key):
+    # Take the checkpoints from a previous run if they were made for the
+    # same key (file path, size and mtime, font, width...). Either way the
+    # cache is rewritten under this key by save_cache().
+    self.cache_path = cache_path
+    self.cache_key = key
+    try:
+      with open(cache_path, "rb") as f:
+        if f.read(len(_CACHE_MAGIC)) != _CACHE_MAGIC:
+          return False
+        klen, count, front_off, front_y, done = struct.unpack("<HIIiB", f.read(15))
+        if f.read(klen) != key:
+          return False
+        ck_off = array.array('I', f.read(count * 4))
+        ck_y = array.array('i', f.read(count * 4))
+    except (OSError, ValueError):
+      return False
+    if len(ck_off) != count or len(ck_y) != count:
+      return False
+    self.ck_off = ck_off
+    self.ck_y = ck_y
+    self.front_off = front_off
+    self.front_y = front_y
+    self.done = done != 0
+    self.saved_count = count
+    return True
+
+  def save_cache(self):
+    # Write the checkpoints if there are more than in the cache file.
+    if self.cache_path is None or len(self.ck_off) == self.saved_count:
+      return
+    try:
+      os.mkdir(READER_CACHE_DIR)
+    except OSError:
+      pass
+    try:
+      with open(self.cache_path, "wb") as f:
+        f.write(_CACHE_MAGIC)
+        f.write(struct.pack("<HIIiB", len(self.cache_key), len(self.ck_off),
+                            self.front_off, self.front_y, 1 if self.done else 0))
+        f.write(self.cache_key)
+        f.write(self.ck_off)
+        f.write(self.ck_y)
+      self.saved_count = len(self.ck_off)
+    except OSError:
+      pass
+
+  def advance(self):
+    # Wrap the chunk at the frontier. False once the whole file is done.
+    if self.done:
+      return False
+    lines, nxt = self._read(self.front_off)
+    self.ck_off.append(self.front_off)
+    self.ck_y.append(self.front_y)
+    y = self.front_y
+    for line in self.wrap(lines):
+      y += self.height_of(line)
+    self.front_y = y
+    self.front_off = nxt
+    if nxt > self.size:
+      self.done = True
+    return True
+
+  def reach(self, y):
+    # Wrap until the frontier is past y (or the file ends).
+    while not self.done and self.front_y <= y:
+      self.advance()
+
+  def _checkpoint(self, y):
+    # Index of the last checkpoint at or above y.
+    ck_y = self.ck_y
+    lo = 0
+    hi = len(ck_y)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if ck_y[mid] <= y:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo - 1 if lo > 0 else 0
+
+  def offset_at(self, y):
+    # Approximate byte offset of pixel y (start of its chunk).
+    if not self.ck_off:
+      return 0
+    return self.ck_off[self._checkpoint(y)]
+
+  def window(self, y0, y1):
+    # Make `view` cover [y0, y1): wrap from the checkpoint before y0, with a
+    # chunk of slack above and a screen below so small scrolls reuse it.
+    self.reach(y1)
+    view = self.view
+    if view and view[0] <= y0 and (y1 <= view[1] or view[4]):
+      return view
+    k = self._checkpoint(y0)
+    if k > 0:
+      k -= 1
+    limit = y1 + (y1 - y0)
+    off = self.ck_off[k]
+    y = self.ck_y[k]
+    top = y
+    lines = []
+    offsets = []
+    while y < limit and off <= self.size:
+      chunk, off = self._read(off)
+      for line in self.wrap(chunk):
+        lines.append(line)
+        offsets.append(y)
+        y += self.height_of(line)
+    self.view = (top, y, lines, offsets, off > self.size)
+    return self.view
+
+
 class Reader:
   def __init__(self, v, vs, paths, isvertical, font, japanese=False):
     self.v = v
@@ -694,9 +891,7 @@ class Reader:
     self.status = ""
     self.status_life = 0
 
-    self.wrapped_lines = []
-    self.line_offsets = []
-    self.total_height = 0
+    self.doc = None
     self.current_path = None
     self.current_key = None
 
@@ -763,73 +958,94 @@ class Reader:
       return line.get("total_height_px", self.line_height + 1)
     return self.line_height
 
-  def _rebuild_line_offsets(self):
-    self.line_offsets = []
-    y = 0
-    for line in self.wrapped_lines:
-      self.line_offsets.append(y)
-      y += self._line_height_px(line)
-    self.total_height = y
+  def _wrap_lines(self, lines):
+    max_width = self.screen_w - self.margin_x * 2
+    if self.markdown_mode:
+      return _build_md_lines(self.v, lines, self.line_height, max_width, self.vertical, self.pre, self.fontname, self.japanese)
+    out = []
+    for line in lines:
+      out.extend(_wrap_line(self.v, line, self.line_height, max_width, self.vertical, self.pre, self.fontname, self.japanese))
+    return out
 
-  def _find_start_line(self, scroll_px):
-    if not self.line_offsets:
+  def _find_start_line(self, view, scroll_px):
+    lines = view[2]
+    offsets = view[3]
+    if not offsets:
       return 0
     lo = 0
-    hi = len(self.line_offsets) - 1
+    hi = len(offsets) - 1
     while lo <= hi:
       mid = (lo + hi) // 2
-      y = self.line_offsets[mid]
-      h = self._line_height_px(self.wrapped_lines[mid])
+      y = offsets[mid]
+      h = self._line_height_px(lines[mid])
       if scroll_px < y:
         hi = mid - 1
       elif scroll_px >= y + h:
         lo = mid + 1
       else:
         return mid
-    if lo >= len(self.line_offsets):
-      return len(self.line_offsets) - 1
+    if lo >= len(offsets):
+      return len(offsets) - 1
     return lo
 
   def load_file(self, path):
     self.current_key = self._state_key(path)
-    raw_text = _read_text_file(path)
+    self.close()
+    self.markdown_mode = _is_md_path(path)
+    # Nothing is wrapped here beyond the first screen (or the saved
+    # position); the rest is wrapped in the background by loop().
+    doc = BookLayout(path, self._wrap_lines, self._line_height_px, self.markdown_mode)
 
-    if _is_cjk(raw_text):
+    if _is_cjk(doc.head()):
       if self.fontname != 'uni':
         self._setup_font('uni')
       if not self.vertical:
         self.japanese = True
 
     self.v.set_font(self.font)
-
-    max_width = self.screen_w - self.margin_x * 2
-    
-    lines = _split_lines(raw_text)
-    self.markdown_mode = _is_md_path(path)
-
-    if self.markdown_mode:
-      self.wrapped_lines = _build_md_lines(self.v, lines, self.line_height, max_width, self.vertical, self.pre, self.fontname, self.japanese)
-    else:
-      self.wrapped_lines = []
-      for line in lines:
-        self.wrapped_lines.extend(_wrap_line(self.v, line, self.line_height, max_width, self.vertical, self.pre, self.fontname, self.japanese))
-
-    self._rebuild_line_offsets()
+    self.doc = doc
+    # With a cached layout, opening at the saved position only wraps the
+    # lines around it.
+    doc.load_cache(_cache_file(path), self._layout_key(path))
 
     saved = self.state.get(self.current_key, {})
     self.scroll_px = int(saved.get("scroll_px", -self.line_height))
+    doc.reach(self.scroll_px + self.text_h)
+    # Start the animation at the saved position, not where the previous
+    # book was (that would wrap everything in between).
+    self.scroll_anm.y = self.scroll_px
     self.update_scroll_px()
     if self.scroll_px < 0:
       self.scroll_px = 0
-    if self.total_height > 0 and self.scroll_px > self.total_height - self.text_h:
-      self.scroll_px = max(0, self.total_height - self.text_h)
+    if doc.front_y > 0 and self.scroll_px > doc.front_y - self.text_h:
+      self.scroll_px = max(0, doc.front_y - self.text_h)
 
     self.op_scroll_px = self.scroll_px
+    self.update_view()
 
     self.status = "Loaded: " + self.basename(path)
     self.status_life = 60
     self.current_path = path
 
+  def _layout_key(self, path):
+    # Everything the checkpoints depend on; any change invalidates them.
+    st = os.stat(path)
+    return "{}\n{}\n{}\n{}\n{}\n{}\n{}\n{}\n{}".format(
+      path, st[6], st[8], self.fontname, int(self.vertical), int(self.japanese),
+      self.screen_w - self.margin_x * 2, self.line_height, self.pre).encode("utf-8")
+
+  def close(self):
+    if self.doc:
+      self.doc.save_cache()
+      self.doc.close()
+      self.doc = None
+
+  def update_view(self):
+    # Keep the wrapped window over everything the scroll animation passes.
+    y0 = int(min(self.scroll_anm.y, self.scroll_px))
+    y1 = int(max(self.scroll_anm.y, self.scroll_px)) + self.text_h
+    self.doc.window(y0, y1)
+
   def save_position(self):
     if not self.current_key:
       return
@@ -837,6 +1053,8 @@ class Reader:
       "scroll_px": int(self.scroll_px),
     }
     _save_state(self.state)
+    if self.doc:
+      self.doc.save_cache()
 
   def next_file(self):
     if len(self.paths) <= 1:
@@ -863,10 +1081,13 @@ class Reader:
     self.scroll_px = self.scroll_px // self.line_height * self.line_height
     if self.scroll_px < -self.line_height:
       self.scroll_px = -self.line_height
-    max_scroll = max(0, self.total_height - self.text_h)
+    # Wrap ahead first, so the end is only clamped to once it is known.
+    self.doc.reach(self.scroll_px + self.text_h)
+    max_scroll = max(0, self.doc.front_y - self.text_h)
     if self.scroll_px > max_scroll:
       self.scroll_px = max_scroll
     self.update_scroll_px()
+    self.update_view()
 
   def page_down(self):
     #self.scroll_by((self.text_h // self.line_height) * self.line_height-self.line_height)
@@ -882,8 +1103,13 @@ class Reader:
       header = base
       try:
         pct = 0
-        if self.total_height > self.text_h:
-          pct = int(self.scroll_px * 100 / (self.total_height - self.text_h))
+        doc = self.doc
+        if not doc.done:
+          # Height of the whole book is not known yet; go by bytes.
+          if doc.size > 0:
+            pct = int(doc.offset_at(self.scroll_px) * 100 / doc.size)
+        elif doc.front_y > self.text_h:
+          pct = int(self.scroll_px * 100 / (doc.front_y - self.text_h))
         header = "{}  {}%".format(base, pct)
       except:
         pass
@@ -1006,7 +1232,8 @@ class Reader:
     self.v.set_draw_color(1)
     self.v.set_font(self.font)
 
-    if not self.current_path:
+    view = self.doc.view if self.doc else None
+    if not self.current_path or view is None:
       self.v.draw_str(50, 100, "Loading book...")
       self.v.finished()
       return
@@ -1014,9 +1241,11 @@ class Reader:
 
     self.op_scroll_px = self.scroll_anm.y
 
-    start_line = self._find_start_line(int(self.op_scroll_px))
-    if start_line < len(self.line_offsets):
-      y_offset = self.line_offsets[start_line] - int(self.op_scroll_px)
+    lines = view[2]
+    offsets = view[3]
+    start_line = self._find_start_line(view, int(self.op_scroll_px))
+    if start_line < len(offsets):
+      y_offset = offsets[start_line] - int(self.op_scroll_px)
     else:
       y_offset = 0
 
@@ -1024,8 +1253,8 @@ class Reader:
     idx = start_line
     limit_y = self.screen_h - self.help_h - self.margin_bottom
 
-    while idx < len(self.wrapped_lines) and y < limit_y:
-      line = self.wrapped_lines[idx]
+    while idx < len(lines) and y < limit_y:
+      line = lines[idx]
       self._draw_segments(self.margin_x, y, line)
       y += self._line_height_px(line)
       idx += 1
@@ -1085,6 +1314,10 @@ class Reader:
       if not self.handle_key(k):
         break
 
+      # Wrap the rest of the book a chunk at a time while idle.
+      if k is None and not self.doc.done:
+        self.doc.advance()
+
       keys = self.v.get_tp_keys()
 
       if not keys:
@@ -1171,6 +1404,7 @@ def main(vs, args_in):
   reader.load_file(paths[0])
   reader.loop()
   v.callback(None)
+  reader.close()
 
   v.print(el.display_mode(True))
   print("finished.", file=vs)
@@ -1,6 +1,7 @@
 import pdeck
 import os
 import ls
+import dir_cache
 
 def _is_dir(path):
   try:
@@ -35,6 +36,7 @@ def main(vs,args):
         continue
       print(f'{ret[0]}/{item} ', file=vs)
       os.unlink(fullpath)
+      dir_cache.invalidate(fullpath)
 
   os.sync()
   print("Deleted", file = vs)
@@ -1,8 +1,10 @@
 import pdeck
 import os
+import dir_cache
 def main(vs,args):
   try:
     os.rmdir(args[1])
+    dir_cache.invalidate(args[1])
   except FileNotFoundError:
     v.print("File not found\n")
   os.sync()
@@ -11,17 +11,31 @@
 # want to record, and switch back (any key stops it) - or just let -t expire.
 #
 # The recording loop is steady-state ZERO-allocation so it can never trigger a
-# GC pause mid-take: the capture buffer and timestamp scratch are preallocated,
-# the arithmetic is all small-int, f.write() goes through the FIL's own sector
-# buffer (FatFS, not the MP heap), and read_nb returns the None singleton while
-# this screen is in the background - the normal recording state. Only with this
-# screen foreground (i.e. when you are back to stop it) does read_nb build its
-# (n, str) tuple.
+# GC pause mid-take: the capture, previous-frame and encode buffers are
+# preallocated, the arithmetic is all small-int, f.write() goes through the
+# FIL's own sector buffer (FatFS, not the MP heap), and read_nb returns the None
+# singleton while this screen is in the background - the normal recording
+# state. Only with this screen foreground (i.e. when you are back to stop it)
+# does read_nb build its (n, str) tuple.
+#
+# Frames are stored as PackBits-coded XOR deltas against the previous frame, so
+# a mostly static screen costs a few hundred bytes per frame instead of 12000,
+# and an unchanged one only its 9-byte frame header. Every --key seconds a
+# keyframe (the frame itself, PackBits-coded) is written so a reader can start
+# decoding there.
 #
 # File format (.pdsr, little-endian):
-#   header: b"PDSR"  u8 version(=1)  u16 width  u16 height
-#   frames: u32 t_ms (since start)  followed by stride*height bytes of the
-#           1bpp MSB-first capture buffer (stride = width // 8)
+#   header: b"PDSR"  u8 version(=2)  u16 width  u16 height
+#   frames: u32 t_ms (since start)  u8 kind  u32 n  followed by n payload bytes
+#           kind 0 = keyframe: PackBits of the 1bpp MSB-first capture buffer
+#                    (stride*height bytes, stride = width // 8)
+#           kind 1 = delta: PackBits of (frame XOR previous frame); n = 0
+#                    means the frame is unchanged
+#   PackBits: control byte c < 0x80 is followed by c+1 literal bytes, c >= 0x80
+#   by one byte repeated (c & 0x7f) + 3 times.
+#
+# Version 1 (still read by pdsr2gif) had no kind/n fields and stored every
+# frame as the raw stride*height capture buffer.
 
 import time
 import os
@@ -31,11 +45,70 @@ import pdeck
 import pdeck_utils as pu
 
 MAGIC = b"PDSR"
-VERSION = 1
+VERSION = 2
 W = 400
 H = 240
 STRIDE = W // 8
 FRAME_BYTES = STRIDE * H
+KIND_KEY = 0
+KIND_DELTA = 1
+HEAD_BYTES = 9  # u32 t_ms, u8 kind, u32 payload length
+# Worst case PackBits output: all literals, one control byte per 128.
+ENC_BYTES = HEAD_BYTES + FRAME_BYTES + (FRAME_BYTES + 127) // 128
+
+
+@micropython.viper
+def _encode(cur, prev, out, n: int, delta: int) -> int:
+  # PackBits-code cur (or cur XOR prev when delta) into out, after the
+  # 9-byte (HEAD_BYTES) frame header. Returns the payload length.
+  c = ptr8(cur)
+  p = ptr8(prev)
+  o = ptr8(out)
+  k: int = 9
+  i: int = 0
+  while i < n:
+    v: int = c[i] ^ p[i] if delta else c[i]
+    j: int = i + 1
+    while j < n and j - i < 130:
+      u: int = c[j] ^ p[j] if delta else c[j]
+      if u != v:
+        break
+      j += 1
+    if j - i >= 3:
+      o[k] = 0x80 | (j - i - 3)
+      o[k + 1] = v
+      k += 2
+      i = j
+      continue
+    # Literal bytes up to the next run of three (or 128 bytes)
+    h: int = k
+    k += 1
+    s: int = i
+    while i < n and i - s < 128:
+      if i + 2 < n:
+        a: int = c[i] ^ p[i] if delta else c[i]
+        b: int = c[i + 1] ^ p[i + 1] if delta else c[i + 1]
+        d: int = c[i + 2] ^ p[i + 2] if delta else c[i + 2]
+        if a == b and b == d:
+          break
+      o[k] = c[i] ^ p[i] if delta else c[i]
+      k += 1
+      i += 1
+    o[h] = i - s - 1
+  return k - 9
+
+
+@micropython.viper
+def _same(cur, prev, n: int) -> int:
+  a = ptr32(cur)
+  b = ptr32(prev)
+  i: int = 0
+  n = n >> 2
+  while i < n:
+    if a[i] != b[i]:
+      return 0
+    i += 1
+  return 1
 
 
 def _le16(n):
@@ -56,11 +129,13 @@ def main(vs, args_in):
   parser.add_argument("out", nargs="?", default=None, help="Output file (default /sd/rec/recMMDD_HHMMSS.pdsr)")
   parser.add_argument("-f", "--fps", type=float, default=5.0, help="Frames per second (default 5)")
   parser.add_argument("-t", "--time", type=float, default=30.0, help="Duration in seconds; 0 = record until a key is pressed (default 30)")
+  parser.add_argument("-k", "--key", type=float, default=10.0, help="Seconds between keyframes (default 10)")
   parser.add_argument("-s", "--screen", type=int, default=None, help="Switch to this screen (0-based) before recording")
   args = parser.parse_args(args_in[1:])
 
   fps = args.fps if args.fps > 0 else 5.0
   interval = int(1000.0 / fps)
+  key_every = max(1, int(fps * args.key)) if args.key > 0 else 1
   limit_ms = int(args.time * 1000) if args.time > 0 else 0
   path = args.out or default_filename()
 
@@ -75,7 +150,8 @@ def main(vs, args_in):
   v_in = vs.v if hasattr(vs, "v") else None
 
   buf = bytearray(FRAME_BYTES)
-  ts = bytearray(4)  # scratch for the little-endian frame timestamp
+  prev = bytearray(FRAME_BYTES)   # last recorded frame (delta reference)
+  out = bytearray(ENC_BYTES)      # frame header + encoded payload
   # pdeck.take_screenshot (module-level, newer firmware) captures the
   # just-presented PHYSICAL frame no matter which screen is foreground, so the
   # recorder keeps working after you switch away. The vscreen method fallback
@@ -88,6 +164,7 @@ def main(vs, args_in):
           "while THIS screen is foreground.", file=vs)
   frames = 0
   misses = 0
+  keys = 0
 
   try:
     f = open(path, "wb")
@@ -104,6 +181,8 @@ def main(vs, args_in):
     # Bind everything the loop needs to locals, then collect, so the take
     # starts with a fresh heap and the loop itself never allocates.
     write = f.write
+    encode = _encode
+    same = _same
     ticks_ms = time.ticks_ms
     ticks_diff = time.ticks_diff
     sleep_ms = time.sleep_ms
@@ -118,12 +197,31 @@ def main(vs, args_in):
         if ret and ret[0] > 0:
           break
       if shot(0, 0, W, H, buf):
-        ts[0] = now & 0xff
-        ts[1] = (now >> 8) & 0xff
-        ts[2] = (now >> 16) & 0xff
-        ts[3] = (now >> 24) & 0xff
-        write(ts)
-        write(buf)
+        if frames % key_every == 0:
+          kind = KIND_KEY
+          n = encode(buf, prev, out, FRAME_BYTES, 0)
+          keys += 1
+        elif same(buf, prev, FRAME_BYTES):
+          kind = KIND_DELTA
+          n = 0
+        else:
+          kind = KIND_DELTA
+          n = encode(buf, prev, out, FRAME_BYTES, 1)
+        out[0] = now & 0xff
+        out[1] = (now >> 8) & 0xff
+        out[2] = (now >> 16) & 0xff
+        out[3] = (now >> 24) & 0xff
+        out[4] = kind
+        out[5] = n & 0xff
+        out[6] = (n >> 8) & 0xff
+        out[7] = (n >> 16) & 0xff
+        out[8] = (n >> 24) & 0xff
+        # MicroPython's stream write(buf, len) writes a prefix without
+        # slicing (a memoryview slice would allocate).
+        write(out, HEAD_BYTES + n)
+        # The capture becomes the reference; the old reference is the next
+        # capture buffer (a swap, not a copy).
+        buf, prev = prev, buf
         frames += 1
       else:
         misses += 1  # display busy this tick; drop the frame and carry on
@@ -141,6 +239,6 @@ def main(vs, args_in):
     size = os.stat(path)[6]
   except OSError:
     size = 0
-  print("Saved %s: %d frame(s), %d bytes%s." %
-        (path, frames, size, (", %d missed" % misses) if misses else ""), file=vs)
+  print("Saved %s: %d frame(s) (%d key), %d bytes%s." %
+        (path, frames, keys, size, (", %d missed" % misses) if misses else ""), file=vs)
   print("Convert on a PC: python utils/pdsr2gif.py <file> -o out.gif", file=vs)
@@ -2,9 +2,11 @@ import os
 import ujson
 import hashlib
 import binascii
+import struct
 import ssh
 import pdeck
 import auto_connect
+import dir_cache
 
 import esclib as _esclib
 
@@ -16,34 +18,195 @@ _DEFAULT_CONFIG = {
   "remotes": {}
 }
 
-# Remote script converts st_mtime to MicroPython Y2K epoch (2000-01-01)
-# so both sides use the same epoch and the device can compare directly.
-_REMOTE_SCRIPT = (
-  "import os,hashlib,json,sys,fnmatch\n"
-  "root=sys.argv[2]\n"
-  "pattern=sys.argv[3] if len(sys.argv)>3 else None\n"
-  "E=946684800\n"
-  "r={}\n"
-  "def _md5(p):\n"
-  "  d=open(p,'rb').read()\n"
-  "  try:return hashlib.md5(d,usedforsecurity=False).hexdigest()\n"
-  "  except TypeError:return hashlib.md5(d).hexdigest()\n"
-  "if os.path.isdir(root):\n"
-  "  for dp,ds,fs in os.walk(root):\n"
-  "    for fn in fs:\n"
-  "      if pattern and not fnmatch.fnmatch(fn,pattern):continue\n"
-  "      p=os.path.join(dp,fn)\n"
-  "      rel=os.path.relpath(p,root).replace('\\\\','/')\n"
-  "      try:\n"
-  "        st=os.stat(p);r[rel]={'md5':_md5(p),'mtime':st.st_mtime-E,'size':st.st_size}\n"
-  "      except Exception:pass\n"
-  "print(json.dumps(r))\n"
-)
+# Helper run on the remote with python3; argv[2] is the mode.
+#
+#   manifest ROOT SAVE [PATTERN]  print {rel: {md5, mtime, size}} of files
+#       under ROOT. MD5s are kept in ROOT/.pdsync/manifest.json (written when
+#       SAVE is 1) and only files whose size or mtime changed are re-read.
+#       st_mtime is converted to the MicroPython Y2K epoch (2000-01-01) so
+#       both sides use the same epoch and the device can compare directly.
+#   need FILE SIG MAP             (delta push) find the blocks of the device's
+#       new file, listed in SIG, anywhere in the old FILE; save where each was
+#       found to MAP and print the [first, count] runs of blocks not found.
+#   patch FILE MAP PATCH SIZE MD5 (delta push) rebuild FILE from its old
+#       blocks (MAP) and the missing ones plus the tail (PATCH); print 'ok'.
+#   delta FILE SIG OUT            (delta pull) write to OUT how to build FILE
+#       from the blocks of the device's old file (SIG) and literal bytes.
+#   mkdirs DIR...                 create the directories (and parents).
+#   pack ROOT OUT REL...          (batched pull) frame the files ROOT/REL into
+#       one bundle file OUT.
+#   unpack ROOT BUNDLE            (batched push) write out the files framed in
+#       BUNDLE under ROOT, then delete it; print the names written.
+#   clean DIR                     remove the transfer temporaries in DIR.
+#
+# SIG is '<II' block size, block count, then per block '<I8s' weak checksum
+# and the first 8 bytes of its MD5 (see _write_sig). A delta is a sequence of
+# b'C' '<II' (first block, count) and b'L' '<I' length + bytes records.
+# A bundle is, per file, '<HI' name length and size, the utf-8 name (relative
+# to the root), then the bytes.
+_REMOTE_SCRIPT = r"""
+import os,hashlib,json,sys,fnmatch,struct
+from operator import mul
+E=946684800
+S='.pdsync'
+def md5(d=b''):
+  try:return hashlib.md5(d,usedforsecurity=False)
+  except TypeError:return hashlib.md5(d)
+def md5_file(p):
+  h=md5()
+  with open(p,'rb') as f:
+    for c in iter(lambda:f.read(65536),b''):h.update(c)
+  return h.hexdigest()
+def load_sig(p):
+  d=open(p,'rb').read()
+  B,n=struct.unpack_from('<II',d,0)
+  t={}
+  for i in range(n):
+    w,s=struct.unpack_from('<I8s',d,8+12*i)
+    t.setdefault(w,[]).append((i,s))
+  return B,n,t
+def scan(d,B,t,hit):
+  # Roll a B byte window over d. hit(o,ids) gets the blocks matching at o
+  # and returns True to jump past them.
+  n=len(d);o=0;fresh=True
+  while o+B<=n:
+    if fresh:
+      w=d[o:o+B];a=sum(w)&0xffff;b=sum(map(mul,range(B,0,-1),w))&0xffff;fresh=False
+    c=t.get(a|b<<16)
+    if c:
+      s=md5(d[o:o+B]).digest()[:8]
+      ids=[i for i,x in c if x==s]
+      if ids and hit(o,ids):
+        o+=B;fresh=True;continue
+    if o+B<n:
+      x=d[o];a=(a-x+d[o+B])&0xffff;b=(b-B*x+a)&0xffff
+    o+=1
+def manifest(root,save,pat):
+  r={};cp=os.path.join(root,S,'manifest.json')
+  try:old=json.load(open(cp))
+  except Exception:old={}
+  new={}
+  if os.path.isdir(root):
+    for dp,ds,fs in os.walk(root):
+      if S in ds:ds.remove(S)
+      for fn in fs:
+        p=os.path.join(dp,fn)
+        rel=os.path.relpath(p,root).replace('\\','/')
+        try:
+          st=os.stat(p);c=old.get(rel)
+          if pat and not fnmatch.fnmatch(fn,pat):
+            if c:new[rel]=c
+            continue
+          if c and c[0]==st.st_size and c[1]==st.st_mtime:h=c[2]
+          else:h=md5_file(p)
+          new[rel]=[st.st_size,st.st_mtime,h]
+          r[rel]={'md5':h,'mtime':st.st_mtime-E,'size':st.st_size}
+        except Exception:pass
+    if save:
+      try:
+        os.makedirs(os.path.join(root,S),exist_ok=True)
+        if new!=old:json.dump(new,open(cp+'.tmp','w'));os.replace(cp+'.tmp',cp)
+      except Exception:pass
+  print(json.dumps(r))
+def need(fp,sp,mp):
+  B,n,t=load_sig(sp);found={}
+  def hit(o,ids):
+    new=[i for i in ids if i not in found]
+    for i in new:found[i]=o
+    return bool(new)
+  scan(open(fp,'rb').read(),B,t,hit)
+  json.dump({'B':B,'n':n,'found':found},open(mp,'w'))
+  runs=[]
+  for i in range(n):
+    if i in found:continue
+    if runs and runs[-1][0]+runs[-1][1]==i:runs[-1][1]+=1
+    else:runs.append([i,1])
+  print(json.dumps(runs))
+def patch(fp,mp,pp,size,h):
+  m=json.load(open(mp));B=m['B'];n=m['n'];found=m['found'];tmp=fp+'.pdsync'
+  with open(fp,'rb') as old,open(pp,'rb') as p,open(tmp,'wb') as out:
+    for i in range(n):
+      o=found.get(str(i))
+      if o is None:out.write(p.read(B))
+      else:old.seek(o);out.write(old.read(B))
+    out.write(p.read(size-n*B))
+  if md5_file(tmp)!=h:
+    os.remove(tmp);print('md5 mismatch');return
+  st=os.stat(fp);os.chmod(tmp,st.st_mode);os.replace(tmp,fp);print('ok')
+def delta(fp,sp,op):
+  B,n,t=load_sig(sp);d=open(fp,'rb').read();out=open(op,'wb');st=[0,None,0]
+  def lit(end):
+    if end>st[0]:out.write(b'L'+struct.pack('<I',end-st[0])+d[st[0]:end])
+  def flush():
+    if st[1] is not None:out.write(b'C'+struct.pack('<II',st[1],st[2]));st[1]=None
+  def hit(o,ids):
+    i=ids[0]
+    if o>st[0]:flush();lit(o)
+    if st[1] is not None and st[1]+st[2] in ids:st[2]+=1
+    else:flush();st[1]=i;st[2]=1
+    st[0]=o+B;return True
+  scan(d,B,t,hit)
+  flush();lit(len(d));out.close()
+  print(json.dumps({'size':len(d),'md5':md5(d).hexdigest()}))
+def mkdirs(ds):
+  for d in ds:os.makedirs(d,exist_ok=True)
+def pack(root,op,rels):
+  with open(op,'wb') as out:
+    for rel in rels:
+      try:d=open(os.path.join(root,rel),'rb').read()
+      except OSError:continue
+      n=rel.encode();out.write(struct.pack('<HI',len(n),len(d))+n+d)
+def unpack(root,bp):
+  done=[]
+  with open(bp,'rb') as f:
+    while True:
+      h=f.read(6)
+      if len(h)<6:break
+      k,size=struct.unpack('<HI',h);rel=f.read(k).decode();d=f.read(size)
+      if len(d)<size:break
+      p=os.path.join(root,rel);tmp=p+'.pdsync'
+      try:
+        os.makedirs(os.path.dirname(p),exist_ok=True)
+        with open(tmp,'wb') as out:out.write(d)
+        os.replace(tmp,p);done.append(rel)
+      except OSError:pass
+  os.remove(bp);print(json.dumps(done))
+def clean(dp):
+  for fn in ('sig','map','patch','delta','bundle'):
+    try:os.remove(os.path.join(dp,fn))
+    except OSError:pass
+a=sys.argv[2:];m=a[0]
+if m=='manifest':manifest(a[1],a[2]=='1',a[3] if len(a)>3 else None)
+elif m=='need':need(a[1],a[2],a[3])
+elif m=='patch':patch(a[1],a[2],a[3],int(a[4]),a[5])
+elif m=='delta':delta(a[1],a[2],a[3])
+elif m=='mkdirs':mkdirs(a[1:])
+elif m=='pack':pack(a[1],a[2],a[3:])
+elif m=='unpack':unpack(a[1],a[2])
+elif m=='clean':clean(a[1])
+"""
 # Precomputed once: hex-encode the script so it can be passed as a plain
 # argument to python3 -c, avoiding heredoc (which depends on the remote
 # login shell supporting POSIX syntax — fish does not).
 _REMOTE_SCRIPT_HEX = binascii.hexlify(_REMOTE_SCRIPT.encode()).decode()
 
+# Per-root state directory, on both sides: the cached manifest and the
+# temporaries of delta transfers. Never synced itself.
+STATE_DIR = ".pdsync"
+
+# Modified files at least this big are sent as a delta (block signatures,
+# then only the blocks the other side lacks). Below it the extra round
+# trips cost more than sending the whole file.
+DELTA_MIN = 16 * 1024
+
+# Names of files pulled in one bundle go on the remote command line; this
+# bounds its length.
+_PACK_ARGS = 8192
+
+# Block size bounds for delta transfers; see _block_size().
+_BLOCK_MIN = 512
+_MAX_BLOCKS = 2048
+
 
 _el = _esclib.esclib()
 _RST = "\x1b[0m"
@@ -71,6 +234,10 @@ def _save_config(cfg):
     ujson.dump(cfg, f, separators=(',\n', ': '))
 
 
+def _hexdigest(h):
+  return "".join(["%02x" % b for b in h.digest()])
+
+
 def _md5_file(path):
   h = hashlib.md5()
   with open(path, "rb") as f:
@@ -79,51 +246,142 @@ def _md5_file(path):
       if not chunk:
         break
       h.update(chunk)
-  return "".join(["%02x" % b for b in h.digest()])
+  return _hexdigest(h)
+
+
+try:
+  # Weak (rsync-style) checksum of buf[:n]: low 16 bits the byte sum, high
+  # 16 bits the sum weighted n..1. The remote helper rolls the same one.
+  @micropython.viper
+  def _weak(buf, n: int) -> uint:
+    p = ptr8(buf)
+    a = 0
+    b = 0
+    i = 0
+    while i < n:
+      a += p[i]
+      b += (n - i) * p[i]
+      i += 1
+    return uint(((b & 0xffff) << 16) | (a & 0xffff))
+
+except:
+  def _weak(buf, n):
+    a = 0
+    b = 0
+    for i in range(n):
+      a += buf[i]
+      b += (n - i) * buf[i]
+    return ((b & 0xffff) << 16) | (a & 0xffff)
 
 
 def _walk(root, rel=""):
+  # (relative path, size, mtime) of every file under root, from the shared
+  # listing cache: types and sizes come with the directory read.
   result = []
   base = root if not rel else root + "/" + rel
   try:
-    entries = os.listdir(base)
+    entries = dir_cache.entries(base)
   except OSError:
     return result
-  for name in entries:
-    full = base + "/" + name
+  for e in entries:
+    name = e[dir_cache.NAME]
+    if not rel and name == STATE_DIR:
+      continue
     rel_name = name if not rel else rel + "/" + name
-    st = os.stat(full)
-    if st[0] & 0x4000:
+    if e[dir_cache.IS_DIR]:
       result.extend(_walk(root, rel_name))
     else:
-      result.append((rel_name, st))
+      mtime = dir_cache.mtime(base, e)
+      result.append((rel_name, e[dir_cache.SIZE], mtime))
   return result
 
 
-def _build_local_manifest(root, pattern=None):
+def _cache_path(root):
+  return root + "/" + STATE_DIR + "/manifest.json"
+
+
+def _load_cache(root):
+  # {rel: [size, mtime, md5]} as saved by the last sync of root.
+  try:
+    with open(_cache_path(root), "r") as f:
+      return ujson.load(f)
+  except (OSError, ValueError):
+    return {}
+
+
+def _save_cache(root, cache):
+  path = _cache_path(root)
+  try:
+    os.mkdir(root + "/" + STATE_DIR)
+  except OSError:
+    pass
+  try:
+    with open(path + ".tmp", "w") as f:
+      ujson.dump(cache, f)
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+    os.rename(path + ".tmp", path)
+  except OSError:
+    pass
+
+
+def _build_local_manifest(root, pattern=None, cache=None):
+  # Files whose size and mtime match their cache entry keep the cached MD5;
+  # only new and changed files are read. cache is updated in place to the
+  # files now under root.
+  if cache is None:
+    cache = {}
+  # Sizes and mtimes must be current here: other apps (journal, ...) write
+  # files without telling dir_cache.
+  dir_cache.invalidate(root)
   manifest = {}
-  for rel_path, st in _walk(root):
+  seen = {}
+  for rel_path, size, mtime in _walk(root):
+    c = cache.get(rel_path)
     if pattern:
       basename = rel_path.rsplit('/', 1)[-1] if '/' in rel_path else rel_path
       if not _glob_match(basename, pattern):
+        if c:
+          seen[rel_path] = c
         continue
-    full = root + "/" + rel_path
-    try:
-      manifest[rel_path] = {
-        "md5": _md5_file(full),
-        "mtime": st[8],
-        "size": st[6],
-      }
-    except OSError:
-      pass
+    if c and c[0] == size and c[1] == mtime:
+      md5 = c[2]
+    else:
+      try:
+        md5 = _md5_file(root + "/" + rel_path)
+      except OSError:
+        continue
+    seen[rel_path] = [size, mtime, md5]
+    manifest[rel_path] = {
+      "md5": md5,
+      "mtime": mtime,
+      "size": size,
+    }
+  cache.clear()
+  cache.update(seen)
   return manifest
 
 
-def _build_remote_manifest(session, remote_root, pattern=None):
-  safe_root = remote_root.replace("'", "'\\''")
-  safe_pat = (" '" + pattern.replace("'", "'\\''") + "'") if pattern else ""
-  cmd = f"python3 -c 'import binascii,sys;exec(binascii.unhexlify(sys.argv[1]).decode())' {_REMOTE_SCRIPT_HEX} '{safe_root}'{safe_pat}"
-  rc, out = session.exec(cmd)
+def _q(s):
+  # Quote one argument for the remote shell.
+  return "'" + str(s).replace("'", "'\\''") + "'"
+
+
+def _remote(session, *args):
+  # Run _REMOTE_SCRIPT with args; returns session.exec()'s (rc, output).
+  cmd = "python3 -c 'import binascii,sys;exec(binascii.unhexlify(sys.argv[1]).decode())' " + _REMOTE_SCRIPT_HEX
+  for a in args:
+    cmd += " " + _q(a)
+  return session.exec(cmd)
+
+
+def _build_remote_manifest(session, remote_root, pattern=None, save=True):
+  args = ["manifest", remote_root, "1" if save else "0"]
+  if pattern:
+    args.append(pattern)
+  rc, out = _remote(session, *args)
   if rc != 0 or not out.strip():
     return {}
   try:
@@ -132,6 +390,221 @@ def _build_remote_manifest(session, remote_root, pattern=None):
     return {}
 
 
+def _block_size(size):
+  # At least _BLOCK_MIN bytes, and no more than _MAX_BLOCKS blocks, so a
+  # signature stays under 25KB whatever the file size.
+  b = _BLOCK_MIN
+  while size // b > _MAX_BLOCKS:
+    b *= 2
+  return b
+
+
+def _write_sig(src, sig, bs):
+  # Signature of src's full blocks (the format is described with
+  # _REMOTE_SCRIPT). Returns the number of blocks.
+  buf = bytearray(bs)
+  n = 0
+  with open(src, "rb") as f:
+    with open(sig, "wb") as out:
+      out.write(struct.pack("<II", bs, 0))
+      while f.readinto(buf) == bs:
+        out.write(struct.pack("<I", _weak(buf, bs) & 0xffffffff))
+        out.write(hashlib.md5(buf).digest()[:8])
+        n += 1
+      out.seek(4)
+      out.write(struct.pack("<I", n))
+  return n
+
+
+def _copy(src, dst, n, h=None):
+  # Copy n bytes (fewer at end of file) from src to dst, hashing into h.
+  while n > 0:
+    data = src.read(min(n, 4096))
+    if not data:
+      break
+    dst.write(data)
+    if h is not None:
+      h.update(data)
+    n -= len(data)
+
+
+def _push_delta(session, local_abs, remote_abs, state, l):
+  # Update the remote's older copy of local_abs in place: the remote looks up
+  # our block signatures in its copy, we send just the blocks it lacks.
+  # Returns the bytes sent.
+  lst, rst = state["local"], state["remote"]
+  bs = _block_size(l["size"])
+  n = _write_sig(local_abs, lst + "/sig", bs)
+  session.put(lst + "/sig", rst + "/sig")
+  rc, out = _remote(session, "need", remote_abs, rst + "/sig", rst + "/map")
+  if rc != 0:
+    raise OSError("delta: " + out.decode())
+  sent = 8 + 12 * n
+  with open(local_abs, "rb") as f:
+    with open(lst + "/patch", "wb") as p:
+      for first, count in ujson.loads(out.decode()):
+        f.seek(first * bs)
+        _copy(f, p, count * bs)
+        sent += count * bs
+      f.seek(n * bs)
+      _copy(f, p, l["size"] - n * bs)
+      sent += l["size"] - n * bs
+  session.put(lst + "/patch", rst + "/patch")
+  rc, out = _remote(session, "patch", remote_abs, rst + "/map", rst + "/patch",
+                    l["size"], l["md5"])
+  if rc != 0 or out.strip() != b"ok":
+    raise OSError("delta: " + out.decode())
+  return sent
+
+
+def _pull_delta(session, local_abs, remote_abs, state, l, r):
+  # The remote describes its newer version as blocks of our copy plus
+  # literal bytes; rebuild it next to ours, check it, then replace ours.
+  # Returns the bytes received.
+  lst, rst = state["local"], state["remote"]
+  bs = _block_size(l["size"])
+  _write_sig(local_abs, lst + "/sig", bs)
+  session.put(lst + "/sig", rst + "/sig")
+  rc, out = _remote(session, "delta", remote_abs, rst + "/sig", rst + "/delta")
+  if rc != 0:
+    raise OSError("delta: " + out.decode())
+  session.get(rst + "/delta", lst + "/delta")
+  tmp = lst + "/new"
+  h = hashlib.md5()
+  with open(lst + "/delta", "rb") as d:
+    with open(local_abs, "rb") as old:
+      with open(tmp, "wb") as new:
+        while True:
+          op = d.read(1)
+          if not op:
+            break
+          if op == b"C":
+            first, count = struct.unpack("<II", d.read(8))
+            old.seek(first * bs)
+            _copy(old, new, count * bs, h)
+          else:
+            _copy(d, new, struct.unpack("<I", d.read(4))[0], h)
+      received = d.tell()
+  if _hexdigest(h) != r["md5"]:
+    os.remove(tmp)
+    raise OSError("delta: md5 mismatch")
+  # FAT won't rename over an existing file.
+  os.remove(local_abs)
+  os.rename(tmp, local_abs)
+  return received
+
+
+def _use_delta(l, r):
+  return l and r and l["size"] >= DELTA_MIN and r["size"] >= DELTA_MIN
+
+
+def _push(session, local_abs, remote_abs, state, l, r, vs):
+  if _use_delta(l, r):
+    try:
+      _makedirs_local(state["local"])
+      state["used"] = True
+      sent = _push_delta(session, local_abs, remote_abs, state, l)
+      _p(vs, f"      delta: sent {sent:,} of {l['size']:,} bytes")
+      return
+    except Exception as e:
+      _p(vs, f"      {e}; sending the whole file")
+  session.put(local_abs, remote_abs)
+
+
+def _pull(session, local_abs, remote_abs, state, l, r, vs):
+  if _use_delta(l, r):
+    try:
+      _makedirs_local(state["local"])
+      state["used"] = True
+      got = _pull_delta(session, local_abs, remote_abs, state, l, r)
+      _p(vs, f"      delta: received {got:,} of {r['size']:,} bytes")
+      return
+    except Exception as e:
+      _p(vs, f"      {e}; fetching the whole file")
+  session.get(remote_abs, local_abs)
+
+
+def _batched(op):
+  # Small files travel in bundles: one put or get for all of them instead
+  # of a round trip each. Delta candidates and big files go on their own.
+  kind, rel, l, r = op
+  return not _use_delta(l, r) and (l if kind == "push" else r)["size"] < DELTA_MIN
+
+
+def _push_bundle(session, local_root, remote_root, state, ops):
+  # Frame ops' files into one bundle, put it, and have the remote helper
+  # write them out. Returns the set of rels the remote wrote.
+  bundle = state["local"] + "/bundle"
+  _makedirs_local(state["local"])
+  with open(bundle, "wb") as out:
+    for kind, rel, l, r in ops:
+      name = rel.encode()
+      with open(local_root + "/" + rel, "rb") as f:
+        size = f.seek(0, 2)
+        f.seek(0)
+        out.write(struct.pack("<HI", len(name), size))
+        out.write(name)
+        _copy(f, out, size)
+  session.put(bundle, state["remote"] + "/bundle")
+  rc, out = _remote(session, "unpack", remote_root, state["remote"] + "/bundle")
+  if rc != 0:
+    raise OSError("bundle: " + out.decode())
+  return set(ujson.loads(out.decode()))
+
+
+def _pull_bundle(session, local_root, remote_root, state, ops):
+  # Have the remote helper frame ops' files into one bundle, get it and
+  # write them out. Returns {rel: md5 of what was written}.
+  bundle = state["local"] + "/bundle"
+  _makedirs_local(state["local"])
+  state["used"] = True
+  rc, out = _remote(session, "pack", remote_root, state["remote"] + "/bundle",
+                    *[op[1] for op in ops])
+  if rc != 0:
+    raise OSError("bundle: " + out.decode())
+  session.get(state["remote"] + "/bundle", bundle)
+  want = set(op[1] for op in ops)
+  got = {}
+  with open(bundle, "rb") as f:
+    while True:
+      head = f.read(6)
+      if len(head) < 6:
+        break
+      k, size = struct.unpack("<HI", head)
+      rel = f.read(k).decode()
+      if rel not in want:
+        raise OSError("bundle: unexpected " + rel)
+      h = hashlib.md5()
+      with open(local_root + "/" + rel, "wb") as out:
+        _copy(f, out, size, h)
+      got[rel] = _hexdigest(h)
+  return got
+
+
+def _groups(ops, limit):
+  # Split ops so the names of each group fit on one remote command line.
+  group = []
+  n = 0
+  for op in ops:
+    if group and n + len(op[1]) > limit:
+      yield group
+      group = []
+      n = 0
+    group.append(op)
+    n += len(op[1]) + 3
+  if group:
+    yield group
+
+
+def _pulled(cache, rel, local_abs, r):
+  # A pulled file's MD5 is known: record it so the next run needn't read it.
+  try:
+    st = os.stat(local_abs)
+    cache[rel] = [st[6], st[8], r["md5"]]
+  except OSError:
+    pass
+
+
 def _makedirs_local(path):
   parts = [p for p in path.split("/") if p]
   current = ""
@@ -139,15 +612,11 @@ def _makedirs_local(path):
     current += "/" + part
     try:
       os.mkdir(current)
+      dir_cache.invalidate(current)
     except OSError:
       pass
 
 
-def _makedirs_remote(session, path):
-  safe = path.replace("'", "'\\''")
-  session.exec(f"mkdir -p '{safe}'")
-
-
 def _parent(path):
   idx = path.rfind("/")
   return path[:idx] if idx > 0 else "/"
@@ -179,58 +648,120 @@ def _sync_pair(session, local_root, remote_root, vs, pattern=None, dry_run=False
     _p(vs, f"  {_b('[DRY RUN]')}")
 
   _p(vs, "  Scanning local...")
-  local = _build_local_manifest(local_root, pattern)
+  cache = _load_cache(local_root)
+  local = _build_local_manifest(local_root, pattern, cache)
   _p(vs, f"  {_b(len(local))} local files")
 
   _p(vs, "  Scanning remote...")
-  remote = _build_remote_manifest(session, remote_root, pattern)
+  remote = _build_remote_manifest(session, remote_root, pattern, not dry_run)
   _p(vs, f"  {_b(len(remote))} remote files")
 
-  if not dry_run:
-    _makedirs_remote(session, remote_root)
-    _makedirs_local(local_root)
-
-  pushed = pulled = skipped = errors = 0
-
+  # Plan first: the listing below is the same with or without -n.
+  skipped = 0
+  plan = []
   for rel in sorted(set(local.keys()) | set(remote.keys())):
-    local_abs = local_root + "/" + rel
-    remote_abs = remote_root + "/" + rel
     l = local.get(rel)
     r = remote.get(rel)
+    if l and r:
+      if l["md5"] == r["md5"]:
+        skipped += 1
+        continue
+      kind = "pull" if r["mtime"] > l["mtime"] else "push"
+      _p(vs, f"  [C] {_b(kind)} {rel}")
+    else:
+      kind = "push" if l else "pull"
+      _p(vs, f"  {_b(kind)} {rel}")
+    plan.append((kind, rel, l, r))
+
+  pushes = [op for op in plan if op[0] == "push"]
+  pulls = [op for op in plan if op[0] == "pull"]
+  if dry_run:
+    return len(pushes), len(pulls), skipped, 0
+
+  state = {
+    "local": local_root + "/" + STATE_DIR,
+    "remote": remote_root + "/" + STATE_DIR,
+    "used": False,
+  }
+  pushed = pulled = errors = 0
+
+  def fail(rel, e):
+    nonlocal errors
+    _p(vs, f"  {_b('ERR')} {rel}: {e}")
+    errors += 1
+
+  # Every directory a transfer needs, created up front: one exec for the
+  # remote side, one mkdir walk per local directory.
+  rdirs = {remote_root, state["remote"]}
+  for op in pushes:
+    rdirs.add(_parent(remote_root + "/" + op[1]))
+  if plan:
+    _remote(session, "mkdirs", *sorted(rdirs))
+  ldirs = {local_root}
+  for op in pulls:
+    ldirs.add(_parent(local_root + "/" + op[1]))
+  for d in sorted(ldirs):
+    _makedirs_local(d)
+
+  small = [op for op in pulls if _batched(op)]
+  for group in _groups(small, _PACK_ARGS):
+    try:
+      got = _pull_bundle(session, local_root, remote_root, state, group)
+    except Exception as e:
+      got = {}
+      err = e
+    else:
+      err = "not received"
+    for kind, rel, l, r in group:
+      if rel not in got:
+        fail(rel, err)
+      elif got[rel] != r["md5"]:
+        fail(rel, "md5 mismatch")
+      else:
+        _pulled(cache, rel, local_root + "/" + rel, r)
+        pulled += 1
 
+  small = [op for op in pushes if _batched(op)]
+  if small:
     try:
-      if l and r:
-        if l["md5"] == r["md5"]:
-          skipped += 1
-          continue
-        if r["mtime"] > l["mtime"]:
-          _p(vs, f"  [C] {_b('pull')} {rel}")
-          if not dry_run:
-            _makedirs_local(_parent(local_abs))
-            session.get(remote_abs, local_abs)
-          pulled += 1
-        else:
-          _p(vs, f"  [C] {_b('push')} {rel}")
-          if not dry_run:
-            _makedirs_remote(session, _parent(remote_abs))
-            session.put(local_abs, remote_abs)
-          pushed += 1
-      elif l:
-        _p(vs, f"  {_b('push')} {rel}")
-        if not dry_run:
-          _makedirs_remote(session, _parent(remote_abs))
-          session.put(local_abs, remote_abs)
+      written = _push_bundle(session, local_root, remote_root, state, small)
+      err = "not written"
+    except Exception as e:
+      written = set()
+      err = e
+    for kind, rel, l, r in small:
+      if rel in written:
         pushed += 1
       else:
-        _p(vs, f"  {_b('pull')} {rel}")
-        if not dry_run:
-          _makedirs_local(_parent(local_abs))
-          session.get(remote_abs, local_abs)
+        fail(rel, err)
+
+  for op in plan:
+    if _batched(op):
+      continue
+    kind, rel, l, r = op
+    local_abs = local_root + "/" + rel
+    remote_abs = remote_root + "/" + rel
+    try:
+      if kind == "pull":
+        _pull(session, local_abs, remote_abs, state, l, r, vs)
+        _pulled(cache, rel, local_abs, r)
         pulled += 1
+      else:
+        _push(session, local_abs, remote_abs, state, l, r, vs)
+        pushed += 1
     except Exception as e:
-      _p(vs, f"  {_b('ERR')} {rel}: {e}")
-      errors += 1
+      fail(rel, e)
 
+  if state["used"]:
+    _remote(session, "clean", state["remote"])
+  for name in ("sig", "patch", "delta", "new", "bundle"):
+    try:
+      os.remove(state["local"] + "/" + name)
+    except OSError:
+      pass
+  _save_cache(local_root, cache)
+  if pulled:
+    dir_cache.invalidate(local_root)
   return pushed, pulled, skipped, errors
 
 
@@ -27,6 +27,39 @@ def _tail_lines(vs, lines, n):
   return 0
 
 
+def _tail_bytes_sink(vs, n):
+  # Streaming stdin: keep the last n bytes (trimmed once they pass 2n).
+  data = b''
+  while True:
+    line = yield
+    if line is None:
+      break
+    data += line.encode('utf-8')
+    if len(data) > 2 * n:
+      data = data[-n:] if n else b''
+  _tail_bytes(vs, data, n)
+
+
+def _tail_lines_sink(vs, n):
+  # Streaming stdin: a ring of the last n lines, printed at the end.
+  ring = [None] * n if n > 0 else []
+  count = 0
+  while True:
+    line = yield
+    if line is None:
+      break
+    if ring:
+      ring[count % n] = line.rstrip('\n')
+      count += 1
+  if count > n:
+    start = count % n
+    lines = ring[start:] + ring[:start]
+  else:
+    lines = ring[:count]
+  for line in lines:
+    print(line, file=vs)
+
+
 def _tail_file(vs, path, n, nbytes):
   try:
     if nbytes is not None:
@@ -41,15 +74,33 @@ def _tail_file(vs, path, n, nbytes):
     return 1
 
 
-def main(vs, args_in):
+def _parse(args_in):
   parser = argparse.ArgumentParser(description='print last lines of files')
   parser.add_argument('-n', type=int, default=10, help='number of lines')
   parser.add_argument('-c', type=int, default=None, help='number of bytes')
   parser.add_argument('files', nargs='*', help='file paths')
-
   try:
-    args = parser.parse_args(args_in[1:])
+    return parser.parse_args(args_in[1:])
   except SystemExit:
+    return None
+
+
+def pipe(vs, args_in):
+  # Streaming stdin entry point (see pstdin): a line sink, or None to run
+  # main() instead.
+  args = _parse(args_in)
+  if args is None:
+    return iter(())   # usage error already shown: take no input
+  if args.files and args.files != ['-']:
+    return None
+  if args.c is not None:
+    return _tail_bytes_sink(vs, args.c)
+  return _tail_lines_sink(vs, args.n)
+
+
+def main(vs, args_in):
+  args = _parse(args_in)
+  if args is None:
     return
 
   # No file (or '-'): read piped stdin if the shell provided any.
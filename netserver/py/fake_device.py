@@ -0,0 +1,280 @@
+# A stand-in for the netserver app on Pocket Deck, for trying out and
+# benchmarking the screencast without the hardware.
+#
+# It listens on the netserver port and answers the commands proxy.py sends
+# (auth, send_screen, stream_screen, clipboard, files), showing a .pdsr
+# recording made with screenrec (looped, at its own pace) as the screen.
+# Uploaded files are kept in memory and listed and downloadable afterwards.
+#
+#   python py/fake_device.py rec.pdsr             serve on port 12022
+#   python py/fake_device.py rec.pdsr --no-stream  behave like firmware without
+#                                                  stream_screen
+#   python py/fake_device.py rec.pdsr --bench 10   compare the screencast modes
+#
+# --rtt delays every reply to a request, like the Wi-Fi round trip to the
+# device; it is what limits the frame rate of the request-per-frame mode.
+
+import argparse
+import asyncio
+import bisect
+import hashlib
+import time
+
+import screen_codec
+
+DEFAULT_PORT = 12022
+
+
+def _reply(code):
+  return bytes([code, 0, 0, 0])
+
+
+class FakeDevice:
+  def __init__(self, frames, password="password", stream=True, rtt_ms=0.0):
+    self.frames = frames
+    self.times = [t for t, _ in frames]
+    self.length = max(self.times[-1], 1)
+    self.auth_md5 = hashlib.md5(password.encode('utf-8')).hexdigest()
+    self.stream = stream
+    self.rtt = rtt_ms / 1000.0
+    self.clipboard = b""
+    self.files = {}
+    self.start = time.monotonic()
+    self.tasks = set()    # the running handle() tasks, for close()
+
+  def screen(self):
+    # The recording frame showing now (the recording loops).
+    t = int((time.monotonic() - self.start) * 1000) % self.length
+    i = bisect.bisect_right(self.times, t) - 1
+    return self.frames[max(i, 0)][1]
+
+  async def _push(self, writer, fps):
+    # stream_screen: frame records of each change, and an unchanged-frame
+    # record once a second so the proxy knows the device is still there.
+    interval = 1.0 / fps
+    start = time.monotonic()
+    prev = None
+    last = 0.0
+    while True:
+      t0 = time.monotonic()
+      cur = self.screen()
+      if cur is not prev or t0 - last >= 1.0:
+        writer.write(screen_codec.encode_frame(int((t0 - start) * 1000), cur, prev))
+        await writer.drain()
+        prev = cur
+        last = t0
+      await asyncio.sleep(max(0.0, interval - (time.monotonic() - t0)))
+
+  async def handle(self, reader, writer):
+    task = asyncio.current_task()
+    self.tasks.add(task)
+    authed = False
+    buf = b""
+
+    async def need(n):
+      nonlocal buf
+      while len(buf) < n:
+        data = await reader.read(65536)
+        if not data:
+          raise ConnectionError("closed")
+        buf += data
+      out = buf[:n]
+      buf = buf[n:]
+      return out
+
+    async def until(sep):
+      nonlocal buf
+      while sep not in buf:
+        data = await reader.read(65536)
+        if not data:
+          raise ConnectionError("closed")
+        buf += data
+      return await need(buf.index(sep) + len(sep))
+
+    async def send(data):
+      if self.rtt:
+        await asyncio.sleep(self.rtt)
+      writer.write(data)
+      await writer.drain()
+
+    try:
+      while True:
+        if not buf:
+          data = await reader.read(65536)
+          if not data:
+            break
+          buf += data
+        if buf.startswith(b"auth "):
+          token = (await need(5 + 32))[5:].decode('ascii', 'replace')
+          authed = token == self.auth_md5
+          await send(_reply(0 if authed else 1))
+        elif not authed:
+          buf = b""
+          await send(_reply(1))
+        elif buf.startswith(b"send_screen"):
+          await need(11)
+          await send(_reply(0) + self.screen())
+        elif buf.startswith(b"stream_screen"):
+          cmd = buf.decode('ascii', 'replace')
+          buf = b""
+          if not self.stream:
+            await send(_reply(1))
+            continue
+          try:
+            fps = max(1, int(cmd.split()[1]))
+          except (IndexError, ValueError):
+            fps = 30
+          await send(_reply(0))
+          await self._push(writer, fps)
+        elif buf.startswith(b"put_clipboard"):
+          await need(13)
+          size = int.from_bytes(await need(4), 'little')
+          self.clipboard = await need(size)
+          await send(_reply(0))
+        elif buf.startswith(b"get_clipboard"):
+          await need(13)
+          await send(_reply(0) + len(self.clipboard).to_bytes(4, 'little') + self.clipboard)
+        elif buf.startswith(b"get_file_list"):
+          await need(13)
+          names = ",".join(sorted(self.files)).encode('utf-8')
+          await send(_reply(0) + len(names).to_bytes(4, 'little') + names)
+        elif buf.startswith(b"get_file "):
+          name = buf[9:].decode('utf-8', 'replace')
+          buf = b""
+          data = self.files.get(name)
+          if data is None:
+            await send(_reply(2))
+          else:
+            await send(_reply(0) + len(data).to_bytes(4, 'little') + data)
+        elif buf.startswith(b"put_file "):
+          await need(9)
+          name = (await until(b"\0"))[:-1].decode('utf-8', 'replace')
+          size = int.from_bytes(await need(4), 'little')
+          self.files[name] = await need(size)
+          await send(_reply(0))
+        else:
+          buf = b""
+          await send(_reply(1))
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    except asyncio.CancelledError:
+      # close(), or shutting down. Finish normally: Python 3.11 reports a
+      # cancelled connection handler as an unhandled exception.
+      pass
+    finally:
+      self.tasks.discard(task)
+      writer.close()
+
+  async def close(self):
+    # End the open connections; a server's close() leaves them running.
+    tasks = list(self.tasks)
+    for t in tasks:
+      t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _bench_pull(host, port, auth_md5, seconds):
+  # The request-per-frame screencast: a full screen per send_screen.
+  reader, writer = await asyncio.open_connection(host, port)
+  writer.write(f"auth {auth_md5}".encode('utf-8'))
+  await writer.drain()
+  await reader.readexactly(4)
+  frames = changed = nbytes = 0
+  prev = None
+  end = time.monotonic() + seconds
+  while time.monotonic() < end:
+    writer.write(b"send_screen")
+    await writer.drain()
+    await reader.readexactly(4)
+    cur = await reader.readexactly(screen_codec.FRAME_BYTES)
+    frames += 1
+    nbytes += len(cur)
+    changed += cur != prev
+    prev = cur
+  writer.close()
+  return frames, changed, nbytes
+
+
+async def _bench_stream(host, port, auth_md5, fps, seconds):
+  # proxy.py's stream task, with the WebSocket replaced by a counter.
+  import proxy
+  proxy.ESP32_PORT = port
+  stats = {"frames": 0, "changed": 0, "bytes": 0, "mode": None}
+
+  async def send(record):
+    stats["frames"] += 1
+    stats["bytes"] += len(record)
+    stats["changed"] += screen_codec.HEAD.unpack_from(record)[2] > 0
+
+  async def status(msg):
+    stats["mode"] = msg.split(':', 1)[1]
+
+  try:
+    await asyncio.wait_for(proxy._stream(host, auth_md5, fps, send, status), seconds)
+  except asyncio.TimeoutError:
+    pass
+  return stats
+
+
+async def _bench(frames, args):
+  host = "127.0.0.1"
+  results = []
+  for label, stream in (("pull (send_screen per frame)", True),
+                        ("stream, device push", True),
+                        ("stream, proxy polling", False)):
+    dev = FakeDevice(frames, args.password, stream, args.rtt)
+    server = await asyncio.start_server(dev.handle, host, 0)
+    port = server.sockets[0].getsockname()[1]
+    if label.startswith("pull"):
+      n, changed, nbytes = await _bench_pull(host, port, dev.auth_md5, args.bench)
+    else:
+      st = await _bench_stream(host, port, dev.auth_md5, args.fps, args.bench)
+      n, changed, nbytes = st["frames"], st["changed"], st["bytes"]
+      label += f" [{st['mode']}]"
+    server.close()
+    await dev.close()
+    await server.wait_closed()
+    results.append((label, n, changed, nbytes))
+
+  secs = args.bench
+  print(f"{secs:g} s each, rtt {args.rtt:g} ms, stream fps {args.fps}")
+  print(f"{'mode':44} {'msgs/s':>8} {'updates/s':>10} {'KB/s':>8} {'B/msg':>7}")
+  for label, n, changed, nbytes in results:
+    print(f"{label:44} {n / secs:8.1f} {changed / secs:10.1f} {nbytes / secs / 1024:8.1f} {nbytes // max(n, 1):7}")
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Fake Pocket Deck netserver replaying a .pdsr recording")
+  parser.add_argument("recording", help=".pdsr file from screenrec")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+  parser.add_argument("--password", default="password")
+  parser.add_argument("--no-stream", action="store_true", help="refuse stream_screen, like older firmware")
+  parser.add_argument("--rtt", type=float, default=0.0, help="delay replies by this many ms")
+  parser.add_argument("--bench", type=float, metavar="SECONDS", help="benchmark the screencast modes and exit")
+  parser.add_argument("--fps", type=int, default=40, help="stream fps for --bench")
+  args = parser.parse_args()
+
+  frames = screen_codec.read_pdsr(args.recording)
+  if not frames:
+    raise SystemExit(f"{args.recording}: no frames")
+  if args.bench:
+    asyncio.run(_bench(frames, args))
+    return
+
+  async def serve():
+    dev = FakeDevice(frames, args.password, not args.no_stream, args.rtt)
+    server = await asyncio.start_server(dev.handle, args.host, args.port)
+    print(f"Fake device on {args.host}:{args.port}, {len(frames)} frames "
+          f"({frames[-1][0] / 1000:.1f} s, looped)")
+    async with server:
+      await server.serve_forever()
+
+  try:
+    asyncio.run(serve())
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == "__main__":
+  main()
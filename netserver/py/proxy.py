@@ -1,7 +1,15 @@
 import asyncio
-import websockets
 import sys
 import hashlib
+import json
+import os
+import re
+import struct
+import tempfile
+import time
+import zlib
+
+import screen_codec
 
 ESP32_PORT = 12022
 WEBSOCKET_PORT = 8000
@@ -10,12 +18,228 @@ BUFFER_SIZE = 12000
 TCP_CONNECT_TIMEOUT = 5.0
 TCP_OP_TIMEOUT = 5.0
 
+# Screencast streaming ("start_stream:<fps>" from the browser).
+#
+# The stream gets its own TCP connection to the device, so clipboard and file
+# requests on the main one are not stuck behind frames. On it the proxy asks
+# for "stream_screen <fps>": a device that supports it answers code 0 and
+# then pushes frame records (see screen_codec) whenever the screen changes,
+# plus an unchanged-frame record about once a second as a keepalive. Those
+# are forwarded to the browser as they are, one WebSocket message each.
+#
+# Firmware without stream_screen gets polled with send_screen on the stream
+# connection instead, and the proxy encodes the same frame records itself:
+# the browser still receives only changes and never waits for a request.
+STREAM_FPS_MAX = 60
+STREAM_PROBE_TIMEOUT = 2.0
+STREAM_IDLE_TIMEOUT = 5.0
+
+# Binary WebSocket messages start with a channel byte, so screen frames and
+# file data can share the connection (and interleave) without being mixed up.
+CH_SCREEN = 1    # stream frame records, send_screen frames
+CH_FILE = 2      # file chunks, both ways
+
+# File transfers ("upload_begin:" / "get_file:" from the browser).
+#
+# Files move between browser and proxy in chunks of CHUNK_SIZE:
+#   [CH_FILE] u16 key length, key (utf-8), u64 offset, u32 crc32, data
+# where the key is the upload id or the download's device path. The receiver
+# checks offset and CRC of each chunk; a bad one is asked for again from its
+# offset. Chunks are spooled to disk (SPOOL_DIR) instead of being held in
+# memory, and spools outlive the WebSocket connection: after a reconnect an
+# upload continues from the bytes the proxy already has ("upload_offset:")
+# and a download from the bytes the browser already has ("get_file_from:").
+# Only a resume reuses a download spool: a new "get_file:" fetches the file
+# from the device again, as it may have changed since.
+#
+# The device itself only knows whole-file put_file/get_file, so that leg is
+# streamed from/to the spool once the file is complete, with
+# "file_progress:" messages; a failed device write keeps the spool, and the
+# next upload_begin of the same file retries it without a new upload.
+CHUNK_SIZE = 64 * 1024
+CHUNK_HEAD = struct.Struct("<QI")
+SPOOL_DIR = os.path.join(tempfile.gettempdir(), "pdeck_proxy")
+SPOOL_MAX_AGE = 24 * 3600
+_ID_OK = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# Transfers in progress, kept across WebSocket connections.
+_uploads = {}     # id -> {"id", "path", "size", "spool", "sending"}
+_downloads = {}   # device path -> {"spool", "size"}
+
+
+async def _open_device(host, auth_md5):
+  # A new authorized connection to the device: (reader, writer).
+  reader, writer = await asyncio.wait_for(
+    asyncio.open_connection(host, ESP32_PORT), timeout=TCP_CONNECT_TIMEOUT)
+  try:
+    writer.write(f"auth {auth_md5}".encode('utf-8'))
+    await writer.drain()
+    header = await asyncio.wait_for(reader.readexactly(4), timeout=TCP_OP_TIMEOUT)
+    if header[0] != 0:
+      raise ConnectionError(f"auth failed: code {header[0]}")
+  except BaseException:
+    writer.close()
+    raise
+  return reader, writer
+
+
+async def _close(writer):
+  try:
+    writer.close()
+    await writer.wait_closed()
+  except Exception:
+    pass
+
+
+async def _stream_native(reader, send):
+  # Forward the device's frame records until the connection ends.
+  head_size = screen_codec.HEAD.size
+  while True:
+    head = await asyncio.wait_for(reader.readexactly(head_size), timeout=STREAM_IDLE_TIMEOUT)
+    n = screen_codec.HEAD.unpack(head)[2]
+    body = await asyncio.wait_for(reader.readexactly(n), timeout=TCP_OP_TIMEOUT) if n else b""
+    await send(head + body)
+
+
+async def _stream_polled(reader, writer, fps, send):
+  # Poll send_screen at up to fps and send frame records of the changes.
+  interval = 1.0 / fps
+  prev = None
+  start = time.monotonic()
+  last_sent = 0.0
+  while True:
+    t0 = time.monotonic()
+    writer.write(b"send_screen")
+    await writer.drain()
+    header = await asyncio.wait_for(reader.readexactly(4), timeout=TCP_OP_TIMEOUT)
+    if header[0] != 0:
+      raise ConnectionError(f"send_screen failed: code {header[0]}")
+    cur = await asyncio.wait_for(reader.readexactly(BUFFER_SIZE), timeout=TCP_OP_TIMEOUT)
+    if cur != prev or t0 - last_sent >= 1.0:
+      await send(screen_codec.encode_frame(int((t0 - start) * 1000), cur, prev))
+      prev = cur
+      last_sent = t0
+    await asyncio.sleep(max(0.0, interval - (time.monotonic() - t0)))
+
+
+async def _stream(host, auth_md5, fps, send, status):
+  # Body of the stream task: native push if the device has it, else polling.
+  reader, writer = await _open_device(host, auth_md5)
+  try:
+    writer.write(f"stream_screen {fps}".encode('utf-8'))
+    await writer.drain()
+    try:
+      header = await asyncio.wait_for(reader.readexactly(4), timeout=STREAM_PROBE_TIMEOUT)
+      native = header[0] == 0
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+      native = False
+    if native:
+      await status("stream_started:push")
+      await _stream_native(reader, send)
+      return
+    # Unknown command: the connection may be in any state, start afresh.
+    await _close(writer)
+    reader, writer = await _open_device(host, auth_md5)
+    await status("stream_started:poll")
+    await _stream_polled(reader, writer, fps, send)
+  finally:
+    await _close(writer)
+
+
+def _spool_path(kind, key):
+  name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+  return os.path.join(SPOOL_DIR, f"{kind}-{name}")
+
+
+def _clean_spools():
+  # Drop spools of transfers abandoned long ago.
+  try:
+    names = os.listdir(SPOOL_DIR)
+  except OSError:
+    return
+  now = time.time()
+  for name in names:
+    path = os.path.join(SPOOL_DIR, name)
+    try:
+      if now - os.path.getmtime(path) > SPOOL_MAX_AGE:
+        os.remove(path)
+    except OSError:
+      pass
+
+
+def _spool_size(path):
+  try:
+    return os.path.getsize(path)
+  except OSError:
+    return 0
+
+
+def _pack_chunk(key, offset, data):
+  k = key.encode('utf-8')
+  return (bytes([CH_FILE]) + len(k).to_bytes(2, 'little') + k +
+          CHUNK_HEAD.pack(offset, zlib.crc32(data)) + data)
+
+
+def _parse_chunk(message):
+  # (key, offset, data) of a file chunk, or None if the CRC does not match.
+  k = int.from_bytes(message[1:3], 'little')
+  key = message[3:3 + k].decode('utf-8')
+  offset, crc = CHUNK_HEAD.unpack_from(message, 3 + k)
+  data = message[3 + k + CHUNK_HEAD.size:]
+  return key, offset, data if zlib.crc32(data) == crc else None
+
 
 async def forward_to_esp32(websocket):
   print(f"Client connected: {websocket.remote_address}")
 
   tcp_reader = None
   tcp_writer = None
+  target_host = None
+  auth_md5 = None
+  stream_task = None
+  # Device commands take turns on the one connection (the lock is FIFO, so in
+  # the order they arrived). They run as tasks: while a file goes to the
+  # device, this loop keeps taking upload chunks and stream control.
+  tcp_lock = asyncio.Lock()
+  tasks = set()
+  # Downloads being sent to the browser: path -> offset to go back to, set
+  # when the browser asks for a chunk again.
+  resend = {}
+
+  async def ws_send_frame(data):
+    await websocket.send(bytes([CH_SCREEN]) + data)
+
+  async def run_stream(fps):
+    try:
+      await _stream(target_host, auth_md5, fps, ws_send_frame, websocket.send)
+    except asyncio.CancelledError:
+      raise
+    except Exception as e:
+      print(f"Stream ended: {e}")
+      try:
+        await websocket.send(f"stream_failed:{e}")
+      except Exception:
+        pass
+
+  async def stop_stream():
+    nonlocal stream_task
+    if stream_task:
+      stream_task.cancel()
+      try:
+        await stream_task
+      except BaseException:
+        pass
+      stream_task = None
+
+  def spawn(coro):
+    task = asyncio.create_task(coro)
+    tasks.add(task)
+    task.add_done_callback(task_done)
+
+  def task_done(task):
+    tasks.discard(task)
+    if not task.cancelled() and task.exception():
+      print(f"Task failed: {task.exception()}")
 
   async def tcp_read_exactly(n):
     return await asyncio.wait_for(tcp_reader.readexactly(n), timeout=TCP_OP_TIMEOUT)
@@ -39,137 +263,299 @@ async def forward_to_esp32(websocket):
     tcp_reader = None
     tcp_writer = None
 
+  async def device(op, *args):
+    # Run a device command in its turn; returns what op returns, or None.
+    async with tcp_lock:
+      if not tcp_writer:
+        await websocket.send("ERROR: Not connected to target device.")
+        return None
+      try:
+        return await op(*args)
+      except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError) as e:
+        print(f"TCP error: {e}")
+        await close_tcp()
+        await websocket.send(f"ERROR: {e}")
+        return None
+
+  async def connect(new_host):
+    nonlocal tcp_reader, tcp_writer, target_host
+    async with tcp_lock:
+      try:
+        await stop_stream()
+        await close_tcp()
+        target_host = new_host
+        print(f"Connecting to ESP32 at {new_host}:{ESP32_PORT}...")
+        tcp_reader, tcp_writer = await asyncio.wait_for(
+          asyncio.open_connection(new_host, ESP32_PORT),
+          timeout=TCP_CONNECT_TIMEOUT
+        )
+        print("Connected to ESP32.")
+        await websocket.send("connect_success")
+      except Exception as e:
+        print(f"Connection failed: {e}")
+        await close_tcp()
+        await websocket.send(f"connect_failed:{e}")
+
+  async def auth(password):
+    nonlocal auth_md5
+    md5_hex = hashlib.md5(password.encode('utf-8')).hexdigest()
+    await tcp_write(f"auth {md5_hex}".encode('utf-8'))
+    code = await read_resp_header()
+    if code == 0:
+      auth_md5 = md5_hex
+      await websocket.send("auth_success")
+      print("Authorization successful.")
+    else:
+      await websocket.send(f"auth_failed:code_{code}")
+      print(f"Authorization failed: code {code}")
+
+  async def send_screen():
+    await tcp_write(b"send_screen")
+    code = await read_resp_header()
+    if code != 0:
+      await websocket.send(f"ERROR: Code {code}")
+      return
+    data = await tcp_read_exactly(BUFFER_SIZE)
+    await ws_send_frame(data)
+
+  async def put_clipboard(text):
+    content = text.encode('utf-8')
+    await tcp_write(b"put_clipboard")
+    await tcp_write(len(content).to_bytes(4, 'little'))
+    await tcp_write(content)
+    code = await read_resp_header()
+    if code != 0:
+      await websocket.send(f"ERROR: Clipboard put failed ({code})")
+
+  async def get_clipboard():
+    await tcp_write(b"get_clipboard")
+    code = await read_resp_header()
+    if code != 0:
+      await websocket.send(f"ERROR: Clipboard get failed ({code})")
+      return
+    size_bytes = await tcp_read_exactly(4)
+    size = int.from_bytes(size_bytes, 'little')
+    clip_data = await tcp_read_exactly(size) if size > 0 else b''
+    text = clip_data.decode('utf-8', errors='ignore')
+    await websocket.send(f"clipboard_data:{text}")
+
+  async def get_file_list():
+    await tcp_write(b"get_file_list")
+    code = await read_resp_header()
+    if code != 0:
+      await websocket.send(f"file_list_error:{code}")
+      return
+    size = int.from_bytes(await tcp_read_exactly(4), 'little')
+    data = await tcp_read_exactly(size)
+    await websocket.send(f"file_list:{data.decode('utf-8')}")
+
+  async def fetch_file(filename):
+    # Device -> spool. Returns the download entry, or None on a device error.
+    await tcp_write(f"get_file {filename}".encode('utf-8'))
+    code = await read_resp_header()
+    if code != 0:
+      await websocket.send(f"file_get_error:{code}:{filename}")
+      return None
+    size = int.from_bytes(await tcp_read_exactly(4), 'little')
+    print(f"Receiving file {filename} ({size} bytes)")
+    spool = _spool_path("get", filename)
+    received = 0
+    with open(spool, "wb") as f:
+      while received < size:
+        chunk = await asyncio.wait_for(
+          tcp_reader.read(min(CHUNK_SIZE, size - received)),
+          timeout=TCP_OP_TIMEOUT
+        )
+        if not chunk:
+          raise ConnectionError("connection closed during get_file")
+        f.write(chunk)
+        received += len(chunk)
+        await websocket.send(f"file_progress:{filename}:device:{received}:{size}")
+    entry = {"spool": spool, "size": size}
+    _downloads[filename] = entry
+    return entry
+
+  async def get_file(filename, offset, resume):
+    # Spool -> browser from offset. A resume continues from the spool of the
+    # interrupted download if it is complete; otherwise (and always for a
+    # new download) the file is fetched from the device again and sent from
+    # the start.
+    if filename in resend:
+      resend[filename] = offset    # already being sent: rewind that sender
+      return
+    resend[filename] = None
+    try:
+      entry = _downloads.get(filename) if resume else None
+      if not entry or _spool_size(entry["spool"]) != entry["size"]:
+        get_file_done(filename)
+        entry = await device(fetch_file, filename)
+        if not entry:
+          return
+        offset = 0    # a fresh copy: the browser starts over (file_start)
+      size = entry["size"]
+      await websocket.send(f"file_start:{filename}:{size}:{offset}")
+      with open(entry["spool"], "rb") as f:
+        while True:
+          if resend[filename] is not None:
+            offset = resend[filename]
+            resend[filename] = None
+          if offset >= size:
+            break
+          f.seek(offset)
+          data = f.read(CHUNK_SIZE)
+          if not data:
+            break
+          await websocket.send(_pack_chunk(filename, offset, data))
+          offset += len(data)
+    finally:
+      del resend[filename]
+
+  async def put_file(up):
+    # Spool -> device, once the upload is complete.
+    size = up["size"]
+    await tcp_write(b"put_file ")
+    await tcp_write(up["path"].encode('utf-8') + b"\0")
+    await tcp_write(size.to_bytes(4, 'little'))
+    sent = 0
+    with open(up["spool"], "rb") as f:
+      while sent < size:
+        data = f.read(CHUNK_SIZE)
+        if not data:
+          raise ConnectionError("upload spool is short")
+        await tcp_write(data)
+        sent += len(data)
+        await websocket.send(f"file_progress:{up['id']}:device:{sent}:{size}")
+    code = await read_resp_header()
+    if code != 0:
+      await websocket.send(f"file_put_error:{up['id']}:{code}")
+      return
+    _uploads.pop(up["id"], None)
+    try:
+      os.remove(up["spool"])
+    except OSError:
+      pass
+    print(f"Sent file {up['path']} ({size} bytes)")
+    await websocket.send(f"file_put_success:{up['id']}")
+
+  async def send_upload(up):
+    try:
+      await device(put_file, up)
+    finally:
+      up["sending"] = False
+
+  def upload_ready(up):
+    # Everything is in the spool: queue the device write (once).
+    if not up["sending"] and _spool_size(up["spool"]) == up["size"]:
+      up["sending"] = True
+      spawn(send_upload(up))
+
+  async def upload_begin(spec):
+    try:
+      req = json.loads(spec)
+      up_id, path, size = req["id"], req["path"], int(req["size"])
+    except (ValueError, KeyError, TypeError):
+      await websocket.send("ERROR: bad upload_begin")
+      return
+    if not _ID_OK.match(up_id) or size < 0 or size > 0xffffffff:
+      await websocket.send(f"file_put_error:{up_id}:bad_request")
+      return
+    up = _uploads.get(up_id)
+    if not up or up["path"] != path or up["size"] != size:
+      os.makedirs(SPOOL_DIR, exist_ok=True)
+      up = {"id": up_id, "path": path, "size": size,
+            "spool": _spool_path("put", up_id), "sending": False}
+      _uploads[up_id] = up
+    have = _spool_size(up["spool"])
+    if have > size:
+      os.remove(up["spool"])
+      have = 0
+    elif have == 0:
+      open(up["spool"], "wb").close()
+    await websocket.send(f"upload_offset:{up_id}:{have}")
+    upload_ready(up)
+
+  async def upload_chunk(message):
+    key, offset, data = _parse_chunk(message)
+    up = _uploads.get(key)
+    if not up:
+      await websocket.send(f"file_put_error:{key}:unknown_upload")
+      return
+    have = _spool_size(up["spool"])
+    if offset != have:
+      # Lost or repeated chunk: tell the browser where to carry on.
+      await websocket.send(f"upload_offset:{key}:{have}")
+      return
+    if data is None or offset + len(data) > up["size"]:
+      await websocket.send(f"upload_nack:{key}:{offset}")
+      return
+    with open(up["spool"], "ab") as f:
+      f.write(data)
+    await websocket.send(f"upload_ack:{key}:{offset + len(data)}")
+    upload_ready(up)
+
+  def get_file_done(filename):
+    entry = _downloads.pop(filename, None)
+    if entry:
+      try:
+        os.remove(entry["spool"])
+      except OSError:
+        pass
+
   try:
     async for message in websocket:
       if isinstance(message, str):
         if message.startswith("target_ip:"):
-          new_host = message.split(':', 1)[1]
+          await connect(message.split(':', 1)[1])
+
+        elif message.startswith("start_stream:"):
+          await stop_stream()
+          if not tcp_writer:
+            await websocket.send("ERROR: Not connected to target device.")
+            continue
           try:
-            await close_tcp()
-            print(f"Connecting to ESP32 at {new_host}:{ESP32_PORT}...")
-            tcp_reader, tcp_writer = await asyncio.wait_for(
-              asyncio.open_connection(new_host, ESP32_PORT),
-              timeout=TCP_CONNECT_TIMEOUT
-            )
-            print("Connected to ESP32.")
-            await websocket.send("connect_success")
-          except Exception as e:
-            print(f"Connection failed: {e}")
-            await close_tcp()
-            await websocket.send(f"connect_failed:{e}")
-          continue
-
-        if not tcp_writer:
-          await websocket.send("ERROR: Not connected to target device.")
-          continue
-
-        try:
-          if message.startswith("auth:"):
-            password = message.split(':', 1)[1]
-            md5_hex = hashlib.md5(password.encode('utf-8')).hexdigest()
-            await tcp_write(f"auth {md5_hex}".encode('utf-8'))
-            code = await read_resp_header()
-            if code == 0:
-              await websocket.send("auth_success")
-              print("Authorization successful.")
-            else:
-              await websocket.send(f"auth_failed:code_{code}")
-              print(f"Authorization failed: code {code}")
-
-          elif message == "send_screen":
-            await tcp_write(b"send_screen")
-            code = await read_resp_header()
-            if code != 0:
-              await websocket.send(f"ERROR: Code {code}")
-              continue
-            data = await tcp_read_exactly(BUFFER_SIZE)
-            await websocket.send(data)
-
-          elif message.startswith("put_clipboard:"):
-            content = message.split(':', 1)[1].encode('utf-8')
-            await tcp_write(b"put_clipboard")
-            await tcp_write(len(content).to_bytes(4, 'little'))
-            await tcp_write(content)
-            code = await read_resp_header()
-            if code != 0:
-              await websocket.send(f"ERROR: Clipboard put failed ({code})")
-
-          elif message == "get_clipboard":
-            await tcp_write(b"get_clipboard")
-            code = await read_resp_header()
-            if code != 0:
-              await websocket.send(f"ERROR: Clipboard get failed ({code})")
-              continue
-            size_bytes = await tcp_read_exactly(4)
-            size = int.from_bytes(size_bytes, 'little')
-            clip_data = await tcp_read_exactly(size) if size > 0 else b''
-            text = clip_data.decode('utf-8', errors='ignore')
-            await websocket.send(f"clipboard_data:{text}")
-
-          elif message == "get_file_list":
-            await tcp_write(b"get_file_list")
-            code = await read_resp_header()
-            if code != 0:
-              await websocket.send(f"file_list_error:{code}")
-              continue
-            size = int.from_bytes(await tcp_read_exactly(4), 'little')
-            data = await tcp_read_exactly(size)
-            await websocket.send(f"file_list:{data.decode('utf-8')}")
-
-          elif message.startswith("get_file:"):
-            filename = message.split(':', 1)[1]
-            await tcp_write(f"get_file {filename}".encode('utf-8'))
-            code = await read_resp_header()
-            if code != 0:
-              await websocket.send(f"file_get_error:{code}")
-              continue
-            size = int.from_bytes(await tcp_read_exactly(4), 'little')
-            await websocket.send(f"file_start:{filename}:{size}")
-            print(f"Receiving file {filename} ({size} bytes)")
-            remaining = size
-            while remaining > 0:
-              chunk = await asyncio.wait_for(
-                tcp_reader.read(min(4096, remaining)),
-                timeout=TCP_OP_TIMEOUT
-              )
-              if not chunk:
-                break
-              await websocket.send(chunk)
-              remaining -= len(chunk)
-
-          else:
-            print(f"Unknown string message: {message}")
-
-        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError) as e:
-          print(f"TCP error: {e}")
-          await close_tcp()
-          await websocket.send(f"ERROR: {e}")
+            fps = int(message.split(':', 1)[1])
+          except ValueError:
+            fps = 30
+          fps = max(1, min(STREAM_FPS_MAX, fps))
+          stream_task = asyncio.create_task(run_stream(fps))
+
+        elif message == "stop_stream":
+          await stop_stream()
+
+        elif message.startswith("upload_begin:"):
+          await upload_begin(message.split(':', 1)[1])
+
+        elif message.startswith("get_file_done:"):
+          get_file_done(message.split(':', 1)[1])
+
+        elif message.startswith("get_file_from:"):
+          _, offset, filename = message.split(':', 2)
+          spawn(get_file(filename, int(offset), True))
+
+        elif message.startswith("get_file:"):
+          spawn(get_file(message.split(':', 1)[1], 0, False))
+
+        elif message.startswith("auth:"):
+          spawn(device(auth, message.split(':', 1)[1]))
+
+        elif message == "send_screen":
+          spawn(device(send_screen))
+
+        elif message.startswith("put_clipboard:"):
+          spawn(device(put_clipboard, message.split(':', 1)[1]))
+
+        elif message == "get_clipboard":
+          spawn(device(get_clipboard))
+
+        elif message == "get_file_list":
+          spawn(device(get_file_list))
+
+        else:
+          print(f"Unknown string message: {message}")
 
       elif isinstance(message, bytes):
-        if not tcp_writer:
-          await websocket.send("ERROR: Not connected to target device.")
-          continue
-
-        if message.startswith(b"put_file:"):
-          content = message.split(b":", 1)[1]
-          f_null_idx = content.find(b"\0")
-          if f_null_idx != -1:
-            filename = content[:f_null_idx].decode('utf-8')
-            file_data = content[f_null_idx+1:]
-            try:
-              await tcp_write(b"put_file ")
-              await tcp_write(filename.encode('utf-8') + b"\0")
-              await tcp_write(len(file_data).to_bytes(4, 'little'))
-              await tcp_write(file_data)
-              code = await read_resp_header()
-              if code == 0:
-                await websocket.send("file_put_success")
-              else:
-                await websocket.send(f"file_put_error:{code}")
-            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError) as e:
-              print(f"TCP error during put_file: {e}")
-              await close_tcp()
-              await websocket.send(f"ERROR: {e}")
+        if message[:1] == bytes([CH_FILE]):
+          await upload_chunk(message)
         else:
           print(f"Unknown binary message: {len(message)} bytes")
 
@@ -180,12 +566,20 @@ async def forward_to_esp32(websocket):
     except Exception:
       pass
   finally:
+    await stop_stream()
+    for task in list(tasks):
+      task.cancel()
     await close_tcp()
     print(f"Client disconnected: {websocket.remote_address}")
 
 
 async def main():
+  # Imported here so fake_device.py --bench can use the stream code above
+  # without websockets installed.
+  import websockets
   host = sys.argv[1] if len(sys.argv) == 2 else None
+  os.makedirs(SPOOL_DIR, exist_ok=True)
+  _clean_spools()
   print(f"Starting WebSocket Proxy on port {WEBSOCKET_PORT}")
   async with websockets.serve(forward_to_esp32, "localhost", WEBSOCKET_PORT):
     await asyncio.Future()
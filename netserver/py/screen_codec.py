@@ -0,0 +1,127 @@
+# Screen frame coding shared by proxy.py and fake_device.py.
+#
+# Streamed frames use the frame record of the .pdsr recordings written by
+# lib/screenrec.py (little-endian):
+#   u32 t_ms  u8 kind  u32 n  followed by n payload bytes
+#   kind 0 = keyframe: PackBits of the 1bpp MSB-first screen (50*240 bytes)
+#   kind 1 = delta: PackBits of (frame XOR previous frame); n = 0 means the
+#            frame is unchanged
+#   PackBits: control byte c < 0x80 is followed by c+1 literal bytes, c >= 0x80
+#   by one byte repeated (c & 0x7f) + 3 times.
+
+import re
+import struct
+
+WIDTH = 400
+HEIGHT = 240
+FRAME_BYTES = WIDTH // 8 * HEIGHT
+KIND_KEY = 0
+KIND_DELTA = 1
+HEAD = struct.Struct("<IBI")
+
+# Runs of 3 or more equal bytes; everything between them is literal.
+_RUN = re.compile(rb"(.)\1{2,}", re.S)
+
+
+def _literals(out, data, start, end):
+  while start < end:
+    k = min(128, end - start)
+    out.append(k - 1)
+    out += data[start:start + k]
+    start += k
+
+
+def packbits(data):
+  """PackBits-code bytes `data` (the hot loops run in re and slicing)."""
+  out = bytearray()
+  pos = 0
+  for m in _RUN.finditer(data):
+    s, e = m.span()
+    _literals(out, data, pos, s)
+    v = data[s]
+    while e - s >= 3:
+      k = min(130, e - s)
+      out.append(0x80 | (k - 3))
+      out.append(v)
+      s += k
+    pos = s    # a 1-2 byte remainder of the run joins the next literals
+  _literals(out, data, pos, len(data))
+  return bytes(out)
+
+
+def unpackbits(data, size=FRAME_BYTES):
+  """Decode PackBits `data` into exactly `size` bytes."""
+  out = bytearray()
+  off = 0
+  end = len(data)
+  while off < end:
+    c = data[off]
+    if c < 0x80:
+      out += data[off + 1:off + 2 + c]
+      off += 2 + c
+    else:
+      out += bytes([data[off + 1]]) * ((c & 0x7f) + 3)
+      off += 2
+  if len(out) != size:
+    raise ValueError("bad frame data (%d bytes, expected %d)" % (len(out), size))
+  return bytes(out)
+
+
+def xor_bytes(a, b):
+  return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).to_bytes(len(a), "big")
+
+
+def encode_frame(t_ms, cur, prev=None):
+  """Frame record for screen `cur`: a delta against `prev`, or a keyframe
+  when there is no previous frame."""
+  if prev is None:
+    body = packbits(cur)
+    kind = KIND_KEY
+  elif cur == prev:
+    body = b""
+    kind = KIND_DELTA
+  else:
+    body = packbits(xor_bytes(cur, prev))
+    kind = KIND_DELTA
+  return HEAD.pack(t_ms & 0xffffffff, kind, len(body)) + body
+
+
+def apply_frame(record, prev=None):
+  """Screen after frame record `record` (header included) on top of `prev`."""
+  t_ms, kind, n = HEAD.unpack_from(record, 0)
+  body = record[HEAD.size:HEAD.size + n]
+  if kind == KIND_KEY:
+    return unpackbits(body)
+  if prev is None:
+    raise ValueError("delta frame without a keyframe")
+  if not n:
+    return prev
+  return xor_bytes(prev, unpackbits(body))
+
+
+def read_pdsr(path):
+  """(t_ms, screen) of every frame of a .pdsr recording (version 1 or 2)."""
+  with open(path, "rb") as f:
+    data = f.read()
+  if len(data) < 9 or data[:4] != b"PDSR" or data[4] not in (1, 2):
+    raise ValueError("%s: not a .pdsr recording" % path)
+  w, h = struct.unpack_from("<HH", data, 5)
+  if (w, h) != (WIDTH, HEIGHT):
+    raise ValueError("%s: %dx%d, expected %dx%d" % (path, w, h, WIDTH, HEIGHT))
+  frames = []
+  off = 9
+  prev = None
+  if data[4] == 1:
+    while off + 4 + FRAME_BYTES <= len(data):
+      (t_ms,) = struct.unpack_from("<I", data, off)
+      frames.append((t_ms, data[off + 4:off + 4 + FRAME_BYTES]))
+      off += 4 + FRAME_BYTES
+    return frames
+  while off + HEAD.size <= len(data):
+    t_ms, kind, n = HEAD.unpack_from(data, off)
+    if off + HEAD.size + n > len(data):
+      break
+    prev = apply_frame(data[off:off + HEAD.size + n], prev)
+    frames.append((t_ms, prev))
+    off += HEAD.size + n
+  return frames
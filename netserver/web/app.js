@@ -1,6 +1,18 @@
 const CANVAS_WIDTH = 400;
 const CANVAS_HEIGHT = 240;
 const WS_URL = 'ws://localhost:8000';
+const FRAME_BYTES = CANVAS_WIDTH / 8 * CANVAS_HEIGHT;
+const STRIDE = CANVAS_WIDTH / 8;
+// Frames per second asked of the stream (see proxy.py); the device only
+// sends frames that changed, so a static screen costs nothing.
+const STREAM_FPS = 40;
+// Binary messages start with a channel byte (see proxy.py).
+const CH_SCREEN = 1;
+const CH_FILE = 2;
+// File transfers go in CRC-checked chunks; a few uploads run at a time, each
+// with one chunk in flight.
+const CHUNK_SIZE = 64 * 1024;
+const MAX_PARALLEL_UPLOADS = 3;
 
 // Element references
 const canvas = document.getElementById('screenCanvas');
@@ -13,6 +25,7 @@ const btnRefreshFiles = document.getElementById('refreshFilesBtn');
 const uploadInput = document.getElementById('uploadInput');
 const uploadPathInput = document.getElementById('uploadPath');
 const fileList = document.getElementById('fileList');
+const transferList = document.getElementById('transferList');
 const statusDot = document.getElementById('status-indicator');
 const statusText = document.getElementById('status-text');
 const fpsDisplay = document.getElementById('fpsCounter');
@@ -23,18 +36,21 @@ const deviceIpInput = document.getElementById('deviceIp');
 let ws = null;
 let isConnected = false;
 let isCasting = false;
+let castMode = 'stream';   // 'stream' (pushed deltas) or 'pull' (send_screen per frame)
 let frameCount = 0;
 let lastTime = performance.now();
-let pendingFileDownload = null;
-let downloadSize = 0;
-let receivedBytes = 0;
-let downloadChunks = [];
+// Transfers survive a reconnect and continue where they stopped.
+const uploads = [];          // {id, file, path, size, sent, state}
+const downloads = new Map(); // device path -> {size, received, parts}
 
 // Image buffer (monochrome -> RGBA)
 const imageData = ctx.createImageData(CANVAS_WIDTH, CANVAS_HEIGHT);
 const buf32 = new Uint32Array(imageData.data.buffer);
 const COLOR_BLACK = 0xFF000000;
 const COLOR_WHITE = 0xFFFFFFFF;
+// The screen as last drawn (1bpp, MSB first); stream deltas apply to it.
+const screenBits = new Uint8Array(FRAME_BYTES);
+let haveKeyframe = false;
 
 /**
  * Update the UI status indicator and buttons based on connection state
@@ -73,18 +89,7 @@ function resetCastState() {
     btnCast.className = 'bg-surface-container-high text-on-surface h-[50px] rounded-full flex items-center justify-center gap-2 transition-active active:opacity-70 disabled:opacity-30';
 }
 
-function processFrame(data) {
-    if (data.byteLength !== 12000) return;
-    const u8 = new Uint8Array(data);
-    let pixelIndex = 0;
-    for (let i = 0; i < u8.length; i++) {
-        const byte = u8[i];
-        for (let b = 0; b < 8; b++) {
-            const isWhite = (byte & (1 << (7 - b))) !== 0;
-            buf32[pixelIndex++] = isWhite ? COLOR_WHITE : COLOR_BLACK;
-        }
-    }
-    ctx.putImageData(imageData, 0, 0);
+function countFrame() {
     frameCount++;
     const now = performance.now();
     if (now - lastTime >= 1000) {
@@ -94,12 +99,103 @@ function processFrame(data) {
     }
 }
 
+// Convert screenBits[start:end] to pixels and draw the rows they cover.
+function paintBytes(start, end) {
+    const y0 = Math.floor(start / STRIDE);
+    const y1 = Math.floor((end - 1) / STRIDE) + 1;
+    let pixelIndex = y0 * STRIDE * 8;
+    for (let i = y0 * STRIDE; i < y1 * STRIDE; i++) {
+        const byte = screenBits[i];
+        for (let b = 0; b < 8; b++) {
+            const isWhite = (byte & (1 << (7 - b))) !== 0;
+            buf32[pixelIndex++] = isWhite ? COLOR_WHITE : COLOR_BLACK;
+        }
+    }
+    ctx.putImageData(imageData, 0, 0, 0, y0, CANVAS_WIDTH, y1 - y0);
+}
+
+// Decode a PackBits payload (see netserver/py/screen_codec.py) into
+// screenBits, replacing bytes (keyframe) or XOR-ing them in (delta). Returns
+// the [first, last + 1) range of bytes that changed, or null.
+function applyPackBits(u8, off, end, xor) {
+    let pos = 0, lo = FRAME_BYTES, hi = 0;
+    while (off < end && pos < FRAME_BYTES) {
+        const c = u8[off];
+        if (c < 0x80) {
+            const n = Math.min(c + 1, FRAME_BYTES - pos);
+            for (let k = 0; k < n; k++) {
+                const v = u8[off + 1 + k];
+                if (xor ? v !== 0 : screenBits[pos + k] !== v) {
+                    screenBits[pos + k] = xor ? screenBits[pos + k] ^ v : v;
+                    if (pos + k < lo) lo = pos + k;
+                    hi = pos + k + 1;
+                }
+            }
+            pos += n;
+            off += c + 2;
+        } else {
+            const n = Math.min((c & 0x7f) + 3, FRAME_BYTES - pos);
+            const v = u8[off + 1];
+            if (!xor || v !== 0) {
+                for (let k = 0; k < n; k++) {
+                    const nv = xor ? screenBits[pos + k] ^ v : v;
+                    if (nv !== screenBits[pos + k]) {
+                        screenBits[pos + k] = nv;
+                        if (pos + k < lo) lo = pos + k;
+                        hi = pos + k + 1;
+                    }
+                }
+            }
+            pos += n;
+            off += 2;
+        }
+    }
+    return hi > lo ? [lo, hi] : null;
+}
+
+// One streamed frame record: u32 t_ms, u8 kind (0 key, 1 delta), u32 n, payload.
+function processStreamFrame(data) {
+    if (data.byteLength < 9) return;
+    const u8 = new Uint8Array(data);
+    const view = new DataView(data);
+    const kind = view.getUint8(4);
+    const n = view.getUint32(5, true);
+    if (9 + n > data.byteLength) return;
+    if (kind === 0) {
+        haveKeyframe = true;
+    } else if (!haveKeyframe || n === 0) {
+        return;
+    }
+    const changed = applyPackBits(u8, 9, 9 + n, kind === 1);
+    // A keyframe repaints everything: the canvas may show the screensaver.
+    if (kind === 0) paintBytes(0, FRAME_BYTES);
+    else if (changed) paintBytes(changed[0], changed[1]);
+    countFrame();
+}
+
+function processFrame(data) {
+    if (castMode === 'stream') {
+        processStreamFrame(data);
+        return;
+    }
+    if (data.byteLength !== 12000) return;
+    screenBits.set(new Uint8Array(data));
+    paintBytes(0, FRAME_BYTES);
+    countFrame();
+}
+
 function requestFrame() {
     if (ws && ws.readyState === WebSocket.OPEN && isCasting) {
         ws.send("send_screen");
     }
 }
 
+function startCast() {
+    castMode = 'stream';
+    haveKeyframe = false;
+    ws.send(`start_stream:${STREAM_FPS}`);
+}
+
 function updateFileList(listStr) {
     fileList.innerHTML = '';
     if (!listStr) {
@@ -113,25 +209,206 @@ function updateFileList(listStr) {
         const filename = fullpath.split('/').pop();
         const item = document.createElement('div');
         item.className = 'ios-list-item p-4 flex justify-between items-center active:bg-black/5 cursor-pointer group';
-        item.onclick = () => { if (isConnected) ws.send(`get_file:${fullpath}`); };
+        item.onclick = () => startDownload(fullpath);
         item.innerHTML = `<div class="flex items-center gap-3"><span class="font-headline italic text-[17px] filename-label">${filename}</span></div><span class="material-symbols-outlined text-outline text-[16px]">download</span>`;
         fileList.appendChild(item);
     });
 }
 
-function saveDownloadedFile() {
-    if (!pendingFileDownload) return;
-    const blob = new Blob(downloadChunks);
+function saveDownloadedFile(path, parts) {
+    const blob = new Blob(parts);
     const url = URL.createObjectURL(blob);
     const a = document.createElement('a');
     a.href = url;
-    a.download = pendingFileDownload.split('/').pop();
+    a.download = path.split('/').pop();
     document.body.appendChild(a);
     a.click();
     document.body.removeChild(a);
     URL.revokeObjectURL(url);
-    pendingFileDownload = null;
-    downloadChunks = [];
+}
+
+const CRC_TABLE = new Uint32Array(256);
+for (let n = 0; n < 256; n++) {
+    let c = n;
+    for (let k = 0; k < 8; k++) c = (c & 1) ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+    CRC_TABLE[n] = c >>> 0;
+}
+
+// Same value as Python's zlib.crc32.
+function crc32(u8) {
+    let c = 0xFFFFFFFF;
+    for (let i = 0; i < u8.length; i++) c = CRC_TABLE[(c ^ u8[i]) & 0xFF] ^ (c >>> 8);
+    return (c ^ 0xFFFFFFFF) >>> 0;
+}
+
+// File chunk: [CH_FILE] u16 key length, key, u64 offset, u32 crc32, data.
+function packChunk(key, offset, data) {
+    const k = new TextEncoder().encode(key);
+    const out = new Uint8Array(3 + k.length + 12 + data.length);
+    const view = new DataView(out.buffer);
+    out[0] = CH_FILE;
+    view.setUint16(1, k.length, true);
+    out.set(k, 3);
+    view.setUint32(3 + k.length, offset % 0x100000000, true);
+    view.setUint32(7 + k.length, Math.floor(offset / 0x100000000), true);
+    view.setUint32(11 + k.length, crc32(data), true);
+    out.set(data, 15 + k.length);
+    return out;
+}
+
+function parseChunk(buf) {
+    const view = new DataView(buf);
+    const klen = view.getUint16(1, true);
+    const key = new TextDecoder().decode(new Uint8Array(buf, 3, klen));
+    const offset = view.getUint32(3 + klen, true) + view.getUint32(7 + klen, true) * 0x100000000;
+    const crc = view.getUint32(11 + klen, true);
+    return { key, offset, crc, data: new Uint8Array(buf, 15 + klen) };
+}
+
+// Upload ids name a file at a destination, so the same file picked again
+// after a reload continues the spool the proxy already has.
+function uploadId(path, file) {
+    let h = 0x811C9DC5;
+    const s = `${path}|${file.size}|${file.lastModified}`;
+    for (let i = 0; i < s.length; i++) h = Math.imul(h ^ s.charCodeAt(i), 0x01000193);
+    return (h >>> 0).toString(16) + '-' + file.size.toString(36);
+}
+
+function wsOpen() {
+    return ws && ws.readyState === WebSocket.OPEN && isConnected;
+}
+
+function percent(done, total) {
+    return total ? Math.floor(done * 100 / total) : 100;
+}
+
+function renderTransfers() {
+    transferList.innerHTML = '';
+    const row = (text) => {
+        const li = document.createElement('li');
+        li.className = 'flex justify-between gap-2';
+        li.innerHTML = '<span class="truncate"></span><span></span>';
+        li.firstChild.textContent = text[0];
+        li.lastChild.textContent = text[1];
+        transferList.appendChild(li);
+    };
+    for (const up of uploads) {
+        const name = up.path.split('/').pop();
+        if (up.state === 'queued') row([`↑ ${name}`, 'queued']);
+        else if (up.state === 'sending') row([`↑ ${name}`, `${percent(up.sent, up.size)}%`]);
+        else if (up.state === 'device') row([`↑ ${name}`, `device ${percent(up.sent, up.size)}%`]);
+        else if (up.state === 'error') row([`↑ ${name}`, `failed ${up.error}`]);
+    }
+    for (const [path, d] of downloads) {
+        const name = path.split('/').pop();
+        if (d.size < 0) row([`↓ ${name}`, `device ${percent(d.fetched, d.fetchSize)}%`]);
+        else row([`↓ ${name}`, `${percent(d.received, d.size)}%`]);
+    }
+}
+
+function queueUploads(files) {
+    const destPath = uploadPathInput.value.trim() || "/tmp/";
+    for (const file of files) {
+        const path = destPath.endsWith('/') ? destPath + file.name : destPath + "/" + file.name;
+        const id = uploadId(path, file);
+        if (uploads.some(up => up.id === id && up.state !== 'error')) continue;
+        uploads.push({ id, file, path, size: file.size, sent: 0, state: 'queued' });
+    }
+    pumpUploads();
+}
+
+// Start queued uploads while fewer than MAX_PARALLEL_UPLOADS are sending.
+function pumpUploads() {
+    if (wsOpen()) {
+        let active = uploads.filter(up => up.state === 'sending').length;
+        for (const up of uploads) {
+            if (active >= MAX_PARALLEL_UPLOADS) break;
+            if (up.state !== 'queued') continue;
+            up.state = 'sending';
+            active++;
+            ws.send('upload_begin:' + JSON.stringify({ id: up.id, path: up.path, size: up.size }));
+        }
+    }
+    renderTransfers();
+}
+
+// The proxy has `offset` bytes of upload `id`: send the next chunk, read
+// from the file only now, so large files are never held in memory.
+function continueUpload(id, offset) {
+    const up = uploads.find(u => u.id === id);
+    if (!up || (up.state !== 'sending' && up.state !== 'device')) return;
+    up.sent = offset;
+    if (offset >= up.size) {
+        up.sent = 0;
+        up.state = 'device';
+        pumpUploads();
+        return;
+    }
+    up.state = 'sending';
+    up.file.slice(offset, offset + CHUNK_SIZE).arrayBuffer().then(buf => {
+        if (wsOpen() && up.state === 'sending' && up.sent === offset) {
+            ws.send(packChunk(up.id, offset, new Uint8Array(buf)));
+        }
+    });
+    renderTransfers();
+}
+
+function finishUpload(id, error) {
+    const i = uploads.findIndex(u => u.id === id);
+    if (i < 0) return;
+    if (error === undefined) {
+        uploads.splice(i, 1);
+        if (wsOpen() && !uploads.some(up => up.state === 'device')) ws.send("get_file_list");
+    } else {
+        uploads[i].state = 'error';
+        uploads[i].error = error;
+        console.error(`Upload of ${uploads[i].path} failed:`, error);
+    }
+    pumpUploads();
+}
+
+function startDownload(path) {
+    if (!wsOpen() || downloads.has(path)) return;
+    downloads.set(path, { size: -1, received: 0, parts: [], fetched: 0, fetchSize: 0 });
+    ws.send(`get_file:${path}`);
+    renderTransfers();
+}
+
+function finishDownload(path) {
+    const d = downloads.get(path);
+    downloads.delete(path);
+    if (wsOpen()) ws.send(`get_file_done:${path}`);
+    saveDownloadedFile(path, d.parts);
+    renderTransfers();
+}
+
+function processFileChunk(buf) {
+    const chunk = parseChunk(buf);
+    const d = downloads.get(chunk.key);
+    // Chunks after a bad one are dropped until the proxy goes back to it.
+    if (!d || chunk.offset !== d.received) return;
+    if (crc32(chunk.data) !== chunk.crc) {
+        ws.send(`get_file_from:${d.received}:${chunk.key}`);
+        return;
+    }
+    d.parts.push(chunk.data.slice());
+    d.received += chunk.data.length;
+    if (d.received >= d.size) finishDownload(chunk.key);
+    else renderTransfers();
+}
+
+// After (re)authorizing: pick up every transfer where it stopped.
+function resumeTransfers() {
+    for (const up of uploads) {
+        if (up.state === 'sending' || up.state === 'device') {
+            up.state = 'sending';
+            ws.send('upload_begin:' + JSON.stringify({ id: up.id, path: up.path, size: up.size }));
+        }
+    }
+    for (const [path, d] of downloads) {
+        ws.send(d.size < 0 ? `get_file:${path}` : `get_file_from:${d.received}:${path}`);
+    }
+    pumpUploads();
 }
 
 // Initialization: Load saved credentials
@@ -163,13 +440,12 @@ function connect() {
         ws.onopen = () => ws.send(`target_ip:${ip}`);
         ws.onmessage = (event) => {
             if (event.data instanceof ArrayBuffer) {
-                if (pendingFileDownload) {
-                    downloadChunks.push(new Uint8Array(event.data));
-                    receivedBytes += event.data.byteLength;
-                    if (receivedBytes >= downloadSize) saveDownloadedFile();
-                } else {
-                    processFrame(event.data);
-                    if (isCasting) requestFrame();
+                const channel = new Uint8Array(event.data, 0, 1)[0];
+                if (channel === CH_FILE) {
+                    processFileChunk(event.data);
+                } else if (channel === CH_SCREEN) {
+                    processFrame(event.data.slice(1));
+                    if (isCasting && castMode === 'pull') requestFrame();
                 }
             } else {
                 const msg = event.data;
@@ -181,24 +457,65 @@ function connect() {
                 } else if (msg === "auth_success") {
                     updateStatus('connected', 'Engine Synchronized');
                     ws.send("get_file_list");
+                    resumeTransfers();
                 } else if (msg.startsWith("auth_failed:")) {
                     alert("Authorization failed.");
                     ws.close();
-                } else if (msg === "file_put_success") {
-                    alert("File successfully injected onto the device!");
-                    ws.send("get_file_list");
+                } else if (msg.startsWith("upload_offset:") || msg.startsWith("upload_ack:") || msg.startsWith("upload_nack:")) {
+                    const parts = msg.split(':');
+                    continueUpload(parts[1], parseInt(parts[2]));
+                } else if (msg.startsWith("file_put_success:")) {
+                    finishUpload(msg.substring(17));
+                } else if (msg.startsWith("file_put_error:")) {
+                    const parts = msg.split(':');
+                    finishUpload(parts[1], parts[2]);
+                } else if (msg.startsWith("file_progress:")) {
+                    // file_progress:<upload id or path>:device:<done>:<size>
+                    const parts = msg.substring(14).split(':');
+                    const size = parseInt(parts.pop());
+                    const done = parseInt(parts.pop());
+                    parts.pop();
+                    const key = parts.join(':');
+                    const up = uploads.find(u => u.id === key);
+                    const d = downloads.get(key);
+                    if (up) up.sent = done;
+                    if (d) { d.fetched = done; d.fetchSize = size; }
+                    renderTransfers();
                 } else if (msg.startsWith("file_list:")) {
                     updateFileList(msg.substring(10));
                 } else if (msg.startsWith("clipboard_data:")) {
                     navigator.clipboard.writeText(msg.substring(15));
                     alert("Clipboard synchronized:" + msg.substring(15));
                 } else if (msg.startsWith("file_start:")) {
+                    // file_start:<path>:<size>:<offset>
+                    const parts = msg.substring(11).split(':');
+                    const offset = parseInt(parts.pop());
+                    const size = parseInt(parts.pop());
+                    const path = parts.join(':');
+                    const d = downloads.get(path);
+                    if (!d) return;
+                    if (offset === 0 && d.received > 0) {
+                        d.received = 0;
+                        d.parts = [];
+                    }
+                    d.size = size;
+                    if (size === 0) finishDownload(path);
+                    else renderTransfers();
+                } else if (msg.startsWith("file_get_error:")) {
                     const parts = msg.split(':');
-                    pendingFileDownload = parts[1];
-                    downloadSize = parseInt(parts[2]);
-                    receivedBytes = 0;
-                    downloadChunks = [];
-                    if (downloadSize === 0) saveDownloadedFile();
+                    const path = parts.slice(2).join(':');
+                    console.error(`Download of ${path} failed:`, parts[1]);
+                    downloads.delete(path);
+                    renderTransfers();
+                } else if (msg.startsWith("stream_started:")) {
+                    console.log("Screencast mode:", msg.substring(15));
+                } else if (msg.startsWith("stream_failed:")) {
+                    // No second connection to the device: ask for frames one by one.
+                    console.error("Stream failed:", msg.substring(14));
+                    if (isCasting) {
+                        castMode = 'pull';
+                        requestFrame();
+                    }
                 } else if (msg.startsWith("ERROR:")) {
                     console.error("Proxy error:", msg);
                 }
@@ -215,12 +532,13 @@ btnCast.addEventListener('click', () => {
     if (!isConnected) return;
     if (isCasting) {
         isCasting = false;
+        if (castMode === 'stream') ws.send("stop_stream");
         resetCastState();
         startScreensaver();
     } else {
         stopScreensaver();
         isCasting = true;
-        requestFrame();
+        startCast();
         btnCast.innerHTML = '<span class="font-headline font-semibold text-[17px]">Terminate Stream</span>';
         btnCast.className = 'bg-primary text-on-primary h-[50px] rounded-full flex items-center justify-center gap-2 transition-active active:opacity-70';
     }
@@ -239,19 +557,9 @@ btnRefreshFiles.addEventListener('click', () => {
 });
 
 uploadInput.addEventListener('change', (e) => {
-    const file = e.target.files[0];
-    if (!file || !isConnected) return;
-    const reader = new FileReader();
-    reader.onload = (event) => {
-        const destPath = uploadPathInput.value.trim() || "/tmp/";
-        const fullpath = destPath.endsWith('/') ? destPath + file.name : destPath + "/" + file.name;
-        const prefix = new TextEncoder().encode("put_file:" + fullpath + "\0");
-        const combined = new Uint8Array(prefix.length + event.target.result.byteLength);
-        combined.set(prefix);
-        combined.set(new Uint8Array(event.target.result), prefix.length);
-        ws.send(combined);
-    };
-    reader.readAsArrayBuffer(file);
+    if (!isConnected) return;
+    queueUploads(Array.from(e.target.files));
+    e.target.value = '';
 });
 
 // Retro Screensaver logic
@@ -9,6 +9,15 @@ try:
 except:
   config = {}
 
+# Shell pipes ('a | b') stream line by line into grep, head, tail and cat
+# instead of capturing each stage whole (see pstdin). pdeck_utils looks
+# run_stages up at call time, so this covers every shell started later.
+try:
+  import pstdin
+  pstdin.install()
+except Exception:
+  pass
+
 boot_app = config.get('boot_app', 'home')
 ble_keyboard = config.get('ble_keyboard', False)
 wifi_on_boot = config.get('wifi_on_boot', False)
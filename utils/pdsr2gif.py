@@ -2,8 +2,13 @@
 # on-device screenrec app) into an animated GIF, or dump the frames as PNGs.
 #
 # Format (little-endian): b"PDSR" u8 version u16 width u16 height, then per
-# frame: u32 t_ms followed by (width // 8) * height bytes of 1bpp MSB-first
-# pixels (bit = 1 means a drawn pixel).
+# frame (stride = width // 8, 1bpp MSB-first pixels, bit = 1 means drawn):
+#   version 1: u32 t_ms followed by stride * height raw bytes
+#   version 2: u32 t_ms  u8 kind  u32 n  followed by n bytes of PackBits data;
+#              kind 0 (keyframe) decodes to the frame, kind 1 (delta) to the
+#              frame XOR the previous one, and n = 0 repeats the previous frame.
+#              PackBits control c < 0x80: c+1 literal bytes follow; c >= 0x80:
+#              the next byte repeated (c & 0x7f) + 3 times.
 #
 # The output is constant-frame-rate: the recorded timeline is resampled onto a
 # fixed grid using each frame's timestamp, duplicating the previous frame
@@ -13,17 +18,93 @@
 # Durations are laid on the cumulative grid, keeping total rounding error
 # under 10ms no matter how long the recording is.
 #
+# With NumPy installed the GIF is written directly: runs of identical output
+# frames become one frame with the summed duration, frames are unpacked in
+# bulk (np.unpackbits over a batch) and each one only encodes the bounding box
+# of what changed since the previous frame. Pillow is still used for the LZW
+# encoding. Without NumPy (or with --no-numpy) the whole sequence goes through
+# Pillow's multi-frame GIF writer, which is several times slower on long
+# recordings. --png-dir writes each distinct frame once, in parallel (-j), and
+# hard-links the duplicates. --bench times both GIF paths on the input.
+#
 # Usage:
 #   python -B pdsr2gif.py rec0717_1530.pdsr                # -> rec0717_1530.gif
 #   python -B pdsr2gif.py rec.pdsr -o demo.gif --scale 2 --fps 10
 #   python -B pdsr2gif.py rec.pdsr --png-dir frames/       # for ffmpeg etc.
+#   python -B pdsr2gif.py rec.pdsr --bench                 # compare GIF paths
 
 import argparse
 import os
+import shutil
 import struct
 import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from PIL import Image
+from PIL import GifImagePlugin
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+BATCH = 256           # frames unpacked per np.unpackbits call
+GIF_MAX_MS = 655350   # longest duration a GIF frame can hold (u16 centiseconds)
+
+
+def unpackbits(data, off, end, size):
+  """Decode the PackBits run data[off:end] into exactly `size` bytes."""
+  out = bytearray()
+  while off < end:
+    c = data[off]
+    if c < 0x80:
+      out += data[off + 1:off + 2 + c]
+      off += 2 + c
+    else:
+      out += bytes([data[off + 1]]) * ((c & 0x7f) + 3)
+      off += 2
+  if len(out) != size:
+    raise ValueError("bad frame data (%d bytes, expected %d)" % (len(out), size))
+  return bytes(out)
+
+
+def xor_bytes(a, b):
+  return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).to_bytes(len(a), "big")
+
+
+def read_frames_v1(data, off, frame_bytes):
+  frames = []
+  while off + 4 + frame_bytes <= len(data):
+    (t_ms,) = struct.unpack_from("<I", data, off)
+    off += 4
+    frames.append((t_ms, data[off:off + frame_bytes]))
+    off += frame_bytes
+  return frames, off
+
+
+def read_frames_v2(data, off, frame_bytes):
+  frames = []
+  prev = None
+  while off + 9 <= len(data):
+    t_ms, kind, n = struct.unpack_from("<IBI", data, off)
+    if off + 9 + n > len(data):
+      break
+    body = off + 9
+    if kind == 0:
+      prev = unpackbits(data, body, body + n, frame_bytes)
+    elif kind == 1:
+      if prev is None:
+        # Delta before any keyframe (should not happen): nothing to apply it to.
+        raise SystemExit("delta frame at offset %d without a keyframe" % off)
+      if n:
+        prev = xor_bytes(prev, unpackbits(data, body, body + n, frame_bytes))
+    else:
+      raise SystemExit("unknown frame kind %d at offset %d" % (kind, off))
+    frames.append((t_ms, prev))
+    off = body + n
+  return frames, off
 
 
 def read_pdsr(path):
@@ -33,18 +114,15 @@ def read_pdsr(path):
   if len(data) < 9 or data[:4] != b"PDSR":
     raise SystemExit("%s: not a .pdsr file" % path)
   version = data[4]
-  if version != 1:
+  if version not in (1, 2):
     raise SystemExit("%s: unsupported version %d" % (path, version))
   w, h = struct.unpack_from("<HH", data, 5)
   stride = w // 8
   frame_bytes = stride * h
-  frames = []
-  off = 9
-  while off + 4 + frame_bytes <= len(data):
-    (t_ms,) = struct.unpack_from("<I", data, off)
-    off += 4
-    frames.append((t_ms, data[off:off + frame_bytes]))
-    off += frame_bytes
+  if version == 1:
+    frames, off = read_frames_v1(data, 9, frame_bytes)
+  else:
+    frames, off = read_frames_v2(data, 9, frame_bytes)
   if off != len(data):
     print("warning: %d trailing byte(s) ignored (truncated last frame?)"
           % (len(data) - off), file=sys.stderr)
@@ -78,15 +156,193 @@ def resample(frames, fps):
   return picks
 
 
+def grid_edges_ms(n_out, fps):
+  """Tick boundaries for grid_durations_ms (n_out + 1 values)."""
+  interval = 1000.0 / fps
+  return [int(round(i * interval / 10.0)) * 10 for i in range(n_out + 1)]
+
+
 def grid_durations_ms(n_out, fps):
   """Per-frame durations on the cumulative grid, snapped to the GIF's 10ms
   granularity so rounding error never accumulates: duration i spans from
   round(t_i) to round(t_{i+1}) rather than round(t_{i+1} - t_i)."""
-  interval = 1000.0 / fps
-  edges = [int(round(i * interval / 10.0)) * 10 for i in range(n_out + 1)]
+  edges = grid_edges_ms(n_out, fps)
   return [max(10, edges[i + 1] - edges[i]) for i in range(n_out)]
 
 
+def resample_np(frames, fps):
+  """resample() with one searchsorted over the timestamps."""
+  interval = 1000.0 / fps
+  total = frames[-1][0]
+  n_out = max(1, int(round(total / interval)) + 1)
+  times = np.fromiter((t for t, _ in frames), dtype=np.int64, count=len(frames))
+  grid = np.arange(n_out) * interval
+  picks = np.searchsorted(times[1:], grid, side="right")
+  return picks.tolist()
+
+
+def merge_runs(frames, picks):
+  """Group consecutive output ticks showing the same pixels. Returns
+  [(source index, first tick)], each run ending where the next starts."""
+  runs = []
+  last = None
+  for i, idx in enumerate(picks):
+    raw = frames[idx][1]
+    if last is not None and (raw is last or raw == last):
+      continue
+    runs.append((idx, i))
+    last = raw
+  return runs
+
+
+def unpacked_batches(frames, idxs, w, h):
+  """Yield (start, bits) with bits a (n, h, w) uint8 0/1 array for
+  idxs[start:start + n], BATCH frames at a time."""
+  stride = w // 8
+  for start in range(0, len(idxs), BATCH):
+    chunk = idxs[start:start + BATCH]
+    packed = np.frombuffer(b"".join(frames[i][1] for i in chunk), dtype=np.uint8)
+    bits = np.unpackbits(packed.reshape(len(chunk), h, stride), axis=2)
+    yield start, bits[:, :, :w]
+
+
+def gif_palette(dark):
+  # Index = pixel bit. Drawn pixels are black on white unless --dark.
+  return b"\x00\x00\x00\xff\xff\xff" if dark else b"\xff\xff\xff\x00\x00\x00"
+
+
+def write_gif_np(out, frames, w, h, runs, edges, dark, scale):
+  """Write runs (from merge_runs) as a GIF; edges are the tick boundaries in
+  ms. Returns the number of GIF frames written."""
+  idxs = [idx for idx, _ in runs]
+  ends = [tick for _, tick in runs[1:]] + [len(edges) - 1]
+  written = 0
+  with open(out, "wb") as f:
+    f.write(b"GIF89a" + struct.pack("<HHBBB", w * scale, h * scale, 0x80, 0, 0))
+    f.write(gif_palette(dark))
+    f.write(b"!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00")  # loop forever
+    prev = None
+    for start, bits in unpacked_batches(frames, idxs, w, h):
+      # Changed rows/columns of every frame in the batch against its
+      # predecessor (the first frame of the take is all changed).
+      if prev is None:
+        before = np.concatenate((1 - bits[:1], bits[:-1]))
+      else:
+        before = np.concatenate((prev[None], bits[:-1]))
+      diff = bits != before
+      rows = diff.any(axis=2)
+      cols = diff.any(axis=1)
+      y0s = rows.argmax(axis=1)
+      y1s = h - rows[:, ::-1].argmax(axis=1)
+      x0s = cols.argmax(axis=1)
+      x1s = w - cols[:, ::-1].argmax(axis=1)
+      for k in range(len(bits)):
+        n = start + k
+        tick = runs[n][1]
+        ms = max(10, edges[ends[n]] - edges[tick])
+        if rows[k].any():
+          y0, y1, x0, x1 = int(y0s[k]), int(y1s[k]), int(x0s[k]), int(x1s[k])
+        else:
+          y0, y1, x0, x1 = 0, 1, 0, 1  # differs only in stride padding
+        while True:
+          crop = bits[k, y0:y1, x0:x1]
+          if scale > 1:
+            crop = crop.repeat(scale, axis=0).repeat(scale, axis=1)
+          im = Image.fromarray(np.ascontiguousarray(crop))
+          d = min(ms, GIF_MAX_MS)
+          for part in GifImagePlugin.getdata(im, offset=(x0 * scale, y0 * scale),
+                                             duration=d, disposal=1):
+            f.write(part)
+          written += 1
+          ms -= d
+          if ms <= 0:
+            break
+          y0, y1, x0, x1 = 0, 1, 0, 1  # hold the frame: redraw one pixel
+      prev = bits[-1].copy()
+    f.write(b";")
+  return written
+
+
+def write_gif_pil(out, frames, w, h, picks, fps, dark, scale):
+  """The plain Pillow path: every output tick as a full frame, deduplicated
+  and cropped by Pillow's own GIF writer."""
+  cache = {}
+  for idx in set(picks):
+    cache[idx] = to_image(frames[idx][1], w, h, dark, scale).convert("P")
+  seq = [cache[idx] for idx in picks]
+  durations = grid_durations_ms(len(picks), fps)
+  seq[0].save(out, save_all=True, append_images=seq[1:],
+              duration=durations, loop=0, optimize=True)
+
+
+def _png_job(job):
+  # Worker: (raw, w, h, dark, scale, path). Top level so it pickles.
+  raw, w, h, dark, scale, path = job
+  to_image(raw, w, h, dark, scale).save(path)
+  return path
+
+
+def write_pngs(png_dir, frames, w, h, picks, dark, scale, jobs):
+  """Write one PNG per output tick. Each distinct frame is encoded once (in
+  parallel with jobs > 1); later ticks showing the same pixels are hard links
+  (copies where links are not supported)."""
+  os.makedirs(png_dir, exist_ok=True)
+  first = {}
+  work = []
+  links = []
+  last = last_path = None
+  for i, idx in enumerate(picks):
+    path = os.path.join(png_dir, "frame%05d.png" % i)
+    raw = frames[idx][1]
+    if last is not None and (raw is last or raw == last):
+      links.append((last_path, path))
+      continue
+    src = first.get(raw)
+    if src is not None:
+      links.append((src, path))
+    else:
+      first[raw] = path
+      work.append((raw, w, h, dark, scale, path))
+    last, last_path = raw, path
+  if jobs > 1 and len(work) > 1:
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+      for _ in pool.map(_png_job, work, chunksize=16):
+        pass
+  else:
+    for job in work:
+      _png_job(job)
+  for src, dst in links:
+    try:
+      os.remove(dst)
+    except OSError:
+      pass
+    try:
+      os.link(src, dst)
+    except OSError:
+      shutil.copyfile(src, dst)
+  return len(work)
+
+
+def run_bench(path, frames, w, h, picks, fps, dark, scale):
+  print("bench: %d source frame(s), %d output tick(s)" % (len(frames), len(picks)))
+  with tempfile.TemporaryDirectory() as tmp:
+    t = time.perf_counter()
+    out = os.path.join(tmp, "pil.gif")
+    write_gif_pil(out, frames, w, h, picks, fps, dark, scale)
+    t_pil = time.perf_counter() - t
+    print("  pillow : %7.2fs  %9d bytes" % (t_pil, os.stat(out).st_size))
+    if np is None:
+      print("  numpy  : not installed")
+      return
+    t = time.perf_counter()
+    out = os.path.join(tmp, "np.gif")
+    runs = merge_runs(frames, resample_np(frames, fps))
+    n = write_gif_np(out, frames, w, h, runs, grid_edges_ms(len(picks), fps), dark, scale)
+    t_np = time.perf_counter() - t
+    print("  numpy  : %7.2fs  %9d bytes  (%d GIF frames, %.1fx)"
+          % (t_np, os.stat(out).st_size, n, t_pil / max(t_np, 1e-6)))
+
+
 def main():
   parser = argparse.ArgumentParser(description="Convert a .pdsr screen recording to a constant-frame-rate GIF or PNG frames")
   parser.add_argument("input", help=".pdsr file from the device's screenrec app")
@@ -95,6 +351,9 @@ def main():
   parser.add_argument("--scale", type=int, default=1, help="Integer upscale factor (nearest-neighbor)")
   parser.add_argument("--dark", action="store_true", help="White-on-black (native polarity) instead of black-on-white")
   parser.add_argument("--png-dir", default=None, help="Dump the resampled PNG frame sequence to this directory instead of a GIF")
+  parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="Worker processes for --png-dir (default: CPU count)")
+  parser.add_argument("--no-numpy", action="store_true", help="Use the plain Pillow GIF writer even if NumPy is installed")
+  parser.add_argument("--bench", action="store_true", help="Time the Pillow and NumPy GIF paths on the input (writes nothing)")
   args = parser.parse_args()
 
   w, h, frames = read_pdsr(args.input)
@@ -111,37 +370,32 @@ def main():
     snapped = round(fps)
     if snapped >= 1 and abs(fps - snapped) / snapped < 0.05:
       fps = float(snapped)
-  picks = resample(frames, fps)
+  use_np = np is not None and not args.no_numpy
+  picks = resample_np(frames, fps) if use_np else resample(frames, fps)
   dups = len(picks) - len(set(picks))
   print("%s: %dx%d, %d source frame(s), %.1fs -> %d frame(s) at %.4g fps (%d duplicate fill(s))"
         % (args.input, w, h, len(frames), frames[-1][0] / 1000.0,
            len(picks), fps, dups))
 
-  # Decode each source frame once; duplicates reuse the same Image object.
-  cache = {}
-  def frame_image(idx):
-    if idx not in cache:
-      cache[idx] = to_image(frames[idx][1], w, h, args.dark, args.scale)
-    return cache[idx]
+  if args.bench:
+    run_bench(args.input, frames, w, h, picks, fps, args.dark, args.scale)
+    return
 
   if args.png_dir:
-    os.makedirs(args.png_dir, exist_ok=True)
-    for i, idx in enumerate(picks):
-      frame_image(idx).save(os.path.join(args.png_dir, "frame%05d.png" % i))
-    print("Wrote %d PNGs to %s" % (len(picks), args.png_dir))
+    n = write_pngs(args.png_dir, frames, w, h, picks, args.dark, args.scale, max(1, args.jobs))
+    print("Wrote %d PNGs (%d distinct) to %s" % (len(picks), n, args.png_dir))
     print("ffmpeg example: ffmpeg -framerate %.4g -i %s/frame%%05d.png out.mp4"
           % (fps, args.png_dir.rstrip("/")))
     return
 
-  durations = grid_durations_ms(len(picks), fps)
-  pal = {}
-  for idx in set(picks):
-    pal[idx] = frame_image(idx).convert("P")
-  seq = [pal[idx] for idx in picks]
   out = args.output or os.path.splitext(args.input)[0] + ".gif"
-  seq[0].save(out, save_all=True, append_images=seq[1:],
-              duration=durations, loop=0, optimize=True)
-  print("Wrote %s (%d bytes)" % (out, os.stat(out).st_size))
+  if use_np:
+    runs = merge_runs(frames, picks)
+    n = write_gif_np(out, frames, w, h, runs, grid_edges_ms(len(picks), fps), args.dark, args.scale)
+    print("Wrote %s (%d bytes, %d GIF frames)" % (out, os.stat(out).st_size, n))
+  else:
+    write_gif_pil(out, frames, w, h, picks, fps, args.dark, args.scale)
+    print("Wrote %s (%d bytes)" % (out, os.stat(out).st_size))
 
 
 if __name__ == "__main__":
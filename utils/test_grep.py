@@ -0,0 +1,59 @@
+"""
+Host-side checks for grep's literal prefilter.
+Run: python3 utils/test_grep.py   (or pytest utils/test_grep.py)
+
+grep skips a line without running the regex when it lacks the literal
+_required_literal() found in the pattern, so that literal must be in every
+line the regex matches. Escapes are where this goes wrong: the characters
+after \\x, \\u or an octal/backref escape are its argument, not text.
+"""
+import io
+import os
+import re
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'lib'), os.path.join(ROOT, 'lib', 'noa')]
+
+import grep
+
+# (pattern, a line it matches)
+ESCAPES = [
+  ('ab\\x41c', 'abAc'),
+  ('ab\\101c', 'abAc'),
+  ('ab\\u0041cd', 'abAcd'),
+  ('ab\\U00000041cd', 'abAcd'),
+  ('ab\\0c', 'ab\0c'),
+  ('(x)yy\\1zzz', 'xyyxzzz'),
+  ('ab\\N{LATIN CAPITAL LETTER A}cd', 'abAcd'),
+  ('ab\\tcd', 'ab\tcd'),
+  ('ab\\.cd', 'ab.cd'),
+]
+
+
+def test_required_literal_skips_escape_arguments():
+  for pattern, line in ESCAPES:
+    assert re.search(pattern, line), pattern
+    lit = grep._required_literal(pattern)
+    assert lit in line, (pattern, lit)
+  assert grep._required_literal('ab\\x41c') == 'ab'
+  assert grep._required_literal('ab\\101c') == 'ab'
+  assert grep._required_literal('ab\\.cd') == 'ab.cd'
+
+
+def test_grep_finds_hex_and_octal_escapes():
+  with tempfile.TemporaryDirectory() as d:
+    path = os.path.join(d, 'f.txt')
+    with open(path, 'w') as f:
+      f.write('abAc\nabBc\nxyz\n')
+    for pattern in ('ab\\x41c', 'ab\\101c'):
+      out = io.StringIO()
+      grep.main(out, ['grep', '-c', pattern, path])
+      assert out.getvalue().rstrip().endswith(': 1'), (pattern, out.getvalue())
+
+
+if __name__ == '__main__':
+  test_required_literal_skips_escape_arguments()
+  test_grep_finds_hex_and_octal_escapes()
+  print('ok')